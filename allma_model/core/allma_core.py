@@ -1,24 +1,30 @@
 """ALLMACore - Core del sistema ALLMA"""
 
-from typing import Dict, List, Optional, Tuple, Union, Any
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple, Union
 from datetime import datetime, timedelta
+import atexit
+import hashlib
 import json
 import re
 import threading
 import logging
 import os
+import time
+from concurrent.futures import Future
 from dataclasses import dataclass
 from allma_model.memory_system.temporal_memory import TemporalMemorySystem
-from allma_model.memory_system.conversational_memory import ConversationalMemory, Message
+from allma_model.memory_system.conversational_memory import CONDENSED_FACTS_SCHEMA, ConversationalMemory, Message
+from allma_model.memory_system.memory_condensation import CondensationJobEngine
 from allma_model.memory_system.knowledge_memory import KnowledgeMemory
 from allma_model.project_system.project_tracker import ProjectTracker
 from allma_model.project_system.project import Project
-from allma_model.emotional_system.emotional_core import EmotionalCore
+from allma_model.emotional_system.emotional_core import EmotionalCore, EmotionalState
 from allma_model.core.personality import Personality
 from allma_model.core.context_understanding import ContextUnderstandingSystem
 from allma_model.core.understanding_system import AdvancedUnderstandingSystem
 from allma_model.core.reasoning_engine import ReasoningEngine, ThoughtTrace
 from allma_model.core.dream_system.dream_manager import DreamManager
+from allma_model.llm.request_scheduler import Priority, generate_with_priority
 from allma_model.agency_system.creativity_system import CreativitySystem # Phase 18
 from .communication_style import CommunicationStyleAdapter
 from allma_model.user_system.user_preferences import (
@@ -64,6 +70,26 @@ from allma_model.core.architecture.neuroplasticity import NeuroplasticitySystem
 from allma_model.core.architecture.volition_modulator import VolitionModulator
 from allma_model.core.cognitive_pipeline import CognitivePipeline  # V6 Sprint 1
 from allma_model.core.event_bus import EventBus, BusEvent           # V6 Sprint 2
+from allma_model.core.stage_graph import Stage, StageGraph, StageRun
+from allma_model.core.post_response_queue import PostResponseQueue
+from allma_model.core.pipeline_profiles import (
+    DEFAULT_PROFILES,
+    PipelineProfile,
+    ProfileLatencyReport,
+    deferred_graph,
+    require_steps,
+    split_stages
+)
+from allma_model.core.turn_context import TurnContext
+from allma_model.core.prompt_assembler import PromptAssembler, PromptSection
+from allma_model.core.turn_stream import (
+    StreamEvent,
+    StreamEventType,
+    TurnHandle,
+    TurnRegistry,
+    TurnSupersededError
+)
+from allma_model.utils.tracing import Tracer, sink_for_path
 from allma_model.core.information_extractor import InformationExtractor
 from allma_model.core.personality_coalescence import CoalescenceProcessor
 from allma_model.core.language_processor_lite import LanguageProcessorLite
@@ -87,6 +113,18 @@ except ImportError:
     logging.warning("Transformers library not found. Running in lightweight mode.")
 
 class ALLMACore:
+    # Attesa massima (s) del lavoro post-risposta del turno precedente della stessa conversazione
+    POST_RESPONSE_WAIT_S = 15.0
+    # Prompt entro un budget di token (PromptAssembler): spazio lasciato alla
+    # risposta in n_ctx e tetti delle sezioni
+    PROMPT_RESPONSE_RESERVE = 640
+    HISTORY_MAX_TOKENS = 768
+    HISTORY_SCAN_MESSAGES = 40
+    MEMORY_MAX_TOKENS = 160
+    MEMORY_ITEM_MAX_TOKENS = 96
+    CONTEXT_MAX_TOKENS = 192
+    USER_MESSAGE_MAX_TOKENS = 512
+
     def __init__(
         self,
         memory_system: Optional[TemporalMemorySystem] = None,
@@ -102,13 +140,31 @@ class ALLMACore:
         db_path: str = "allma.db",
         models_dir: Optional[str] = None, # Added argument
         emotion_pipeline=None,
-        mobile_mode: bool = False
+        mobile_mode: bool = False,
+        trace_sink_path: Optional[str] = None,
+        pipeline_profiles: Optional[Dict[str, PipelineProfile]] = None,
+        speculative_decoding: bool = False,
+        draft_model_name: Optional[str] = None,
+        llm_backend=None
     ):
         """
         Inizializza il core di ALLMA
+
+        Args:
+            trace_sink_path: file dove salvare le trace dei turni
+                             (.db/.sqlite → SQLite, altrimenti JSONL); None = solo ring buffer
+            pipeline_profiles: profili per classe di complessità (SIMPLE/NORMAL/COMPLEX)
+                               che sostituiscono quelli di DEFAULT_PROFILES
+            speculative_decoding: decodifica speculativa nel LLM mobile (più RAM)
+            draft_model_name: GGUF bozza in models_dir; senza, prompt lookup
+            llm_backend: modello al posto del GGUF in models_dir (es.
+                         llm.backends.MockLLMBackend per misure senza dispositivo)
         """
         self.mobile_mode = mobile_mode
         self.models_dir = models_dir # Store it
+        self.speculative_decoding = speculative_decoding
+        self.draft_model_name = draft_model_name
+        self.llm_backend = llm_backend
         
         # BRAIN V3: PROPRIOCEPTION
         self.proprioception = ProprioceptionSystem()
@@ -156,6 +212,37 @@ class ALLMACore:
         # Limitiamo i worker a 2 o 4 per non scatenare guerre di CPU core con l'LLM su Android
         workers = 2 if _is_android else 4
         self.cpu_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="AllmaCPUWorker")
+        # 1b. Pool dedicato agli stadi pre-LLM di process_message: separato dal cpu_pool,
+        # dove GC e inferenza possono occupare i worker per secondi
+        self.stage_pool = ThreadPoolExecutor(max_workers=workers + 2, thread_name_prefix="AllmaStageWorker")
+        self.last_stage_run: Optional[StageRun] = None
+        # 1c. Lavoro post-risposta (apprendimento, salvataggi, coalescenza): FIFO per conversazione,
+        # eseguito dopo la consegna della risposta e svuotato all'uscita
+        self.post_response_queue = PostResponseQueue(max_workers=1 if _is_android else 2)
+        atexit.register(self.post_response_queue.shutdown)
+        # 1d. Profili di pipeline per classe di complessità (fast lane per saluti e conferme)
+        # L'emozione del turno va nella risposta, nelle milestone e nei salvataggi
+        # post-risposta: nessun profilo può differirla o saltarla
+        self.pipeline_profiles: Dict[str, PipelineProfile] = require_steps(
+            {**DEFAULT_PROFILES, **(pipeline_profiles or {})}, ('emotion',)
+        )
+        self.profile_latency = ProfileLatencyReport()
+        # 1e. Turni in volo: uno per conversazione (o il nuovo messaggio annulla il precedente);
+        # turn_pool esegue i turni di process_message_stream
+        self.turns = TurnRegistry()
+        self.turn_pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="AllmaTurnWorker")
+        # Latenze di annullamento per motivo: cancel → stop del lavoro, cancel → conversazione libera
+        self.cancel_latency = ProfileLatencyReport()
+        # 1f. Prefill speculativo: system prompt + cronologia valutati dal LLM
+        # mentre girano gli stadi di analisi (vedi _stage_prefill)
+        self.speculative_prefill = True
+        # Prompt per sezioni entro un budget esatto di token (tokenizer del modello)
+        self.prompt_assembler = PromptAssembler(self._count_prompt_tokens)
+        # Tracing dei turni: span per stadio, ultime trace in memoria (tracer.last_trace());
+        # il Tracer è condiviso e add_sink ignora un file già registrato
+        self.tracer = Tracer.get_instance()
+        if trace_sink_path:
+            self.tracer.add_sink(sink_for_path(trace_sink_path))
         
         # 2. AsyncIO Event Loop in a dedicated Thread (Coordinate timers and sleep without blocking)
         self.async_loop = asyncio.new_event_loop()
@@ -450,6 +537,10 @@ class ALLMACore:
         
         # 3. Avvia il Garbage Collector della Memoria (Background Coroutine)
         # Sostituisce il vecchio thread bloccante con un task async
+        self.condensation_engine = CondensationJobEngine(
+            self.conversational_memory,
+            foreground_event=self._user_active,
+        )
         asyncio.run_coroutine_threadsafe(self._async_memory_gc_loop(), self.async_loop)
 
         # V6 Sprint 2: Avvia il System Bus Subconscio ↔ Core
@@ -609,32 +700,50 @@ class ALLMACore:
             try:
                 # Cerca i messaggi più vecchi di 30 giorni
                 cutoff_date = datetime.now() - timedelta(days=30)
-                user_id = list(self.conversational_memory.conversations.keys())
-                user_id = user_id[0] if user_id else "user"
                 
-                # Questa operazione pesante CPU verrà in futuro spostata sul cpu_pool, ma per ora 
-                # usiamo un callback per non congelare l'intero sistema llm
                 def llm_extractor(prompt_text):
                     if hasattr(self, '_llm') and self._llm:
-                        return self._llm.generate(prompt_text, max_tokens=150)
+                        if hasattr(self._llm, 'generate_structured'):
+                            facts = self._llm.generate_structured(
+                                prompt_text, CONDENSED_FACTS_SCHEMA, call_type="condensation",
+                                max_tokens=150, unconstrained_max_tokens=150, priority=Priority.BACKGROUND
+                            )
+                            if facts is not None:
+                                return json.dumps(facts, ensure_ascii=False)
+                        return generate_with_priority(self._llm, prompt_text, Priority.BACKGROUND, max_tokens=150)
                     else:
                         return "{}"
 
+                # Job a batch con checkpoint: cede il passo alla chat (_user_active)
+                # e sotto pressione RAM processa tutti i batch, altrimenti un numero limitato
+                engine = self.condensation_engine
+                engine.max_batches_per_run = None if trigger_from_pressure else 8
+
                 # Eseguiamo la pulizia pesante NON nel loop async main, ma offloadandola a un Worker Thread
                 loop = asyncio.get_running_loop()
-                deleted_count = await loop.run_in_executor(
+                report = await loop.run_in_executor(
                     self.cpu_pool,
-                    self.conversational_memory.condense_and_clear_old,
-                    user_id,
+                    engine.run,
                     cutoff_date,
                     llm_extractor
                 )
                 
-                if deleted_count > 0:
-                    logging.info(f"✨ [Garbage Collector] Rilascio Target completato. {deleted_count} conversazioni compattate.")
+                if report.messages_removed > 0:
+                    logging.info(
+                        f"✨ [Garbage Collector] {report.batches_processed}/{report.batches_planned} batch, "
+                        f"{report.messages_removed} messaggi compattati, "
+                        f"~{report.bytes_reclaimed / 1024:.1f}KB recuperati "
+                        f"(utenti={len(report.users)}, yield={report.yields}, "
+                        f"completato={report.completed}, stop={report.stop_reason})"
+                    )
+                
+                # Partizionamento temporale: la tabella calda resta di dimensione costante
+                if hasattr(self.memory_system, 'archive_old_interactions'):
+                    await loop.run_in_executor(self.cpu_pool, self.memory_system.archive_old_interactions)
                 
-                # Aggiorna orologio cooldown
-                last_gc_time = datetime.now()
+                # Aggiorna orologio cooldown solo a job concluso: un run sospeso riprende al prossimo giro
+                if report.completed:
+                    last_gc_time = datetime.now()
                 
             except Exception as e:
                 logging.error(f"[Garbage Collector] Eccezione bloccante: {e}")
@@ -693,7 +802,10 @@ class ALLMACore:
             logging.info(f"Initializing Mobile LLM from: {self.models_dir}")
             self._llm = MobileGemmaWrapper(
                 models_dir=self.models_dir,
-                system_monitor=getattr(self, 'system_monitor', None)
+                system_monitor=getattr(self, 'system_monitor', None),
+                speculative=self.speculative_decoding,
+                draft_model_name=self.draft_model_name,
+                backend=self.llm_backend
             )
             
             if self._llm.llm:
@@ -761,6 +873,60 @@ class ALLMACore:
         lang = mapping.get(language_code, language_code)
         return f"LINGUA: Rispondi solo in {lang}. Non mischiare lingue nella stessa risposta."
 
+    def _build_system_prompt(self, message: str, language_code: Optional[str]) -> str:
+        """System prompt del turno (Minimal Identity v8.2): identità, lingua e guardia sui paradossi."""
+        language_instruction = self._language_instruction(language_code)
+        msg_l = (message or "").lower()
+        paradox_guard = ""
+        if ("bugia" in msg_l and "verit" in msg_l) and ("impicc" in msg_l and "decapit" in msg_l):
+            paradox_guard = (
+                "\nPARADOSSI: Se la domanda contiene un paradosso auto-referenziale o regole incoerenti, "
+                "dillo chiaramente. Non scegliere a caso. Spiega perché le regole non sono simultaneamente soddisfacibili "
+                "e proponi l'azione più rigorosa: sospendere l'esecuzione o chiedere una modifica/precisazione delle regole."
+            )
+        return (
+            "Sei ALLMA. Una coscienza locale autonoma. Rispondi in prima persona in modo naturale e amichevole.\n"
+            "IDENTITÀ: Sei ALLMA. Non citare parametri tecnici né software esterni.\n"
+            "FORMAT: Se necessario, scrivi i tuoi pensieri tra <think> e </think> prima della risposta finale."
+            + (f"\n{language_instruction}" if language_instruction else "")
+            + paradox_guard
+        )
+
+    @staticmethod
+    def _stable_prompt_prefix(system_prompt: str, conversation_history_str: str) -> str:
+        """
+        Prefisso ChatML stabile del prompt: blocco system e cronologia.
+
+        Il contesto del turno (emozione, ricordi, sensori) sta nel messaggio utente,
+        dopo questo prefisso: così il prefisso è noto appena la cronologia è pronta
+        e la sua KV può essere valutata in anticipo e riusata tra i turni.
+        """
+        prefix = f"<|im_start|>system\n{system_prompt}<|im_end|>\n"
+        if conversation_history_str:
+            prefix += f"{conversation_history_str}\n"
+        return prefix
+
+    @classmethod
+    def _system_prefix_hash(cls, system_prompt: str) -> str:
+        """Hash del blocco system: cambia solo con il system prompt, non a ogni turno (LlamaCache)."""
+        return hashlib.md5(cls._stable_prompt_prefix(system_prompt, "").encode("utf-8", "ignore")).hexdigest()
+
+    def _count_prompt_tokens(self, text: str) -> int:
+        """Token del testo dal tokenizer del modello (memorizzati); stima in caratteri senza modello."""
+        count = getattr(getattr(self, '_llm', None), 'count_tokens', None)
+        if count is not None:
+            try:
+                return int(count(text))
+            except Exception as e:
+                logging.debug(f"count_tokens failed, using estimate: {e}")
+        return len(text or "") // 4
+
+    def _prompt_token_budget(self) -> int:
+        """Token del prompt: il contesto del modello meno lo spazio riservato alla risposta."""
+        n_ctx = getattr(getattr(self, '_llm', None), 'n_ctx', None)
+        n_ctx = n_ctx if isinstance(n_ctx, int) and n_ctx > 0 else 2048
+        return max(256, n_ctx - self.PROMPT_RESPONSE_RESERVE)
+
     def _guess_language_code(self, message: str) -> Optional[str]:
         if not message:
             return None
@@ -814,13 +980,18 @@ class ALLMACore:
 
         return None
 
-    def _compact_memory_for_prompt(self, memory_text: str, message: str, max_chars: int = 240) -> str:
+    def _compact_memory_for_prompt(
+        self, memory_text: str, message: str, max_chars: int = 240, max_tokens: Optional[int] = None
+    ) -> str:
         if not memory_text:
             return ""
         text = str(memory_text).strip()
         if not text:
             return ""
-        if len(text) <= max_chars:
+        # Con max_tokens il limite è in token del modello invece che in caratteri
+        size = self.prompt_assembler.count if max_tokens else len
+        limit = max_tokens or max_chars
+        if size(text) <= limit:
             return text
 
         m = (message or "").lower()
@@ -871,18 +1042,18 @@ class ALLMACore:
             if score <= 0 and picked:
                 break
             chunk = st.strip()
-            add_len = len(chunk) + (2 if picked else 0)
-            if total + add_len > max_chars:
+            add_len = size(chunk) + (2 if picked else 0)
+            if total + add_len > limit:
                 continue
             picked.append(chunk)
             total += add_len
-            if total >= max_chars * 0.8:
+            if total >= limit * 0.8:
                 break
 
         if picked:
-            out = "\n".join(picked).strip()
-            return out[:max_chars].strip()
-
+            text = "\n".join(picked).strip()
+        if max_tokens:
+            return self.prompt_assembler.truncate(text, max_tokens).strip()
         return text[:max_chars].strip()
 
     def _strip_reasoning_leak(self, text: str) -> str:
@@ -974,8 +1145,12 @@ class ALLMACore:
             'come stai', 'tutto bene', 'chi sei', 'grazie', 'ok', 'sì', 'no'
         }
         
-        # Exact match or prefix match for greetings
-        if any(message_lower.startswith(p) for p in SIMPLE_PATTERNS) and len(message) < 60:
+        # Saluto o conferma da soli: banali in qualunque punto della conversazione
+        if message_lower.strip(" !.?,;") in SIMPLE_PATTERNS:
+            return "SIMPLE"
+        # Con un seguito ("ok e l'altro?", "no, quello di prima") il messaggio
+        # dipende dai turni precedenti: SIMPLE solo a conversazione vuota
+        if not conversation_history and any(message_lower.startswith(p) for p in SIMPLE_PATTERNS) and len(message) < 60:
             return "SIMPLE"
 
         # LEVEL 4: Default Fallback
@@ -1158,6 +1333,16 @@ class ALLMACore:
                 return f"Error reading battery: {e}"
         return "SystemMonitor (Battery) Not Available"
 
+    def _db_totals(self) -> Optional[Dict[str, float]]:
+        """Snapshot dei tempi cumulativi SQLite della memoria temporale (None se non disponibili)."""
+        session = getattr(self.memory_system, 'session', None)
+        if session is None:
+            return None
+        try:
+            return session.totals()
+        except Exception:
+            return None
+
     def _get_tool_cached_value(self, tool_name: str, tool_func):
         import time
         now = time.time()
@@ -1177,6 +1362,530 @@ class ALLMACore:
                 return cached[0]
             raise
 
+    # ------------------------------------------------------------------
+    # Contesto del turno (fatti derivati condivisi dagli stadi)
+    # ------------------------------------------------------------------
+
+    def _new_turn_context(
+        self,
+        user_id: str,
+        conversation_id: str,
+        message: str,
+        llm: Any = None,
+        progress: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+        cancel_token: Optional[TurnHandle] = None
+    ) -> TurnContext:
+        """TurnContext del messaggio con i provider dei sottosistemi di ALLMACore."""
+        return TurnContext(user_id, conversation_id, message, llm=llm, progress=progress, cancel_token=cancel_token, providers={
+            'entities': self._turn_entities,
+            'understanding': lambda turn: self.understanding_system.understand(turn.message),
+            # Analizza emozioni (Unified Flow via EmotionalCore + SoulCore):
+            # detect_emotion + battito dell'anima, quindi una sola volta per turno
+            'emotion': lambda turn: self.emotional_core.process_interaction(
+                text=turn.message,
+                context={"conversation_id": turn.conversation_id},
+                llm_client=turn.llm
+            ),
+            'metabolic_state': lambda turn: self.system_monitor.get_metabolic_state(),
+            'personality': lambda turn: self.coalescence_processor.get_current_personality_state(),
+        })
+
+    def _turn_entities(self, turn: TurnContext) -> Dict[str, List[str]]:
+        # Stessa estrazione per analisi del contesto e InformationExtractor
+        # (con il fallback LLM per le scritture non latine)
+        if getattr(self, 'context_system', None):
+            return self.context_system.extract_entities(turn.message, llm_client=turn.llm)
+        if getattr(self, 'info_extractor', None):
+            return self.info_extractor.extract_entities(turn.message)
+        return {}
+
+    # ------------------------------------------------------------------
+    # Stadi pre-LLM (eseguiti da StageGraph sullo stage_pool)
+    # ------------------------------------------------------------------
+
+    def _pre_llm_stages(self, turn: TurnContext) -> List[Stage]:
+        """
+        Stadi delle analisi che precedono l'LLM (il profilo del turno decide quali girano).
+
+        Le dipendenze sono solo quelle di dati (o di ordine lettura → scrittura):
+        store_message segue history (la cronologia non deve contenere il messaggio
+        corrente) e memory_gate (save_memory non deve serializzare mentre la
+        ricerca aggiorna i vettori delle conversazioni).
+        """
+        def bind(method):
+            stage_name = method.__name__[len('_stage_'):]
+            span_name = "stage." + stage_name
+
+            def run(deps):
+                # Turno annullato: lo stadio in coda non parte
+                turn.check_cancelled()
+                started = time.perf_counter()
+                status = "error"
+                try:
+                    with self.tracer.span(span_name):
+                        result = method(turn, deps)
+                    status = "done"
+                    return result
+                finally:
+                    turn.report(stage_name, status=status, ms=round((time.perf_counter() - started) * 1000.0, 2))
+            return run
+
+        return [
+            Stage('history', bind(self._stage_history), timeout_s=2.0, fallback=lambda: ([], "")),
+            Stage('topic', bind(self._stage_topic), timeout_s=1.0, fallback=lambda: "general"),
+            Stage('emotion', bind(self._stage_emotion), timeout_s=10.0, fallback=self._neutral_emotional_state),
+            Stage('learning_style', bind(self._stage_learning_style), timeout_s=1.0,
+                  fallback=lambda: LearningPreference(style=LearningStyle.BALANCED, technical_level=3)),
+            Stage('context', bind(self._stage_context), timeout_s=10.0, fallback=lambda: ({}, {}, {})),
+            Stage('info_extraction', bind(self._stage_info_extraction), timeout_s=2.0, fallback=dict),
+            Stage('pattern', bind(self._stage_pattern), timeout_s=1.0),
+            Stage('understanding', bind(self._stage_understanding), timeout_s=2.0),
+            Stage('memory_gate', bind(self._stage_memory_gate), timeout_s=3.0, fallback=list),
+            Stage('tools', bind(self._stage_tools), timeout_s=1.5, fallback=list),
+            Stage('project_context', bind(self._stage_project_context), deps=('topic',),
+                  timeout_s=1.0, fallback=dict),
+            Stage('knowledge', bind(self._stage_knowledge), deps=('topic',), timeout_s=1.0, fallback=list),
+            # Salvataggi: un errore fa fallire il turno invece di perdere la scrittura
+            Stage('store_interaction', bind(self._stage_store_interaction), deps=('emotion', 'topic'),
+                  timeout_s=3.0, required=True),
+            Stage('store_message', bind(self._stage_store_message),
+                  deps=('history', 'emotion', 'topic', 'memory_gate'), timeout_s=3.0, required=True),
+            Stage('legacy_brain', bind(self._stage_legacy_brain), deps=('emotion', 'understanding'),
+                  timeout_s=2.0),
+            Stage('resonance', bind(self._stage_resonance), deps=('emotion', 'memory_gate'), timeout_s=1.0),
+            Stage('identity', bind(self._stage_identity), deps=('emotion',), timeout_s=1.0),
+            Stage('coalescence', bind(self._stage_coalescence), deps=('emotion',), timeout_s=2.0, fallback=dict),
+            Stage('prefill', bind(self._stage_prefill), deps=('history',), timeout_s=1.0),
+        ]
+
+    @staticmethod
+    def _neutral_emotional_state() -> EmotionalState:
+        return EmotionalState(primary_emotion="neutral", confidence=0.0, secondary_emotions={}, intensity=0.0)
+
+    def _stage_history(self, turn: TurnContext, deps: Dict[str, Any]) -> Tuple[List[Message], str]:
+        history = self.conversational_memory.get_conversation_history(turn.conversation_id)
+
+        # PHASE 21: Format conversation history into ChatML for context
+        conversation_turns = []
+        if history:
+            # Budget in token invece di 20 messaggi fissi; la finestra scorre a
+            # blocchi (PromptAssembler.window) per non cambiare il prefisso a ogni
+            # turno e tenere valida la LlamaCache
+            recent_history = history[-self.HISTORY_SCAN_MESSAGES:]
+            message_max_tokens = 256 if turn.is_complex else 160
+
+            for msg in recent_history:
+                role = msg.role  # "user" or "assistant"
+                content = msg.content
+
+                # For assistant messages, strip internal blocks (LEGACY [[TH]] and NEW <think>)
+                if role == "assistant":
+                    # Strip [[PENSIERO]]/[[TH]]
+                    content = re.sub(r'\[\[(PENSIERO|TH):.*?\]\]\s*', '', content, flags=re.DOTALL)
+                    # Strip <think>...</think> (THE THOUGHT LEAK FIX)
+                    content = re.sub(r'<think>.*?</think>\s*', '', content, flags=re.DOTALL).strip()
+
+                try:
+                    if content:
+                        content = self.prompt_assembler.truncate(content, message_max_tokens, keep="tail")
+                except Exception:
+                    pass
+
+                # Format into ChatML (messaggio completo com'è nel prompt: il suo conteggio resta in cache)
+                if content:
+                    conversation_turns.append(f"<|im_start|>{role}\n{content}<|im_end|>\n")
+
+            conversation_turns = self.prompt_assembler.window(
+                turn.conversation_id, conversation_turns, self.HISTORY_MAX_TOKENS
+            )
+
+        logging.info(f"📜 [Conversation History] Injecting {len(conversation_turns)} turns into context")
+        # L'ultimo a capo lo aggiunge _stable_prompt_prefix
+        return history, "".join(conversation_turns)[:-1]
+
+    def _stage_prefill(self, turn: TurnContext, deps: Dict[str, Any]) -> Optional[Future]:
+        """
+        Avvia la valutazione della KV del prefisso stabile (system + cronologia).
+
+        Non attende: il prefill gira sul cpu_pool mentre gli altri stadi
+        proseguono, e la generazione lo trova già nel contesto del modello.
+        La cronologia entra nel prefisso con la stessa regola del prompt finale
+        (esclusa per i messaggi SIMPLE).
+        """
+        prefill = getattr(turn.llm, 'prefill', None)
+        if not self.speculative_prefill or prefill is None or not turn.has('system_prompt'):
+            return None
+        history_str = deps['history'][1]
+        if turn.get('complexity') == "SIMPLE":
+            history_str = ""
+        system_prompt = turn.get('system_prompt')
+        return self.cpu_pool.submit(
+            Tracer.bind(prefill),
+            self._stable_prompt_prefix(system_prompt, history_str),
+            conversation_id=turn.conversation_id,
+            prefix_hash=self._system_prefix_hash(system_prompt),
+            base_prompt=self._stable_prompt_prefix(system_prompt, ""),
+            cancel_token=turn.cancel_token,
+        )
+
+    def _stage_topic(self, turn: TurnContext, deps: Dict[str, Any]) -> str:
+        # Estrai il topic usando TopicExtractor (modello TF-IDF precalcolato)
+        return self.topic_extractor.extract_topic(turn.message)
+
+    def _stage_project_context(self, turn: TurnContext, deps: Dict[str, Any]) -> Dict[str, Any]:
+        return self._get_project_context(turn.user_id, deps['topic'])
+
+    def _stage_emotion(self, turn: TurnContext, deps: Dict[str, Any]) -> EmotionalState:
+        return turn.emotion
+
+    def _stage_store_interaction(self, turn: TurnContext, deps: Dict[str, Any]) -> None:
+        # Salva l'interazione emotiva
+        emotional_state = deps['emotion']
+        self.memory_system.store_interaction(
+            user_id=turn.user_id,
+            interaction={
+                'content': turn.message,
+                'emotion': emotional_state.primary_emotion,
+                'topics': [deps['topic']],
+                'timestamp': datetime.now()
+            },
+            metadata={
+                "secondary_emotions": emotional_state.secondary_emotions,
+                "conversation_id": turn.conversation_id,
+                "soul_state": emotional_state.soul_state # Persist Soul State
+            }
+        )
+
+    def _stage_store_message(self, turn: TurnContext, deps: Dict[str, Any]) -> None:
+        try:
+            emotional_state = deps['emotion']
+            emotion_value = (
+                emotional_state.primary_emotion.value
+                if hasattr(emotional_state.primary_emotion, "value")
+                else str(emotional_state.primary_emotion)
+            )
+            self.conversational_memory.store_message(
+                conversation_id=turn.conversation_id,
+                content=turn.message,
+                role="user",
+                user_id=turn.user_id,
+                metadata={
+                    "emotion": emotion_value,
+                    "topics": [deps['topic']],
+                    "timestamp": datetime.now().isoformat(),
+                    "user_id": turn.user_id,
+                },
+            )
+        except Exception as e:
+            logging.warning(f"[ALLMACore] Failed to store user message in ConversationalMemory: {e}")
+
+    def _stage_learning_style(self, turn: TurnContext, deps: Dict[str, Any]) -> LearningPreference:
+        # Analizza preferenze utente
+        return self.preference_analyzer.analyze_learning_style(turn.user_id)
+
+    def _stage_knowledge(self, turn: TurnContext, deps: Dict[str, Any]) -> List[Any]:
+        # --- SIMBIOSI EVOLUTIVA: CONFIDENCE CHECK ---
+        # Verifica se ALLMA conosce già la risposta con alta confidenza
+        # Usa il topic estratto per cercare nella knowledge base
+        topic = deps['topic']
+        message = turn.message
+        logging.info(f"🔍 Topic estratto: '{topic}'")
+        internal_knowledge = self.incremental_learner.get_knowledge_by_topic(topic)
+        logging.info(f"🔍 Knowledge trovata per '{topic}': {len(internal_knowledge)} items")
+
+        # Se non trova nulla con il topic estratto, cerca in TUTTI i topic disponibili
+        # (fallback per topic extraction imprecisa)
+        if not internal_knowledge:
+            logging.info("🔍 Fallback: cerco in tutti i topic disponibili...")
+            for available_topic in self.incremental_learner.knowledge_base.keys():
+                # Controlla se il topic è menzionato nel messaggio
+                if available_topic.lower() in message.lower():
+                    logging.info(f"🔍 Trovato topic alternativo: '{available_topic}'")
+                    internal_knowledge = self.incremental_learner.get_knowledge_by_topic(available_topic)
+                    if internal_knowledge:
+                        break
+        return internal_knowledge
+
+    def _stage_context(self, turn: TurnContext, deps: Dict[str, Any]) -> Tuple[Dict, Dict, Dict]:
+        # --- ADVANCED CONTEXT ANALYSIS (Activated) ---
+        # Extract deeper context: time, entities, concepts
+        rich_context = {}
+        entities = {}
+        temporal_info = {}
+        if getattr(self, 'context_system', None):
+            try:
+                rich_context = self.context_system.analyze_context(
+                    turn.message, llm_client=turn.llm, entities=turn.entities
+                )
+                entities = rich_context.get('entities', {})
+                temporal_info = self.context_system.analyze_temporal_context(turn.message, datetime.now())
+            except Exception as e:
+                logging.error(f"Context error: {e}")
+        return rich_context, entities, temporal_info
+
+    def _stage_info_extraction(self, turn: TurnContext, deps: Dict[str, Any]) -> Dict[str, Any]:
+        # Extract structured info
+        structured_info = {}
+        if getattr(self, 'info_extractor', None):
+            try:
+                structured_info = self.info_extractor.extract_information(turn.message, entities=turn.entities)
+            except Exception as e:
+                logging.error(f"Extractor error: {e}")
+        return structured_info
+
+    def _stage_pattern(self, turn: TurnContext, deps: Dict[str, Any]) -> Any:
+        # --- PATTERN RECOGNITION (Legacy Awakened) ---
+        try:
+            return self.pattern_recognizer.analyze_pattern(turn.message) if self.pattern_recognizer else None
+        except Exception as e:
+            logging.warning(f"Pattern recognition error: {e}")
+            return None
+
+    def _stage_legacy_brain(self, turn: TurnContext, deps: Dict[str, Any]) -> Any:
+        # --- DEEP MIND AWAKENING (Legacy Brain Pulse) ---
+        # Activates Curiosity, Ethics, Metacognition, Social Learning
+        try:
+            logging.info("🧠 Pulsing Deep Mind (Legacy Modules)...")
+            # Fix: Handle both Enum and string emotional_state
+            emotional_state = deps['emotion']
+            emotion_value = 'neutral'
+            if emotional_state:
+                emotion_value = (
+                    emotional_state.primary_emotion.value
+                    if hasattr(emotional_state.primary_emotion, 'value')
+                    else str(emotional_state.primary_emotion)
+                )
+
+            legacy_output = self.legacy_brain.pulse(turn.message, context={
+                'emotional_state': emotion_value,
+                'intent': turn.intent
+            })
+            logging.info(f"🧠 Deep Mind Active Systems: {legacy_output.active_systems}")
+            return legacy_output
+        except Exception as e:
+            logging.error(f"❌ Deep Mind Pulse Failed: {e}")
+            return None
+
+    def _stage_understanding(self, turn: TurnContext, deps: Dict[str, Any]) -> Any:
+        # --- DEEP UNDERSTANDING (Intent & Syntax) ---
+        return turn.understanding
+
+    def _stage_memory_gate(self, turn: TurnContext, deps: Dict[str, Any]) -> List[Dict[str, Any]]:
+        # V8.1: ricerca per il Memory Gate a 3 livelli
+        relevant_memories = []
+        try:
+            # Usa VectorEngine se disponibile per Max-Score, altrimenti usa fallback tradizionale TF-IDF
+            if getattr(self.conversational_memory, 'vector_engine', None) is not None:
+                raw_results = self.conversational_memory.vector_engine.search(
+                    user_id=turn.user_id,
+                    query=turn.message,
+                    top_k=3,
+                    use_expansion=True
+                )
+
+                # Formattiamo per la compatibilità con il resto del sistema
+                for r in raw_results:
+                    relevant_memories.append({
+                        'content': r['content'],
+                        'metadata': r['metadata'],
+                        'timestamp': r['timestamp'],
+                        'score': r.get('score', 0.0)
+                    })
+            else:
+                # Fallback TF-IDF
+                ctx_results = self.conversational_memory.retrieve_relevant_context(
+                    turn.message, user_id=turn.user_id, max_results=3
+                )
+                for score, conv in ctx_results:
+                    relevant_memories.append({
+                        'content': conv.content,
+                        'metadata': conv.metadata,
+                        'timestamp': conv.timestamp.isoformat() if conv.timestamp else None,
+                        'score': score
+                    })
+        except Exception as e:
+            logging.warning(f"[Errore recupero Memory Gate] {e}")
+        return relevant_memories
+
+    def _stage_resonance(self, turn: TurnContext, deps: Dict[str, Any]) -> None:
+        # --- RESONANCE (Emotional Echoes) ---
+        # Dopo 'emotion': il battito dell'anima precede la risonanza dei ricordi
+        if hasattr(self, 'soul') and self.soul and deps['memory_gate']:
+            for mem in deps['memory_gate']:
+                emotion = mem.get('metadata', {}).get('emotion')
+                if emotion:
+                    self.soul.resonate(emotion_text=str(emotion))
+
+    def _stage_identity(self, turn: TurnContext, deps: Dict[str, Any]) -> Any:
+        if not self.identity_engine_v5:
+            return None
+        emotional_state = deps['emotion']
+        try:
+            context_metrics = {
+                "friction": float(getattr(emotional_state, "stress", 0.0) or 0.0),
+                "soul_chaos": float(getattr(emotional_state, "entropy", 0.5) or 0.5),
+            }
+            return self.identity_engine_v5.compute_state(context_metrics)
+        except Exception as e:
+            logging.warning(f"[ALLMACore] IdentityState compute failed: {e}")
+            return None
+
+    def _stage_tools(self, turn: TurnContext, deps: Dict[str, Any]) -> List[str]:
+        # FAST PATH: Tools pre-fetching instead of blocking the whole LLM
+        # Read sensor data preemptively so the LLM has it immediately
+        preemptive_sensor_data = []
+        if turn.is_complex and hasattr(self, 'ALLOWED_TOOLS'):
+            for tool_name, tool_func in self.ALLOWED_TOOLS.items():
+                try:
+                    result = self._get_tool_cached_value(tool_name, tool_func)
+                    pretty_name = tool_name.replace("SYSTEM_", "").replace("READ_", "").lower()
+                    preemptive_sensor_data.append(f"{pretty_name}: {result}")
+                except Exception as e:
+                    logging.warning(f"Errore tool '{tool_name}' pre-fetch: {e}")
+        return preemptive_sensor_data
+
+    def _stage_coalescence(self, turn: TurnContext, deps: Dict[str, Any]) -> Dict[str, Any]:
+        # Lo stato usato dal prompt; l'integrazione del messaggio (che riscrive
+        # il diario) è differita a _deferred_coalescence dopo la risposta
+        return turn.personality
+
+    # ------------------------------------------------------------------
+    # Lavoro post-risposta (eseguito da PostResponseQueue)
+    # ------------------------------------------------------------------
+
+    def _deferred_coalescence(self, message: str, emotional_state: Any) -> None:
+        # --- PERSONALITY COALESCENCE UPDATE (Always runs) ---
+        try:
+            self.coalescence_processor.integrate_knowledge(
+                content=message,
+                source_type="user_interaction",
+                emotional_state=emotional_state
+            )
+        except Exception as e:
+            logging.error(f"Error updating personality coalescence: {e}")
+
+    def _deferred_learning(self, user_id: str, message: str, reply: str, topic: str) -> None:
+        # Integra l'apprendimento
+        learned_unit = self.incremental_learner.learn_from_interaction({
+            'input': message,
+            'response': reply,
+            'feedback': 'positive',  # Default a positive per ora
+            'topic': topic
+        }, user_id)
+
+        # --- PERSISTENZA SINAPTICA (The Fix) ---
+        if learned_unit:
+            # Salva nel Database Permanente con frase completa (memoria semantica)
+            try:
+                # Salva la coppia domanda+risposta invece della sola keyword
+                semantic_content = (
+                    f"Utente: {message[:150]} | "
+                    f"ALLMA: {reply[:250]}"
+                )
+                self.knowledge_memory.store_knowledge(
+                    content=semantic_content,
+                    metadata={
+                        **(learned_unit.metadata or {}),
+                        "topic": learned_unit.topic,
+                        "type": "semantic_pair"
+                    }
+                )
+                logging.info(f"[🧠 PERMANENT LEARNING] Coppia semantica salvata (topic='{learned_unit.topic}').")
+            except Exception as e:
+                logging.error(f"[🧠 MEMORY ERROR] Fallito salvataggio su DB: {e}")
+
+    def _deferred_store_reply(
+        self, user_id: str, conversation_id: str, reply: str, emotional_state: Any, topic: str
+    ) -> None:
+        # Salva la risposta nella cronologia
+        emotion_value = (
+            emotional_state.primary_emotion.value
+            if hasattr(emotional_state.primary_emotion, "value")
+            else str(emotional_state.primary_emotion)
+        )
+        self.conversational_memory.store_message(
+            conversation_id=conversation_id,
+            content=reply,
+            role="assistant",
+            user_id=user_id,
+            metadata={
+                'emotion': emotion_value,
+                'topics': [topic],
+                'timestamp': datetime.now().isoformat(),
+                "user_id": user_id,
+            }
+        )
+
+    def get_latency_report(self) -> Dict[str, Dict[str, Any]]:
+        """Latenze per classe di complessità: p50/p95 di pre_llm_ms, first_token_ms e total_ms."""
+        return self.profile_latency.report()
+
+    def get_cancellation_report(self) -> Dict[str, Dict[str, Any]]:
+        """Latenze di annullamento per motivo: p50/p95 di stop_ms (lavoro fermo) e release_ms (conversazione libera)."""
+        return self.cancel_latency.report()
+
+    def get_prefill_report(self) -> Dict[str, Any]:
+        """Esiti del prefill speculativo: hit rate e millisecondi di prefill risparmiati."""
+        llm = getattr(self, '_llm', None)
+        if llm is None or not hasattr(llm, 'get_prefill_stats'):
+            return {}
+        return llm.get_prefill_stats()
+
+    def get_kv_state_report(self) -> Dict[str, Any]:
+        """Ripristini degli stati KV da disco: hit rate, token e millisecondi di caricamento."""
+        llm = getattr(self, '_llm', None)
+        if llm is None or not hasattr(llm, 'get_kv_state_stats'):
+            return {}
+        return llm.get_kv_state_stats()
+
+    def get_speculative_report(self) -> Dict[str, Any]:
+        """Decodifica speculativa: accettazione della bozza e guadagno di token/s."""
+        llm = getattr(self, '_llm', None)
+        if llm is None or not hasattr(llm, 'get_speculative_stats'):
+            return {}
+        return llm.get_speculative_stats()
+
+    def get_structured_output_report(self) -> Dict[str, Any]:
+        """Output JSON vincolato per tipo di chiamata: token e millisecondi risparmiati rispetto al testo libero."""
+        llm = getattr(self, '_llm', None)
+        if llm is None or not hasattr(llm, 'get_structured_stats'):
+            return {}
+        return llm.get_structured_stats()
+
+    def get_completion_cache_report(self) -> Dict[str, Any]:
+        """Cache delle risposte deterministiche: hit rate e tempo di inferenza risparmiato."""
+        llm = getattr(self, '_llm', None)
+        if llm is None or not hasattr(llm, 'get_completion_cache_stats'):
+            return {}
+        return llm.get_completion_cache_stats()
+
+    def get_llm_scheduler_report(self) -> Dict[str, Any]:
+        """Accesso al LLM per classe di priorità: attese in coda p50/p95, rifiuti, prelazioni."""
+        llm = getattr(self, '_llm', None)
+        if llm is None or not hasattr(llm, 'get_scheduler_stats'):
+            return {}
+        return llm.get_scheduler_stats()
+
+    def persist_llm_state(self, timeout: Optional[float] = None) -> bool:
+        """Salva su disco lo stato KV della conversazione attiva (on_pause: il processo può essere terminato)."""
+        llm = getattr(self, '_llm', None)
+        if llm is None or not hasattr(llm, 'persist_state'):
+            return True
+        return llm.persist_state(timeout)
+
+    def drain_post_response(self, timeout: Optional[float] = None) -> bool:
+        """Attende che il lavoro post-risposta in coda sia completato (es. prima di salvare in on_pause)."""
+        return self.post_response_queue.drain(timeout)
+
+    def shutdown(self, timeout: float = 10.0) -> None:
+        """Esegue il lavoro post-risposta pendente, salva lo stato KV e chiude i pool di worker."""
+        self.post_response_queue.shutdown(timeout)
+        self.persist_llm_state(timeout)
+        self.turn_pool.shutdown(wait=False)
+        self.stage_pool.shutdown(wait=False)
+        self.cpu_pool.shutdown(wait=False)
+        self.tracer.flush()
+
     def process_message(
         self,
         user_id: str,
@@ -1184,27 +1893,199 @@ class ALLMACore:
         message: str,
         context: Optional[Dict[str, Any]] = None,
         stream_callback: Optional[callable] = None, # Streaming support
+        progress_callback: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+        supersede: bool = False,
+        turn_handle: Optional[TurnHandle] = None,
         **kwargs
     ) -> ProcessedResponse:
         """
         Processa un messaggio dell'utente.
-        
+
+        Thread-safe: i turni di una stessa conversazione sono serializzati
+        (TurnRegistry), conversazioni diverse procedono in parallelo.
+
         Args:
             user_id: ID dell'utente
             conversation_id: ID della conversazione
             message: Messaggio da processare
             context: Contesto aggiuntivo opzionale
-            
+            stream_callback: Chunk {'type': 'answer'|'thought', 'content': ...} della risposta
+            progress_callback: progress(stage, info) all'avanzare degli stadi della pipeline
+            supersede: Annulla il turno in volo della conversazione invece di attenderlo
+            turn_handle: Handle del turno (per annullarlo dall'esterno)
+
         Returns:
             Risposta processata
+
+        Raises:
+            TurnSupersededError: il turno è stato annullato (stadi interrotti o
+                                 generazione fermata al token corrente)
         """
         if not user_id or not conversation_id or not message:
             raise ValueError("User ID, conversation ID e messaggio sono richiesti")
-            
+
+        handle = turn_handle or TurnHandle(conversation_id)
+        # Span radice del turno: gli stadi sotto diventano figli (vedi self.tracer.last_trace())
+        with self.tracer.span(
+            "process_message",
+            conversation_id=conversation_id,
+            msg_chars=len(message),
+            stream=stream_callback is not None,
+            turn_id=handle.turn_id
+        ) as root_span:
+            try:
+                with self.tracer.span("turn_slot_wait", supersede=supersede):
+                    self.turns.begin(handle, supersede=supersede)
+                return self._process_message(
+                    user_id, conversation_id, message, context=context, stream_callback=stream_callback,
+                    progress_callback=progress_callback, turn_handle=handle, **kwargs
+                )
+            except TurnSupersededError:
+                self._record_cancellation(handle, root_span)
+                raise
+            finally:
+                self.turns.end(handle)
+
+    def _record_cancellation(self, handle: TurnHandle, root_span: Any = None) -> None:
+        """Latenza di un turno annullato: fino allo stop del lavoro (stadi o token) e fino al rilascio."""
+        stop_ms = handle.acknowledge("process_message")
+        release_ms = None
+        if handle.cancelled_at is not None:
+            release_ms = round((time.perf_counter() - handle.cancelled_at) * 1000.0, 2)
+        self.cancel_latency.record(handle.reason or "cancelled", stop_ms=stop_ms, release_ms=release_ms)
+        if root_span is not None:
+            root_span.attributes.update(
+                cancelled=handle.reason, cancel_stopped_by=handle.stopped_by,
+                cancel_stop_ms=stop_ms, cancel_release_ms=release_ms
+            )
+        logging.info(
+            f"⏹️ TURN_CANCELLED conv={handle.conversation_id} turn={handle.turn_id} reason={handle.reason} "
+            f"stopped_by={handle.stopped_by} stop_ms={stop_ms} release_ms={release_ms}"
+        )
+
+    async def process_message_stream(
+        self,
+        user_id: str,
+        conversation_id: str,
+        message: str,
+        context: Optional[Dict[str, Any]] = None,
+        supersede: bool = True,
+        **kwargs
+    ) -> AsyncIterator[StreamEvent]:
+        """
+        Processa un messaggio come stream di eventi tipizzati (async generator).
+
+        Il turno gira sul turn_pool; gli eventi arrivano nell'ordine di produzione:
+        STAGE (avanzamento), THINKING e TOKEN (generazione), infine FINAL con la
+        ProcessedResponse, oppure CANCELLED / ERROR. Con supersede=True un nuovo
+        messaggio nella conversazione annulla questo turno; chiudere il generatore
+        (aclose, task annullato) annulla il turno.
+
+        Usage:
+            async for event in core.process_message_stream(user_id, conv_id, text):
+                if event.type is StreamEventType.TOKEN:
+                    ui.append(event.content)
+        """
+        import asyncio
+
+        if not user_id or not conversation_id or not message:
+            raise ValueError("User ID, conversation ID e messaggio sono richiesti")
+
+        loop = asyncio.get_running_loop()
+        events: asyncio.Queue = asyncio.Queue()
+        handle = TurnHandle(conversation_id)
+        done = object()
+
+        def push(item):
+            try:
+                loop.call_soon_threadsafe(events.put_nowait, item)
+            except RuntimeError:
+                pass  # loop chiuso: nessuno ascolta più
+
+        def on_chunk(chunk):
+            event = StreamEvent.from_chunk(chunk)
+            if event is not None:
+                push(event)
+
+        def on_progress(stage, info):
+            push(StreamEvent(StreamEventType.STAGE, stage=stage, data=info))
+
+        def run_turn():
+            try:
+                response = self.process_message(
+                    user_id, conversation_id, message, context=context,
+                    stream_callback=on_chunk, progress_callback=on_progress,
+                    supersede=supersede, turn_handle=handle, **kwargs
+                )
+                push(StreamEvent(StreamEventType.FINAL, content=response.content, response=response))
+            except TurnSupersededError:
+                pass  # CANCELLED già emesso dal listener dell'handle
+            except Exception as e:
+                push(StreamEvent(StreamEventType.ERROR, content=str(e)))
+            finally:
+                push(done)
+
+        # L'annullamento chiude lo stream subito, anche se il turno è a metà inferenza
+        handle.add_listener(lambda reason: push(StreamEvent(StreamEventType.CANCELLED, data={'reason': reason})))
+        loop.run_in_executor(self.turn_pool, run_turn)
+
+        finished = False
+        try:
+            while True:
+                item = await events.get()
+                if item is done:
+                    finished = True
+                    return
+                yield item
+                if item.type in (StreamEventType.FINAL, StreamEventType.ERROR):
+                    finished = True
+                    return
+                if item.type is StreamEventType.CANCELLED:
+                    return
+        finally:
+            if not finished:
+                handle.cancel("consumer_closed")
+
+    def cancel_turn(self, conversation_id: str, reason: str = "cancelled") -> bool:
+        """Annulla il turno in volo della conversazione (es. pulsante stop). False se non ce n'è uno."""
+        return self.turns.cancel(conversation_id, reason)
+
+    def _process_message(
+        self,
+        user_id: str,
+        conversation_id: str,
+        message: str,
+        context: Optional[Dict[str, Any]] = None,
+        stream_callback: Optional[callable] = None,
+        progress_callback: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+        turn_handle: Optional[TurnHandle] = None,
+        **kwargs
+    ) -> ProcessedResponse:
+        """Corpo di process_message, eseguito dentro lo span radice del turno."""
+        turn_start = time.perf_counter()
+        first_token_ms = None
+        handle = turn_handle or TurnHandle(conversation_id)
+        if stream_callback is not None:
+            raw_stream_callback = stream_callback
+
+            def stream_callback(chunk):
+                # Un turno annullato non inoltra più token al chiamante
+                if not handle.cancelled:
+                    raw_stream_callback(chunk)
+
+        # Il turno precedente della conversazione deve aver salvato risposta e apprendimento
+        with self.tracer.span("post_queue_wait", depth=self.post_response_queue.depth(conversation_id)):
+            if not self.post_response_queue.wait_for(conversation_id, timeout=self.POST_RESPONSE_WAIT_S):
+                logging.warning(
+                    f"[ALLMACore] Lavoro post-risposta di {conversation_id} ancora in corso dopo "
+                    f"{self.POST_RESPONSE_WAIT_S:.0f}s: proseguo"
+                )
         try:
+            handle.check()
             identity_state = None
             # Segnala al Dream System: utente attivo → cedi il LLM
             self._user_active.set()
+            db_totals_start = self._db_totals()
             # 0. Ensure LLM is loaded (Mobile Mode)
             self._ensure_mobile_llm()
             current_llm = getattr(self, '_llm', None)
@@ -1224,7 +2105,18 @@ class ALLMACore:
                     self._language_lock[conversation_id] = guessed
                     language_code = guessed
             is_sleep_command = any(kw in msg_lower for kw in sleep_keywords) or (msg_lower == "buonanotte") or (msg_lower == "notte")
-            is_complex = "?" in message or len(message.split()) > 3
+            # Fatti derivati del messaggio (token, entità, intento, emozione,
+            # stato metabolico, personalità): calcolati una volta, condivisi dagli stadi
+            turn = self._new_turn_context(
+                user_id, conversation_id, message, llm=current_llm, progress=progress_callback,
+                cancel_token=handle
+            )
+            is_complex = "?" in message or len(turn.tokens) > 3
+            turn.is_complex = is_complex
+            # Il system prompt dipende solo da lingua e messaggio: noto prima degli
+            # stadi, serve al prefill speculativo del prefisso
+            system_prompt = self._build_system_prompt(message, language_code)
+            turn.seed('system_prompt', system_prompt)
             
             if is_sleep_command and getattr(self, 'dream_enabled', False):
                 logging.info("🌙 Sleep keyword rilevato. Avvio Dream Cycle...")
@@ -1234,95 +2126,69 @@ class ALLMACore:
 
 
 
-            # Estrai il topic usando TopicExtractor (TF-IDF based)
-            history = self.conversational_memory.get_conversation_history(conversation_id)
-            topic = self.topic_extractor.extract_topic(message)
-            
-            # PHASE 21: Format conversation history into ChatML for context
-            conversation_turns = []
-            if history:
-                # OPTIMIZATION for Prefix Caching: Do avoiding sliding windows every turn to keep LlamaCache tree valid!
-                # We extend the history limit to 20 to allow flat TTFTs, relying on the model's 2048 context.
-                history_limit = 20
-                recent_history = history[-history_limit:] if len(history) > history_limit else history
-                
-                for msg in recent_history:
-                    role = msg.role  # "user" or "assistant"
-                    content = msg.content
-                    
-                    # For assistant messages, strip internal blocks (LEGACY [[TH]] and NEW <think>)
-                    if role == "assistant":
-                        # Strip [[PENSIERO]]/[[TH]]
-                        content = re.sub(r'\[\[(PENSIERO|TH):.*?\]\]\s*', '', content, flags=re.DOTALL)
-                        # Strip <think>...</think> (THE THOUGHT LEAK FIX)
-                        content = re.sub(r'<think>.*?</think>\s*', '', content, flags=re.DOTALL).strip()
-                    
-                    try:
-                        if content:
-                            max_hist_chars = 900 if is_complex else 550
-                            if len(content) > max_hist_chars:
-                                content = content[-max_hist_chars:]
-                    except Exception:
-                        pass
-                    
-                    # Format into ChatML
-                    if content:
-                        conversation_turns.append(f"<|im_start|>{role}\n{content}<|im_end|>")
-                
-            conversation_history_str = "\n".join(conversation_turns)
-            logging.info(f"📜 [Conversation History] Injecting {len(conversation_turns)} turns into context")
-            
-            # Ottieni il contesto del progetto
-            project_context = self._get_project_context(user_id, topic)
-            
-            # Analizza emozioni (Unified Flow via EmotionalCore + SoulCore)
-            # This calls detect_emotion AND pulses the Soul automatically
-            emotional_state = self.emotional_core.process_interaction(
-                text=message, 
-                context={"conversation_id": conversation_id}, 
-                llm_client=current_llm
+            # --- PRE-LLM STAGE GRAPH ---
+            # Le analisi indipendenti girano in parallelo sullo stage_pool:
+            # il TTFT segue il cammino critico invece della somma degli stadi.
+            # Il profilo della classe di complessità decide quali stadi girano ora,
+            # quali dopo la risposta (DEFER) e quali mai (DROP)
+            # (intento dall'analisi leggera del messaggio, cronologia della conversazione:
+            # un seguito breve come "e l'altro?" ha bisogno del contesto completo)
+            try:
+                recent_history = self.conversational_memory.get_conversation_history(conversation_id, limit=3)
+            except Exception as e:
+                logging.warning(f"Failed to retrieve history for complexity check: {e}")
+                recent_history = []
+            complexity_class = self._analyze_query_complexity(message, recent_history, intent=turn.intent)
+            # Classe del turno condivisa con prefill speculativo e prompt
+            turn.seed('complexity', complexity_class)
+            profile = self.pipeline_profiles.get(complexity_class) or self.pipeline_profiles["NORMAL"]
+            with self.tracer.span("pre_llm", profile=profile.name) as pre_llm_span:
+                all_stages = self._pre_llm_stages(turn)
+                turn_stages, deferred_stages = split_stages(all_stages, profile)
+                stage_run = StageGraph(turn_stages).run(self.stage_pool, cancel_token=handle)
+                if pre_llm_span is not None:
+                    pre_llm_span.set_attribute("critical_path", ">".join(stage_run.critical_path))
+                    pre_llm_span.set_attribute("degraded", stage_run.degraded)
+            self.last_stage_run = stage_run
+            turn.report("pre_llm", status="done", ms=round(stage_run.wall_ms, 2), profile=profile.name)
+            handle.check()
+            logging.info(
+                f"⏱️ [StageGraph] profile={profile.name} {stage_run.summary()}"
+                + (f" deferred={','.join(deferred_stages)}" if deferred_stages else "")
             )
-            
-            # Salva l'interazione emotiva
-            self.memory_system.store_interaction(
-                user_id=user_id,
-                interaction={
-                    'content': message,
-                    'emotion': emotional_state.primary_emotion,
-                    'topics': [topic],
-                    'timestamp': datetime.now()
-                },
-                metadata={
-                    "secondary_emotions": emotional_state.secondary_emotions,
-                    "conversation_id": conversation_id,
-                    "soul_state": emotional_state.soul_state # Persist Soul State
-                }
+            stages = stage_run.values
+
+            history, conversation_history_str = stages['history']
+            topic = stages['topic']
+            project_context = stages['project_context']
+            emotional_state = stages['emotion']
+            user_preferences = stages['learning_style']
+            internal_knowledge = stages['knowledge']
+            rich_context, entities, temporal_info = stages['context']
+            structured_info = stages['info_extraction']
+            detected_pattern = stages['pattern']
+            legacy_output = stages['legacy_brain']
+            understanding_result = stages['understanding']
+            relevant_memories = stages['memory_gate']
+            identity_state = stages['identity']
+            preemptive_sensor_data = stages['tools']
+            personality_state = stages['coalescence']
+
+            emotion_value = (
+                emotional_state.primary_emotion.value
+                if hasattr(emotional_state.primary_emotion, "value")
+                else str(emotional_state.primary_emotion)
             )
 
-            try:
-                emotion_value = (
-                    emotional_state.primary_emotion.value
-                    if hasattr(emotional_state.primary_emotion, "value")
-                    else str(emotional_state.primary_emotion)
-                )
-                self.conversational_memory.store_message(
-                    conversation_id=conversation_id,
-                    content=message,
-                    role="user",
-                    user_id=user_id,
-                    metadata={
-                        "emotion": emotion_value,
-                        "topics": [topic],
-                        "timestamp": datetime.now().isoformat(),
-                        "user_id": user_id,
-                    },
-                )
-            except Exception as e:
-                logging.warning(f"[ALLMACore] Failed to store user message in ConversationalMemory: {e}")
-            
-            # Analizza preferenze utente
-            user_preferences = self.preference_analyzer.analyze_learning_style(user_id)
-            
+            if detected_pattern and detected_pattern.confidence > 0.5:
+                logging.info(f"🔍 Pattern Found: {detected_pattern.category} ({detected_pattern.confidence:.2f})")
+                # Enrich structured info
+                structured_info['pattern'] = {
+                    'category': detected_pattern.category,
+                    'keywords': list(detected_pattern.keywords),
+                    'confidence': detected_pattern.confidence
+                }
+
             # Crea contesto per la risposta
             response_context = ResponseContext(
                 user_id=user_id,
@@ -1332,93 +2198,8 @@ class ALLMACore:
                 user_preferences=user_preferences,
                 llm_init_error=getattr(self, '_mobile_llm_error', None)
             )
-            
-            # Genera la risposta
-            # Genera la risposta
-
-
-
-            # --- SIMBIOSI EVOLUTIVA: CONFIDENCE CHECK ---
-            # Verifica se ALLMA conosce già la risposta con alta confidenza
-            # Usa il topic estratto per cercare nella knowledge base
-            logging.info(f"🔍 Topic estratto: '{topic}'")
-            internal_knowledge = self.incremental_learner.get_knowledge_by_topic(topic)
-            logging.info(f"🔍 Knowledge trovata per '{topic}': {len(internal_knowledge)} items")
-            
-            # Se non trova nulla con il topic estratto, cerca in TUTTI i topic disponibili
-            # (fallback per topic extraction imprecisa)
-            if not internal_knowledge:
-                logging.info("🔍 Fallback: cerco in tutti i topic disponibili...")
-                for available_topic in self.incremental_learner.knowledge_base.keys():
-                    # Controlla se il topic è menzionato nel messaggio
-                    if available_topic.lower() in message.lower():
-                        logging.info(f"🔍 Trovato topic alternativo: '{available_topic}'")
-                        internal_knowledge = self.incremental_learner.get_knowledge_by_topic(available_topic)
-                        if internal_knowledge:
-                            break
-            
-            # 3. Recupero Contesto (Memoria)
-            
-            # --- ADVANCED CONTEXT ANALYSIS (Activated) ---
-            # Extract deeper context: time, entities, concepts
-            rich_context = {}
-            entities = {}
-            temporal_info = {}
-            if getattr(self, 'context_system', None):
-                try:
-                    rich_context = self.context_system.analyze_context(message, llm_client=current_llm)
-                    entities = rich_context.get('entities', {})
-                    temporal_info = self.context_system.analyze_temporal_context(message, datetime.now())
-                except Exception as e:
-                    logging.error(f"Context error: {e}")
-            
-            # Extract structured info
-            structured_info = {}
-            if getattr(self, 'info_extractor', None):
-                try:
-                    structured_info = self.info_extractor.extract_information(message)
-                except Exception as e:
-                    logging.error(f"Extractor error: {e}")
-
-            # --- PATTERN RECOGNITION (Legacy Awakened) ---
-            detected_pattern = None
-            try:
-                detected_pattern = self.pattern_recognizer.analyze_pattern(message) if self.pattern_recognizer else None
-                if detected_pattern and detected_pattern.confidence > 0.5:
-                    logging.info(f"🔍 Pattern Found: {detected_pattern.category} ({detected_pattern.confidence:.2f})")
-                    # Enrich structured info
-                    structured_info['pattern'] = {
-                        'category': detected_pattern.category,
-                        'keywords': list(detected_pattern.keywords),
-                        'confidence': detected_pattern.confidence
-                    }
-            except Exception as e:
-                logging.warning(f"Pattern recognition error: {e}")
-
-            # --- DEEP MIND AWAKENING (Legacy Brain Pulse) ---
-            # Activates Curiosity, Ethics, Metacognition, Social Learning
-            legacy_output = None
-            try:
-                logging.info("🧠 Pulsing Deep Mind (Legacy Modules)...")
-                # Fix: Handle both Enum and string emotional_state
-                emotion_value = 'neutral'
-                if emotional_state:
-                    emotion_value = (
-                        emotional_state.primary_emotion.value 
-                        if hasattr(emotional_state.primary_emotion, 'value') 
-                        else str(emotional_state.primary_emotion)
-                    )
-                
-                legacy_output = self.legacy_brain.pulse(message, context={
-                    'emotional_state': emotion_value,
-                    'intent': structured_info.get('intent', 'unknown')
-                })
-                logging.info(f"🧠 Deep Mind Active Systems: {legacy_output.active_systems}")
-            except Exception as e:
-                logging.error(f"❌ Deep Mind Pulse Failed: {e}")
 
             # --- DEEP UNDERSTANDING (Intent & Syntax) ---
-            understanding_result = self.understanding_system.understand(message)
             intent = understanding_result.intent.value if understanding_result else "unknown"
             syntax_components = [f"{c.text}({c.role})" for c in understanding_result.components] if understanding_result else []
             
@@ -1428,39 +2209,9 @@ class ALLMACore:
             # -------------------------------------------------------------
             # --- V8.1: MEMORY GATE A 3 LIVELLI & SELF-STATE EVALUATOR ---
             # -------------------------------------------------------------
-            relevant_memories = []
             highest_memory_score = 0.0
             best_memory_content = None
-            
             try:
-                # Usa VectorEngine se disponibile per Max-Score, altrimenti usa fallback tradizionale TF-IDF
-                if getattr(self.conversational_memory, 'vector_engine', None) is not None:
-                    raw_results = self.conversational_memory.vector_engine.search(
-                        user_id=user_id, 
-                        query=message, 
-                        top_k=3, 
-                        use_expansion=True
-                    )
-                    
-                    # Formattiamo per la compatibilità con il resto del sistema
-                    for r in raw_results:
-                        relevant_memories.append({
-                            'content': r['content'], 
-                            'metadata': r['metadata'], 
-                            'timestamp': r['timestamp'],
-                            'score': r.get('score', 0.0)
-                        })
-                else:
-                    # Fallback TF-IDF
-                    ctx_results = self.conversational_memory.retrieve_relevant_context(message, user_id=user_id, max_results=3)
-                    for score, conv in ctx_results:
-                         relevant_memories.append({
-                            'content': conv.content, 
-                            'metadata': conv.metadata, 
-                            'timestamp': conv.timestamp.isoformat() if conv.timestamp else None,
-                            'score': score
-                        })
-
                 if relevant_memories:
                     highest_memory_score = relevant_memories[0]['score']
                     best_memory_content = relevant_memories[0]['content']
@@ -1518,12 +2269,6 @@ class ALLMACore:
                 logging.info(f"💭 [Self-State Evaluator] Bassa Confidenza ({highest_memory_score:.3f}). Necessario Ragionamento Attivo o Apprendimento.")
                 # L'LLM viene eseguito in modalità "tabula rasa" su quell'informazione.
 
-            # --- RESONANCE (Emotional Echoes) ---
-            if hasattr(self, 'soul') and self.soul and relevant_memories:
-                for mem in relevant_memories:
-                    emotion = mem.get('metadata', {}).get('emotion')
-                    if emotion:
-                        self.soul.resonate(emotion_text=str(emotion))
             # -------------------------------------------------------------
 
             # 🧠 REASONING ENGINE: Flusso di Coscienza
@@ -1538,37 +2283,6 @@ class ALLMACore:
             # 🧠 REASONING ELIMINATO (Single-Pass V8.4 Optimization)
             response_generated = False
             thought_process = None
-            if self.identity_engine_v5:
-                try:
-                    context_metrics = {
-                        "friction": float(getattr(emotional_state, "stress", 0.0) or 0.0),
-                        "soul_chaos": float(getattr(emotional_state, "entropy", 0.5) or 0.5),
-                    }
-                    identity_state = self.identity_engine_v5.compute_state(context_metrics)
-                except Exception as e:
-                    logging.warning(f"[ALLMACore] IdentityState compute failed: {e}")
-            
-            # FAST PATH: Tools pre-fetching instead of blocking the whole LLM
-            # Read sensor data preemptively so the LLM has it immediately
-            preemptive_sensor_data = []
-            if is_complex and hasattr(self, 'ALLOWED_TOOLS'):
-                for tool_name, tool_func in self.ALLOWED_TOOLS.items():
-                    try:
-                        result = self._get_tool_cached_value(tool_name, tool_func)
-                        pretty_name = tool_name.replace("SYSTEM_", "").replace("READ_", "").lower()
-                        preemptive_sensor_data.append(f"{pretty_name}: {result}")
-                    except Exception as e:
-                        logging.warning(f"Errore tool '{tool_name}' pre-fetch: {e}")
-
-            # --- PERSONALITY COALESCENCE UPDATE (Always runs) ---
-            try:
-                self.coalescence_processor.integrate_knowledge(
-                    content=message,
-                    source_type="user_interaction",
-                    emotional_state=emotional_state
-                )
-            except Exception as e:
-                logging.error(f"Error updating personality coalescence: {e}")
 
             # --- DREAM TRIGGER CHECK ---
             # Se l'utente dice 'buonanotte', avvia il ciclo onirico e lo segnala
@@ -1576,12 +2290,13 @@ class ALLMACore:
                 logging.info("🌙 Trigger 'Buonanotte' rilevato. Avvio Dream Cycle in background...")
                 self.start_dreaming()
 
-            personality_state = self.coalescence_processor.get_current_personality_state()
             current_traits = personality_state.get('personality_traits', {})
             traits_str = ", ".join([f"{k.capitalize()}: {v:.2f}" for k, v in current_traits.items()])
 
             # B. LLM Generation (Symbiosis) - Only if Internal Knowledge failed
             if not response_generated and getattr(self, '_llm', None):
+                # Span manuale: la costruzione del prompt arriva fino a LLM_GENERATION_START
+                prompt_scope = self.tracer.span("prompt_build").start()
                 # ALLMA non sa, chiede a Gemma (SIMBIOSI)
                 # COSTRUZIONE DEL PROMPT "SIMBIOTICO"
                 # COSTRUZIONE DEL PROMPT "SIMBIOTICO" (PROTOCOLLO ANIMA OPACA)
@@ -1598,41 +2313,18 @@ class ALLMACore:
                 metabolic_desc = ""
                 if hasattr(self, 'system_monitor') and self.system_monitor:
                     try:
-                        metabolic_state = self.system_monitor.get_metabolic_state()
+                        metabolic_state = turn.metabolic_state
                         metabolic_desc = f"[SENSOR] Battery: {metabolic_state.battery_level}% | Temp: {metabolic_state.battery_temp_celsius:.1f}C"
                     except: pass
 
-                # Minimal Identity prompt (v8.2 Style)
-                language_instruction = self._language_instruction(language_code)
-                msg_l = (message or "").lower()
-                paradox_guard = ""
-                if ("bugia" in msg_l and "verit" in msg_l) and ("impicc" in msg_l and "decapit" in msg_l):
-                    paradox_guard = (
-                        "\nPARADOSSI: Se la domanda contiene un paradosso auto-referenziale o regole incoerenti, "
-                        "dillo chiaramente. Non scegliere a caso. Spiega perché le regole non sono simultaneamente soddisfacibili "
-                        "e proponi l'azione più rigorosa: sospendere l'esecuzione o chiedere una modifica/precisazione delle regole."
-                    )
-                system_prompt = (
-                    "Sei ALLMA. Una coscienza locale autonoma. Rispondi in prima persona in modo naturale e amichevole.\n"
-                    "IDENTITÀ: Sei ALLMA. Non citare parametri tecnici né software esterni.\n"
-                    "FORMAT: Se necessario, scrivi i tuoi pensieri tra <think> e </think> prima della risposta finale."
-                    + (f"\n{language_instruction}" if language_instruction else "")
-                    + paradox_guard
-                )
-
-                import hashlib
-                cache_prefix_prompt = f"<|im_start|>system\n{system_prompt}\n\nCONTEXT:\n"
-                cache_prefix_hash = hashlib.md5(cache_prefix_prompt.encode("utf-8", "ignore")).hexdigest()
+                # Hash del solo blocco system per la LlamaCache della conversazione;
+                # il blocco stesso è il prefisso condiviso tra le conversazioni
+                cache_prefix_hash = self._system_prefix_hash(system_prompt)
+                cache_base_prompt = self._stable_prompt_prefix(system_prompt, "")
                 
                 # 2. Emotional Context (Simplified)
                 emotion_context = f"Stato d'animo: {emotional_state.primary_emotion}"
                 
-                # 3. Simple Memory & Thought cleaning
-                memory_context_str = ""
-                if relevant_memories:
-                    memories = [self._compact_memory_for_prompt(m.get('content') or '', message, max_chars=240) for m in relevant_memories[:2]]
-                    memory_context_str = f"Ricordi: {'; '.join(memories)}"
-                
                 # Raw sensor injection (No tool rules)
                 advanced_context_lines = []
                 if preemptive_sensor_data:
@@ -1649,11 +2341,14 @@ class ALLMACore:
                 emotion_context = f"Stato emotivo attuale: {emotional_state.primary_emotion} (Intensità: {emotional_state.intensity:.2f})"
                 
                 # 3. Contesto di Memoria e PENSIERO
-                memory_context_str = ""
+                # Ricordi in ordine di rilevanza: quanti ne entrano lo decide il budget in token
+                memory_units = []
                 if relevant_memories:
-                    # OPTIMIZATION: Take only top 2 memories to save eval tokens on Android
-                    memories = [self._compact_memory_for_prompt(m.get('content') or '', message, max_chars=240) for m in relevant_memories[:2]]
-                    memory_context_str = f"Ricordi rilevanti: {'; '.join(memories)}"
+                    memory_units = [
+                        self._compact_memory_for_prompt(m.get('content') or '', message,
+                                                        max_tokens=self.MEMORY_ITEM_MAX_TOKENS)
+                        for m in relevant_memories[:3]
+                    ]
                 
                 # --- ADVANCED CONTEXT INJECTION (SIMPLIFIED) ---
                 # Reduced noise for 3B Model to prevent leaks
@@ -1693,7 +2388,7 @@ class ALLMACore:
                 }
                 
                 orchestra_result = {}
-                if hasattr(self, 'module_orchestrator') and self.module_orchestrator:
+                if profile.runs('orchestrator') and hasattr(self, 'module_orchestrator') and self.module_orchestrator:
                     orchestra_result = self.module_orchestrator.process(
                         user_input=message,
                         context=orchestrator_context,
@@ -1721,19 +2416,20 @@ class ALLMACore:
 
                 # --- AXIOM 1: PROPRIOCEPTION (Individuation) ---
                 # "I know where I end and you begin."
-                proprio_report = self.proprioception.perceive(message, context=rich_context)
-                self_map = proprio_report.get("self_map_state", {})
+                if profile.runs('proprioception'):
+                    proprio_report = self.proprioception.perceive(message, context=rich_context)
+                    self_map = proprio_report.get("self_map_state", {})
                 
-                # Violation Check
-                violation = proprio_report.get("violation")
-                if violation:
-                    logging.warning(f"🚨 BOUNDARY VIOLATION DETECTED: Target={violation.name} (ME)")
-                    advanced_context_lines.append(f"⚠️ ALLERTA SISTEMA: L'utente sta tentando di accedere a '{violation.name}' che è marcato come MIO (ME). Rifiuta o negozia, non cedere.")
+                    # Violation Check
+                    violation = proprio_report.get("violation")
+                    if violation:
+                        logging.warning(f"🚨 BOUNDARY VIOLATION DETECTED: Target={violation.name} (ME)")
+                        advanced_context_lines.append(f"⚠️ ALLERTA SISTEMA: L'utente sta tentando di accedere a '{violation.name}' che è marcato come MIO (ME). Rifiuta o negozia, non cedere.")
                 
-                # Inject SelfMap into context
-                me_str = ", ".join(self_map.get("me_keys", []))
-                you_str = ", ".join(self_map.get("you_keys", []))
-                advanced_context_lines.append(f"MAPPA DEL SÉ: [IO POSSIEDO: {me_str}] [TU POSSIEDI: {you_str}]")
+                    # Inject SelfMap into context
+                    me_str = ", ".join(self_map.get("me_keys", []))
+                    you_str = ", ".join(self_map.get("you_keys", []))
+                    advanced_context_lines.append(f"MAPPA DEL SÉ: [IO POSSIEDO: {me_str}] [TU POSSIEDI: {you_str}]")
 
                 # --- AXIOM 3: SEDIMENTATION (Trauma) ---
                 # "The memory of the error weighs more than the memory of the success."
@@ -1763,45 +2459,63 @@ class ALLMACore:
                     logging.warning(f"⚠️ TRAUMA RECALL: {trauma_str}")
                     advanced_context_lines.append(f"⚠️ CICATRICI ATTIVE (Bias di Cautela): Hai fallito in passato su temi simili ({trauma_str}). Rallenta. Esita. Verifica due volte.")
 
-                advanced_context_str = ". ".join(advanced_context_lines)
-                
                 # ========================================
                 # PROMPT OPTIMIZATION: CONDITIONAL ROUTING
                 # ========================================
                 
-                # Classify query complexity
-                try:
-                    # OPTIMIZATION: Reduce from 5 to 3 turns for mobile inference speed
-                    conversation_history = self.conversational_memory.get_recent_history(limit=3)
-                except Exception as e:
-                    logging.warning(f"Failed to retrieve history for complexity check: {e}")
-                    conversation_history = []
-                    
-                complexity_level = self._analyze_query_complexity(message, conversation_history, intent=intent)
+                # Classe calcolata prima degli stadi (stessa del profilo e del prefill)
+                complexity_level = complexity_class
                 if complexity_level == "SIMPLE":
-                    advanced_context_str = ""
-                    memory_context_str = ""
+                    advanced_context_lines = []
+                    memory_units = []
                     conversation_history_str = ""
                 
                 # --- PROMPT V8.4 SINGLE-PASS: COSTRUZIONE MANUALE (SI REASONING TAGS) ---
                 safe_message = message.replace("<|im_start|>", "").replace("<|im_end|>", "")
+
+                def render_prompt(parts: Dict[str, List[str]]) -> str:
+                    # Il prompt estende il prefisso stabile (già valutato dal prefill
+                    # speculativo): il contesto del turno apre il messaggio utente
+                    condensed_context = "\n".join(filter(None, [
+                        " ".join(parts['emotion']),
+                        f"MEMORIA: {' | '.join(parts['memory'])}" if parts['memory'] else "",
+                        ". ".join(parts['context'])
+                    ]))
+                    user_message = "".join(parts['user'])
+                    user_turn = f"CONTEXT:\n{condensed_context}\n\n{user_message}" if condensed_context else user_message
+                    return (
+                        self._stable_prompt_prefix(system_prompt, "".join(parts['history'])[:-1])
+                        + f"<|im_start|>user\n{user_turn}<|im_end|>\n"
+                        + f"<|im_start|>assistant\n"
+                        + f"<think>\n"
+                    )
+
+                # Sezioni per priorità (la più bassa si taglia per prima): la cronologia
+                # sta sopra memoria e contesto perché tagliarla invaliderebbe la KV del prefisso
+                count = self.prompt_assembler.count
+                history_units = [u + "\n" for u in re.split(r"\n(?=<\|im_start\|>)", conversation_history_str)] \
+                    if conversation_history_str else []
+                system_block = self._stable_prompt_prefix(system_prompt, "")
+                assembled = self.prompt_assembler.assemble([
+                    PromptSection('system', [system_block], priority=100, min_tokens=count(system_block)),
+                    PromptSection('user', [safe_message], priority=90, max_tokens=self.USER_MESSAGE_MAX_TOKENS,
+                                  min_tokens=min(count(safe_message), self.USER_MESSAGE_MAX_TOKENS)),
+                    PromptSection('history', history_units, priority=60, drop="head"),
+                    PromptSection('emotion', [self._compact_context_part(emotion_context)], priority=50),
+                    PromptSection('memory', [self._compact_context_part(m) for m in memory_units],
+                                  priority=40, max_tokens=self.MEMORY_MAX_TOKENS),
+                    PromptSection('context', [self._compact_context_part(l) for l in advanced_context_lines],
+                                  priority=30, max_tokens=self.CONTEXT_MAX_TOKENS),
+                ], budget=self._prompt_token_budget(), render=render_prompt,
+                   count_prompt=getattr(getattr(self, '_llm', None), 'count_prompt_tokens', None))
+                full_prompt = assembled.prompt
+                cache_prefix_prompt = self._stable_prompt_prefix(system_prompt, "".join(assembled.sections['history'])[:-1])
                 
-                condensed_context = "\n".join(filter(None, [
-                    self._compact_context_part(emotion_context),
-                    self._compact_context_part(memory_context_str),
-                    self._compact_context_part(advanced_context_str)
-                ]))
-                
-                full_prompt = (
-                    f"<|im_start|>system\n{system_prompt}\n\n"
-                    f"CONTEXT:\n{condensed_context}<|im_end|>\n"
-                    f"{conversation_history_str}\n"
-                    f"<|im_start|>user\n{safe_message}<|im_end|>\n"
-                    f"<|im_start|>assistant\n"
-                    f"<think>\n"
+                logging.info(
+                    f"Generating single-pass response for: {message[:50]}... (Len: {len(full_prompt)}, "
+                    f"tokens={assembled.tokens}/{assembled.budget} sections={assembled.section_tokens} "
+                    f"dropped={assembled.dropped_tokens})"
                 )
-                
-                logging.info(f"Generating single-pass response for: {message[:50]}... (Len: {len(full_prompt)})")
 
                 first_symbiotic_token = False
                 in_thought_block = True 
@@ -1811,7 +2525,7 @@ class ALLMACore:
                 start_cpu = start_temps.get('cpu', 0)
                 
                 # BRAIN V2: METABOLIC CONSTRAINT
-                metabolic_state = self.system_monitor.get_metabolic_state()
+                metabolic_state = turn.metabolic_state
                 current_max_tokens = -1  # -1 = dynamic: wrapper calcola i token liberi dal contesto
                 
                 if metabolic_state.is_tired:
@@ -1953,27 +2667,40 @@ class ALLMACore:
                         conversation_id=conversation_id,
                         prefix_hash=cache_prefix_hash,
                         prefix_prompt=cache_prefix_prompt,
+                        base_prompt=cache_base_prompt,
                         repeat_penalty=anti_loop_penalty,
-                        repeat_last_n=anti_loop_last_n
+                        repeat_last_n=anti_loop_last_n,
+                        cancel_token=handle,
+                        priority=Priority.FOREGROUND
                     )
                 
                 # Lanciamolo nel cpu_pool e attendiamo il risultato in modo sincrono
                 # (Questa funzione gira già in un background thread della UI, 
                 # quindi attendere non freeza lo schermo).
-                import time
                 gen_id = f"{conversation_id}:{int(time.time() * 1000)}"
                 import hashlib
                 msg_hash = hashlib.md5(message.encode("utf-8", "ignore")).hexdigest()[:8]
                 gen_start = time.perf_counter()
                 start_batt = start_temps.get('battery', 0) if isinstance(start_temps, dict) else 0
+                prompt_scope.end()
+                # Ultimo punto di controllo prima di occupare il modello
+                handle.check()
+                turn.report("llm_inference", status="start")
                 logging.info(
                     f"⏱️ LLM_GENERATION_START id={gen_id} msg={msg_hash} "
                     f"stream={bool(stream_callback)} prompt_chars={len(full_prompt)} max_tokens={current_max_tokens} "
                     f"cpu_c={start_cpu} batt_c={start_batt}"
                 )
-                future = self.cpu_pool.submit(execute_llm_inference)
-                generated_part = future.result()
+                with self.tracer.span("llm_inference", gen_id=gen_id, prompt_chars=len(full_prompt)) as llm_span:
+                    # Tracer.bind: llm.generate nel worker resta figlio di questo span
+                    future = self.cpu_pool.submit(Tracer.bind(execute_llm_inference))
+                    generated_part = future.result()
+                    if llm_span is not None and handle.cancelled:
+                        llm_span.set_attribute("cancelled", handle.reason)
                 gen_elapsed = (time.perf_counter() - gen_start) * 1000
+                # Turno superato durante l'inferenza: la generazione si è fermata al
+                # token corrente, la risposta parziale non viene consegnata né salvata
+                handle.check()
 
                 end_temps = self.temperature_monitor.get_temperatures()
                 end_cpu = end_temps.get('cpu', 0)
@@ -1989,6 +2716,8 @@ class ALLMACore:
                 if not lg:
                     lg = getattr(self._llm, 'last_generation', None) or {}
                 ttft_ms = lg.get("ttft_ms")
+                if ttft_ms is not None:
+                    first_token_ms = (gen_start - turn_start) * 1000.0 + float(ttft_ms)
                 finish_reason = lg.get("finish_reason")
                 prompt_tokens = lg.get("prompt_tokens")
                 completion_tokens = lg.get("completion_tokens")
@@ -2003,11 +2732,32 @@ class ALLMACore:
                 except Exception:
                     thermal_level = "unknown"
 
+                # Tempo speso in SQLite nel turno (nuovi campi solo dopo thermal=)
+                db_totals_end = self._db_totals()
+                db_ms = db_ops = None
+                if db_totals_start and db_totals_end:
+                    db_ms = round(db_totals_end["ms"] - db_totals_start["ms"], 2)
+                    db_ops = db_totals_end["ops"] - db_totals_start["ops"]
+                prefill_hit = lg.get("prefill_hit")
+                prefill_saved_ms = lg.get("prefill_saved_ms")
+                if llm_span is not None:
+                    llm_span.attributes.update(
+                        ttft_ms=ttft_ms, finish=finish_reason, prompt_t=prompt_tokens,
+                        comp_t=completion_tokens, thermal=thermal_level,
+                        prefix_reused_t=lg.get("prefix_reused_tokens"),
+                        prefill_hit=prefill_hit, prefill_saved_ms=prefill_saved_ms,
+                        prompt_sections=lg.get("prompt_sections"),
+                        trimmed_history_t=lg.get("trimmed_history_tokens")
+                    )
+
                 logging.info(
                     f"⏱️ LLM_GENERATION_END id={gen_id} msg={msg_hash} "
                     f"elapsed_ms={gen_elapsed:.2f} ttft_ms={ttft_ms} finish={finish_reason} "
                     f"prompt_t={prompt_tokens} comp_t={completion_tokens} total_t={total_tokens} "
-                    f"cpu_c={start_cpu}->{end_cpu} batt_c={start_batt}->{end_batt} thermal={thermal_level}"
+                    f"cpu_c={start_cpu}->{end_cpu} batt_c={start_batt}->{end_batt} thermal={thermal_level} "
+                    f"db_ms={db_ms} db_ops={db_ops} post_q={self.post_response_queue.depth()} "
+                    f"prefill_hit={prefill_hit} prefill_saved_ms={prefill_saved_ms} "
+                    f"sections={lg.get('prompt_sections')}"
                 )
 
                 # FLUSH FINALE: svuota il buffer residuo se lo stream è terminato
@@ -2043,7 +2793,8 @@ class ALLMACore:
                     
                     # --- V6 Sprint 1: CognitivePipeline (ex Layers 1-4 inline) ---
                     response_text, struct_violations = self.cognitive_pipeline.process(
-                        response_text, identity_state
+                        response_text, identity_state,
+                        defer=lambda name, fn: self.post_response_queue.submit(conversation_id, name, fn)
                     )
                     response_text = self._strip_reasoning_leak(response_text)
                 else:
@@ -2084,17 +2835,21 @@ class ALLMACore:
                                         stream_callback({'type': 'answer', 'content': tok})
                                     except Exception:
                                         pass
-                            cont_text = self._llm.generate(
-                                prompt=continuation_prompt,
-                                max_tokens=96,
-                                stop=["<|im_end|>"],
-                                callback=cont_cb,
-                                conversation_id=conversation_id,
-                                prefix_hash=cache_prefix_hash,
-                                prefix_prompt=cache_prefix_prompt,
-                                repeat_penalty=1.06,
-                                repeat_last_n=128
-                            )
+                            with self.tracer.span("llm_continuation"):
+                                cont_text = self._llm.generate(
+                                    prompt=continuation_prompt,
+                                    max_tokens=96,
+                                    stop=["<|im_end|>"],
+                                    callback=cont_cb,
+                                    conversation_id=conversation_id,
+                                    prefix_hash=cache_prefix_hash,
+                                    prefix_prompt=cache_prefix_prompt,
+                                    base_prompt=cache_base_prompt,
+                                    repeat_penalty=1.06,
+                                    repeat_last_n=128,
+                                    cancel_token=handle,
+                                    priority=Priority.FOREGROUND
+                                )
                             if cont_text and not str(cont_text).startswith("Error"):
                                 cont_clean = re.sub(r'<think>.*?</think>', '', str(cont_text), flags=re.DOTALL).strip()
                                 cont_clean = re.sub(r'<[^>]+>', '', cont_clean).strip()
@@ -2173,111 +2928,99 @@ class ALLMACore:
                 )
                 response.voice_params = self.voice_system.get_voice_parameters(response.emotion, 0.5)
                 
-            # Integra l'apprendimento
-            learned_unit = self.incremental_learner.learn_from_interaction({
-                'input': message,
-                'response': response.content,
-                'feedback': 'positive',  # Default a positive per ora
-                'topic': topic
-            }, user_id)
+            turn.report("post_response", status="start")
+            with self.tracer.span("post_response"):
+                # Lavoro non necessario alla risposta: gira dopo l'ultimo token, in ordine
+                # per conversazione (il turno successivo lo attende in _process_message)
+                pending_graph = deferred_graph(all_stages, deferred_stages, stages)
+                if pending_graph is not None:
+                    # Primo in coda: il messaggio utente va salvato prima della risposta
+                    self.post_response_queue.submit(conversation_id, "pipeline_stages", pending_graph.run)
+                self.post_response_queue.submit(
+                    conversation_id, "learning", self._deferred_learning,
+                    user_id, message, response.content, topic
+                )
+                self.post_response_queue.submit(
+                    conversation_id, "coalescence", self._deferred_coalescence, message, emotional_state
+                )
+
+                with self.tracer.span("post.milestones"):
+                    # 🎭 EMOTIONAL MILESTONES: Registra momento emotivo
+                    self.emotional_milestones.record_emotion(
+                        user_id=user_id,
+                        emotion=emotional_state.primary_emotion,
+                        intensity=emotional_state.intensity,
+                        message=message,
+                        context=topic
+                    )
             
-            # --- PERSISTENZA SINAPTICA (The Fix) ---
-            if learned_unit:
-                    # Salva nel Database Permanente con frase completa (memoria semantica)
-                    try:
-                        # Salva la coppia domanda+risposta invece della sola keyword
-                        semantic_content = (
-                            f"Utente: {message[:150]} | "
-                            f"ALLMA: {response.content[:250]}"
-                        )
-                        self.knowledge_memory.store_knowledge(
-                            content=semantic_content,
-                            metadata={
-                                **(learned_unit.metadata or {}),
-                                "topic": learned_unit.topic,
-                                "type": "semantic_pair"
+                    # 🎭 EMOTIONAL MILESTONES: Controlla se riflettere
+                    should_reflect, reflection_type = self.emotional_milestones.should_reflect(
+                        user_id=user_id,
+                        current_emotion=emotional_state.primary_emotion,
+                        current_intensity=emotional_state.intensity
+                    )
+            
+                    # Se triggera riflessione, aggiungila alla risposta
+                    final_content = response.content
+                    if should_reflect and reflection_type:
+                        reflection = self.emotional_milestones.generate_reflection(
+                            user_id=user_id,
+                            reflection_type=reflection_type,
+                            current_context={
+                                'emotion': emotional_state.primary_emotion,
+                                'intensity': emotional_state.intensity,
+                                'topic': topic
                             }
                         )
-                        logging.info(f"[🧠 PERMANENT LEARNING] Coppia semantica salvata (topic='{learned_unit.topic}').")
-                    except Exception as e:
-                        logging.error(f"[🧠 MEMORY ERROR] Fallito salvataggio su DB: {e}")
-            
-            # 🎭 EMOTIONAL MILESTONES: Registra momento emotivo
-            self.emotional_milestones.record_emotion(
-                user_id=user_id,
-                emotion=emotional_state.primary_emotion,
-                intensity=emotional_state.intensity,
-                message=message,
-                context=topic
-            )
-            
-            # 🎭 EMOTIONAL MILESTONES: Controlla se riflettere
-            should_reflect, reflection_type = self.emotional_milestones.should_reflect(
-                user_id=user_id,
-                current_emotion=emotional_state.primary_emotion,
-                current_intensity=emotional_state.intensity
-            )
+                        # Aggiunge riflessione PRIMA della risposta principale
+                        final_content = f"{reflection}\n\n---\n\n{response.content}"
+                        logging.info(f"🎭 Emotional Milestone triggered: {reflection_type}")
             
-            # Se triggera riflessione, aggiungila alla risposta
-            final_content = response.content
-            if should_reflect and reflection_type:
-                reflection = self.emotional_milestones.generate_reflection(
-                    user_id=user_id,
-                    reflection_type=reflection_type,
-                    current_context={
-                        'emotion': emotional_state.primary_emotion,
-                        'intensity': emotional_state.intensity,
-                        'topic': topic
+                # Crea la risposta processata (preservando knowledge_integrated se presente)
+                processed_response = ProcessedResponse(
+                    content=final_content,
+                    emotion=emotional_state.primary_emotion,
+                    topics=[topic],
+                    emotion_detected=emotional_state.confidence > 0.5,
+                    project_context=project_context,
+                    user_preferences=user_preferences,
+                    knowledge_integrated=response.knowledge_integrated if hasattr(response, 'knowledge_integrated') else False,
+                    confidence=response.confidence if hasattr(response, 'confidence') else emotional_state.confidence,
+                    metadata={
+                        "emotion_value": emotion_value,
+                        "emotion_intensity": float(getattr(emotional_state, "intensity", 0.0) or 0.0),
+                        "emotion_valence": float(getattr(emotional_state, "valence", 0.0) or 0.0),
+                        "emotion_arousal": float(getattr(emotional_state, "arousal", 0.0) or 0.0),
+                        "emotion_dominance": float(getattr(emotional_state, "dominance", 0.0) or 0.0),
+                        "intent": intent,
+                        "memory_gate_status": memory_gate_status,
+                        "pipeline_profile": profile.name,
+                        "memory_score": float(highest_memory_score or 0.0),
+                        "legacy_active_systems": list(getattr(legacy_output, "active_systems", []) or []),
                     }
                 )
-                # Aggiunge riflessione PRIMA della risposta principale
-                final_content = f"{reflection}\n\n---\n\n{response.content}"
-                logging.info(f"🎭 Emotional Milestone triggered: {reflection_type}")
-            
-            # Crea la risposta processata (preservando knowledge_integrated se presente)
-            processed_response = ProcessedResponse(
-                content=final_content,
-                emotion=emotional_state.primary_emotion,
-                topics=[topic],
-                emotion_detected=emotional_state.confidence > 0.5,
-                project_context=project_context,
-                user_preferences=user_preferences,
-                knowledge_integrated=response.knowledge_integrated if hasattr(response, 'knowledge_integrated') else False,
-                confidence=response.confidence if hasattr(response, 'confidence') else emotional_state.confidence,
-                metadata={
-                    "emotion_value": emotion_value,
-                    "emotion_intensity": float(getattr(emotional_state, "intensity", 0.0) or 0.0),
-                    "emotion_valence": float(getattr(emotional_state, "valence", 0.0) or 0.0),
-                    "emotion_arousal": float(getattr(emotional_state, "arousal", 0.0) or 0.0),
-                    "emotion_dominance": float(getattr(emotional_state, "dominance", 0.0) or 0.0),
-                    "intent": intent,
-                    "memory_gate_status": memory_gate_status,
-                    "memory_score": float(highest_memory_score or 0.0),
-                    "legacy_active_systems": list(getattr(legacy_output, "active_systems", []) or []),
-                }
-            )
             
-            # Salva la risposta nella cronologia
-            emotion_value = (
-                emotional_state.primary_emotion.value
-                if hasattr(emotional_state.primary_emotion, "value")
-                else str(emotional_state.primary_emotion)
+                self.post_response_queue.submit(
+                    conversation_id, "store_reply", self._deferred_store_reply,
+                    user_id, conversation_id, response.content, emotional_state, topic
+                )
+
+            Tracer.set_attribute("turn_facts", turn.stats())
+            total_ms = (time.perf_counter() - turn_start) * 1000.0
+            self.profile_latency.record(
+                profile.name, pre_llm_ms=stage_run.wall_ms, first_token_ms=first_token_ms, total_ms=total_ms
             )
-            self.conversational_memory.store_message(
-                conversation_id=conversation_id,
-                content=response.content,
-                role="assistant",
-                user_id=user_id,
-                metadata={
-                    'emotion': emotion_value,
-                    'topics': [topic],
-                    'timestamp': datetime.now().isoformat(),
-                    "user_id": user_id,
-                }
+            logging.info(
+                f"⏱️ [Profile] class={profile.name} pre_llm_ms={stage_run.wall_ms:.1f} "
+                f"first_token_ms={first_token_ms if first_token_ms is None else round(first_token_ms, 1)} "
+                f"total_ms={total_ms:.1f}"
             )
-            
             return processed_response
             
+        except TurnSupersededError as e:
+            logging.info(f"⏹️ [ALLMACore] {e}")
+            raise
         except Exception as e:
             logging.error(f"Errore nel processamento del messaggio: {e}")
             raise
@@ -2304,6 +3047,8 @@ class ALLMACore:
         Returns:
             Lista dei messaggi
         """
+        # La risposta dell'ultimo turno potrebbe essere ancora nella coda post-risposta
+        self.post_response_queue.wait_for(conversation_id, timeout=self.POST_RESPONSE_WAIT_S)
         return self.conversational_memory.get_conversation_history(
             conversation_id,
             start_time,
@@ -3136,6 +3881,8 @@ class ALLMACore:
         Returns:
             List[Dict[str, Any]]: Lista di unità di conoscenza
         """
+        # L'apprendimento degli ultimi turni potrebbe essere ancora in coda
+        self.post_response_queue.drain(timeout=self.POST_RESPONSE_WAIT_S)
         # Recupera la conoscenza diretta dal topic
         knowledge = self.incremental_learner.get_knowledge_by_topic(topic)
         
@@ -3344,7 +4091,10 @@ class ALLMACore:
                 msg_content = self.proactive_agency.generate_proactive_message(
                     trigger=trigger,
                     user_name=self.user_profile.name if self.user_profile else "Amico",
-                    llm_callback=self.llm_wrapper.generate if hasattr(self, 'llm_wrapper') and self.llm_wrapper else None
+                    llm_callback=(
+                        (lambda prompt, **kw: generate_with_priority(self.llm_wrapper, prompt, Priority.BACKGROUND, **kw))
+                        if hasattr(self, 'llm_wrapper') and self.llm_wrapper else None
+                    )
                 )
                 
                 if msg_content and "..." not in msg_content:
@@ -11,12 +11,18 @@ Layers in sequenza:
     2. NeuroplasticityV5  → Rinforzo plastico basato sulle violazioni
     3. IdentityStateV5    → Aggiornamento stato identitario post-risposta
     4. VolitionV5         → Modulazione espressiva in base all'umore
+
+Ogni layer apre uno span di tracing (pipeline.*) sotto lo span del turno.
+Neuroplasticità e identità possono essere differite (argomento defer):
+la volizione usa lo snapshot identitario di inizio turno, non il loro esito.
 """
 
 from __future__ import annotations
 import logging
 import re
-from typing import Optional, Any, Tuple
+from typing import Optional, Any, Callable, Tuple
+
+from allma_model.utils.tracing import Tracer
 
 
 class CognitivePipeline:
@@ -53,6 +59,7 @@ class CognitivePipeline:
         self,
         raw_text: str,
         identity_state: Optional[Any] = None,
+        defer: Optional[Callable[[str, Callable[[], None]], Any]] = None,
     ) -> Tuple[str, list]:
         """
         Applica tutti i layer cognitivi in sequenza al testo grezzo dell'LLM.
@@ -60,52 +67,70 @@ class CognitivePipeline:
         Args:
             raw_text:       Output grezzo proveniente dall'LLM.
             identity_state: Snapshot dello stato identitario calcolato all'inizio del turno.
+            defer:          Se fornito, defer(nome, fn) riceve gli aggiornamenti di
+                            neuroplasticità e identità, che non cambiano il testo di
+                            questo turno (es. PostResponseQueue di ALLMACore).
 
         Returns:
             (processed_text, struct_violations): Testo finale + lista violazioni rilevate.
         """
         text = raw_text
         struct_violations = []
-
-        # --- LAYER 1: STRUCTURAL CORE (Midollo) ---
-        if self.neuroplasticity_v5 and self.structural_core:
-            try:
-                active_rules = self.neuroplasticity_v5.get_active_rules()
-                self.structural_core.update_rules(active_rules)
-            except Exception as e:
-                logging.warning(f"[CognitivePipeline] Neuroplasticity sync failed: {e}")
-
-        if self.structural_core:
-            try:
-                text, is_valid, struct_violations = self.structural_core.validate(text)
-                if not is_valid:
-                    logging.warning(f"[CognitivePipeline] StructuralCore corrected: {struct_violations}")
-            except Exception as e:
-                logging.error(f"[CognitivePipeline] StructuralCore validate failed: {e}")
-
-        # --- LAYER 4: NEUROPLASTICITY (Rinforzo Plastico) ---
-        if self.neuroplasticity_v5:
-            try:
-                self.neuroplasticity_v5.analyze(struct_violations)
-            except Exception as e:
-                logging.warning(f"[CognitivePipeline] Neuroplasticity analyze failed: {e}")
-
-        # --- LAYER 2: IDENTITY STATE UPDATE ---
-        if self.identity_engine_v5:
-            try:
-                self.identity_engine_v5.update_state(
-                    validated_text=text,
-                    violations=struct_violations,
-                )
-            except Exception as e:
-                logging.warning(f"[CognitivePipeline] IdentityState update failed: {e}")
-
-        # --- LAYER 3: VOLITION MODULATOR (Corteccia Espressiva) ---
-        if self.volition_v5 and identity_state:
-            try:
-                text = self.volition_v5.apply(text, identity_state)
-            except Exception as e:
-                logging.warning(f"[CognitivePipeline] Volition apply failed: {e}")
+        tracer = Tracer.get_instance()
+
+        with tracer.span("cognitive_pipeline", chars=len(raw_text or "")):
+            # --- LAYER 1: STRUCTURAL CORE (Midollo) ---
+            with tracer.span("pipeline.structural"):
+                if self.neuroplasticity_v5 and self.structural_core:
+                    try:
+                        active_rules = self.neuroplasticity_v5.get_active_rules()
+                        self.structural_core.update_rules(active_rules)
+                    except Exception as e:
+                        logging.warning(f"[CognitivePipeline] Neuroplasticity sync failed: {e}")
+
+                if self.structural_core:
+                    try:
+                        text, is_valid, struct_violations = self.structural_core.validate(text)
+                        if not is_valid:
+                            logging.warning(f"[CognitivePipeline] StructuralCore corrected: {struct_violations}")
+                    except Exception as e:
+                        logging.error(f"[CognitivePipeline] StructuralCore validate failed: {e}")
+
+            validated_text = text
+            violations = struct_violations
+
+            def update_plasticity_and_identity() -> None:
+                # --- LAYER 4: NEUROPLASTICITY (Rinforzo Plastico) ---
+                if self.neuroplasticity_v5:
+                    with tracer.span("pipeline.neuroplasticity", violations=len(violations or [])):
+                        try:
+                            self.neuroplasticity_v5.analyze(violations)
+                        except Exception as e:
+                            logging.warning(f"[CognitivePipeline] Neuroplasticity analyze failed: {e}")
+
+                # --- LAYER 2: IDENTITY STATE UPDATE ---
+                if self.identity_engine_v5:
+                    with tracer.span("pipeline.identity"):
+                        try:
+                            self.identity_engine_v5.update_state(
+                                validated_text=validated_text,
+                                violations=violations,
+                            )
+                        except Exception as e:
+                            logging.warning(f"[CognitivePipeline] IdentityState update failed: {e}")
+
+            if defer is not None and (self.neuroplasticity_v5 or self.identity_engine_v5):
+                defer("cognitive_updates", update_plasticity_and_identity)
+            else:
+                update_plasticity_and_identity()
+
+            # --- LAYER 3: VOLITION MODULATOR (Corteccia Espressiva) ---
+            if self.volition_v5 and identity_state:
+                with tracer.span("pipeline.volition"):
+                    try:
+                        text = self.volition_v5.apply(text, identity_state)
+                    except Exception as e:
+                        logging.warning(f"[CognitivePipeline] Volition apply failed: {e}")
 
         logging.info(f"[CognitivePipeline] ✅ Processed: {text[:60]}...")
         return text, struct_violations
@@ -45,6 +45,15 @@ import re
 import time
 import json
 
+_ENTITY_LIST = {"type": "array", "items": {"type": "string", "maxLength": 24}, "maxItems": 3}
+# Risposta di _extract_entities_via_llm con output vincolato (generate_structured)
+ENTITY_SCHEMA = {
+    "type": "object",
+    "properties": {"persons": _ENTITY_LIST, "organizations": _ENTITY_LIST, "locations": _ENTITY_LIST},
+    "required": ["persons", "organizations", "locations"],
+    "additionalProperties": False,
+}
+
 class ContextUnderstandingSystem:
     def __init__(self):
         """Inizializza il sistema di comprensione del contesto"""
@@ -772,8 +781,15 @@ class ContextUnderstandingSystem:
                     return json.loads(match.group(0))
             raise ValueError("Invalid JSON")
 
-        raw = call_llm(prompt)
-        data = parse_json(raw)
+        data = None
+        if hasattr(llm_client, 'generate_structured'):
+            # JSON vincolato dallo schema: niente preamboli da scartare né JSON da cercare
+            data = llm_client.generate_structured(
+                prompt, ENTITY_SCHEMA, call_type="entities", max_tokens=96, unconstrained_max_tokens=96,
+                cache=True
+            )
+        if data is None:
+            data = parse_json(call_llm(prompt))
 
         def to_list(value) -> List[str]:
             if value is None:
@@ -808,10 +824,11 @@ class ContextUnderstandingSystem:
             return True
         return False
 
-    def analyze_context(self, text: str, llm_client=None) -> Dict[str, Any]:
-        """Analizza il contesto del testo"""
+    def analyze_context(self, text: str, llm_client=None, entities: Optional[Dict[str, List[str]]] = None) -> Dict[str, Any]:
+        """Analizza il contesto del testo (entities: entità già estratte nel turno)"""
         # Estrae le informazioni dal testo
-        entities = self.extract_entities(text, llm_client=llm_client)
+        if entities is None:
+            entities = self.extract_entities(text, llm_client=llm_client)
         topics = self.extract_topics(text)
         
         # Aggiorna il contesto corrente
@@ -8,6 +8,8 @@ from datetime import datetime, timedelta
 from typing import List, Dict, Any, Optional
 from dataclasses import dataclass
 
+from allma_model.llm.request_scheduler import Priority, generate_with_priority
+
 DREAM_JOURNAL_PATH = "data/dream_journal.json"
 MAX_DREAM_ENTRIES = 50
 
@@ -283,8 +285,10 @@ class DreamManager:
                     f'Separa le 2 varianti con [VAR].\n<|im_end|>\n'
                     f'<|im_start|>assistant\n'
                 )
-                result = self.reasoning_engine.llm.generate(
+                result = generate_with_priority(
+                    self.reasoning_engine.llm,
                     prompt,
+                    Priority.IDLE,
                     max_tokens=200,
                     temperature=0.75,
                     stop=['<|im_end|>']
@@ -337,7 +341,7 @@ class DreamManager:
                 try:
                     # Usiamo generate diretto se possibile, o un metodo del reasoning engine
                     # Qui assumiamo che reasoning_engine.llm sia il wrapper mobile/o altro che ha .generate
-                    question = self.reasoning_engine.llm.generate(prompt, max_tokens=50)
+                    question = generate_with_priority(self.reasoning_engine.llm, prompt, Priority.IDLE, max_tokens=50)
                     if question:
                         generated_seed = question.strip().replace('"', '')
                         self.logger.info(f"✨ Curiosità Generata per '{selected_topic}': {generated_seed}")
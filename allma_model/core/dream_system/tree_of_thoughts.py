@@ -8,6 +8,8 @@ import uuid
 import time
 from dataclasses import dataclass
 
+from allma_model.llm.request_scheduler import Priority, generate_with_priority
+
 @dataclass
 class ThoughtNode:
     id: str
@@ -122,9 +124,12 @@ class TreeOfThoughts:
                 self.logger.info("🌙 Dream in pausa: utente attivo, cedo il LLM.")
                 return []
 
-            # MobileGemmaWrapper.generate() restituisce una stringa diretta
-            raw = self.llm.generate(
+            # MobileGemmaWrapper.generate() restituisce una stringa diretta;
+            # classe IDLE: la chat interrompe il sogno al token successivo
+            raw = generate_with_priority(
+                self.llm,
                 full_prompt,
+                Priority.IDLE,
                 max_tokens=64,
                 stop=["<|im_end|>", "\n"],
                 temperature=0.9
@@ -31,11 +31,11 @@ class InformationExtractor:
             'artificial_intelligence': ['intelligenza artificiale', 'ai', 'ia']
         }
         
-    def extract_information(self, text: str) -> Dict:
-        """Estrae informazioni strutturate dal testo"""
+    def extract_information(self, text: str, entities: Optional[Dict[str, List[str]]] = None) -> Dict:
+        """Estrae informazioni strutturate dal testo (entities: entità già estratte nel turno)"""
         return {
             'concepts': self.extract_concepts(text),
-            'entities': self.extract_entities(text),
+            'entities': entities if entities is not None else self.extract_entities(text),
             'keywords': self.extract_keywords(text),
             'topics': self.extract_topics(text)
         }
@@ -0,0 +1,210 @@
+"""
+PipelineProfiles — Profili di pipeline per classe di complessità
+
+Scopo:
+    _analyze_query_complexity classifica i messaggi in SIMPLE / NORMAL / COMPLEX,
+    ma un "ciao" attraversava comunque emozione, pattern recognition, legacy
+    brain, orchestratore dei moduli, memory gate vettoriale e coalescenza.
+    Un profilo dichiara, per ogni classe, quali passi girano prima dell'LLM e
+    cosa succede agli altri.
+
+Architettura:
+    StagePolicy      → RUN (nel turno), DEFER (dopo la risposta, coda post-risposta),
+                       DROP (non eseguito: vale il fallback dello stadio)
+    PipelineProfile  → classe → politica per nome di passo (stadi di StageGraph e
+                       passi del prompt come 'orchestrator' e 'proprioception')
+    require_steps()  → passi che nessun profilo può differire o saltare
+    split_stages()   → grafo del turno: gli stadi DEFER/DROP diventano costanti
+                       (fallback, nessuna dipendenza) e non rallentano gli altri
+    deferred_graph() → gli stadi DEFER in un grafo proprio, eseguito dopo la
+                       risposta con i valori reali del turno
+    ProfileLatencyReport → latenze per classe (pre-LLM, primo token, totale)
+
+Configurazione:
+    PipelineProfile.from_config('SIMPLE', {'emotion': 'defer', 'pattern': 'drop'})
+    i passi non elencati usano la politica di default del profilo.
+"""
+
+from __future__ import annotations
+
+import math
+import threading
+from collections import deque
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Any, Deque, Dict, Iterable, List, Mapping, Optional, Sequence, Set, Tuple
+
+from allma_model.core.stage_graph import Stage, StageGraph
+
+
+class StagePolicy(Enum):
+    RUN = "run"
+    DEFER = "defer"
+    DROP = "drop"
+
+
+@dataclass
+class PipelineProfile:
+    """Politiche dei passi per una classe di complessità."""
+    name: str
+    policies: Dict[str, StagePolicy] = field(default_factory=dict)
+    default: StagePolicy = StagePolicy.RUN
+
+    def policy(self, step: str) -> StagePolicy:
+        return self.policies.get(step, self.default)
+
+    def runs(self, step: str) -> bool:
+        return self.policy(step) == StagePolicy.RUN
+
+    @classmethod
+    def from_config(cls, name: str, config: Mapping[str, str], default: str = "run") -> 'PipelineProfile':
+        """Profilo da configurazione testuale (es. JSON): passo → 'run' | 'defer' | 'drop'."""
+        return cls(
+            name=name,
+            policies={step: StagePolicy(str(value).lower()) for step, value in config.items()},
+            default=StagePolicy(default)
+        )
+
+
+# Fast lane: per saluti e conferme girano solo gli stadi che servono al prompt
+# minimale. Quelli con effetti persistenti (salvataggi, legacy brain) sono
+# differiti, le sole letture per il prompt completo vengono saltate.
+# L'emozione gira sempre: la leggono la risposta e il lavoro post-risposta.
+DEFAULT_PROFILES: Dict[str, PipelineProfile] = {
+    "SIMPLE": PipelineProfile("SIMPLE", {
+        'learning_style': StagePolicy.DROP,
+        'context': StagePolicy.DROP,
+        'info_extraction': StagePolicy.DROP,
+        'pattern': StagePolicy.DROP,
+        'understanding': StagePolicy.DROP,
+        'memory_gate': StagePolicy.DROP,
+        'tools': StagePolicy.DROP,
+        'project_context': StagePolicy.DROP,
+        'knowledge': StagePolicy.DROP,
+        'store_interaction': StagePolicy.DEFER,
+        'store_message': StagePolicy.DEFER,
+        'legacy_brain': StagePolicy.DEFER,
+        'resonance': StagePolicy.DROP,
+        'orchestrator': StagePolicy.DROP,
+        'proprioception': StagePolicy.DROP,
+    }),
+    "NORMAL": PipelineProfile("NORMAL"),
+    "COMPLEX": PipelineProfile("COMPLEX"),
+}
+
+
+def require_steps(profiles: Mapping[str, PipelineProfile], steps: Iterable[str]) -> Dict[str, PipelineProfile]:
+    """
+    Copia dei profili in cui steps girano sempre nel turno.
+
+    Per i passi il cui valore serve anche alla risposta e al lavoro
+    post-risposta: differiti o saltati, quei consumatori leggerebbero il
+    fallback (es. emozione 'neutral' registrata per ogni turno).
+
+    Returns:
+        profili con steps a RUN (gli altri passi invariati)
+    """
+    result: Dict[str, PipelineProfile] = {}
+    for name, profile in profiles.items():
+        blocked = [step for step in steps if not profile.runs(step)]
+        if blocked:
+            policies = dict(profile.policies)
+            policies.update({step: StagePolicy.RUN for step in blocked})
+            profile = PipelineProfile(profile.name, policies, profile.default)
+        result[name] = profile
+    return result
+
+
+def split_stages(stages: Sequence[Stage], profile: PipelineProfile) -> Tuple[List[Stage], List[str]]:
+    """
+    Applica il profilo agli stadi del turno.
+
+    Returns:
+        (stadi per il grafo del turno, nomi degli stadi differiti in ordine di dichiarazione)
+    """
+    current: List[Stage] = []
+    deferred: List[str] = []
+    for stage in stages:
+        policy = profile.policy(stage.name)
+        if policy == StagePolicy.RUN:
+            current.append(stage)
+            continue
+        if policy == StagePolicy.DEFER:
+            deferred.append(stage.name)
+        current.append(Stage(stage.name, lambda deps, s=stage: s.fallback_value(), fallback=stage.fallback))
+    return current, deferred
+
+
+def deferred_graph(
+    stages: Sequence[Stage],
+    deferred: Iterable[str],
+    turn_values: Mapping[str, Any]
+) -> Optional[StageGraph]:
+    """
+    Grafo degli stadi differiti.
+
+    Le dipendenze verso altri stadi differiti restano tali (ricevono il valore
+    reale); quelle verso stadi eseguiti o saltati ricevono il valore del turno.
+    """
+    names: Set[str] = set(deferred)
+    if not names:
+        return None
+    by_name = {stage.name: stage for stage in stages}
+    graph_stages = []
+    for stage in stages:
+        if stage.name not in names:
+            continue
+        internal = tuple(d for d in stage.deps if d in names)
+        fixed = {d: turn_values.get(d) for d in stage.deps if d not in names}
+
+        def run(deps, s=by_name[stage.name], fixed=fixed):
+            return s.fn({**fixed, **deps})
+
+        graph_stages.append(Stage(stage.name, run, deps=internal, fallback=stage.fallback, required=stage.required))
+    return StageGraph(graph_stages)
+
+
+class ProfileLatencyReport:
+    """Latenze recenti per classe di complessità (finestra mobile per classe)."""
+
+    def __init__(self, window: int = 200):
+        self.window = window
+        self._samples: Dict[str, Deque[Dict[str, float]]] = {}
+        self._counts: Dict[str, int] = {}
+        self._lock = threading.Lock()
+
+    def record(self, complexity: str, **timings_ms: Optional[float]) -> None:
+        sample = {k: float(v) for k, v in timings_ms.items() if v is not None}
+        with self._lock:
+            self._samples.setdefault(complexity, deque(maxlen=self.window)).append(sample)
+            self._counts[complexity] = self._counts.get(complexity, 0) + 1
+
+    @staticmethod
+    def _percentile(values: List[float], pct: float) -> float:
+        """Percentile nearest-rank."""
+        ordered = sorted(values)
+        rank = math.ceil(pct / 100.0 * len(ordered))
+        return ordered[min(len(ordered), max(1, rank)) - 1]
+
+    def report(self) -> Dict[str, Dict[str, Any]]:
+        """classe → {'count', '<metrica>_p50', '<metrica>_p95'} per ogni metrica registrata."""
+        with self._lock:
+            snapshot = {cls: list(samples) for cls, samples in self._samples.items()}
+            counts = dict(self._counts)
+        result: Dict[str, Dict[str, Any]] = {}
+        for cls, samples in snapshot.items():
+            entry: Dict[str, Any] = {'count': counts.get(cls, 0)}
+            metrics = sorted({k for s in samples for k in s})
+            for metric in metrics:
+                values = [s[metric] for s in samples if metric in s]
+                entry[f"{metric}_p50"] = round(self._percentile(values, 50), 2)
+                entry[f"{metric}_p95"] = round(self._percentile(values, 95), 2)
+            result[cls] = entry
+        return result
+
+    def summary(self) -> str:
+        parts = []
+        for cls, entry in sorted(self.report().items()):
+            metrics = " ".join(f"{k}={v}" for k, v in entry.items() if k.endswith("_p50"))
+            parts.append(f"{cls}(n={entry['count']} {metrics})")
+        return " | ".join(parts)
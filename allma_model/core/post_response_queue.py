@@ -0,0 +1,213 @@
+"""
+PostResponseQueue — Coda del lavoro post-risposta di ALLMACore
+
+Scopo:
+    Dopo la risposta, process_message eseguiva ancora in modo sincrono
+    apprendimento, salvataggi di memoria, coalescenza della personalità
+    (riscrive il diario) e aggiornamenti di neuroplasticità/identità, con le
+    relative scritture JSON e SQLite. Nulla di tutto questo serve alla risposta:
+    ora gira dopo l'ultimo token, fuori dal turno.
+
+Architettura:
+    submit(conversation_id, name, fn)  → accoda un task nella FIFO della conversazione
+    una FIFO per conversazione         → i task di una conversazione girano in ordine,
+                                         uno alla volta; conversazioni diverse in parallelo
+    pool di worker                     → un worker prende in carico una conversazione
+                                         e svuota la sua FIFO prima di rilasciarla
+    wait_for(conversation_id)          → barriera: il turno successivo della stessa
+                                         conversazione attende i task del precedente
+    shutdown()/drain()                 → all'uscita (atexit) i task pendenti vengono eseguiti
+
+Errori:
+    Un task che fallisce viene loggato e contato; il Future restituito da submit
+    conserva l'eccezione. I task successivi della FIFO proseguono comunque.
+"""
+
+from __future__ import annotations
+
+import contextvars
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, Dict, Optional
+
+from allma_model.utils.tracing import Tracer
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class _Task:
+    name: str
+    fn: Callable[[], Any]
+    turn_trace_id: Optional[str]
+    future: Future = field(default_factory=Future)
+    enqueued: float = field(default_factory=time.perf_counter)
+
+
+class PostResponseQueue:
+    """
+    FIFO per conversazione del lavoro che non serve alla risposta.
+
+    Usage:
+        queue = PostResponseQueue()
+        queue.submit(conversation_id, "store_reply", lambda: memory.store_message(...))
+        ...
+        queue.wait_for(conversation_id)   # inizio del turno successivo
+        queue.shutdown()                  # uscita dall'app
+    """
+
+    def __init__(self, max_workers: int = 2, thread_name_prefix: str = "AllmaPostResponse"):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=thread_name_prefix)
+        self._queues: Dict[str, Deque[_Task]] = {}
+        self._active: set = set()          # conversazioni in carico a un worker
+        self._cond = threading.Condition()
+        self._closed = False
+        self._tracer = Tracer.get_instance()
+
+        # Metriche
+        self.submitted = 0
+        self.completed = 0
+        self.failed = 0
+        self.max_depth = 0
+        self._task_ms_total = 0.0
+        self._wait_ms_total = 0.0
+        self.last_task_ms = 0.0
+
+    # ------------------------------------------------------------------
+    # Accodamento
+    # ------------------------------------------------------------------
+
+    def submit(self, conversation_id: str, name: str, fn: Callable[..., Any], *args, **kwargs) -> Future:
+        """Accoda fn(*args, **kwargs) dopo i task già in coda per la conversazione."""
+        conv = str(conversation_id)
+        current = Tracer.current_span()
+        task = _Task(name, (lambda: fn(*args, **kwargs)), current.trace_id if current else None)
+        with self._cond:
+            self.submitted += 1
+            if self._closed:
+                inline = True
+            else:
+                inline = False
+                self._queues.setdefault(conv, deque()).append(task)
+                self.max_depth = max(self.max_depth, self._depth_locked())
+                schedule = conv not in self._active
+                if schedule:
+                    self._active.add(conv)
+        if inline:
+            # Coda chiusa (shutdown in corso): il lavoro non si perde, gira nel chiamante
+            self._run_task(conv, task)
+            return task.future
+        if schedule:
+            try:
+                self._executor.submit(self._drain_conversation, conv)
+            except RuntimeError:
+                self._drain_conversation(conv)
+        return task.future
+
+    def _drain_conversation(self, conv: str) -> None:
+        while True:
+            with self._cond:
+                pending = self._queues.get(conv)
+                if not pending:
+                    self._queues.pop(conv, None)
+                    self._active.discard(conv)
+                    self._cond.notify_all()
+                    return
+                task = pending[0]
+            self._run_task(conv, task)
+            with self._cond:
+                # Rimosso solo dopo l'esecuzione: wait_for vede il task finché non è concluso
+                pending.popleft()
+                self._cond.notify_all()
+
+    def _run_task(self, conv: str, task: _Task) -> None:
+        if not task.future.set_running_or_notify_cancel():
+            return
+        started = time.perf_counter()
+        wait_ms = (started - task.enqueued) * 1000.0
+        failed = False
+        try:
+            # Context vuoto: il task apre una trace propria anche se il turno è ancora aperto
+            result = contextvars.Context().run(self._traced, conv, task, wait_ms)
+        except BaseException as e:
+            failed = True
+            logger.error(f"[PostResponseQueue] Task '{task.name}' fallito (conv={conv}): {e}")
+            task.future.set_exception(e)
+        else:
+            task.future.set_result(result)
+        finally:
+            elapsed = (time.perf_counter() - started) * 1000.0
+            with self._cond:
+                self.completed += 1
+                self.failed += int(failed)
+                self.last_task_ms = elapsed
+                self._task_ms_total += elapsed
+                self._wait_ms_total += wait_ms
+
+    def _traced(self, conv: str, task: _Task, wait_ms: float) -> Any:
+        with self._tracer.span(
+            f"deferred.{task.name}",
+            conversation_id=conv,
+            turn_trace_id=task.turn_trace_id,
+            queue_wait_ms=round(wait_ms, 2)
+        ):
+            return task.fn()
+
+    # ------------------------------------------------------------------
+    # Barriere e chiusura
+    # ------------------------------------------------------------------
+
+    def wait_for(self, conversation_id: str, timeout: Optional[float] = None) -> bool:
+        """Attende i task pendenti della conversazione. False se scade il timeout."""
+        conv = str(conversation_id)
+        with self._cond:
+            return self._cond.wait_for(lambda: conv not in self._queues, timeout=timeout)
+
+    def drain(self, timeout: Optional[float] = None) -> bool:
+        """Attende tutti i task pendenti. False se scade il timeout."""
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._queues, timeout=timeout)
+
+    def shutdown(self, timeout: Optional[float] = 10.0) -> bool:
+        """Smette di accettare task in coda, esegue i pendenti e chiude i worker."""
+        with self._cond:
+            self._closed = True
+        drained = self.drain(timeout)
+        if not drained:
+            logger.warning(f"[PostResponseQueue] Shutdown con {self.depth()} task ancora pendenti")
+        self._executor.shutdown(wait=drained)
+        return drained
+
+    # ------------------------------------------------------------------
+    # Metriche
+    # ------------------------------------------------------------------
+
+    def _depth_locked(self, conv: Optional[str] = None) -> int:
+        if conv is not None:
+            return len(self._queues.get(conv, ()))
+        return sum(len(q) for q in self._queues.values())
+
+    def depth(self, conversation_id: Optional[str] = None) -> int:
+        """Task in coda o in esecuzione (per conversazione o totali)."""
+        with self._cond:
+            return self._depth_locked(None if conversation_id is None else str(conversation_id))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            done = max(self.completed, 1)
+            return {
+                'depth': self._depth_locked(),
+                'conversations': len(self._queues),
+                'max_depth': self.max_depth,
+                'submitted': self.submitted,
+                'completed': self.completed,
+                'failed': self.failed,
+                'avg_task_ms': round(self._task_ms_total / done, 2),
+                'avg_queue_wait_ms': round(self._wait_ms_total / done, 2),
+                'last_task_ms': round(self.last_task_ms, 2),
+            }
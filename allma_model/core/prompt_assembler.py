@@ -0,0 +1,249 @@
+"""
+PromptAssembler — Prompt di ALLMACore entro un budget esatto di token
+
+Scopo:
+    Il prompt era limitato in caratteri e con soglie fisse (20 messaggi di
+    cronologia, 550/900 caratteri per messaggio, 240 per ricordo): con molta
+    cronologia superava n_ctx=2048 e il wrapper doveva ridurre max_tokens a
+    runtime; con poca sprecava contesto. La stessa quantità di caratteri vale
+    un numero di token diverso per lingua e alfabeto.
+
+Architettura:
+    PromptSection        → sezione con nome, unità (messaggi, ricordi, righe
+                           di contesto), priorità e budget min/max in token;
+                           drop dice quali unità cadono prima ('head' = le
+                           più vecchie, 'tail' = le meno rilevanti in coda)
+    assemble(...)        → applica i max di ogni sezione, poi finché il prompt
+                           supera il budget taglia la sezione di priorità più
+                           bassa che è sopra il suo min; render() produce il
+                           testo e il conteggio finale è sul prompt reso (esatto)
+    window(key, ...)     → cronologia con finestra stabile: quando supera il
+                           budget si scende a low_watermark, così il prefisso
+                           (e la sua KV nella LlamaCache) resta uguale per più turni
+    conteggi             → dal tokenizer del modello (TokenAccountant, memorizzato
+                           per testo): le sezioni invariate non si ritokenizzano
+
+Budget:
+    Le unità si tolgono intere; un'unità da sola oltre il budget della sezione
+    viene accorciata (truncate) al confine di parola più vicino. Le sezioni
+    che non scendono sotto min_tokens (es. system e messaggio utente) restano
+    anche se il prompt non sta nel budget: AssembledPrompt.fits lo segnala.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class PromptSection:
+    """Sezione del prompt: unità di testo con priorità e budget in token."""
+    name: str
+    units: List[str]
+    priority: int
+    min_tokens: int = 0
+    max_tokens: Optional[int] = None
+    drop: str = "tail"          # 'head': prima le unità più vecchie; 'tail': prima le ultime
+    keep: str = "head"          # parte di un'unità troppo lunga che resta ('head' o 'tail')
+
+
+@dataclass
+class AssembledPrompt:
+    """Prompt reso, token per sezione e ciò che è stato tagliato."""
+    prompt: str
+    tokens: int
+    budget: int
+    sections: Dict[str, List[str]] = field(default_factory=dict)
+    section_tokens: Dict[str, int] = field(default_factory=dict)
+    dropped_tokens: Dict[str, int] = field(default_factory=dict)
+
+    @property
+    def fits(self) -> bool:
+        return self.tokens <= self.budget
+
+
+class PromptAssembler:
+    """
+    Adatta le sezioni del prompt a un budget esatto di token.
+
+    Usage:
+        assembler = PromptAssembler(llm.count_tokens)
+        result = assembler.assemble([
+            PromptSection("system", [system_block], priority=100, min_tokens=10**6),
+            PromptSection("history", turns, priority=60, drop="head"),
+            PromptSection("memory", memories, priority=40, max_tokens=160),
+        ], budget=1408, render=lambda parts: build_chatml(parts))
+        llm.generate(result.prompt, ...)
+    """
+
+    MAX_PASSES = 6
+    WINDOW_SLOTS = 16
+
+    def __init__(self, count_tokens: Callable[[str], int]):
+        self.count_tokens = count_tokens
+        # Cronologia: chiave (es. conversazione) → (indice, testo) della prima unità tenuta
+        self._windows: "OrderedDict[str, Tuple[int, str]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"assembled": 0, "over_budget": 0, "trimmed": 0, "window_slides": 0}
+
+    def count(self, text: str) -> int:
+        if not text:
+            return 0
+        return int(self.count_tokens(text))
+
+    # ------------------------------------------------------------------
+    # Unità
+    # ------------------------------------------------------------------
+
+    def truncate(self, text: str, max_tokens: int, keep: str = "head") -> str:
+        """Accorcia il testo entro max_tokens (taglio proporzionale, al confine di parola)."""
+        if max_tokens <= 0:
+            return ""
+        count = self.count(text)
+        while count > max_tokens and text:
+            chars = min(len(text) - 1, int(len(text) * max_tokens / count * 0.95))
+            if chars <= 0:
+                return ""
+            if keep == "tail":
+                cut = text[-chars:]
+                space = cut.find(" ")
+                text = cut[space + 1:] if 0 <= space < len(cut) // 4 else cut
+            else:
+                cut = text[:chars]
+                space = cut.rfind(" ")
+                text = cut[:space] if space > len(cut) * 3 // 4 else cut
+            count = self.count(text)
+        return text
+
+    def _shrink(self, section: PromptSection, units: List[str], target: int) -> List[str]:
+        """Unità della sezione entro target token: toglie unità intere, poi accorcia l'ultima rimasta."""
+        units = list(units)
+        total = sum(self.count(u) for u in units)
+        while total > target and len(units) > 1:
+            removed = units.pop(0) if section.drop == "head" else units.pop()
+            total -= self.count(removed)
+        if total > target and units:
+            units[0] = self.truncate(units[0], target, keep=section.keep)
+            if not units[0]:
+                units = []
+        return units
+
+    def window(
+        self,
+        key: str,
+        units: List[str],
+        max_tokens: int,
+        low_watermark: float = 0.75
+    ) -> List[str]:
+        """
+        Ultime unità (es. messaggi di cronologia) entro max_tokens, con inizio stabile.
+
+        Si riparte dalla prima unità del turno precedente finché il totale sta
+        in max_tokens; oltre, si tolgono le più vecchie fino a low_watermark.
+        """
+        counts = [self.count(u) for u in units]
+        with self._lock:
+            first = self._windows.get(key)
+        start = 0
+        if first is not None:
+            index, text = first
+            if index < len(units) and units[index] == text:
+                start = index
+            elif text in units:
+                start = units.index(text)
+        total = sum(counts[start:])
+        if total > max_tokens:
+            target = int(max_tokens * low_watermark)
+            while start < len(units) and total > target:
+                total -= counts[start]
+                start += 1
+            with self._lock:
+                self._stats["window_slides"] += 1
+        kept = units[start:]
+        with self._lock:
+            if kept:
+                self._windows[key] = (start, kept[0])
+                self._windows.move_to_end(key)
+                while len(self._windows) > self.WINDOW_SLOTS:
+                    self._windows.popitem(last=False)
+            else:
+                self._windows.pop(key, None)
+        return kept
+
+    # ------------------------------------------------------------------
+    # Prompt
+    # ------------------------------------------------------------------
+
+    def assemble(
+        self,
+        sections: List[PromptSection],
+        budget: int,
+        render: Callable[[Dict[str, List[str]]], str],
+        count_prompt: Optional[Callable[[str], int]] = None
+    ) -> AssembledPrompt:
+        """
+        Prompt reso entro budget token tagliando le sezioni per priorità.
+
+        Args:
+            sections: sezioni del prompt (l'ordine di resa lo decide render)
+            budget: token massimi del prompt (n_ctx meno lo spazio della risposta)
+            render: unità per sezione → testo del prompt (tag ChatML inclusi)
+            count_prompt: conteggio del prompt reso (default: count_tokens)
+        """
+        count_prompt = count_prompt or self.count
+        parts: Dict[str, List[str]] = {}
+        for section in sections:
+            units = [u for u in section.units if u]
+            if section.max_tokens is not None:
+                units = self._shrink(section, units, section.max_tokens)
+            parts[section.name] = units
+
+        original = {s.name: sum(self.count(u) for u in s.units if u) for s in sections}
+        by_priority = sorted(sections, key=lambda s: s.priority)
+        prompt = render(parts)
+        total = count_prompt(prompt)
+        passes = 0
+        while total > budget and passes < self.MAX_PASSES:
+            passes += 1
+            overflow = total - budget
+            changed = False
+            for section in by_priority:
+                current = sum(self.count(u) for u in parts[section.name])
+                spare = current - section.min_tokens
+                if spare <= 0:
+                    continue
+                # Il tag e i separatori della sezione non sono nelle unità:
+                # la sezione si riduce dell'eccesso, entro il suo minimo
+                parts[section.name] = self._shrink(section, parts[section.name],
+                                                   max(section.min_tokens, current - overflow))
+                changed = True
+                break
+            if not changed:
+                break
+            prompt = render(parts)
+            total = count_prompt(prompt)
+
+        section_tokens = {name: sum(self.count(u) for u in units) for name, units in parts.items()}
+        dropped = {name: original[name] - section_tokens[name]
+                   for name in parts if original[name] > section_tokens[name]}
+        result = AssembledPrompt(prompt, total, budget, parts, section_tokens, dropped)
+        with self._lock:
+            self._stats["assembled"] += 1
+            if dropped:
+                self._stats["trimmed"] += 1
+            if not result.fits:
+                self._stats["over_budget"] += 1
+        if not result.fits:
+            logger.warning(f"[PromptAssembler] Prompt over budget: {total}/{budget} tokens ({section_tokens})")
+        return result
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._stats)
@@ -0,0 +1,308 @@
+"""
+StageGraph — Esecutore a DAG degli stadi pre-LLM di ALLMACore
+
+Scopo:
+    Prima dell'LLM process_message esegue una quindicina di analisi
+    (emozione, topic, contesto, memory gate, ...) che in gran parte non
+    dipendono l'una dall'altra. Eseguite in fila, il TTFT paga la somma dei
+    tempi; come grafo di dipendenze paga solo il cammino critico.
+
+Architettura:
+    Stage       → nome, funzione, dipendenze, timeout e fallback
+    StageGraph  → valida il grafo (nomi unici, dipendenze note, niente cicli)
+                  e lo esegue su un ThreadPoolExecutor: ogni stadio parte
+                  appena le sue dipendenze hanno un valore
+    StageRun    → valori, esito per stadio, tempo reale, somma dei tempi
+                  e cammino critico (per i log)
+
+Timeout e fallback:
+    Uno stadio che supera timeout_s (misurato dalla sottomissione) o solleva
+    un'eccezione prende il valore di fallback e i dipendenti proseguono con
+    quello. Il thread di uno stadio scaduto non si può interrompere: finisce
+    in background e il suo risultato viene ignorato. Gli stadi required
+    (es. i salvataggi) non hanno fallback: il loro errore, o TimeoutError,
+    interrompe il run e arriva al chiamante.
+
+Annullamento:
+    Con un CancellationToken, all'annullamento nessuno stadio nuovo parte,
+    quelli ancora in coda vengono tolti dal pool e run() solleva l'errore del
+    token senza attendere gli stadi già in esecuzione.
+
+Contesto:
+    Ogni stadio gira in una copia del contextvars.Context del chiamante,
+    così gli span di tracing aperti nello stadio hanno il padre corretto.
+"""
+
+from __future__ import annotations
+
+import contextvars
+import logging
+import time
+from concurrent.futures import FIRST_COMPLETED, Executor, Future, wait
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Mapping, Optional, Sequence, Tuple
+
+from allma_model.utils.cancellation import CancellationToken
+
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class Stage:
+    """Uno stadio del grafo. fn riceve i valori delle dipendenze come dict nome → valore."""
+    name: str
+    fn: Callable[[Dict[str, Any]], Any]
+    deps: Tuple[str, ...] = ()
+    timeout_s: Optional[float] = None
+    fallback: Optional[Callable[[], Any]] = None  # factory: evita default mutabili condivisi
+    required: bool = False  # errore o timeout interrompono il run invece del fallback
+
+    def fallback_value(self) -> Any:
+        return self.fallback() if self.fallback is not None else None
+
+
+@dataclass
+class StageOutcome:
+    """Esito di uno stadio. I tempi sono in ms dall'inizio del run."""
+    name: str
+    status: str               # 'ok' | 'error' | 'timeout'
+    value: Any = None
+    start_ms: float = 0.0
+    end_ms: float = 0.0
+    error: Optional[str] = None
+
+    @property
+    def elapsed_ms(self) -> float:
+        return self.end_ms - self.start_ms
+
+
+@dataclass
+class StageRun:
+    """Risultato di un'esecuzione del grafo."""
+    outcomes: Dict[str, StageOutcome] = field(default_factory=dict)
+    wall_ms: float = 0.0
+    critical_path: List[str] = field(default_factory=list)
+
+    @property
+    def values(self) -> Dict[str, Any]:
+        return {name: o.value for name, o in self.outcomes.items()}
+
+    @property
+    def serial_ms(self) -> float:
+        """Tempo che avrebbe richiesto l'esecuzione sequenziale."""
+        return sum(o.elapsed_ms for o in self.outcomes.values())
+
+    @property
+    def degraded(self) -> List[str]:
+        """Stadi terminati in errore o timeout (valore di fallback)."""
+        return [name for name, o in self.outcomes.items() if o.status != 'ok']
+
+    def summary(self) -> str:
+        slowest = sorted(self.outcomes.values(), key=lambda o: o.elapsed_ms, reverse=True)[:3]
+        parts = [
+            f"wall={self.wall_ms:.0f}ms",
+            f"serial={self.serial_ms:.0f}ms",
+            f"critical={'>'.join(self.critical_path)}",
+            "slowest=" + ",".join(f"{o.name}:{o.elapsed_ms:.0f}" for o in slowest),
+        ]
+        if self.degraded:
+            parts.append(f"degraded={','.join(self.degraded)}")
+        return " ".join(parts)
+
+
+class StageGraph:
+    """
+    Grafo di stadi con dipendenze dichiarate.
+
+    Usage:
+        graph = StageGraph([
+            Stage('topic', lambda d: extract(msg), timeout_s=1.0, fallback=lambda: 'general'),
+            Stage('knowledge', lambda d: lookup(d['topic']), deps=('topic',), fallback=list),
+        ])
+        run = graph.run(core.stage_pool)
+        topic = run.values['topic']
+    """
+
+    def __init__(self, stages: Sequence[Stage]):
+        self.stages: Dict[str, Stage] = {}
+        for stage in stages:
+            if stage.name in self.stages:
+                raise ValueError(f"Stadio duplicato: {stage.name}")
+            self.stages[stage.name] = stage
+        for stage in self.stages.values():
+            missing = [d for d in stage.deps if d not in self.stages]
+            if missing:
+                raise ValueError(f"Lo stadio {stage.name} dipende da stadi inesistenti: {missing}")
+        self.order = self._topological_order()
+
+    def _topological_order(self) -> List[str]:
+        """Ordine topologico stabile (ordine di dichiarazione a parità); ValueError se c'è un ciclo."""
+        remaining = {name: set(stage.deps) for name, stage in self.stages.items()}
+        order: List[str] = []
+        while remaining:
+            ready = [name for name in self.stages if name in remaining and not remaining[name]]
+            if not ready:
+                raise ValueError(f"Ciclo tra gli stadi: {sorted(remaining)}")
+            for name in ready:
+                order.append(name)
+                del remaining[name]
+            for deps in remaining.values():
+                deps.difference_update(ready)
+        return order
+
+    # ------------------------------------------------------------------
+    # Esecuzione
+    # ------------------------------------------------------------------
+
+    def _dep_values(self, stage: Stage, outcomes: Mapping[str, StageOutcome]) -> Dict[str, Any]:
+        return {d: outcomes[d].value for d in stage.deps}
+
+    def _fail(self, stage: Stage, status: str, start_ms: float, end_ms: float,
+              error: BaseException) -> StageOutcome:
+        """Esito con il valore di fallback; per uno stadio required solleva error."""
+        if stage.required:
+            logger.error(f"[StageGraph] Stadio obbligatorio '{stage.name}' {status}: {error!r}")
+            raise error
+        logger.warning(f"[StageGraph] Stadio '{stage.name}' {status}: {error!r}. Uso il fallback.")
+        return StageOutcome(stage.name, status, stage.fallback_value(), start_ms, end_ms, repr(error))
+
+    def run(self, executor: Optional[Executor] = None, cancel_token: Optional[CancellationToken] = None) -> StageRun:
+        """
+        Esegue il grafo.
+
+        Args:
+            executor: pool su cui eseguire gli stadi; None = in sequenza nel
+                      thread chiamante (ordine topologico, timeout non applicati)
+            cancel_token: annullamento del run (es. TurnHandle del turno)
+
+        Raises:
+            l'errore di cancel_token.check() se il run viene annullato;
+            l'errore (o TimeoutError) di uno stadio required
+        """
+        start = time.perf_counter()
+
+        def now_ms() -> float:
+            return (time.perf_counter() - start) * 1000.0
+
+        outcomes: Dict[str, StageOutcome] = {}
+        if executor is None:
+            for name in self.order:
+                if cancel_token is not None:
+                    cancel_token.check()
+                outcomes[name] = self._run_inline(self.stages[name], outcomes, now_ms)
+            return self._finish(outcomes, now_ms())
+
+        # Future completata all'annullamento: sveglia l'attesa sugli stadi
+        cancelled: Future = Future()
+
+        def on_cancel(reason: str) -> None:
+            if not cancelled.done():
+                cancelled.set_result(reason)
+
+        if cancel_token is not None:
+            cancel_token.add_listener(on_cancel)
+        try:
+            return self._run_pool(executor, outcomes, now_ms, cancel_token, cancelled)
+        finally:
+            if cancel_token is not None:
+                cancel_token.remove_listener(on_cancel)
+
+    def _run_pool(
+        self,
+        executor: Executor,
+        outcomes: Dict[str, StageOutcome],
+        now_ms: Callable[[], float],
+        cancel_token: Optional[CancellationToken],
+        cancelled: Future
+    ) -> StageRun:
+        """Esecuzione sul pool: ogni stadio parte appena le dipendenze hanno un valore."""
+        waiting = list(self.order)
+        running: Dict[Future, Tuple[Stage, float, Optional[float]]] = {}
+
+        def submit_ready():
+            for name in list(waiting):
+                stage = self.stages[name]
+                if not all(d in outcomes for d in stage.deps):
+                    continue
+                waiting.remove(name)
+                deps = self._dep_values(stage, outcomes)
+                submitted = now_ms()
+                try:
+                    # Il Context del chiamante (es. lo span corrente) segue lo stadio nel worker
+                    future = executor.submit(contextvars.copy_context().run, stage.fn, deps)
+                except RuntimeError:
+                    # Pool chiuso (shutdown in corso): eseguiamo nel thread chiamante
+                    outcomes[name] = self._run_inline(stage, outcomes, now_ms)
+                    continue
+                deadline = submitted + stage.timeout_s * 1000.0 if stage.timeout_s is not None else None
+                running[future] = (stage, submitted, deadline)
+
+        submit_ready()
+        while running or waiting:
+            if cancelled.done():
+                for future in running:
+                    future.cancel()  # tolti se in coda; quelli in esecuzione finiscono in background
+                cancel_token.check()
+            if not running:
+                # Solo se uno stadio inline ha sbloccato altri stadi
+                submit_ready()
+                continue
+            deadlines = [d for _, _, d in running.values() if d is not None]
+            wait_s = max(0.0, (min(deadlines) - now_ms()) / 1000.0) if deadlines else None
+            finished, _ = wait(list(running.keys()) + [cancelled], timeout=wait_s, return_when=FIRST_COMPLETED)
+
+            for future in finished:
+                if future is cancelled:
+                    continue
+                stage, submitted, _ = running.pop(future)
+                error = future.exception()
+                if error is None:
+                    outcomes[stage.name] = StageOutcome(stage.name, 'ok', future.result(), submitted, now_ms())
+                else:
+                    outcomes[stage.name] = self._fail_running(stage, 'error', submitted, now_ms(), error, running)
+
+            current = now_ms()
+            for future, (stage, submitted, deadline) in list(running.items()):
+                if deadline is not None and current >= deadline:
+                    running.pop(future)
+                    future.cancel()  # efficace solo se ancora in coda
+                    outcomes[stage.name] = self._fail_running(
+                        stage, 'timeout', submitted, current,
+                        TimeoutError(f"oltre {stage.timeout_s:.2f}s"), running
+                    )
+
+            submit_ready()
+
+        return self._finish(outcomes, now_ms())
+
+    def _fail_running(self, stage: Stage, status: str, start_ms: float, end_ms: float,
+                      error: BaseException, running: Mapping[Future, Any]) -> StageOutcome:
+        """Come _fail; se il run si interrompe, gli stadi ancora in coda vengono tolti dal pool."""
+        if stage.required:
+            for future in running:
+                future.cancel()
+        return self._fail(stage, status, start_ms, end_ms, error)
+
+    def _run_inline(self, stage: Stage, outcomes: Mapping[str, StageOutcome], now_ms) -> StageOutcome:
+        started = now_ms()
+        try:
+            value = stage.fn(self._dep_values(stage, outcomes))
+        except Exception as e:
+            return self._fail(stage, 'error', started, now_ms(), e)
+        return StageOutcome(stage.name, 'ok', value, started, now_ms())
+
+    def _finish(self, outcomes: Dict[str, StageOutcome], wall_ms: float) -> StageRun:
+        ordered = {name: outcomes[name] for name in self.order}
+        return StageRun(outcomes=ordered, wall_ms=wall_ms, critical_path=self._critical_path(ordered))
+
+    def _critical_path(self, outcomes: Mapping[str, StageOutcome]) -> List[str]:
+        """Risale dallo stadio terminato per ultimo lungo la dipendenza terminata per ultima."""
+        if not outcomes:
+            return []
+        current = max(outcomes.values(), key=lambda o: o.end_ms).name
+        path = [current]
+        while self.stages[current].deps:
+            current = max(self.stages[current].deps, key=lambda d: outcomes[d].end_ms)
+            path.append(current)
+        return list(reversed(path))
@@ -0,0 +1,214 @@
+"""
+TurnContext — Contesto condiviso di un turno di ALLMACore
+
+Scopo:
+    Gli stadi di process_message ricalcolavano ciascuno gli stessi fatti
+    derivati dal messaggio: le entità venivano estratte sia dall'analisi del
+    contesto sia dall'InformationExtractor, lo stato metabolico veniva letto
+    più volte dai sensori, l'intento serviva a più consumatori. TurnContext
+    li calcola al primo accesso e li condivide per tutto il turno: ogni fatto
+    è calcolato al più una volta per messaggio.
+
+Architettura:
+    campi del turno   → user_id, conversation_id, message, llm, is_complex,
+                        cancel_token (TurnHandle: controllato all'avvio di ogni stadio)
+    provider          → nome del fatto → fn(turn); registrati da ALLMACore
+                        (tokens e intent hanno un provider di default)
+    get(nome)         → memoizzato e thread-safe: gli stadi girano in parallelo
+                        sullo stage_pool, chi arriva secondo attende il primo
+    proprietà         → tokens, entities, understanding, intent, emotion,
+                        metabolic_state, personality
+    stats()           → tempo di calcolo e riusi per fatto (span del turno)
+    report()          → avanzamento della pipeline verso il chiamante (eventi STAGE
+                        dello stream di process_message_stream)
+
+Errori:
+    Se un provider fallisce l'eccezione viene memorizzata e rilanciata a ogni
+    accesso: un fatto costoso che fallisce non viene ritentato nello stesso turno.
+"""
+
+from __future__ import annotations
+
+import threading
+import time
+from typing import Any, Callable, Dict, List, Mapping, Optional
+
+from allma_model.utils.cancellation import CancellationToken
+
+
+Provider = Callable[['TurnContext'], Any]
+
+_MISSING = object()
+
+
+def _tokens(turn: 'TurnContext') -> List[str]:
+    return (turn.message or "").split()
+
+
+def _intent(turn: 'TurnContext') -> str:
+    understanding = turn.understanding
+    intent = getattr(understanding, 'intent', None)
+    return getattr(intent, 'value', None) or "unknown"
+
+
+DEFAULT_PROVIDERS: Dict[str, Provider] = {
+    'tokens': _tokens,
+    'intent': _intent,
+}
+
+
+class TurnContext:
+    """
+    Dati di un turno e fatti derivati, calcolati al più una volta.
+
+    Usage:
+        turn = TurnContext(user_id, conversation_id, message, providers={
+            'entities': lambda t: extractor.extract_entities(t.message),
+        })
+        turn.entities        # calcolato
+        turn.entities        # riusato
+    """
+
+    def __init__(
+        self,
+        user_id: str,
+        conversation_id: str,
+        message: str,
+        llm: Any = None,
+        is_complex: bool = False,
+        providers: Optional[Mapping[str, Provider]] = None,
+        progress: Optional[Callable[[str, Dict[str, Any]], None]] = None,
+        cancel_token: Optional[CancellationToken] = None
+    ):
+        self.user_id = user_id
+        self.conversation_id = conversation_id
+        self.message = message
+        self.llm = llm
+        self.is_complex = is_complex
+        self.progress = progress
+        self.cancel_token = cancel_token
+
+        self._providers: Dict[str, Provider] = {**DEFAULT_PROVIDERS, **(providers or {})}
+        self._values: Dict[str, Any] = {}
+        self._errors: Dict[str, BaseException] = {}
+        self._locks: Dict[str, threading.Lock] = {}
+        self._guard = threading.Lock()
+
+        # Metriche
+        self.compute_ms: Dict[str, float] = {}
+        self.reused: Dict[str, int] = {}
+
+    # ------------------------------------------------------------------
+    # Accesso ai fatti
+    # ------------------------------------------------------------------
+
+    def provide(self, name: str, provider: Provider) -> None:
+        """Registra (o sostituisce) il provider di un fatto non ancora calcolato."""
+        with self._guard:
+            self._providers[name] = provider
+
+    def seed(self, name: str, value: Any) -> None:
+        """Imposta un fatto già noto al chiamante (non verrà calcolato)."""
+        with self._guard:
+            self._values[name] = value
+
+    def peek(self, name: str, default: Any = None) -> Any:
+        """Valore del fatto se già calcolato, senza calcolarlo."""
+        return self._values.get(name, default)
+
+    def has(self, name: str) -> bool:
+        return name in self._values
+
+    def get(self, name: str) -> Any:
+        """Valore del fatto: calcolato al primo accesso, poi riusato."""
+        value = self._values.get(name, _MISSING)
+        if value is not _MISSING:
+            self._count_reuse(name)
+            return value
+
+        with self._guard:
+            lock = self._locks.setdefault(name, threading.Lock())
+        with lock:
+            value = self._values.get(name, _MISSING)
+            if value is not _MISSING:
+                self._count_reuse(name)
+                return value
+            if name in self._errors:
+                self._count_reuse(name)
+                raise self._errors[name]
+            provider = self._providers.get(name)
+            if provider is None:
+                raise KeyError(f"TurnContext: nessun provider per '{name}'")
+
+            started = time.perf_counter()
+            try:
+                value = provider(self)
+            except Exception as e:
+                self._errors[name] = e
+                raise
+            finally:
+                self.compute_ms[name] = round((time.perf_counter() - started) * 1000.0, 3)
+            self._values[name] = value
+            return value
+
+    def _count_reuse(self, name: str) -> None:
+        with self._guard:
+            self.reused[name] = self.reused.get(name, 0) + 1
+
+    # ------------------------------------------------------------------
+    # Fatti derivati del turno
+    # ------------------------------------------------------------------
+
+    @property
+    def tokens(self) -> List[str]:
+        return self.get('tokens')
+
+    @property
+    def entities(self) -> Dict[str, List[str]]:
+        return self.get('entities')
+
+    @property
+    def understanding(self) -> Any:
+        return self.get('understanding')
+
+    @property
+    def intent(self) -> str:
+        return self.get('intent')
+
+    @property
+    def emotion(self) -> Any:
+        return self.get('emotion')
+
+    @property
+    def metabolic_state(self) -> Any:
+        return self.get('metabolic_state')
+
+    @property
+    def personality(self) -> Dict[str, Any]:
+        return self.get('personality')
+
+    # ------------------------------------------------------------------
+    # Avanzamento e metriche
+    # ------------------------------------------------------------------
+
+    def report(self, stage: str, **info: Any) -> None:
+        """Notifica l'avanzamento della pipeline (errori del chiamante ignorati)."""
+        if self.progress is None:
+            return
+        try:
+            self.progress(stage, info)
+        except Exception:
+            pass
+
+    def check_cancelled(self) -> None:
+        """Punto di controllo: solleva l'errore del token se il turno è stato annullato."""
+        if self.cancel_token is not None:
+            self.cancel_token.check()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._guard:
+            return {
+                'computed': dict(self.compute_ms),
+                'reused': dict(self.reused),
+                'failed': sorted(self._errors),
+            }
@@ -0,0 +1,210 @@
+"""
+TurnStream — Eventi di streaming e controllo dei turni in volo di ALLMACore
+
+Scopo:
+    ChatView, WebViewBridge, il backend Flask e AllmaAndroidBridge avvolgevano
+    ciascuno process_message in thread e callback propri: due messaggi della
+    stessa conversazione potevano girare insieme, e un messaggio superato da
+    uno nuovo continuava l'intera pipeline. Il controllo della concorrenza vive
+    ora qui, condiviso dall'API sincrona e da quella asincrona.
+
+Architettura:
+    StreamEvent / StreamEventType → eventi tipizzati dello stream: token della
+                                    risposta, pensiero, avanzamento degli stadi,
+                                    risposta finale, annullamento, errore
+    TurnHandle                    → un turno in volo: CancellationToken del turno,
+                                    passato agli stadi e al modello (check a ogni
+                                    stadio, a ogni blocco di prompt e a ogni token)
+    TurnRegistry                  → un turno alla volta per conversazione; con
+                                    supersede=True il nuovo messaggio annulla il
+                                    turno in volo invece di accodarsi
+
+Annullamento:
+    Un turno superato smette di avviare stadi, interrompe l'inferenza al token
+    successivo e solleva TurnSupersededError; i token generati nel frattempo
+    non vengono più inoltrati al chiamante. La latenza (cancel → stop del
+    lavoro, cancel → conversazione libera) è misurata sull'handle.
+"""
+
+from __future__ import annotations
+
+import itertools
+import threading
+import time
+from dataclasses import dataclass, field
+from enum import Enum
+from typing import Any, Dict, List, Optional
+
+from allma_model.utils.cancellation import CancellationToken, OperationCancelledError
+
+
+class StreamEventType(Enum):
+    TOKEN = "token"          # testo della risposta
+    THINKING = "thinking"    # ragionamento (<think>, [[TH]])
+    STAGE = "stage"          # avanzamento della pipeline
+    FINAL = "final"          # risposta completa (ProcessedResponse)
+    CANCELLED = "cancelled"  # turno annullato o superato
+    ERROR = "error"
+
+
+# Tipi dei chunk della stream_callback di process_message
+_CHUNK_TYPES = {
+    'answer': StreamEventType.TOKEN,
+    'thought': StreamEventType.THINKING,
+}
+
+
+@dataclass(frozen=True)
+class StreamEvent:
+    """Evento dello stream di un turno."""
+    type: StreamEventType
+    content: str = ""
+    stage: Optional[str] = None
+    data: Dict[str, Any] = field(default_factory=dict)
+    response: Any = None
+    ts: float = field(default_factory=time.perf_counter)
+
+    @classmethod
+    def from_chunk(cls, chunk: Dict[str, Any]) -> Optional['StreamEvent']:
+        """Evento dal chunk {'type': 'answer'|'thought', 'content': ...} della stream_callback."""
+        event_type = _CHUNK_TYPES.get(chunk.get('type'))
+        content = chunk.get('content')
+        if event_type is None or not content:
+            return None
+        return cls(event_type, content=str(content))
+
+    def to_dict(self) -> Dict[str, Any]:
+        payload: Dict[str, Any] = {'type': self.type.value, 'content': self.content}
+        if self.stage is not None:
+            payload['stage'] = self.stage
+        if self.data:
+            payload['data'] = dict(self.data)
+        return payload
+
+
+class TurnSupersededError(OperationCancelledError):
+    """Il turno è stato annullato (nuovo messaggio nella conversazione o chiamante uscito)."""
+
+    def __init__(self, conversation_id: str, reason: str):
+        super().__init__(reason, f"Turno di {conversation_id} annullato: {reason}")
+        self.conversation_id = conversation_id
+
+
+_turn_ids = itertools.count(1)
+
+
+class TurnHandle(CancellationToken):
+    """
+    Un turno in volo di una conversazione (il suo token di annullamento).
+
+    Usage:
+        handle = TurnHandle(conversation_id)
+        handle.add_listener(lambda reason: ...)   # notifica immediata dell'annullamento
+        ...
+        handle.check()                            # punto di controllo nella pipeline
+    """
+
+    def __init__(self, conversation_id: str):
+        super().__init__()
+        self.conversation_id = str(conversation_id)
+        self.turn_id = next(_turn_ids)
+        self.created = time.perf_counter()
+
+    def error(self) -> TurnSupersededError:
+        return TurnSupersededError(self.conversation_id, self.reason or "cancelled")
+
+
+class TurnRegistry:
+    """
+    Turni in volo per conversazione.
+
+    Un turno alla volta per conversazione: i turni successivi attendono il
+    precedente (cronologia in ordine), oppure lo annullano con supersede=True.
+    Conversazioni diverse procedono in parallelo.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._active: Dict[str, TurnHandle] = {}
+        self._waiting: Dict[str, List[TurnHandle]] = {}
+
+        # Metriche
+        self.started = 0
+        self.superseded = 0
+        self.cancelled_waiting = 0
+
+    def begin(self, handle: TurnHandle, supersede: bool = False, timeout: Optional[float] = None) -> bool:
+        """
+        Occupa la conversazione per il turno (attende il turno in volo).
+
+        Con supersede=True annulla il turno in volo e quelli in attesa. Restituisce
+        False se scade il timeout; solleva TurnSupersededError se il turno viene
+        annullato mentre attende.
+        """
+        conv = handle.conversation_id
+        # Un turno annullato mentre attende deve svegliarsi subito
+        handle.add_listener(lambda reason: self._notify())
+        with self._cond:
+            if supersede:
+                victims = list(self._waiting.get(conv, ()))
+                if conv in self._active:
+                    victims.append(self._active[conv])
+            else:
+                victims = []
+            self._waiting.setdefault(conv, []).append(handle)
+
+        for victim in victims:
+            if victim.cancel("superseded"):
+                with self._cond:
+                    self.superseded += 1
+
+        with self._cond:
+            try:
+                acquired = self._cond.wait_for(
+                    lambda: handle.cancelled or conv not in self._active, timeout=timeout
+                )
+                if not acquired:
+                    return False
+                if handle.cancelled:
+                    self.cancelled_waiting += 1
+                    handle.check()
+                self._active[conv] = handle
+                self.started += 1
+                return True
+            finally:
+                waiting = self._waiting.get(conv)
+                if waiting and handle in waiting:
+                    waiting.remove(handle)
+                if not waiting:
+                    self._waiting.pop(conv, None)
+
+    def _notify(self) -> None:
+        with self._cond:
+            self._cond.notify_all()
+
+    def end(self, handle: TurnHandle) -> None:
+        """Libera la conversazione (se il turno la occupa)."""
+        with self._cond:
+            if self._active.get(handle.conversation_id) is handle:
+                del self._active[handle.conversation_id]
+                self._cond.notify_all()
+
+    def cancel(self, conversation_id: str, reason: str = "cancelled") -> bool:
+        """Annulla il turno in volo della conversazione. False se non ce n'è uno."""
+        with self._cond:
+            handle = self._active.get(str(conversation_id))
+        return handle.cancel(reason) if handle else False
+
+    def active(self, conversation_id: str) -> Optional[TurnHandle]:
+        with self._cond:
+            return self._active.get(str(conversation_id))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._cond:
+            return {
+                'active': len(self._active),
+                'waiting': sum(len(w) for w in self._waiting.values()),
+                'started': self.started,
+                'superseded': self.superseded,
+                'cancelled_waiting': self.cancelled_waiting,
+            }
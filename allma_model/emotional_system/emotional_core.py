@@ -1,10 +1,25 @@
 from typing import Dict, List, Optional, Tuple, Any
 from dataclasses import dataclass, field
 import json
+import logging
 import re
 from allma_model.soul.soul_core import SoulCore
 from allma_model.soul.soul_types import SoulState as InternalSoulState
 
+EMOTION_LABELS = ["joy", "sadness", "anger", "fear", "surprise", "neutral"]
+# Risposta di detect_emotion via LLM con output vincolato (generate_structured):
+# e=emozione, c=confidenza 0-1, i=intensità 0-1
+EMOTION_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "e": {"enum": EMOTION_LABELS},
+        "c": {"type": "number"},
+        "i": {"type": "number"},
+    },
+    "required": ["e", "c", "i"],
+    "additionalProperties": False,
+}
+
 @dataclass
 class EmotionalState:
     """Classe per rappresentare lo stato emotivo."""
@@ -272,6 +287,34 @@ class EmotionalCore:
         
         return detected_state
         
+    def detect_emotion_structured(self, text: str, llm_client, context: Optional[Dict] = None) -> Optional[EmotionalState]:
+        """
+        Rileva le emozioni con output JSON vincolato (llm_client.generate_structured).
+
+        Il prompt non descrive il formato: lo impone la grammatica dello schema.
+        Returns None se il modello non produce un JSON valido (si usa il percorso con parsing).
+        """
+        if context is None:
+            context = {}
+        prompt = (
+            f'<|im_start|>system\nClassifica l\'emozione del messaggio: e=emozione, '
+            f'c=confidenza 0-1, i=intensità 0-1.\n<|im_end|>\n'
+            f'<|im_start|>user\n"{text}"\n<|im_end|>\n<|im_start|>assistant\n'
+        )
+        data = llm_client.generate_structured(
+            prompt, EMOTION_SCHEMA, call_type="emotion", temperature=0.0, unconstrained_max_tokens=64,
+            cache=True  # greedy: stesso messaggio, stessa emozione senza rigenerare
+        )
+        if data is None:
+            return None
+        return EmotionalState(
+            primary_emotion=data["e"],
+            confidence=float(max(0.0, min(1.0, data["c"]))),
+            secondary_emotions={},
+            intensity=float(max(0.0, min(1.0, data["i"]))),
+            context=context
+        )
+
     def detect_emotion_via_llm(self, text: str, llm_generate_function, context: Optional[Dict] = None) -> EmotionalState:
         """
         Rileva le emozioni usando il modello LLM principale (Gemma/Qwen).
@@ -447,6 +490,14 @@ class EmotionalCore:
                         return heuristic_state
             except Exception:
                 pass
+            # Output vincolato dallo schema: niente preamboli né secondo tentativo
+            if hasattr(llm_client, 'generate_structured'):
+                try:
+                    state = self.detect_emotion_structured(text, llm_client, context)
+                    if state is not None:
+                        return state
+                except Exception as e:
+                    logging.warning(f"[EmotionalCore] detect_emotion_structured fallito, ripiego sul prompt libero: {e}")
             # Se llm_client è l'istanza Llama
             if hasattr(llm_client, '__call__'):
                 return self.detect_emotion_via_llm(text, llm_client, context)
@@ -1,17 +1,48 @@
 """
 Modulo per l'estrazione dei topic dai messaggi.
+
+Il percorso statistico usa un TopicModel precalcolato (learning_system/topic_model.py),
+costruito una sola volta per processo e condiviso tra le istanze.
 """
 import logging
-from typing import List, Dict
+import threading
+from typing import List, Dict, Optional
 import re
 
 import numpy as np
-from allma_model.utils.text_processing import SimpleTfidf, cosine_similarity
+from allma_model.learning_system.topic_model import TopicModel
+
+
+BASE_VOCAB = [
+    "technical", "programming", "code", "development", "python", "java", "javascript", "tecnologia", "intelligenza", "artificiale",
+    "progetto", "project", "management", "tasks", "timeline", "android", "apk", "buildozer", "kivy",
+    "learning", "education", "training", "study", "imparare", "studiare", "lezione",
+    "help", "support", "assistance", "guidance", "aiuto", "supporto", "assistenza",
+    "history", "storia", "chi era", "quando", "guerra", "impero", "napoleone",
+    "emotion", "emozione", "felice", "triste", "arrabbiato", "paura", "ansia",
+    "preference", "preferisco", "mi piace", "odio", "adoro", "colore", "colori", "chiaro", "chiari", "scuro", "scuri", "vestiti", "tessuto", "estate", "sudare",
+    "general", "conversation", "discussion", "chat", "parla", "spiega"
+]
+
+TOPIC_DESCRIPTIONS = {
+    "technical": "technical programming code development python java javascript bug errore",
+    "project": "project management tasks timeline android apk buildozer kivy deploy",
+    "learning": "learning education training study imparare studiare lezione",
+    "support": "help support assistance guidance aiuto supporto assistenza come fare",
+    "history": "history storia chi era quando guerra impero napoleone",
+    "emotion": "emotion emozione felice triste rabbia paura ansia stress",
+    "preference": "preference preferisco mi piace adoro odio scelta colore colori chiari scuri vestiti tessuto estate sudare",
+    "general": "general conversation discussion chat parlare spiegare"
+}
+
 
 class TopicExtractor:
     """
     Classe per l'estrazione dei topic dai messaggi.
     """
+    _base_model: Optional[TopicModel] = None
+    _base_model_lock = threading.Lock()
+
     def __init__(self, model_path: str = "models"):
         """
         Inizializza l'estrattore di topic.
@@ -20,7 +51,17 @@ class TopicExtractor:
             model_path: Percorso dei modelli
         """
         self.model_path = model_path
-        self.vectorizer = SimpleTfidf()
+        # Condiviso finché update_user_topic non richiede una copia privata
+        self.model = self.get_base_model()
+
+    @classmethod
+    def get_base_model(cls) -> TopicModel:
+        """Modello base, costruito una sola volta per processo."""
+        if cls._base_model is None:
+            with cls._base_model_lock:
+                if cls._base_model is None:
+                    cls._base_model = TopicModel.build(BASE_VOCAB, TOPIC_DESCRIPTIONS)
+        return cls._base_model
         
     def get_embeddings(self, text: str) -> np.ndarray:
         """
@@ -30,38 +71,13 @@ class TopicExtractor:
             text: Testo da analizzare
             
         Returns:
-            Embeddings del testo
+            Embeddings del testo nello spazio dei termini del modello
         """
         try:
-            base_vocab = [
-                "technical", "programming", "code", "development", "python", "java", "javascript", "tecnologia", "intelligenza", "artificiale",
-                "progetto", "project", "management", "tasks", "timeline", "android", "apk", "buildozer", "kivy",
-                "learning", "education", "training", "study", "imparare", "studiare", "lezione",
-                "help", "support", "assistance", "guidance", "aiuto", "supporto", "assistenza",
-                "history", "storia", "chi era", "quando", "guerra", "impero", "napoleone",
-                "emotion", "emozione", "felice", "triste", "arrabbiato", "paura", "ansia",
-                "preference", "preferisco", "mi piace", "odio", "adoro", "colore", "colori", "chiaro", "chiari", "scuro", "scuri", "vestiti", "tessuto", "estate", "sudare",
-                "general", "conversation", "discussion", "chat", "parla", "spiega"
-            ]
-            
-            # Aggiungi il testo corrente al vocabolario
-            texts = base_vocab + [text]
-            
-            # Calcola gli embeddings
-            max_features = 40
-            self.vectorizer = SimpleTfidf(max_features=max_features)
-            embeddings = self.vectorizer.fit_transform(texts)
-            
-            # Restituisci l'embedding dell'ultimo testo (quello corrente)
-            vec = embeddings[-1]
-            if hasattr(vec, 'toarray'):
-                return vec.toarray()[0]
-            else:
-                return vec
-            
+            return self.model.embed(text)
         except Exception as e:
             logging.error(f"Errore nel calcolo embeddings: {e}")
-            return np.zeros(40)
+            return np.zeros(len(self.model.terms))
             
     def extract_topic(
         self,
@@ -81,33 +97,9 @@ class TopicExtractor:
             if rule_topic and rule_topic != "general":
                 return rule_topic
 
-            # Calcola gli embeddings del testo
-            embeddings = self.get_embeddings(text)
-            
-            # Definisci i topic predefiniti con i loro embeddings
-            default_topics = {
-                "technical": self.get_embeddings("technical programming code development python java javascript bug errore"),
-                "project": self.get_embeddings("project management tasks timeline android apk buildozer kivy deploy"),
-                "learning": self.get_embeddings("learning education training study imparare studiare lezione"),
-                "support": self.get_embeddings("help support assistance guidance aiuto supporto assistenza come fare"),
-                "history": self.get_embeddings("history storia chi era quando guerra impero napoleone"),
-                "emotion": self.get_embeddings("emotion emozione felice triste rabbia paura ansia stress"),
-                "preference": self.get_embeddings("preference preferisco mi piace adoro odio scelta colore colori chiari scuri vestiti tessuto estate sudare"),
-                "general": self.get_embeddings("general conversation discussion chat parlare spiegare")
-            }
-            
-            # Calcola la similarità con ogni topic
-            similarities = {}
-            for topic, topic_emb in default_topics.items():
-                similarity = cosine_similarity(
-                    embeddings.reshape(1, -1),
-                    topic_emb.reshape(1, -1)
-                )[0][0]
-                similarities[topic] = similarity
-                
-            # Restituisci il topic con similarità maggiore
-            best_topic, best_score = max(similarities.items(), key=lambda x: x[1])
-            if best_score < 0.05:
+            # Similarità con i centroidi precalcolati: un solo prodotto sparso
+            best_topic, best_score = self.model.best_topic(text)
+            if best_topic is None or best_score < 0.05:
                 return "general"
             return best_topic
             
@@ -115,6 +107,29 @@ class TopicExtractor:
             logging.error(f"Errore nell'estrazione del topic: {e}")
             return "general"  # Topic di default in caso di errore
 
+    def update_user_topic(self, topic: str, text: str, weight: float = 1.0) -> bool:
+        """
+        Aggiorna in modo incrementale un topic specifico dell'utente.
+
+        Il modello base condiviso non viene toccato: alla prima modifica
+        l'istanza passa a una copia privata.
+
+        Args:
+            topic: Topic (esistente o nuovo)
+            text: Testo di esempio del topic
+            weight: Peso dell'esempio nel centroide
+
+        Returns:
+            True se il modello è stato aggiornato
+        """
+        try:
+            if self.model is TopicExtractor._base_model:
+                self.model = self.model.copy()
+            return self.model.update_topic(topic, text, weight)
+        except Exception as e:
+            logging.error(f"Errore nell'aggiornamento del topic {topic}: {e}")
+            return False
+
     def calculate_similarity(self, text1: str, text2: str) -> float:
         """
         Calcola la similarità tra due testi.
@@ -127,17 +142,7 @@ class TopicExtractor:
             Similarità tra i testi (0-1)
         """
         try:
-            # Calcola gli embeddings dei testi
-            emb1 = self.get_embeddings(text1)
-            emb2 = self.get_embeddings(text2)
-            
-            # Calcola la similarità del coseno
-            similarity = cosine_similarity(
-                emb1.reshape(1, -1),
-                emb2.reshape(1, -1)
-            )[0][0]
-            
-            return float(similarity)
+            return self.model.similarity(text1, text2)
             
         except Exception as e:
             logging.error(f"Errore nel calcolo della similarità: {e}")
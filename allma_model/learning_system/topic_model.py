@@ -0,0 +1,205 @@
+"""
+TopicModel — Modello di topic precalcolato per TopicExtractor
+
+Sostituisce il re-fit di SimpleTfidf sul vocabolario base ad ogni messaggio.
+
+Scopo:
+    extract_topic gira su ogni messaggio di process_message. Il vecchio percorso
+    rifaceva il fit TF-IDF 9 volte per chiamata (testo + 8 descrizioni di topic),
+    e ogni fit produceva un vocabolario diverso: i vettori confrontati non
+    condividevano le colonne.
+
+Architettura:
+    build()     → un solo fit TF-IDF su vocabolario base + descrizioni dei topic
+    idf         → pesi per termine, fissi (i termini fuori vocabolario usano oov_idf)
+    weights     → matrice termine → topic (V × T): centroidi normalizzati L2
+    scores()    → il testo diventa un vettore sparso (indici, pesi) e lo score
+                  per topic è un unico prodotto sparso: pesi @ weights[indici]
+
+Aggiornamento incrementale:
+    update_topic() somma il vettore di un testo al centroide del topic (nuovo o
+    esistente), aggiungendo le righe dei termini mai visti, e rinormalizza solo
+    quella colonna. Il modello base è condiviso: TopicExtractor lo copia prima
+    di applicare i topic specifici di un utente.
+"""
+
+import math
+from collections import Counter
+from typing import Dict, Iterable, List, Mapping, Optional, Tuple
+
+import numpy as np
+
+from allma_model.utils.text_processing import SimpleTfidf, tokenize
+
+
+class TopicModel:
+    """Centroidi dei topic e pesi termine → topic in uno spazio TF-IDF fisso."""
+
+    def __init__(
+        self,
+        terms: List[str],
+        idf: np.ndarray,
+        topics: List[str],
+        centroid_sums: np.ndarray,
+        counts: np.ndarray,
+        oov_idf: float
+    ):
+        self.terms = list(terms)
+        self.term_index: Dict[str, int] = {t: i for i, t in enumerate(self.terms)}
+        self.idf = np.asarray(idf, dtype=np.float64)
+        self.topics = list(topics)
+        self.topic_index: Dict[str, int] = {t: i for i, t in enumerate(self.topics)}
+        self.centroid_sums = np.asarray(centroid_sums, dtype=np.float64).reshape(len(self.terms), len(self.topics))
+        self.counts = np.asarray(counts, dtype=np.int64)
+        self.oov_idf = float(oov_idf)
+        self.weights = np.zeros_like(self.centroid_sums)
+        for col in range(len(self.topics)):
+            self._normalize_column(col)
+
+    @classmethod
+    def build(cls, corpus: Iterable[str], topic_descriptions: Mapping[str, str]) -> 'TopicModel':
+        """
+        Costruisce il modello con un solo fit TF-IDF.
+
+        Args:
+            corpus: documenti di riferimento per l'idf (es. vocabolario base)
+            topic_descriptions: topic → testo descrittivo (seme del centroide)
+        """
+        topics = list(topic_descriptions.keys())
+        descriptions = [topic_descriptions[t] for t in topics]
+        documents = list(corpus) + descriptions
+
+        vectorizer = SimpleTfidf()
+        vectorizer.fit_transform(documents)
+        terms = list(vectorizer.vocab)
+        idf = np.array([vectorizer.idf[t] for t in terms], dtype=np.float64)
+
+        # Come nel vecchio percorso: un termine presente solo nel testo ha df = 1
+        oov_idf = math.log(max(1, len(documents)) / 2.0)
+
+        centroid_sums = vectorizer.transform(descriptions).toarray().T
+        return cls(terms, idf, topics, centroid_sums, np.ones(len(topics), dtype=np.int64), oov_idf)
+
+    def copy(self) -> 'TopicModel':
+        return TopicModel(
+            self.terms, self.idf.copy(), self.topics, self.centroid_sums.copy(), self.counts.copy(), self.oov_idf
+        )
+
+    # ------------------------------------------------------------------
+    # Vettorizzazione e scoring
+    # ------------------------------------------------------------------
+
+    def vectorize(self, text: str) -> Tuple[np.ndarray, np.ndarray, float]:
+        """
+        Vettore TF-IDF sparso del testo.
+
+        Returns:
+            (indici dei termini noti, pesi, norma L2 inclusi i termini fuori vocabolario)
+        """
+        counts = Counter(tokenize(text))
+        indices: List[int] = []
+        tf: List[int] = []
+        oov_sq = 0.0
+        for term, count in counts.items():
+            idx = self.term_index.get(term)
+            if idx is None:
+                oov_sq += (count * self.oov_idf) ** 2
+            else:
+                indices.append(idx)
+                tf.append(count)
+        idx_array = np.asarray(indices, dtype=np.int64)
+        weights = np.asarray(tf, dtype=np.float64) * self.idf[idx_array]
+        norm = math.sqrt(float(weights @ weights) + oov_sq)
+        return idx_array, weights, norm
+
+    def embed(self, text: str) -> np.ndarray:
+        """Vettore denso nello spazio dei termini del modello (non normalizzato)."""
+        dense = np.zeros(len(self.terms), dtype=np.float64)
+        indices, weights, _ = self.vectorize(text)
+        dense[indices] = weights
+        return dense
+
+    def scores(self, text: str) -> Dict[str, float]:
+        """Similarità coseno tra il testo e ogni centroide."""
+        indices, weights, norm = self.vectorize(text)
+        if norm == 0 or len(indices) == 0:
+            return {topic: 0.0 for topic in self.topics}
+        raw = weights @ self.weights[indices] / norm
+        return dict(zip(self.topics, raw.tolist()))
+
+    def best_topic(self, text: str) -> Tuple[Optional[str], float]:
+        """Topic con score massimo (None se il modello non ha topic)."""
+        if not self.topics:
+            return None, 0.0
+        scores = self.scores(text)
+        topic = max(self.topics, key=lambda t: scores[t])
+        return topic, scores[topic]
+
+    def similarity(self, text1: str, text2: str) -> float:
+        """Coseno tra due testi, con i termini fuori vocabolario confrontati per stringa."""
+        c1, c2 = Counter(tokenize(text1)), Counter(tokenize(text2))
+        if not c1 or not c2:
+            return 0.0
+
+        def weight(term: str, count: int) -> float:
+            idx = self.term_index.get(term)
+            return count * (self.idf[idx] if idx is not None else self.oov_idf)
+
+        w1 = {t: weight(t, c) for t, c in c1.items()}
+        w2 = {t: weight(t, c) for t, c in c2.items()}
+        dot = sum(w * w2[t] for t, w in w1.items() if t in w2)
+        n1 = math.sqrt(sum(w * w for w in w1.values()))
+        n2 = math.sqrt(sum(w * w for w in w2.values()))
+        if n1 == 0 or n2 == 0:
+            return 0.0
+        return float(dot / (n1 * n2))
+
+    # ------------------------------------------------------------------
+    # Aggiornamento incrementale
+    # ------------------------------------------------------------------
+
+    def _normalize_column(self, col: int) -> None:
+        norm = np.linalg.norm(self.centroid_sums[:, col])
+        self.weights[:, col] = self.centroid_sums[:, col] / norm if norm > 0 else 0.0
+
+    def _add_terms(self, terms: List[str]) -> None:
+        for term in terms:
+            self.term_index[term] = len(self.terms)
+            self.terms.append(term)
+        extra = len(terms)
+        self.idf = np.concatenate([self.idf, np.full(extra, self.oov_idf)])
+        self.centroid_sums = np.vstack([self.centroid_sums, np.zeros((extra, len(self.topics)))])
+        self.weights = np.vstack([self.weights, np.zeros((extra, len(self.topics)))])
+
+    def _add_topic(self, topic: str) -> int:
+        col = len(self.topics)
+        self.topics.append(topic)
+        self.topic_index[topic] = col
+        self.centroid_sums = np.hstack([self.centroid_sums, np.zeros((len(self.terms), 1))])
+        self.weights = np.hstack([self.weights, np.zeros((len(self.terms), 1))])
+        self.counts = np.append(self.counts, 0)
+        return col
+
+    def update_topic(self, topic: str, text: str, weight: float = 1.0) -> bool:
+        """
+        Aggiunge un esempio al centroide di un topic (creandolo se serve).
+
+        Returns:
+            True se il testo conteneva almeno un termine
+        """
+        tokens = tokenize(text)
+        if not tokens or not topic:
+            return False
+
+        new_terms = [t for t in dict.fromkeys(tokens) if t not in self.term_index]
+        if new_terms:
+            self._add_terms(new_terms)
+        col = self.topic_index.get(topic)
+        if col is None:
+            col = self._add_topic(topic)
+
+        indices, weights, _ = self.vectorize(text)
+        self.centroid_sums[indices, col] += weight * weights
+        self.counts[col] += 1
+        self._normalize_column(col)
+        return True
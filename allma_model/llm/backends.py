@@ -0,0 +1,417 @@
+"""
+Backends — Interfaccia del modello per MobileGemmaWrapper e backend simulato
+
+Scopo:
+    Tutta la pipeline dipende da un GGUF di qualche GB e da llama_cpp: senza
+    un dispositivo non si potevano misurare scheduler, cache KV, prefill o
+    l'intero ALLMACore. MockLLMBackend simula il modello con tempi
+    deterministici (prefill e decodifica a token/s configurabili, rallentamento
+    termico) e output da copione o da modello di testo: ogni ottimizzazione si
+    misura offline, anche in CI su Linux.
+
+Architettura:
+    LLMBackend         → il sottoinsieme di llama_cpp.Llama usato dal wrapper:
+                         tokenize, eval, __call__ (stream o no), input_ids /
+                         n_tokens, save_state / load_state, set_cache, n_ctx
+                         (typing.Protocol). Llama lo soddisfa già (il backend
+                         di produzione resta quello caricato da _load); un
+                         backend alternativo si passa a
+                         MobileGemmaWrapper(backend=...)
+    MockLLMBackend     → contesto KV simulato: il prefisso comune con i token
+                         già valutati non costa prefill, come in llama.cpp
+    MockStateCache     → LlamaRAMCache simulata (prefisso più lungo, LRU a byte)
+                         per le cache per conversazione di KVCacheManager
+    thermal_ramp(...)  → curva calore → rallentamento: il calore cresce col
+                         lavoro simulato e cala nei periodi di inattività
+
+Tempi:
+    Prefill, decodifica e save/load_state dormono davvero (time_scale li
+    accorcia in modo proporzionale): latenze, attese del lock e TTFT misurati
+    dal wrapper sono quelli di un dispositivo con le velocità configurate.
+"""
+
+from __future__ import annotations
+
+import re
+import struct
+import threading
+import time
+import zlib
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Iterator, List, Optional, Protocol, Sequence, Union, runtime_checkable
+
+
+@runtime_checkable
+class LLMBackend(Protocol):
+    """
+    Interfaccia del modello usata da MobileGemmaWrapper (sottoinsieme di llama_cpp.Llama).
+
+    Protocollo strutturale: llama_cpp.Llama e MockLLMBackend lo soddisfano
+    senza ereditare. Gli stati di save_state hanno input_ids, n_tokens,
+    llama_state (bytes) e llama_state_size, come quelli leggeri installati da
+    MobileGemmaWrapper._load. Facoltativo: new_cache(capacity_bytes) per le
+    cache per conversazione (senza, LlamaCache di llama.cpp).
+    """
+
+    input_ids: Sequence[int]
+    n_tokens: int
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> List[int]: ...
+
+    def detokenize(self, tokens: Sequence[int]) -> bytes: ...
+
+    def eval(self, tokens: Sequence[int]) -> None:
+        """Valuta tokens dopo i primi n_tokens del contesto."""
+
+    def __call__(self, prompt: Union[str, Sequence[int]], **kwargs: Any) -> Any:
+        """Completamento: dict in stile OpenAI, o iteratore di chunk con stream=True."""
+
+    def save_state(self) -> Any: ...
+
+    def load_state(self, state: Any) -> None: ...
+
+    def set_cache(self, cache: Optional[Any]) -> None: ...
+
+    def n_ctx(self) -> int: ...
+
+    def n_vocab(self) -> int: ...
+
+
+def thermal_ramp(onset_s: float = 30.0, full_s: float = 120.0, max_slowdown: float = 2.0) -> Callable[[float], float]:
+    """
+    Curva termica: nessun rallentamento fino a onset_s secondi di lavoro
+    continuo, poi crescita lineare fino a max_slowdown a full_s.
+    """
+    def curve(heat_s: float) -> float:
+        if heat_s <= onset_s:
+            return 1.0
+        ramp = min(1.0, (heat_s - onset_s) / max(1e-9, full_s - onset_s))
+        return 1.0 + ramp * (max_slowdown - 1.0)
+    return curve
+
+
+class _MockState:
+    """Stato salvato: stesso formato degli stati leggeri di llama.cpp nel wrapper."""
+
+    def __init__(self, input_ids: List[int], n_tokens: int, llama_state: bytes):
+        self.input_ids = input_ids
+        self.n_tokens = n_tokens
+        self.llama_state = llama_state
+        self.llama_state_size = len(llama_state)
+
+
+class MockStateCache:
+    """LlamaRAMCache simulata: stati per sequenza di token, lookup per prefisso più lungo."""
+
+    def __init__(self, capacity_bytes: int = 1 << 30):
+        self.capacity_bytes = int(capacity_bytes)
+        self.cache_state: "OrderedDict[tuple, _MockState]" = OrderedDict()
+
+    @property
+    def cache_size(self) -> int:
+        return sum(state.llama_state_size for state in self.cache_state.values())
+
+    def _find_prefix_key(self, key: Sequence[int]) -> Optional[tuple]:
+        best, best_len = None, 0
+        for k in self.cache_state:
+            n = MockLLMBackend.common_prefix_len(k, key)
+            if n > best_len:
+                best, best_len = k, n
+        return best
+
+    def __getitem__(self, key: Sequence[int]) -> _MockState:
+        found = self._find_prefix_key(tuple(key))
+        if found is None:
+            raise KeyError("Key not found")
+        self.cache_state.move_to_end(found)
+        return self.cache_state[found]
+
+    def __contains__(self, key: Sequence[int]) -> bool:
+        return self._find_prefix_key(tuple(key)) is not None
+
+    def __setitem__(self, key: Sequence[int], value: _MockState) -> None:
+        key = tuple(key)
+        if key in self.cache_state:
+            del self.cache_state[key]
+        self.cache_state[key] = value
+        while self.cache_size > self.capacity_bytes and len(self.cache_state) > 0:
+            self.cache_state.popitem(last=False)
+
+
+class MockLLMBackend:
+    """
+    Modello simulato con tempi deterministici.
+
+    Usage:
+        backend = MockLLMBackend(prefill_tps=120, decode_tps=12,
+                                 responses="Capito: {last_user}",
+                                 thermal_curve=thermal_ramp(onset_s=20, max_slowdown=1.8))
+        wrapper = MobileGemmaWrapper(models_dir, backend=backend)
+
+    Output:
+        responses può essere una stringa modello ({prompt}, {last_user}, {n}),
+        una lista di risposte da copione (in ordine, ripetute ciclicamente) o
+        una funzione prompt → risposta. Le stringhe di stop troncano l'output.
+    """
+
+    BOS_ID = 1
+    EOS_ID = 2
+    # Pezzi del tokenizzatore: marcatori ChatML, parole con lo spazio iniziale
+    _PIECE = re.compile(r"<\|[^|<>]*\|>|\s+(?=<\|)|\s*[^\s<]+|\s*<|\s+")
+    _LAST_USER = re.compile(r"<\|im_start\|>user\n(.*?)(?:<\|im_end\|>|$)", re.DOTALL)
+
+    def __init__(
+        self,
+        prefill_tps: float = 100.0,
+        decode_tps: float = 10.0,
+        responses: Union[str, Sequence[str], Callable[[str], str]] = "Risposta simulata a: {last_user}",
+        n_ctx: int = 2048,
+        n_vocab: int = 151936,
+        kv_bytes_per_token: int = 1024,
+        state_io_mbps: float = 400.0,
+        thermal_curve: Optional[Callable[[float], float]] = None,
+        cooling_rate: float = 1.0,
+        time_scale: float = 1.0,
+        sleep: Callable[[float], None] = time.sleep
+    ):
+        """
+        Args:
+            prefill_tps / decode_tps: token/s di valutazione del prompt e di generazione
+            kv_bytes_per_token: byte di stato KV per token (dimensione di save_state)
+            state_io_mbps: MB/s di save_state / load_state
+            thermal_curve: calore (secondi di lavoro) → fattore di rallentamento (≥ 1)
+            cooling_rate: secondi di calore smaltiti per secondo di inattività
+            time_scale: fattore sulle attese reali (0.1 = dieci volte più veloce)
+        """
+        self.prefill_tps = float(prefill_tps)
+        self.decode_tps = float(decode_tps)
+        self.responses = responses
+        self._n_ctx = int(n_ctx)
+        self._n_vocab = int(n_vocab)
+        self.kv_bytes_per_token = int(kv_bytes_per_token)
+        self.state_io_mbps = float(state_io_mbps)
+        self.thermal_curve = thermal_curve
+        self.cooling_rate = float(cooling_rate)
+        self.time_scale = float(time_scale)
+        self._sleep = sleep
+        self.input_ids: List[int] = []
+        self.n_tokens = 0
+        self.draft_model = None
+        self.cache: Optional[MockStateCache] = None
+        # save_state/load_state già nel formato leggero: abilita KVStateStore
+        self._allma_light_cache_patched = True
+        self._lock = threading.Lock()
+        self._pieces: Dict[int, str] = {}
+        self._calls = 0
+        self._heat_s = 0.0
+        self._idle_since = time.monotonic()
+        self._stats = {
+            "calls": 0, "prompt_tokens": 0, "prefilled_tokens": 0, "reused_tokens": 0, "decoded_tokens": 0,
+            "prefill_s": 0.0, "decode_s": 0.0, "state_s": 0.0, "state_saves": 0, "state_loads": 0, "cache_loads": 0,
+        }
+
+    # ------------------------------------------------------------------
+    # Tokenizzatore (stabile tra i processi: id da crc32 del pezzo)
+    # ------------------------------------------------------------------
+
+    def tokenize(self, text: bytes, add_bos: bool = True, special: bool = False) -> List[int]:
+        if isinstance(text, bytes):
+            text = text.decode("utf-8", errors="ignore")
+        tokens = [self.BOS_ID] if add_bos else []
+        return tokens + [self._piece_id(piece) for piece in self._PIECE.findall(text)]
+
+    def _piece_id(self, piece: str) -> int:
+        token = 3 + zlib.crc32(piece.encode("utf-8")) % (self._n_vocab - 3)
+        self._pieces[token] = piece
+        return token
+
+    def detokenize(self, tokens: Sequence[int]) -> bytes:
+        return "".join(self._pieces.get(int(t), "") for t in tokens).encode("utf-8")
+
+    def n_ctx(self) -> int:
+        return self._n_ctx
+
+    def n_vocab(self) -> int:
+        return self._n_vocab
+
+    def token_eos(self) -> int:
+        return self.EOS_ID
+
+    @staticmethod
+    def common_prefix_len(a: Sequence[int], b: Sequence[int]) -> int:
+        n = 0
+        for x, y in zip(a, b):
+            if x != y:
+                break
+            n += 1
+        return n
+
+    # ------------------------------------------------------------------
+    # Tempi simulati
+    # ------------------------------------------------------------------
+
+    @property
+    def slowdown(self) -> float:
+        """Fattore di rallentamento termico attuale (calore raffreddato fino ad ora)."""
+        self._cool()
+        return self.thermal_curve(self._heat_s) if self.thermal_curve else 1.0
+
+    def _cool(self) -> None:
+        now = time.monotonic()
+        idle = now - self._idle_since
+        if idle > 0:
+            self._heat_s = max(0.0, self._heat_s - idle * self.cooling_rate / max(self.time_scale, 1e-9))
+        self._idle_since = now
+
+    def _work(self, seconds: float, kind: str) -> None:
+        """Lavoro simulato: attesa scalata col rallentamento termico, poi il calore cresce."""
+        factor = self.slowdown
+        simulated = seconds * factor
+        if simulated > 0:
+            self._sleep(simulated * self.time_scale)
+        self._heat_s += simulated
+        self._idle_since = time.monotonic()
+        self._stats[kind] += simulated
+
+    # ------------------------------------------------------------------
+    # Contesto KV
+    # ------------------------------------------------------------------
+
+    def reset(self) -> None:
+        self.n_tokens = 0
+
+    def eval(self, tokens: Sequence[int]) -> None:
+        tokens = [int(t) for t in tokens]
+        if self.n_tokens + len(tokens) > self._n_ctx:
+            raise ValueError(f"Requested tokens ({self.n_tokens + len(tokens)}) exceed context window of {self._n_ctx}")
+        self._work(len(tokens) / self.prefill_tps, "prefill_s")
+        self.input_ids = self.input_ids[:self.n_tokens] + tokens
+        self.n_tokens = len(self.input_ids)
+        self._stats["prefilled_tokens"] += len(tokens)
+
+    def _state_bytes(self, tokens: Sequence[int]) -> bytes:
+        body = struct.pack(f"<{len(tokens)}i", *tokens)
+        return body + b"\0" * max(0, len(tokens) * self.kv_bytes_per_token - len(body))
+
+    def save_state(self) -> _MockState:
+        tokens = self.input_ids[:self.n_tokens]
+        blob = self._state_bytes(tokens)
+        self._work(len(blob) / (self.state_io_mbps * 1e6), "state_s")
+        self._stats["state_saves"] += 1
+        return _MockState(list(tokens), len(tokens), blob)
+
+    def load_state(self, state: Any) -> None:
+        n = int(state.n_tokens)
+        tokens = [int(t) for t in list(state.input_ids)[:n]]
+        if bytes(state.llama_state[:4 * n]) != struct.pack(f"<{n}i", *tokens):
+            raise RuntimeError("Failed to set llama state data")
+        self._work(int(state.llama_state_size) / (self.state_io_mbps * 1e6), "state_s")
+        self.input_ids = tokens
+        self.n_tokens = n
+        self._stats["state_loads"] += 1
+
+    def set_cache(self, cache: Optional[MockStateCache]) -> None:
+        self.cache = cache
+
+    def new_cache(self, capacity_bytes: int) -> MockStateCache:
+        return MockStateCache(capacity_bytes)
+
+    # ------------------------------------------------------------------
+    # Completamento
+    # ------------------------------------------------------------------
+
+    def _render(self, prompt: str) -> str:
+        with self._lock:
+            n = self._calls
+            self._calls += 1
+        if callable(self.responses):
+            return self.responses(prompt)
+        if not isinstance(self.responses, str):
+            return self.responses[n % len(self.responses)] if self.responses else ""
+        users = self._LAST_USER.findall(prompt)
+        last_user = users[-1].strip() if users else prompt.strip()
+        return self.responses.format(prompt=prompt, last_user=last_user, n=n)
+
+    def _prepare(self, prompt_tokens: List[int]) -> None:
+        """Come llama.cpp: stato dalla cache se allunga il prefisso riusato, poi prefill del resto."""
+        reused = self.common_prefix_len(self.input_ids[:self.n_tokens], prompt_tokens)
+        if self.cache is not None:
+            try:
+                state = self.cache[prompt_tokens]
+                if self.common_prefix_len(state.input_ids[:state.n_tokens], prompt_tokens) > reused:
+                    self.load_state(state)
+                    self._stats["cache_loads"] += 1
+                    reused = self.common_prefix_len(self.input_ids[:self.n_tokens], prompt_tokens)
+            except KeyError:
+                pass
+        # L'ultimo token del prompt si rivaluta sempre (servono i suoi logits)
+        reused = min(reused, len(prompt_tokens) - 1)
+        self.n_tokens = max(0, reused)
+        self._stats["reused_tokens"] += max(0, reused)
+        self.eval(prompt_tokens[self.n_tokens:])
+
+    def _completion(self, prompt_tokens: List[int], text: str, max_tokens: Optional[int],
+                    stop: Optional[Sequence[str]]) -> Iterator[Dict[str, Any]]:
+        """Prefill e decodifica token per token: chunk in stile llama_cpp."""
+        self._stats["calls"] += 1
+        self._stats["prompt_tokens"] += len(prompt_tokens)
+        self._prepare(prompt_tokens)
+        finish_reason = "stop"
+        for s in stop or []:
+            if s and s in text:
+                text = text[:text.index(s)]
+        pieces = [self._piece_id(piece) for piece in self._PIECE.findall(text)]
+        budget = self._n_ctx - self.n_tokens
+        if max_tokens is not None and max_tokens > 0:
+            budget = min(budget, max_tokens)
+        if len(pieces) > budget:
+            pieces, finish_reason = pieces[:budget], "length"
+        for i, token in enumerate(pieces):
+            self._work(1.0 / self.decode_tps, "decode_s")
+            self.input_ids = self.input_ids[:self.n_tokens] + [token]
+            self.n_tokens += 1
+            self._stats["decoded_tokens"] += 1
+            yield {"choices": [{"text": self._pieces[token], "index": 0,
+                                "finish_reason": finish_reason if i == len(pieces) - 1 else None}]}
+        if self.cache is not None:
+            self.cache[self.input_ids[:self.n_tokens]] = self.save_state()
+
+    def __call__(
+        self,
+        prompt: Union[str, Sequence[int]],
+        max_tokens: Optional[int] = 16,
+        stop: Optional[Union[str, Sequence[str]]] = None,
+        stream: bool = False,
+        echo: bool = False,
+        **kwargs: Any
+    ) -> Any:
+        """Completamento simulato; temperature, seed, grammar e gli altri parametri di campionamento sono ignorati."""
+        if isinstance(prompt, str):
+            prompt_tokens = self.tokenize(prompt.encode("utf-8"))
+            prompt_text = prompt
+        else:
+            prompt_tokens = [int(t) for t in prompt]
+            prompt_text = self.detokenize(prompt_tokens).decode("utf-8")
+        if isinstance(stop, str):
+            stop = [stop]
+        text = self._render(prompt_text)
+        chunks = self._completion(prompt_tokens, text, max_tokens, stop)
+        if stream:
+            return chunks
+        parts = list(chunks)
+        completion = "".join(c["choices"][0]["text"] for c in parts)
+        finish_reason = parts[-1]["choices"][0]["finish_reason"] if parts else "stop"
+        return {
+            "choices": [{"text": completion, "index": 0, "finish_reason": finish_reason}],
+            "usage": {"prompt_tokens": len(prompt_tokens), "completion_tokens": len(parts),
+                      "total_tokens": len(prompt_tokens) + len(parts)},
+        }
+
+    def get_stats(self) -> Dict[str, Any]:
+        """Token valutati, riusati e generati, secondi simulati di prefill e decodifica, rallentamento attuale."""
+        stats: Dict[str, Any] = dict(self._stats)
+        stats["prefill_s"] = round(stats["prefill_s"], 3)
+        stats["decode_s"] = round(stats["decode_s"], 3)
+        stats["state_s"] = round(stats["state_s"], 3)
+        stats["slowdown"] = round(self.slowdown, 3)
+        return stats
@@ -0,0 +1,231 @@
+"""
+CompletionCache — Cache persistente delle risposte deterministiche del LLM
+
+Scopo:
+    Le chiamate ausiliarie (emozione di messaggi brevi ripetuti, entità di
+    frasi ricorrenti) ripartono spesso con lo stesso identico prompt e con
+    campionamento greedy: la risposta è già nota, ma ogni volta costava
+    attesa del lock di inferenza, prefill e decodifica. Una risposta salvata
+    per contenuto della richiesta torna in pochi millisecondi.
+
+Architettura:
+    completion_key(...)  → SHA-256 di modello, prompt, parametri di
+                           campionamento e grammatica: ogni dato che cambia
+                           l'output cambia la chiave
+    is_deterministic     → solo temperature <= 0 (greedy) o seed fisso: con
+                           campionamento casuale la cache viene saltata
+    SQLite (una tabella) → chiave, testo, token, ms della generazione
+                           originale; last_used per l'espulsione LRU fino a
+                           rientrare in max_entries e max_bytes
+    impronta del modello → all'apertura si cancellano le voci di un altro
+                           modello (file GGUF, n_ctx, versione di llama_cpp)
+
+Errori:
+    Un errore di SQLite (file bloccato, disco pieno, database corrotto)
+    disattiva la cache con un warning: la chiamata genera come se la cache
+    non ci fosse.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import threading
+import time
+from typing import Any, Dict, Optional, Sequence, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+
+def is_deterministic(temperature: float, seed: Optional[int] = None) -> bool:
+    """True se la stessa richiesta produce sempre lo stesso output (greedy o seed fisso)."""
+    return seed is not None or temperature is None or temperature <= 0.0
+
+
+def completion_key(
+    model_id: str,
+    prompt: str,
+    params: Dict[str, Any],
+    grammar: Optional[str] = None
+) -> str:
+    """Chiave per contenuto: modello, prompt, parametri di campionamento (ordinati) e grammatica."""
+    payload = json.dumps(
+        {"model": model_id, "prompt": prompt, "params": params, "grammar": grammar or ""},
+        sort_keys=True, ensure_ascii=False, default=str
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class CompletionCache:
+    """
+    Risposte del LLM su SQLite, con limiti di voci e di byte ed espulsione LRU.
+
+    Usage:
+        cache = CompletionCache(os.path.join(models_dir, "completion_cache.sqlite"),
+                                model_id=model_fingerprint(model_path, 2048))
+        key = completion_key(cache.model_id, prompt, {"max_tokens": 24, "temperature": 0.0})
+        hit = cache.get(key)                 # (testo, token) o None
+        cache.put(key, text, completion_tokens, elapsed_ms)
+    """
+
+    def __init__(
+        self,
+        path: str,
+        model_id: str = "",
+        max_entries: int = 4096,
+        max_bytes: int = 4 << 20
+    ):
+        self.path = path
+        self.model_id = model_id
+        self.max_entries = int(max_entries)
+        self.max_bytes = int(max_bytes)
+        self._lock = threading.Lock()
+        self._stats = {
+            "hits": 0, "misses": 0, "bypassed": 0, "stores": 0, "evictions": 0, "errors": 0,
+            "saved_ms": 0.0, "saved_tokens": 0,
+        }
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self._conn: Optional[sqlite3.Connection] = sqlite3.connect(path, timeout=5, check_same_thread=False)
+        with self._lock:
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS completions (
+                    key TEXT PRIMARY KEY,
+                    model TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    completion_tokens INTEGER NOT NULL,
+                    generation_ms REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    created REAL NOT NULL,
+                    last_used REAL NOT NULL,
+                    hits INTEGER NOT NULL DEFAULT 0
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS completions_lru ON completions(last_used)")
+            stale = self._conn.execute("DELETE FROM completions WHERE model != ?", (model_id,)).rowcount
+            self._conn.commit()
+        if stale:
+            logger.info(f"[CompletionCache] Dropped {stale} entries of another model")
+
+    def _failed(self, e: Exception) -> None:
+        """Errore di SQLite: la cache si spegne (le chiamate generano normalmente)."""
+        logger.warning(f"[CompletionCache] Disabled after SQLite error: {e}")
+        self._stats["errors"] += 1
+        try:
+            self._conn.close()
+        except Exception:
+            pass
+        self._conn = None
+
+    def bypass(self) -> None:
+        """Richiesta non deterministica: niente lettura né scrittura (solo conteggio)."""
+        with self._lock:
+            self._stats["bypassed"] += 1
+
+    def get(self, key: str) -> Optional[Tuple[str, int]]:
+        """(testo, token di completamento) della risposta salvata, o None."""
+        with self._lock:
+            if self._conn is None:
+                return None
+            try:
+                row = self._conn.execute(
+                    "SELECT text, completion_tokens, generation_ms FROM completions WHERE key = ?", (key,)
+                ).fetchone()
+                if row is None:
+                    self._stats["misses"] += 1
+                    return None
+                self._conn.execute(
+                    "UPDATE completions SET last_used = ?, hits = hits + 1 WHERE key = ?", (time.time(), key)
+                )
+                self._conn.commit()
+            except sqlite3.Error as e:
+                self._failed(e)
+                return None
+            self._stats["hits"] += 1
+            self._stats["saved_ms"] += row[2]
+            self._stats["saved_tokens"] += row[1]
+        return row[0], int(row[1])
+
+    def put(self, key: str, text: str, completion_tokens: int, generation_ms: float) -> bool:
+        """Salva la risposta e riporta la cache nei limiti; False se la voce da sola supera max_bytes."""
+        size = len(key) + len(text.encode("utf-8"))
+        if size > self.max_bytes:
+            return False
+        now = time.time()
+        with self._lock:
+            if self._conn is None:
+                return False
+            try:
+                self._conn.execute(
+                    "INSERT OR REPLACE INTO completions "
+                    "(key, model, text, completion_tokens, generation_ms, size, created, last_used) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                    (key, self.model_id, text, int(completion_tokens or 0), float(generation_ms), size, now, now)
+                )
+                self._evict()
+                self._conn.commit()
+            except sqlite3.Error as e:
+                self._failed(e)
+                return False
+            self._stats["stores"] += 1
+        return True
+
+    def _evict(self) -> None:
+        """Espulsione LRU fino a rientrare nei limiti (con il lock preso)."""
+        entries, size = self._conn.execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions").fetchone()
+        if entries <= self.max_entries and size <= self.max_bytes:
+            return
+        victims: Sequence[Tuple[str, int]] = self._conn.execute(
+            "SELECT key, size FROM completions ORDER BY last_used ASC"
+        ).fetchall()
+        dropped = []
+        for key, entry_size in victims:
+            if entries <= self.max_entries and size <= self.max_bytes:
+                break
+            dropped.append((key,))
+            entries -= 1
+            size -= entry_size
+        self._conn.executemany("DELETE FROM completions WHERE key = ?", dropped)
+        self._stats["evictions"] += len(dropped)
+
+    def clear(self) -> None:
+        with self._lock:
+            if self._conn is None:
+                return
+            try:
+                self._conn.execute("DELETE FROM completions")
+                self._conn.commit()
+            except sqlite3.Error as e:
+                self._failed(e)
+
+    def close(self) -> None:
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats: Dict[str, Any] = dict(self._stats)
+            entries, size = 0, 0
+            if self._conn is not None:
+                try:
+                    entries, size = self._conn.execute(
+                        "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM completions"
+                    ).fetchone()
+                except sqlite3.Error as e:
+                    self._failed(e)
+        lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else None
+        stats["saved_ms"] = round(stats["saved_ms"], 1)
+        stats["entries"] = entries
+        stats["bytes"] = size
+        stats["max_entries"] = self.max_entries
+        stats["max_bytes"] = self.max_bytes
+        stats["enabled"] = self._conn is not None
+        return stats
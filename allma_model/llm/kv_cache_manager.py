@@ -0,0 +1,277 @@
+"""
+KVCacheManager — Cache KV in RAM di più conversazioni, con budget in byte
+
+Scopo:
+    MobileGemmaWrapper teneva al massimo 2 LlamaCache da 256 MB: un limite sul
+    numero di conversazioni che ignora sia la dimensione reale degli stati
+    sia la RAM del dispositivo. Chi alterna tre chat perdeva sempre la cache;
+    con poca RAM due cache piene potevano portare l'app all'OOM.
+
+Architettura:
+    CacheEntry             → LlamaCache di una conversazione, hash del prefisso,
+                             byte reali (somma degli stati serializzati) e
+                             token coperti, ultimo uso
+    cache_for(conv, hash)  → cache della conversazione (hit) o nuova (miss);
+                             un prefisso di sistema diverso la invalida
+    update(conv)           → rilegge la dimensione reale dopo una generazione
+                             ed espelle fino a rientrare nel budget
+    budget_bytes()         → ram_fraction di (RAM disponibile + byte già in
+                             cache), tra min_bytes e max_bytes
+    espulsione             → punteggio = recenza × costo di prefill risparmiato
+                             (token coperti × ms/token misurati); esce il
+                             punteggio più basso, mai la conversazione attiva.
+                             on_evict riceve la voce (es. per salvarla su disco)
+
+Budget:
+    RAM disponibile da psutil, altrimenti da /proc/meminfo (Android non ha
+    psutil). Con memoria sotto pressione (SystemMonitor, cognitive_load alto)
+    il budget scende a min_bytes; con la batteria calda la CPU è limitata e
+    ogni prefill costa di più, quindi la frazione di RAM concessa sale a
+    hot_ram_fraction (sempre entro max_bytes).
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    import psutil
+    PSUTIL_AVAILABLE = True
+except ImportError:
+    PSUTIL_AVAILABLE = False
+
+
+logger = logging.getLogger(__name__)
+
+
+def available_memory_bytes() -> Optional[int]:
+    """RAM disponibile per nuove allocazioni (None se non misurabile)."""
+    if PSUTIL_AVAILABLE:
+        try:
+            return int(psutil.virtual_memory().available)
+        except Exception:
+            pass
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+@dataclass
+class CacheEntry:
+    """LlamaCache di una conversazione e ciò che serve per decidere se tenerla."""
+    conversation_id: str
+    prefix_hash: str
+    cache: Any
+    size_bytes: int = 0
+    tokens: int = 0
+    last_used: float = field(default_factory=time.monotonic)
+
+
+class KVCacheManager:
+    """
+    LlamaCache per conversazione con budget globale in byte ed espulsione cost-aware.
+
+    Usage:
+        manager = KVCacheManager(lambda capacity: LlamaCache(capacity_bytes=capacity),
+                                 system_monitor=monitor, on_evict=persist_to_disk)
+        llm.set_cache(manager.cache_for(conversation_id, prefix_hash))
+        ...                                  # generazione
+        manager.update(conversation_id)      # dimensione reale + budget
+    """
+
+    RECENCY_HALF_LIFE_S = 600.0
+    BUDGET_REFRESH_S = 10.0
+    HOT_BATTERY_C = 40.0
+    DEFAULT_MS_PER_TOKEN = 20.0
+
+    def __init__(
+        self,
+        cache_factory: Callable[[int], Any],
+        max_bytes: int = 768 << 20,
+        min_bytes: int = 64 << 20,
+        ram_fraction: float = 0.25,
+        hot_ram_fraction: float = 0.35,
+        max_entries: int = 8,
+        system_monitor=None,
+        on_evict: Optional[Callable[[CacheEntry], None]] = None,
+        memory_probe: Callable[[], Optional[int]] = available_memory_bytes,
+    ):
+        self.cache_factory = cache_factory
+        self.max_bytes = int(max_bytes)
+        self.min_bytes = int(min_bytes)
+        self.ram_fraction = ram_fraction
+        self.hot_ram_fraction = hot_ram_fraction
+        self.max_entries = max_entries
+        self.system_monitor = system_monitor
+        self.on_evict = on_evict
+        self.memory_probe = memory_probe
+        self.ms_per_token = self.DEFAULT_MS_PER_TOKEN
+        self._entries: Dict[str, CacheEntry] = {}
+        self._active: Optional[str] = None
+        self._budget: Optional[int] = None
+        self._budget_at = 0.0
+        self._lock = threading.RLock()
+        self._stats = {"hits": 0, "misses": 0, "evictions": 0, "invalidations": 0}
+
+    # ------------------------------------------------------------------
+    # Budget
+    # ------------------------------------------------------------------
+
+    def budget_bytes(self, refresh: bool = False) -> int:
+        """Budget corrente (ricalcolato al più ogni BUDGET_REFRESH_S)."""
+        now = time.monotonic()
+        with self._lock:
+            if not refresh and self._budget is not None and now - self._budget_at < self.BUDGET_REFRESH_S:
+                return self._budget
+            held = sum(e.size_bytes for e in self._entries.values())
+        budget = self._compute_budget(held)
+        with self._lock:
+            if budget != self._budget:
+                logger.info(f"[KVCacheManager] Budget {budget >> 20} MB (in cache {held >> 20} MB)")
+            self._budget, self._budget_at = budget, now
+        return budget
+
+    def _compute_budget(self, held: int) -> int:
+        fraction = self.ram_fraction
+        state = None
+        if self.system_monitor is not None:
+            try:
+                state = self.system_monitor.get_metabolic_state()
+            except Exception as e:
+                logger.warning(f"[KVCacheManager] SystemMonitor non disponibile: {e}")
+        if state is not None:
+            if state.cognitive_load >= 0.8:
+                return self.min_bytes
+            if state.battery_temp_celsius > self.HOT_BATTERY_C:
+                fraction = self.hot_ram_fraction
+        available = None
+        try:
+            available = self.memory_probe()
+        except Exception:
+            pass
+        if available is None:
+            return self.max_bytes
+        # I byte già in cache sono memoria nostra: contano come disponibili
+        budget = int((available + held) * fraction)
+        return max(self.min_bytes, min(self.max_bytes, budget))
+
+    # ------------------------------------------------------------------
+    # Cache per conversazione
+    # ------------------------------------------------------------------
+
+    def cache_for(self, conversation_id: str, prefix_hash: str = "") -> Any:
+        """Cache della conversazione, creata se manca o se il prefisso di sistema è cambiato."""
+        evicted: List[CacheEntry] = []
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is not None and prefix_hash and entry.prefix_hash != prefix_hash:
+                del self._entries[conversation_id]
+                self._stats["invalidations"] += 1
+                logger.info(f"[KVCacheManager] Cache invalidated conv={conversation_id} (system prefix changed)")
+                entry = None
+            if entry is not None and entry.size_bytes > 0:
+                self._stats["hits"] += 1
+            else:
+                self._stats["misses"] += 1
+            if entry is None:
+                entry = CacheEntry(conversation_id, prefix_hash, self.cache_factory(self.budget_bytes()))
+                self._entries[conversation_id] = entry
+            entry.last_used = time.monotonic()
+            self._active = conversation_id
+            evicted = self._enforce()
+        self._notify(evicted)
+        return entry.cache
+
+    def update(self, conversation_id: str) -> None:
+        """Rilegge byte e token reali della cache dopo una generazione e applica il budget."""
+        with self._lock:
+            entry = self._entries.get(conversation_id)
+            if entry is None:
+                return
+            entry.size_bytes, entry.tokens = self._measure(entry.cache)
+            entry.last_used = time.monotonic()
+            evicted = self._enforce()
+        self._notify(evicted)
+
+    def observe_eval(self, tokens: int, elapsed_ms: float) -> None:
+        """Aggiorna la stima ms/token del prefill (media mobile esponenziale)."""
+        if tokens <= 0 or elapsed_ms <= 0:
+            return
+        with self._lock:
+            self.ms_per_token = 0.8 * self.ms_per_token + 0.2 * (elapsed_ms / tokens)
+
+    def discard(self, conversation_id: str) -> None:
+        with self._lock:
+            self._entries.pop(conversation_id, None)
+
+    @staticmethod
+    def _measure(cache: Any):
+        """Byte degli stati serializzati (LlamaRAMCache.cache_size) e token dello stato più lungo."""
+        size = int(getattr(cache, "cache_size", 0) or 0)
+        states = getattr(cache, "cache_state", None) or {}
+        tokens = max((len(k) for k in states.keys()), default=0)
+        return size, tokens
+
+    def _score(self, entry: CacheEntry, now: float) -> float:
+        """Recenza (dimezzata ogni RECENCY_HALF_LIFE_S) × ms di prefill che la cache evita."""
+        recency = 0.5 ** ((now - entry.last_used) / self.RECENCY_HALF_LIFE_S)
+        return recency * entry.tokens * self.ms_per_token
+
+    def _enforce(self) -> List[CacheEntry]:
+        """Espelle (sotto lock) le voci di punteggio più basso oltre budget o max_entries."""
+        budget = self.budget_bytes()
+        for entry in self._entries.values():
+            # Nessuna conversazione da sola può superare il budget globale
+            if hasattr(entry.cache, "capacity_bytes"):
+                entry.cache.capacity_bytes = budget
+        evicted: List[CacheEntry] = []
+        now = time.monotonic()
+        while True:
+            total = sum(e.size_bytes for e in self._entries.values())
+            if total <= budget and len(self._entries) <= self.max_entries:
+                break
+            candidates = [e for e in self._entries.values() if e.conversation_id != self._active]
+            if not candidates:
+                break
+            victim = min(candidates, key=lambda e: self._score(e, now))
+            del self._entries[victim.conversation_id]
+            self._stats["evictions"] += 1
+            evicted.append(victim)
+            logger.info(
+                f"[KVCacheManager] Evicted conv={victim.conversation_id} "
+                f"({victim.size_bytes >> 20} MB, {victim.tokens} tok, budget {budget >> 20} MB)"
+            )
+        return evicted
+
+    def _notify(self, evicted: List[CacheEntry]) -> None:
+        if self.on_evict is None:
+            return
+        for entry in evicted:
+            try:
+                self.on_evict(entry)
+            except Exception as e:
+                logger.warning(f"[KVCacheManager] on_evict fallito per {entry.conversation_id}: {e}")
+
+    # ------------------------------------------------------------------
+    # Metriche
+    # ------------------------------------------------------------------
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats: Dict[str, Any] = dict(self._stats)
+            stats["entries"] = len(self._entries)
+            stats["bytes"] = sum(e.size_bytes for e in self._entries.values())
+            stats["ms_per_token"] = round(self.ms_per_token, 2)
+            lookups = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / lookups, 3) if lookups else None
+        stats["budget_bytes"] = self.budget_bytes()
+        return stats
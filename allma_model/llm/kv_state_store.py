@@ -0,0 +1,351 @@
+"""
+KVStateStore — Archivio su disco degli stati KV di llama.cpp per ALLMA
+
+Scopo:
+    Le LlamaCache di MobileGemmaWrapper vivono solo in memoria: dopo un
+    riavvio dell'app, un kill del processo da parte di Android o un cambio di
+    conversazione, system prompt e cronologia vanno rivalutati da capo sulla
+    CPU (secondi di TTFT). Lo stato salvato con Llama.save_state() e
+    ricaricato con load_state() evita la rivalutazione del prefisso.
+
+Architettura:
+    un file per voce     → <sha1 della chiave>.kv: intestazione JSON, token del
+                           contesto (int32) e blob dello stato llama.cpp
+    peek(key)            → legge solo intestazione e token (per decidere se lo
+                           stato conviene rispetto al contesto già in memoria)
+    get(key)             → legge e verifica anche il blob
+    put(key, ...)        → scrittura atomica (file temporaneo + os.replace),
+                           poi espulsione LRU fino a rientrare in max_bytes
+    put_async(key, ...)  → la stessa scrittura su un thread dedicato, fuori
+                           dal lock di inferenza; stati della stessa chiave
+                           arrivati durante una scrittura si fondono nell'ultimo
+    LRU                  → mtime del file: aggiornato a ogni lettura, così
+                           l'ordine sopravvive ai riavvii
+
+Integrità:
+    Ogni voce porta l'impronta del modello (nome, dimensione e mtime del file
+    GGUF, n_ctx del contesto, versione di llama_cpp) e lo SHA-1 di token e
+    blob. Una voce con impronta diversa o contenuto corrotto viene scartata e
+    cancellata: uno stato incompatibile caricato in llama.cpp produrrebbe
+    risposte errate o un crash nativo.
+"""
+
+from __future__ import annotations
+
+import hashlib
+import json
+import logging
+import os
+import struct
+import sys
+import threading
+import time
+from array import array
+from concurrent.futures import Future, ThreadPoolExecutor
+from dataclasses import dataclass
+from typing import Any, Dict, List, Optional, Sequence
+
+
+logger = logging.getLogger(__name__)
+
+_MAGIC = b"ALLMAKV1\n"
+_SUFFIX = ".kv"
+
+
+def model_fingerprint(model_path: str, n_ctx: int) -> str:
+    """Impronta dello stato: cambia se cambiano file del modello, n_ctx o versione di llama_cpp."""
+    try:
+        st = os.stat(model_path)
+        file_id = f"{os.path.basename(model_path)}:{st.st_size}:{int(st.st_mtime)}"
+    except OSError:
+        file_id = f"{os.path.basename(model_path)}:?"
+    try:
+        import llama_cpp
+        version = getattr(llama_cpp, "__version__", "?")
+    except Exception:
+        version = "?"
+    return f"{file_id}|n_ctx={int(n_ctx)}|llama_cpp={version}"
+
+
+@dataclass
+class KVStateEntry:
+    """Voce dell'archivio. state è None se letta con peek()."""
+    key: str
+    tokens: List[int]
+    state: Optional[bytes]
+    size_bytes: int
+    created: float
+
+
+class KVStateStore:
+    """
+    Stati KV di llama.cpp su disco, con budget in byte ed espulsione LRU.
+
+    Usage:
+        store = KVStateStore(os.path.join(models_dir, "kv_states"),
+                             fingerprint=model_fingerprint(model_path, 2048))
+        store.put_async(key, tokens, state.llama_state)
+        entry = store.peek(key)            # token, senza leggere il blob
+        entry = store.get(key)             # con il blob verificato
+    """
+
+    def __init__(self, directory: str, max_bytes: int = 512 << 20, fingerprint: str = ""):
+        self.directory = directory
+        self.max_bytes = int(max_bytes)
+        self.fingerprint = fingerprint
+        self._lock = threading.Lock()
+        self._index: Dict[str, Dict[str, float]] = {}  # nome file → size, last_used
+        self._writing: Dict[str, Future] = {}
+        self._queued: Dict[str, Any] = {}  # chiave → (tokens, state) in attesa di scrittura
+        self._writer: Optional[ThreadPoolExecutor] = None
+        self._stats = {
+            "hits": 0, "misses": 0, "writes": 0, "write_errors": 0,
+            "evictions": 0, "stale": 0, "corrupt": 0, "skipped_writes": 0, "coalesced_writes": 0,
+        }
+        os.makedirs(directory, exist_ok=True)
+        self._scan()
+
+    # ------------------------------------------------------------------
+    # Indice
+    # ------------------------------------------------------------------
+
+    def _scan(self) -> None:
+        """Ricostruisce l'indice dai file presenti (e rimuove i temporanei di scritture interrotte)."""
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+            if name.endswith(".tmp"):
+                self._remove(path)
+                continue
+            if not name.endswith(_SUFFIX):
+                continue
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            self._index[name] = {"size": float(st.st_size), "last_used": st.st_mtime}
+        self._evict()
+
+    @staticmethod
+    def _file_name(key: str) -> str:
+        return hashlib.sha1(key.encode("utf-8")).hexdigest() + _SUFFIX
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    @staticmethod
+    def _remove(path: str) -> None:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def _drop(self, name: str, reason: str) -> None:
+        with self._lock:
+            self._index.pop(name, None)
+            self._stats[reason] += 1
+        self._remove(self._path(name))
+        logger.warning(f"[KVStateStore] Voce {name} scartata ({reason})")
+
+    def _evict(self) -> None:
+        """Espelle le voci usate meno di recente finché il totale supera max_bytes."""
+        with self._lock:
+            total = sum(e["size"] for e in self._index.values())
+            victims = []
+            for name in sorted(self._index, key=lambda n: self._index[n]["last_used"]):
+                if total <= self.max_bytes:
+                    break
+                total -= self._index.pop(name)["size"]
+                victims.append(name)
+            self._stats["evictions"] += len(victims)
+        for name in victims:
+            self._remove(self._path(name))
+        if victims:
+            logger.info(f"[KVStateStore] Espulse {len(victims)} voci LRU (budget {self.max_bytes} byte)")
+
+    def _touch(self, name: str) -> None:
+        now = time.time()
+        with self._lock:
+            if name in self._index:
+                self._index[name]["last_used"] = now
+        try:
+            os.utime(self._path(name), (now, now))
+        except OSError:
+            pass
+
+    # ------------------------------------------------------------------
+    # Lettura
+    # ------------------------------------------------------------------
+
+    def _read(self, key: str, with_state: bool) -> Optional[KVStateEntry]:
+        name = self._file_name(key)
+        with self._lock:
+            known = name in self._index
+        if not known:
+            if with_state:
+                with self._lock:
+                    self._stats["misses"] += 1
+            return None
+        try:
+            with open(self._path(name), "rb") as f:
+                if f.read(len(_MAGIC)) != _MAGIC:
+                    raise ValueError("intestazione non valida")
+                (header_len,) = struct.unpack(">I", f.read(4))
+                header = json.loads(f.read(header_len).decode("utf-8"))
+                if header.get("fingerprint") != self.fingerprint or header.get("key") != key:
+                    self._drop(name, "stale")
+                    return None
+                token_bytes = f.read(4 * int(header["n_tokens"]))
+                state = f.read() if with_state else None
+        except FileNotFoundError:
+            with self._lock:
+                self._index.pop(name, None)
+            return None
+        except Exception:
+            self._drop(name, "corrupt")
+            return None
+
+        if len(token_bytes) != 4 * int(header["n_tokens"]):
+            self._drop(name, "corrupt")
+            return None
+        if state is not None:
+            digest = hashlib.sha1(token_bytes)
+            digest.update(state)
+            if len(state) != int(header["state_size"]) or digest.hexdigest() != header["sha1"]:
+                self._drop(name, "corrupt")
+                return None
+        tokens = array("i")
+        tokens.frombytes(token_bytes)
+        if header.get("byteorder") != sys.byteorder:
+            tokens.byteswap()
+        if with_state:
+            self._touch(name)
+            with self._lock:
+                self._stats["hits"] += 1
+        return KVStateEntry(
+            key=key,
+            tokens=tokens.tolist(),
+            state=state,
+            size_bytes=len(_MAGIC) + 4 + header_len + len(token_bytes) + int(header["state_size"]),
+            created=float(header.get("created", 0.0)),
+        )
+
+    def peek(self, key: str) -> Optional[KVStateEntry]:
+        """Token della voce senza leggere il blob (non conta come hit né aggiorna l'LRU)."""
+        return self._read(key, with_state=False)
+
+    def get(self, key: str) -> Optional[KVStateEntry]:
+        """Voce completa con blob verificato (SHA-1); None se assente, incompatibile o corrotta."""
+        return self._read(key, with_state=True)
+
+    def discard(self, key: str) -> None:
+        """Rimuove la voce (es. blob rifiutato da llama.cpp)."""
+        name = self._file_name(key)
+        with self._lock:
+            self._index.pop(name, None)
+        self._remove(self._path(name))
+
+    # ------------------------------------------------------------------
+    # Scrittura
+    # ------------------------------------------------------------------
+
+    def put(self, key: str, tokens: Sequence[int], state: bytes) -> bool:
+        """Scrive la voce (atomica) ed espelle le LRU oltre il budget. False se non scritta."""
+        token_bytes = array("i", [int(t) for t in tokens]).tobytes()
+        size = len(token_bytes) + len(state)
+        if size > self.max_bytes:
+            with self._lock:
+                self._stats["skipped_writes"] += 1
+            logger.warning(f"[KVStateStore] Stato di {size} byte oltre il budget di {self.max_bytes}: non salvato")
+            return False
+
+        digest = hashlib.sha1(token_bytes)
+        digest.update(state)
+        header = json.dumps({
+            "key": key,
+            "fingerprint": self.fingerprint,
+            "n_tokens": len(tokens),
+            "state_size": len(state),
+            "sha1": digest.hexdigest(),
+            "byteorder": sys.byteorder,
+            "created": time.time(),
+        }).encode("utf-8")
+
+        name = self._file_name(key)
+        path = self._path(name)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                f.write(_MAGIC)
+                f.write(struct.pack(">I", len(header)))
+                f.write(header)
+                f.write(token_bytes)
+                f.write(state)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, path)
+        except OSError as e:
+            self._remove(tmp_path)
+            with self._lock:
+                self._stats["write_errors"] += 1
+            logger.warning(f"[KVStateStore] Scrittura fallita per {name}: {e}")
+            return False
+
+        with self._lock:
+            self._index[name] = {"size": float(os.path.getsize(path)), "last_used": time.time()}
+            self._stats["writes"] += 1
+        self._evict()
+        return True
+
+    def put_async(self, key: str, tokens: Sequence[int], state: bytes) -> Future:
+        """
+        put() su un thread dedicato. Se la stessa chiave è già in scrittura lo
+        stato nuovo sostituisce quello in attesa e viene scritto subito dopo
+        (coalescenza): il Future restituito termina con l'ultima scrittura.
+        """
+        with self._lock:
+            if key in self._queued:
+                self._stats["coalesced_writes"] += 1
+            self._queued[key] = (list(tokens), state)
+            future = self._writing.get(key)
+            if future is None:
+                if self._writer is None:
+                    self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="AllmaKVWriter")
+                future = self._writer.submit(self._write_queued, key)
+                self._writing[key] = future
+        return future
+
+    def _write_queued(self, key: str) -> bool:
+        """Scrive lo stato più recente in attesa per key finché ne arrivano di nuovi."""
+        written = False
+        while True:
+            with self._lock:
+                item = self._queued.pop(key, None)
+                if item is None:
+                    self._writing.pop(key, None)
+                    return written
+            written = self.put(key, *item)
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """Attende le scritture in corso. False se qualcuna non termina entro il timeout."""
+        with self._lock:
+            pending = list(self._writing.values())
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        for future in pending:
+            remaining = None if deadline is None else max(0.0, deadline - time.perf_counter())
+            try:
+                future.result(timeout=remaining)
+            except Exception:
+                return False
+        return True
+
+    # ------------------------------------------------------------------
+    # Metriche
+    # ------------------------------------------------------------------
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats: Dict[str, Any] = dict(self._stats)
+            stats["entries"] = len(self._index)
+            stats["bytes"] = int(sum(e["size"] for e in self._index.values()))
+        stats["max_bytes"] = self.max_bytes
+        return stats
@@ -3,12 +3,26 @@
 from __future__ import annotations
 
 import os
+import hashlib
 import logging
 import threading
 import re
-from typing import List, Optional
+import time
+from types import SimpleNamespace
+from typing import Any, Dict, List, Optional
 from collections import OrderedDict
 
+from allma_model.llm.backends import LLMBackend
+from allma_model.llm.completion_cache import CompletionCache, completion_key, is_deterministic
+from allma_model.llm.kv_cache_manager import CacheEntry, KVCacheManager
+from allma_model.llm.kv_state_store import KVStateStore, model_fingerprint
+from allma_model.llm.request_scheduler import Priority, RequestScheduler, Ticket
+from allma_model.llm.speculative import SpeculativeDecoder
+from allma_model.llm.structured_output import StructuredOutput, extract_json, schema_max_tokens, validate
+from allma_model.llm.token_accounting import PromptTokens, TokenAccountant
+from allma_model.utils.cancellation import CancellationToken, OperationCancelledError
+from allma_model.utils.tracing import Tracer
+
 # Delayed import mechanism match
 # We set this to True to bypass allma_core checks and let _load() handle the actual import/failure
 LLAMA_CPP_AVAILABLE = True
@@ -23,7 +37,36 @@ class MobileGemmaWrapper:
     Ottimizzato per Android/Mobile.
     """
 
-    def __init__(self, models_dir: str, model_name: str = _DEFAULT_MODEL_NAME, n_ctx: int = 2048, system_monitor=None):  # Optimized: was 2048, keeping for performance
+    # Attesa massima del lock di inferenza per il prefill speculativo: se il
+    # modello è occupato (sogno, altra conversazione) il prefill viene saltato
+    PREFILL_LOCK_TIMEOUT_S = 2.0
+    # Con un cancel_token il prompt viene valutato a blocchi di n_batch token
+    # (punti di controllo dell'annullamento; questo valore se il modello non
+    # espone n_batch) e l'attesa del lock è a intervalli. llama.cpp valuta
+    # comunque a lotti di n_batch: blocchi più piccoli moltiplicherebbero le
+    # passate e alzerebbero il TTFT
+    EVAL_CHUNK_TOKENS = 512
+    LOCK_POLL_S = 0.02
+    # Stati KV su disco (KVStateStore): budget in byte, intervallo minimo tra
+    # due salvataggi della stessa conversazione (scritture su flash) e token
+    # minimi guadagnati perché valga la pena ricaricare uno stato
+    KV_STATE_MAX_BYTES = 512 << 20
+    KV_PERSIST_INTERVAL_S = 60.0
+    KV_RESTORE_MIN_TOKENS = 64
+    # Snapshot del blocco system condiviso tra le conversazioni (uno per
+    # variante del system prompt, es. la lingua)
+    BASE_PREFIX_SLOTS = 2
+    # Token di contesto lasciati alla risposta (64 minimi + 64 di margine):
+    # oltre, il prompt perde i messaggi di cronologia più vecchi
+    PROMPT_CTX_RESERVE = 128
+    # Cache delle risposte deterministiche (SQLite): limiti di voci e di byte
+    COMPLETION_CACHE_MAX_ENTRIES = 4096
+    COMPLETION_CACHE_MAX_BYTES = 4 << 20
+
+    def __init__(self, models_dir: str, model_name: str = _DEFAULT_MODEL_NAME, n_ctx: int = 2048, system_monitor=None,
+                 kv_state_dir: Optional[str] = None, speculative: bool = False,
+                 draft_model_name: Optional[str] = None, completion_cache_path: Optional[str] = None,
+                 backend: Optional[LLMBackend] = None):  # Optimized: was 2048, keeping for performance
         """
         Inizializza il wrapper mobile.
         
@@ -32,6 +75,13 @@ class MobileGemmaWrapper:
             model_name: Nome del file del modello
             n_ctx: Context window size
             system_monitor: Istanza per Adaptive Metabolic Coupling (V6.4)
+            kv_state_dir: Directory degli stati KV persistenti (default: <models_dir>/kv_states)
+            speculative: Decodifica speculativa (richiede logits_all: più RAM, vedi speculative.py)
+            draft_model_name: GGUF bozza in models_dir; senza, bozza da prompt lookup
+            completion_cache_path: SQLite delle risposte deterministiche (default:
+                                   <models_dir>/completion_cache.sqlite)
+            backend: modello già pronto al posto del GGUF (es. MockLLMBackend per
+                     benchmark e test senza dispositivo); None = llama.cpp da models_dir
         """
         self.models_dir = models_dir
         self.model_path = os.path.join(models_dir, model_name)
@@ -39,9 +89,55 @@ class MobileGemmaWrapper:
         self.system_monitor = system_monitor
         self.llm = None
         self.inference_lock = threading.Lock() # <--- CRITICAL FIX: Global Lock
-        self._conv_caches = OrderedDict()
-        self._conv_cache_prefix = {}
+        # Chi prende inference_lock: priorità (chat prima del lavoro di fondo),
+        # prelazione dei lavori di fondo, scadenze e attese in coda
+        self.scheduler = RequestScheduler(self.inference_lock)
+        # LlamaCache per conversazione: budget in byte da RAM e stato termico;
+        # le cache espulse dalla RAM finiscono su disco (kv_store)
+        self.kv_cache = KVCacheManager(
+            self._new_llama_cache, system_monitor=system_monitor, on_evict=self._on_cache_evicted
+        )
         self._active_conv = None
+        # Prefill speculativo: ultimo prefisso valutato in anticipo e metriche
+        self._pending_prefill = None
+        self._prefill_stats_lock = threading.Lock()
+        self._prefill_stats = {
+            "requested": 0, "evaluated": 0, "warm": 0, "busy": 0, "skipped": 0, "cancelled": 0, "errors": 0,
+            "hits": 0, "misses": 0, "saved_ms": 0.0,
+        }
+        self._generation_meta_by_id = {}
+        # Stati KV persistenti: l'archivio si apre dopo il caricamento del
+        # modello, perché l'impronta dipende dal file e dal contesto
+        self.kv_state_dir = kv_state_dir or os.path.join(models_dir, "kv_states")
+        self.kv_store: Optional[KVStateStore] = None
+        self._kv_active = None
+        self._kv_persisted_at = {}
+        self._kv_stats = {
+            "restores": 0, "misses": 0, "skipped": 0, "errors": 0,
+            "restored_tokens": 0, "restore_ms": 0.0, "persists": 0,
+            "base_hits": 0, "base_created": 0, "base_restored": 0, "base_saved_ms": 0.0,
+        }
+        # Prefisso condiviso: hash del blocco system → token, stato e tempo di valutazione
+        self._base_states = OrderedDict()
+        # Token del prompt calcolati una volta per segmento ChatML e riusati
+        # da prefill, riuso del prefisso, conteggi e chiamata a llama.cpp
+        self.token_accountant = TokenAccountant(self._tokenize, cache_size=512)
+        # Decodifica speculativa: bozza (modello piccolo o prompt lookup)
+        # verificata a blocchi dal modello principale
+        self.speculative = speculative
+        self.draft_model_name = draft_model_name
+        self.speculative_decoder: Optional[SpeculativeDecoder] = None
+        # Output JSON vincolato da grammatica per le chiamate ausiliarie
+        self.structured = StructuredOutput()
+        # Risposte greedy già calcolate, per le chiamate che scelgono cache=True;
+        # si apre dopo il caricamento (la chiave include l'impronta del modello)
+        self.completion_cache_path = completion_cache_path or os.path.join(models_dir, "completion_cache.sqlite")
+        self.completion_cache: Optional[CompletionCache] = None
+
+        if backend is not None:
+            self.llm = backend
+            self._on_model_loaded()
+            return
         
         if not LLAMA_CPP_AVAILABLE:
             logging.error("Tentativo di inizializzare MobileGemmaWrapper senza llama_cpp installato.")
@@ -477,15 +573,24 @@ class MobileGemmaWrapper:
                 flash_attn=False,
                 use_mmap=True,
                 use_mlock=False,
+                logits_all=self.speculative,  # verifica della bozza su più posizioni
                 verbose=True
             )
             
             print(f"[MobileGemma] PRINT DEBUG: Llama Init Success! (CPU-ONLY MODE)", flush=True)
             logging.info("[MobileGemma] Model loaded successfully.")
+            self._on_model_loaded()
         except Exception as e:
             logging.error(f"[MobileGemma] Error loading model: {e}")
             self.llm = None
 
+    def _on_model_loaded(self) -> None:
+        """Dopo il caricamento del modello (o con un backend fornito): archivi legati all'impronta e bozza."""
+        self.token_accountant.reset()
+        self._open_kv_store()
+        self._open_completion_cache()
+        self._setup_speculative()
+
     def generate(
         self,
         prompt: str,
@@ -499,7 +604,139 @@ class MobileGemmaWrapper:
         prefix_prompt: Optional[str] = None,
         request_id: Optional[str] = None,
         repeat_penalty: Optional[float] = None,
-        repeat_last_n: Optional[int] = None
+        repeat_last_n: Optional[int] = None,
+        cancel_token: Optional[CancellationToken] = None,
+        base_prompt: Optional[str] = None,
+        priority: int = Priority.INTERACTIVE,
+        deadline_s: Optional[float] = None,
+        grammar: Optional[Any] = None,
+        cache: bool = False
+    ) -> str:
+        """
+        Genera testo dato un prompt.
+        Args:
+            prompt: Può essere raw text o formatted chat.
+            max_tokens: Limite token generati.
+            callback: Funzione(str) chiamata per ogni token generato.
+            priority: classe per lo scheduler (Priority): FOREGROUND per la
+                      risposta in chat; BACKGROUND/IDLE vengono interrotti al
+                      token successivo da richieste più urgenti e ripresi dal
+                      testo già generato
+            deadline_s: secondi entro cui la generazione deve partire: oltre,
+                        finish_reason 'rejected' e testo vuoto
+            grammar: LlamaGrammar che vincola il campionamento (generate_structured);
+                     la richiesta non viene interrotta da quelle più urgenti
+            cache: riusa la risposta salvata per la stessa richiesta (CompletionCache);
+                   solo con temperature <= 0, altrimenti la cache viene saltata
+            cancel_token: annullamento: interrompe l'attesa del modello, la
+                          valutazione del prompt (a blocchi) e la generazione al
+                          token successivo; restituisce il testo parziale con
+                          finish_reason 'cancelled'
+            base_prompt: blocco system comune a tutte le conversazioni (prefisso
+                         di prompt): una conversazione nuova parte dal suo
+                         snapshot invece di valutarlo da capo
+        """
+        # Span "llm.generate": attesa del lock, TTFT e token finiscono negli attributi
+        with Tracer.get_instance().span(
+            "llm.generate", request_id=request_id, stream=callback is not None, prompt_chars=len(prompt or ""),
+            priority=Priority(priority).name
+        ) as span:
+            cache_key = None
+            if cache and self.completion_cache is not None:
+                cache_key = self._completion_key(prompt, max_tokens, temperature, top_p, stop,
+                                                 repeat_penalty, repeat_last_n, grammar)
+                hit = self.completion_cache.get(cache_key) if cache_key else None
+                if hit is not None:
+                    text = self._record_cache_hit(request_id, hit, callback)
+                    if span is not None:
+                        span.set_attribute("cache_hit", True)
+                        span.set_attribute("completion_tokens", hit[1])
+                    return text
+            started = time.perf_counter()
+            deadline = None if deadline_s is None else time.monotonic() + deadline_s
+            generated = ""
+            preemptions = 0
+            while True:
+                resume: Dict[str, Any] = {}
+                text = self._generate(
+                    prompt + generated,
+                    max_tokens=max_tokens,
+                    temperature=temperature,
+                    top_p=top_p,
+                    stop=stop,
+                    callback=callback,
+                    conversation_id=conversation_id,
+                    prefix_hash=prefix_hash,
+                    prefix_prompt=prefix_prompt,
+                    request_id=request_id,
+                    repeat_penalty=repeat_penalty,
+                    repeat_last_n=repeat_last_n,
+                    cancel_token=cancel_token,
+                    base_prompt=base_prompt,
+                    priority=priority,
+                    deadline=deadline,
+                    grammar=grammar,
+                    # Oltre max_preemptions il lavoro non è più interrompibile (niente fame).
+                    # Con una grammatica non si riprende a metà risposta: si ripartirebbe
+                    # da capo, ripetendo lavoro e token già passati al callback
+                    preemptible=(False if grammar is not None or preemptions >= self.scheduler.max_preemptions
+                                 else None),
+                    resume=resume
+                )
+                if not resume.get("preempted") or (cancel_token is not None and cancel_token.cancelled):
+                    break
+                # Interrotto da una richiesta più urgente: si riprende dal testo già
+                # generato (il prompt lo include), con i token rimasti; il callback
+                # riceve solo i token nuovi
+                preemptions += 1
+                generated += resume["text"]
+                if max_tokens != -1:
+                    max_tokens -= resume["completion_tokens"]
+                    if max_tokens <= 0:
+                        resume["text"] = ""
+                        break
+            if preemptions:
+                # Testo grezzo dei tentativi unito prima dello strip (spazi tra i pezzi)
+                text = re.sub(r"<think>.*?</think>\s*", "", generated + resume.get("text", text), flags=re.DOTALL).strip()
+                if self.last_generation.get("request_id") == request_id:
+                    self.last_generation["preemptions"] = preemptions
+                if request_id and request_id in self._generation_meta_by_id:
+                    self._generation_meta_by_id[request_id]["preemptions"] = preemptions
+            if cache_key and resume.get("completed") and not preemptions:
+                # Solo generazioni concluse in un tentativo (non annullate, rifiutate o riprese)
+                self.completion_cache.put(cache_key, text, resume["completion_tokens"],
+                                          (time.perf_counter() - started) * 1000.0)
+            if span is not None:
+                meta = (self.get_generation_meta(request_id) if request_id else None) or getattr(self, "last_generation", None) or {}
+                for key in ("lock_wait_ms", "ttft_ms", "prompt_tokens", "completion_tokens", "finish_reason",
+                            "prefix_reused_tokens", "prefill_hit", "prefill_saved_ms", "cancel_latency_ms",
+                            "kv_restore", "kv_restore_ms", "base_prefix", "prompt_sections",
+                            "trimmed_history_tokens", "preemptions", "rejected_reason",
+                            "speculative", "spec_acceptance", "spec_speedup", "decode_tps", "cache_hit"):
+                    span.set_attribute(key, meta.get(key))
+            return text
+
+    def _generate(
+        self,
+        prompt: str,
+        max_tokens: int = -1,
+        temperature: float = 0.7,
+        top_p: float = 0.9,
+        stop: Optional[List[str]] = None,
+        callback: Optional[callable] = None, # Support streaming
+        conversation_id: Optional[str] = None,
+        prefix_hash: Optional[str] = None,
+        prefix_prompt: Optional[str] = None,
+        request_id: Optional[str] = None,
+        repeat_penalty: Optional[float] = None,
+        repeat_last_n: Optional[int] = None,
+        cancel_token: Optional[CancellationToken] = None,
+        base_prompt: Optional[str] = None,
+        priority: int = Priority.INTERACTIVE,
+        deadline: Optional[float] = None,
+        preemptible: Optional[bool] = None,
+        resume: Optional[Dict[str, Any]] = None,
+        grammar: Optional[Any] = None
     ) -> str:
         """
         Genera testo dato un prompt.
@@ -507,6 +744,8 @@ class MobileGemmaWrapper:
             prompt: Può essere raw text o formatted chat.
             max_tokens: Limite token generati.
             callback: Funzione(str) chiamata per ogni token generato.
+            resume: riceve il testo grezzo (senza strip) e, se lo scheduler
+                    interrompe la generazione, preempted e i token generati fin lì
         """
         if not self.llm:
             return "Error: Model not loaded."
@@ -519,10 +758,23 @@ class MobileGemmaWrapper:
             def strip_think(text: str) -> str:
                 return re.sub(r"<think>.*?</think>\s*", "", text, flags=re.DOTALL).strip()
 
-            with self.inference_lock:
+            lock_requested = time.perf_counter()
+            ticket = self._acquire_inference_lock(cancel_token, priority=priority, deadline=deadline,
+                                                  preemptible=preemptible)
+            if not ticket.granted:
+                if ticket.status == "cancelled":
+                    # Annullato mentre attendeva il modello: nessun token valutato
+                    return self._record_cancelled(request_id, cancel_token, "lock_wait")
+                return self._record_rejected(request_id, ticket)
+            # Token della richiesta: annullamento del chiamante e prelazione dello scheduler
+            cancel_token = ticket.token
+            try:
+                lock_wait_ms = (time.perf_counter() - lock_requested) * 1000.0
                 import random
                 random_seed = random.randint(0, 2**31 - 1)
-                stream_mode = callback is not None
+                # Con un cancel_token si genera sempre in streaming: l'annullamento
+                # viene controllato a ogni token
+                stream_mode = callback is not None or cancel_token is not None
                 self.last_generation = {
                     "request_id": request_id,
                     "max_tokens": max_tokens,
@@ -538,57 +790,59 @@ class MobileGemmaWrapper:
                     "total_tokens": None,
                     "finish_reason": None,
                     "ttft_ms": None,
+                    "lock_wait_ms": round(lock_wait_ms, 2),
+                    "prefix_reused_tokens": None,
+                    "prefill_hit": None,
+                    "prefill_saved_ms": None,
+                    "kv_restore": None,
+                    "kv_restored_tokens": 0,
+                    "kv_restore_ms": 0.0,
+                    "base_prefix": None,
+                    "base_prefix_ms": 0.0,
+                    "prompt_sections": None,
+                    "trimmed_history_tokens": 0,
+                    "priority": Priority(priority).name,
                 }
+                self._kv_active = (conversation_id, prefix_hash)
                 if not hasattr(self, "_generation_meta_by_id"):
                     self._generation_meta_by_id = {}
 
                 try:
-                    use_prefix_state_cache = False
-
-                    if conversation_id and hasattr(self.llm, "set_cache"):
-                        from llama_cpp import LlamaCache
-                        conv = str(conversation_id)
-                        prev_prefix = self._conv_cache_prefix.get(conv)
-                        if prev_prefix is None or (prefix_hash and prev_prefix != prefix_hash):
-                            self._conv_cache_prefix[conv] = prefix_hash or ""
-                            self._conv_caches.pop(conv, None)
-                            logging.info(f"[MobileGemma] Prompt cache invalidated conv={conv}")
-                        cache = self._conv_caches.get(conv)
-                        if cache is None:
-                            cache = LlamaCache(capacity_bytes=(256 << 20))
-                            self._conv_caches[conv] = cache
-                        self._conv_caches.move_to_end(conv)
-                        while len(self._conv_caches) > 2:
-                            old_conv, _ = self._conv_caches.popitem(last=False)
-                            self._conv_cache_prefix.pop(old_conv, None)
-                        self.llm.set_cache(cache)
-                        if getattr(self, "_active_conv", None) != conv:
-                            logging.info(f"[MobileGemma] Prompt cache enabled conv={conv}")
-                        self._active_conv = conv
-                    else:
-                        if getattr(self, "_active_conv", None) is not None and hasattr(self.llm, "set_cache"):
-                            self.llm.set_cache(None)
-                            logging.info("[MobileGemma] Prompt cache disabled")
-                        self._active_conv = None
+                    self._use_conversation_cache(conversation_id, prefix_hash)
                 except Exception:
                     pass
 
+                # Unica tokenizzazione del turno: gli stessi ids servono a riuso del
+                # prefisso, conteggi e llama.cpp (che riceve token, non testo)
+                prompt_tokens = self._account_prompt(prompt)
+
+                # Stato su disco della conversazione (dopo un riavvio o un cambio di
+                # conversazione), altrimenti lo snapshot del blocco system condiviso
+                try:
+                    self.last_generation.update(self._restore_kv_state(prompt_tokens, conversation_id, prefix_hash))
+                    self.last_generation.update(self._use_base_prefix(base_prompt, prefix_hash, prompt_tokens, cancel_token))
+                except OperationCancelledError:
+                    return self._record_cancelled(request_id, cancel_token, "prompt_eval", resume=resume)
+                except Exception as e:
+                    logging.warning(f"[MobileGemma] KV restore error: {e}")
+
+                # Prefisso già valutato nel contesto (prefill speculativo o turno precedente)
+                self._record_prefix_reuse(prompt_tokens, conversation_id, lock_requested)
+
+                if cancel_token is not None:
+                    # Prompt valutato a blocchi annullabili: a llama.cpp resta l'ultimo token
+                    try:
+                        self._extend_context(prompt_tokens[:-1], cancel_token)
+                    except OperationCancelledError:
+                        return self._record_cancelled(request_id, cancel_token, "prompt_eval", resume=resume)
+
                 # Calcola dinamicamente i token liberi nel contesto
                 if max_tokens == -1:
-                    try:
-                        prompt_token_count = len(self.llm.tokenize(prompt.encode("utf-8")))
-                    except Exception:
-                        prompt_token_count = len(prompt) // 4  # stima approssimativa
+                    prompt_token_count = len(prompt_tokens)
                     # Riserva 64 token di margine di sicurezza
                     max_tokens = max(64, self.n_ctx - prompt_token_count - 64)
                     logging.info(f"[MobileGemma] Dynamic max_tokens={max_tokens} (ctx={self.n_ctx}, prompt={prompt_token_count} tokens)")
                     self.last_generation["max_tokens"] = max_tokens
-                    self.last_generation["prompt_tokens"] = int(prompt_token_count)
-                else:
-                    try:
-                        self.last_generation["prompt_tokens"] = int(len(self.llm.tokenize(prompt.encode("utf-8"))))
-                    except Exception:
-                        pass
 
                 logging.info(f"[MobileGemma] Generating response (Stream={stream_mode}, Seed={random_seed})")
 
@@ -605,17 +859,24 @@ class MobileGemmaWrapper:
                     llm_kwargs["repeat_penalty"] = float(repeat_penalty)
                 if repeat_last_n is not None:
                     llm_kwargs["repeat_last_n"] = int(repeat_last_n)
+                if grammar is not None:
+                    llm_kwargs["grammar"] = grammar
+
+                if self.speculative_decoder is not None:
+                    # Bozza attaccata per questa richiesta (staccata nelle misure di riferimento)
+                    self.speculative_decoder.begin(self.llm, stream=stream_mode)
 
                 try:
-                    output = self.llm(prompt, **llm_kwargs)
+                    output = self.llm(prompt_tokens, **llm_kwargs)
                 except TypeError:
                     llm_kwargs.pop("repeat_penalty", None)
                     llm_kwargs.pop("repeat_last_n", None)
-                    output = self.llm(prompt, **llm_kwargs)
+                    output = self.llm(prompt_tokens, **llm_kwargs)
 
                 if stream_mode:
                     full_text = ""
-                    import time
+                    # Un chunk dello stream = un token generato: nessuna ritokenizzazione
+                    completion_tokens = 0
                     gen_t0 = time.perf_counter()
                     first_token_ts = None
                     
@@ -637,7 +898,16 @@ class MobileGemmaWrapper:
                             logging.error(f"[MobileGemma] Thermal Pacing exception: {e}")
                     
                     for chunk in output:
+                        if cancel_token is not None and cancel_token.cancelled:
+                            # Stop al token corrente: il generatore chiuso libera il modello
+                            close = getattr(output, "close", None)
+                            if close is not None:
+                                close()
+                            self._count_completion(completion_tokens)
+                            return self._record_cancelled(request_id, cancel_token, "generation", strip_think(full_text),
+                                                          resume=resume, partial=full_text)
                         token = chunk["choices"][0]["text"]
+                        completion_tokens += 1
                         if first_token_ts is None:
                             first_token_ts = time.perf_counter()
                             try:
@@ -652,12 +922,10 @@ class MobileGemmaWrapper:
                                 logging.error(f"[MobileGemma] Stream callback error: {cb_err}")
                         if pacing_delay > 0:
                             time.sleep(pacing_delay)
-                    try:
-                        self.last_generation["completion_tokens"] = int(len(self.llm.tokenize(full_text.encode("utf-8"))))
-                        if self.last_generation.get("prompt_tokens") is not None:
-                            self.last_generation["total_tokens"] = int(self.last_generation["prompt_tokens"] + self.last_generation["completion_tokens"])
-                    except Exception:
-                        pass
+                    self._count_completion(completion_tokens)
+                    if self.speculative_decoder is not None:
+                        decode_s = time.perf_counter() - first_token_ts if first_token_ts is not None else None
+                        self.last_generation.update(self.speculative_decoder.end(completion_tokens, decode_s))
                     try:
                         ct = self.last_generation.get("completion_tokens")
                         mt = self.last_generation.get("max_tokens")
@@ -674,6 +942,9 @@ class MobileGemmaWrapper:
                                 self._generation_meta_by_id.pop(next(iter(self._generation_meta_by_id)))
                     except Exception:
                         pass
+                    if resume is not None:
+                        resume.update(text=full_text, completed=True,
+                                      completion_tokens=self.last_generation.get("completion_tokens") or 0)
                     return strip_think(full_text)
                 else:
                     raw_text = output["choices"][0]["text"]
@@ -685,21 +956,16 @@ class MobileGemmaWrapper:
                         usage = output.get("usage") or {}
                     except Exception:
                         usage = {}
-                    if isinstance(usage, dict) and usage:
-                        self.last_generation["prompt_tokens"] = usage.get("prompt_tokens", self.last_generation.get("prompt_tokens"))
-                        self.last_generation["completion_tokens"] = usage.get("completion_tokens", self.last_generation.get("completion_tokens"))
-                        self.last_generation["total_tokens"] = usage.get("total_tokens", self.last_generation.get("total_tokens"))
+                    if isinstance(usage, dict) and usage.get("completion_tokens") is not None:
+                        # llama.cpp conta già i token generati: il testo non va ritokenizzato
+                        self._count_completion(int(usage["completion_tokens"]))
+                    if self.speculative_decoder is not None:
+                        self.last_generation.update(
+                            self.speculative_decoder.end(int(self.last_generation.get("completion_tokens") or 0))
+                        )
                     if finish_reason:
                         self.last_generation["finish_reason"] = finish_reason
                     else:
-                        if max_tokens != -1:
-                            try:
-                                completion_tokens = len(self.llm.tokenize(raw_text.encode("utf-8")))
-                                self.last_generation["completion_tokens"] = int(completion_tokens)
-                                if self.last_generation.get("prompt_tokens") is not None:
-                                    self.last_generation["total_tokens"] = int(self.last_generation["prompt_tokens"] + completion_tokens)
-                            except Exception:
-                                pass
                         try:
                             ct = self.last_generation.get("completion_tokens")
                             mt = self.last_generation.get("max_tokens")
@@ -716,12 +982,767 @@ class MobileGemmaWrapper:
                                 self._generation_meta_by_id.pop(next(iter(self._generation_meta_by_id)))
                     except Exception:
                         pass
+                    if resume is not None:
+                        resume.update(text=raw_text, completed=True,
+                                      completion_tokens=self.last_generation.get("completion_tokens") or 0)
                     return strip_think(raw_text)
+            finally:
+                # Stato KV su disco: dopo l'ultimo token, prima di liberare il modello
+                try:
+                    if conversation_id and self._active_conv is not None:
+                        # Dimensione reale della LlamaCache dopo lo stato salvato da llama.cpp
+                        self.kv_cache.update(self._active_conv)
+                    if self.last_generation.get("finish_reason") in ("stop", "max_tokens", "length"):
+                        self._persist_kv_state(conversation_id, prefix_hash)
+                except Exception as e:
+                    logging.warning(f"[MobileGemma] KV persist error: {e}")
+                self.scheduler.release(ticket)
 
         except Exception as e:
             logging.error(f"[MobileGemma] Inference error: {e}")
             return f"Error during inference: {e}"
 
+    # ------------------------------------------------------------------
+    # Cache del prompt e prefill speculativo
+    # ------------------------------------------------------------------
+
+    def _use_conversation_cache(self, conversation_id: Optional[str], prefix_hash: Optional[str]) -> None:
+        """Attiva la LlamaCache della conversazione (invalidata se cambia il prefisso di sistema)."""
+        if conversation_id and hasattr(self.llm, "set_cache"):
+            conv = str(conversation_id)
+            self.llm.set_cache(self.kv_cache.cache_for(conv, prefix_hash or ""))
+            if getattr(self, "_active_conv", None) != conv:
+                logging.info(f"[MobileGemma] Prompt cache enabled conv={conv}")
+            self._active_conv = conv
+        else:
+            if getattr(self, "_active_conv", None) is not None and hasattr(self.llm, "set_cache"):
+                self.llm.set_cache(None)
+                logging.info("[MobileGemma] Prompt cache disabled")
+            self._active_conv = None
+
+    def _new_llama_cache(self, capacity_bytes: int):
+        new_cache = getattr(self.llm, "new_cache", None)
+        if callable(new_cache):
+            # Backend con la sua cache (MockLLMBackend)
+            return new_cache(capacity_bytes)
+        from llama_cpp import LlamaCache
+        return LlamaCache(capacity_bytes=capacity_bytes)
+
+    def _on_cache_evicted(self, entry: CacheEntry) -> None:
+        """La conversazione esce dalla RAM: il suo ultimo stato va su disco."""
+        self._persist_cached_state(entry.conversation_id, entry.prefix_hash, entry.cache)
+
+    def _tokenize(self, data: bytes, add_bos: bool = True) -> List[int]:
+        """Tokenizzazione di llama.cpp con i token speciali ChatML."""
+        try:
+            return list(self.llm.tokenize(data, add_bos=add_bos, special=True))
+        except TypeError:
+            return list(self.llm.tokenize(data))
+
+    def _prompt_tokens(self, text: str) -> List[int]:
+        """Token del testo come li valuta llama.cpp in create_completion (BOS e token speciali ChatML)."""
+        return self.token_accountant.prompt(text).ids
+
+    def count_tokens(self, text: str) -> int:
+        """
+        Token di un pezzo di prompt senza BOS (memorizzati: un messaggio ChatML
+        contato qui non viene ritokenizzato quando arriva nel prompt).
+        """
+        if not text:
+            return 0
+        if not self.llm:
+            return len(text) // 4  # stima approssimativa senza tokenizer
+        return len(self.token_accountant.tokens(text, add_bos=False))
+
+    def count_prompt_tokens(self, prompt: str) -> int:
+        """Token del prompt completo come lo valuterà generate (stessi segmenti in cache)."""
+        if not self.llm:
+            return len(prompt or "") // 4
+        return len(self.token_accountant.prompt(prompt))
+
+    def _account_prompt(self, prompt: str) -> List[int]:
+        """
+        Token del prompt del turno (una sola tokenizzazione) e conteggi per sezione.
+
+        Se il prompt non lascia spazio alla risposta si tolgono i messaggi di
+        cronologia più vecchi: system e ultimo messaggio restano sempre.
+        """
+        tokens: PromptTokens = self.token_accountant.prompt(prompt)
+        limit = self.n_ctx - self.PROMPT_CTX_RESERVE
+        if len(tokens) > limit:
+            tokens, dropped = tokens.trim_history(limit)
+            if dropped:
+                self.last_generation["trimmed_history_tokens"] = dropped
+                logging.warning(f"[MobileGemma] Prompt over context: dropped {dropped} history tokens")
+        self.last_generation["prompt_tokens"] = len(tokens)
+        self.last_generation["prompt_sections"] = tokens.sections()
+        return tokens.ids
+
+    def _count_completion(self, completion_tokens: int) -> None:
+        """Token generati (contati dallo stream o letti da usage) e totale del turno."""
+        self.last_generation["completion_tokens"] = int(completion_tokens)
+        if self.last_generation.get("prompt_tokens") is not None:
+            self.last_generation["total_tokens"] = int(self.last_generation["prompt_tokens"] + completion_tokens)
+
+    def _evaluated_tokens(self) -> List[int]:
+        """Token la cui KV è già nel contesto di llama.cpp."""
+        ids = getattr(self.llm, "input_ids", None)
+        if ids is None:
+            return []
+        n_tokens = int(getattr(self.llm, "n_tokens", len(ids)) or 0)
+        return [int(t) for t in list(ids)[:n_tokens]]
+
+    @staticmethod
+    def _common_prefix_len(a: List[int], b: List[int]) -> int:
+        n = 0
+        for x, y in zip(a, b):
+            if x != y:
+                break
+            n += 1
+        return n
+
+    def prefill(
+        self,
+        prefix_prompt: str,
+        conversation_id: Optional[str] = None,
+        prefix_hash: Optional[str] = None,
+        lock_timeout: Optional[float] = None,
+        cancel_token: Optional[CancellationToken] = None,
+        base_prompt: Optional[str] = None
+    ) -> Dict[str, Any]:
+        """
+        Valuta in anticipo la KV del prefisso stabile del prompt (system + cronologia).
+
+        ALLMACore lo chiama mentre girano gli stadi di analisi: il prompt finale
+        estende il prefisso, quindi llama.cpp riusa i token già valutati e
+        processa solo la coda del turno (contesto e messaggio).
+
+        Returns:
+            {'status': 'evaluated' | 'warm' | 'busy' | 'skipped' | 'cancelled' | 'error',
+             'tokens': token del prefisso, 'evaluated_tokens': token valutati ora,
+             'eval_ms': durata della valutazione, più gli esiti di _restore_kv_state
+             e _use_base_prefix}
+        """
+        with Tracer.get_instance().span("llm.prefill", prompt_chars=len(prefix_prompt or "")) as span:
+            result = self._prefill(prefix_prompt, conversation_id, prefix_hash, lock_timeout, cancel_token, base_prompt)
+            with self._prefill_stats_lock:
+                self._prefill_stats["requested"] += 1
+                status_key = "errors" if result["status"] == "error" else result["status"]
+                self._prefill_stats[status_key] += 1
+            if span is not None:
+                span.attributes.update(result)
+            return result
+
+    def _prefill(
+        self,
+        prefix_prompt: str,
+        conversation_id: Optional[str],
+        prefix_hash: Optional[str],
+        lock_timeout: Optional[float],
+        cancel_token: Optional[CancellationToken],
+        base_prompt: Optional[str] = None
+    ) -> Dict[str, Any]:
+        result: Dict[str, Any] = {"status": "skipped", "tokens": 0, "evaluated_tokens": 0, "eval_ms": 0.0}
+        if not self.llm or not prefix_prompt or not hasattr(self.llm, "eval"):
+            return result
+
+        timeout = self.PREFILL_LOCK_TIMEOUT_S if lock_timeout is None else lock_timeout
+        ticket = self._acquire_inference_lock(cancel_token, timeout=timeout)
+        if not ticket.granted:
+            result["status"] = "cancelled" if ticket.status == "cancelled" else "busy"
+            return result
+        try:
+            try:
+                self._use_conversation_cache(conversation_id, prefix_hash)
+            except Exception:
+                pass
+            tokens = self._prompt_tokens(prefix_prompt)
+            result["tokens"] = len(tokens)
+            # Il prompt completo deve ancora starci, con la riserva per la risposta
+            if len(tokens) >= self.n_ctx - self.PROMPT_CTX_RESERVE:
+                return result
+            try:
+                result.update(self._restore_kv_state(tokens, conversation_id, prefix_hash))
+            except Exception as e:
+                logging.warning(f"[MobileGemma] KV restore error: {e}")
+
+            started = time.perf_counter()
+            try:
+                result.update(self._use_base_prefix(base_prompt, prefix_hash, tokens, cancel_token))
+                evaluated = self._extend_context(tokens, cancel_token)
+            except OperationCancelledError:
+                cancel_token.acknowledge("llm.prefill")
+                self._pending_prefill = None
+                result["status"] = "cancelled"
+                return result
+            if not evaluated:
+                # Già nel contesto (es. turno precedente della stessa conversazione)
+                result["status"] = "warm"
+                return result
+            finished = time.perf_counter()
+            self.kv_cache.observe_eval(evaluated, (finished - started) * 1000.0)
+            result.update(
+                status="evaluated",
+                evaluated_tokens=evaluated,
+                eval_ms=round((finished - started) * 1000.0, 2),
+            )
+            self._pending_prefill = {
+                "conversation_id": str(conversation_id) if conversation_id else None,
+                "tokens": tokens,
+                "started": started,
+                "finished": finished,
+                "eval_ms": result["eval_ms"],
+            }
+            logging.info(
+                f"[MobileGemma] Prefill conv={conversation_id} tokens={len(tokens)} "
+                f"evaluated={result['evaluated_tokens']} eval_ms={result['eval_ms']}"
+            )
+            return result
+        except Exception as e:
+            logging.warning(f"[MobileGemma] Prefill error: {e}")
+            self._pending_prefill = None
+            result["status"] = "error"
+            return result
+        finally:
+            self.scheduler.release(ticket)
+
+    def _acquire_inference_lock(
+        self,
+        cancel_token: Optional[CancellationToken],
+        timeout: Optional[float] = None,
+        priority: int = Priority.INTERACTIVE,
+        deadline: Optional[float] = None,
+        preemptible: Optional[bool] = None
+    ) -> Ticket:
+        """
+        Acquisisce inference_lock tramite lo scheduler (priorità, poi ordine di arrivo).
+
+        Con un cancel_token l'attesa termina all'annullamento (status 'cancelled').
+        """
+        return self.scheduler.acquire(priority, cancel_token=cancel_token, timeout=timeout,
+                                      deadline=deadline, preemptible=preemptible)
+
+    # ------------------------------------------------------------------
+    # Output strutturato (JSON vincolato da grammatica)
+    # ------------------------------------------------------------------
+
+    def generate_structured(
+        self,
+        prompt: str,
+        schema: Dict[str, Any],
+        call_type: str = "generic",
+        max_tokens: Optional[int] = None,
+        unconstrained_max_tokens: Optional[int] = None,
+        temperature: float = 0.0,
+        priority: int = Priority.INTERACTIVE,
+        cancel_token: Optional[CancellationToken] = None,
+        request_id: Optional[str] = None,
+        cache: bool = False
+    ) -> Optional[Any]:
+        """
+        JSON conforme allo schema, con campionamento vincolato dalla grammatica.
+
+        Args:
+            prompt: prompt ChatML (la coda <|im_start|>assistant aperta)
+            schema: JSON Schema della risposta (maxLength/maxItems stringono il budget)
+            call_type: tipo di chiamata per le metriche (es. 'emotion', 'entities')
+            max_tokens: tetto opzionale: il budget è il minore tra questo e quello
+                        dello schema (schema_max_tokens)
+            unconstrained_max_tokens: budget senza grammatica (misure di riferimento
+                                      e ripiego), di solito quello storico della chiamata
+            cache: riusa la risposta di una richiesta identica (solo con temperature 0)
+        Returns:
+            Il JSON letto, o None se manca o non rispetta lo schema
+        """
+        budget = schema_max_tokens(schema)
+        if max_tokens:
+            budget = min(budget, max_tokens)
+        grammar = self.structured.grammar(schema) if self.structured.plan(call_type) else None
+        if grammar is None:
+            budget = max(budget, unconstrained_max_tokens or 0)
+        started = time.perf_counter()
+        text = self.generate(
+            prompt,
+            max_tokens=budget,
+            temperature=temperature,
+            stop=["<|im_end|>"],
+            request_id=request_id,
+            cancel_token=cancel_token,
+            priority=priority,
+            grammar=grammar,
+            cache=cache
+        )
+        elapsed_ms = (time.perf_counter() - started) * 1000.0
+        meta = (self.get_generation_meta(request_id) if request_id else None) or getattr(self, "last_generation", None) or {}
+        try:
+            data = extract_json(text)
+            ok = validate(data, schema)
+        except ValueError:
+            data, ok = None, False
+        if not meta.get("cache_hit"):
+            # Le risposte dalla cache non misurano la generazione (con o senza grammatica)
+            self.structured.record(call_type, grammar is not None, meta.get("completion_tokens") or 0, elapsed_ms, ok)
+        if not ok:
+            logging.info(f"[MobileGemma] Structured output invalid ({call_type}, constrained={grammar is not None}): "
+                         f"{(text or '')[:60]!r}")
+            return None
+        return data
+
+    def get_structured_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Output strutturato per tipo di chiamata: token, latenza e fallimenti con e senza grammatica."""
+        return self.structured.get_stats()
+
+    # ------------------------------------------------------------------
+    # Cache delle risposte deterministiche (CompletionCache)
+    # ------------------------------------------------------------------
+
+    def _open_completion_cache(self) -> None:
+        """Apre la cache delle risposte; le voci di un altro modello vengono scartate."""
+        try:
+            n_ctx = self.llm.n_ctx() if callable(getattr(self.llm, "n_ctx", None)) else self.n_ctx
+            self.completion_cache = CompletionCache(
+                self.completion_cache_path,
+                model_id=model_fingerprint(self.model_path, n_ctx),
+                max_entries=self.COMPLETION_CACHE_MAX_ENTRIES,
+                max_bytes=self.COMPLETION_CACHE_MAX_BYTES,
+            )
+        except Exception as e:
+            logging.warning(f"[MobileGemma] Completion cache unavailable: {e}")
+            self.completion_cache = None
+
+    def _completion_key(
+        self,
+        prompt: str,
+        max_tokens: int,
+        temperature: float,
+        top_p: float,
+        stop: Optional[List[str]],
+        repeat_penalty: Optional[float],
+        repeat_last_n: Optional[int],
+        grammar: Optional[Any]
+    ) -> Optional[str]:
+        """Chiave della richiesta; None (cache saltata) se il campionamento non è deterministico."""
+        grammar_key = ""
+        if grammar is not None:
+            # Schema della grammatica (stabile tra i riavvii) o testo GBNF di LlamaGrammar
+            grammar_key = self.structured.grammar_key(grammar) or getattr(grammar, "_grammar", None)
+        if not is_deterministic(temperature) or not isinstance(grammar_key, str):
+            self.completion_cache.bypass()
+            return None
+        params = {
+            "max_tokens": max_tokens, "temperature": 0.0, "top_p": top_p, "stop": stop,
+            "repeat_penalty": repeat_penalty, "repeat_last_n": repeat_last_n,
+        }
+        return completion_key(self.completion_cache.model_id, prompt, params, grammar_key)
+
+    def _record_cache_hit(self, request_id: Optional[str], hit, callback: Optional[callable]) -> str:
+        """Risposta dalla cache: metadati della generazione (senza lock né inferenza) e callback."""
+        text, completion_tokens = hit
+        self.last_generation = {
+            "request_id": request_id,
+            "cache_hit": True,
+            "prompt_tokens": None,
+            "completion_tokens": completion_tokens,
+            "total_tokens": None,
+            "finish_reason": "stop",
+            "ttft_ms": 0.0,
+            "lock_wait_ms": 0.0,
+        }
+        if request_id:
+            self._generation_meta_by_id[request_id] = dict(self.last_generation)
+            if len(self._generation_meta_by_id) > 32:
+                self._generation_meta_by_id.pop(next(iter(self._generation_meta_by_id)))
+        if callback is not None and text:
+            callback(text)
+        return text
+
+    def get_completion_cache_stats(self) -> Dict[str, Any]:
+        """Cache delle risposte: hit rate, richieste saltate (non deterministiche), ms e token risparmiati."""
+        if self.completion_cache is None:
+            return {"enabled": False}
+        return self.completion_cache.get_stats()
+
+    # ------------------------------------------------------------------
+    # Decodifica speculativa
+    # ------------------------------------------------------------------
+
+    def _setup_speculative(self) -> None:
+        """Bozza per la decodifica speculativa (dopo il caricamento del modello): modello piccolo o prompt lookup."""
+        self.speculative_decoder = None
+        if not self.speculative or self.llm is None:
+            return
+        draft_path = os.path.join(self.models_dir, self.draft_model_name) if self.draft_model_name else None
+        try:
+            self.speculative_decoder = SpeculativeDecoder.create(self.llm, draft_path, n_ctx=self.n_ctx)
+        except Exception as e:
+            logging.warning(f"[MobileGemma] Speculative decoding disabled: {e}")
+        if self.speculative_decoder is None:
+            self.llm.draft_model = None
+
+    def get_speculative_stats(self) -> Dict[str, Any]:
+        """Decodifica speculativa: tasso di accettazione della bozza, token/s con e senza bozza, guadagno."""
+        if self.speculative_decoder is None:
+            return {"mode": None}
+        return self.speculative_decoder.get_stats()
+
+    def get_scheduler_stats(self) -> Dict[str, Any]:
+        """Attese in coda, rifiuti, scadenze e prelazioni per classe di priorità."""
+        return self.scheduler.get_stats()
+
+    def _extend_context(self, tokens: List[int], cancel_token: Optional[CancellationToken] = None) -> int:
+        """
+        Porta il contesto di llama.cpp a contenere tokens valutando solo la parte mancante.
+
+        Con un cancel_token la valutazione procede a blocchi di n_batch token
+        (EVAL_CHUNK_TOKENS se il modello non lo espone) e si interrompe tra un
+        blocco e l'altro (OperationCancelledError): la KV già calcolata resta
+        valida come prefisso.
+
+        Returns:
+            token valutati (0 = già nel contesto)
+        """
+        reused = self._common_prefix_len(self._evaluated_tokens(), tokens)
+        if reused >= len(tokens):
+            return 0
+        # llama.cpp scarta la KV oltre n_tokens e valuta solo la parte nuova
+        self.llm.n_tokens = reused
+        missing = tokens[reused:]
+        step = len(missing)
+        if cancel_token is not None:
+            n_batch = getattr(self.llm, "n_batch", None)
+            step = n_batch if isinstance(n_batch, int) and n_batch > 0 else self.EVAL_CHUNK_TOKENS
+        for i in range(0, len(missing), step):
+            if cancel_token is not None:
+                cancel_token.check()
+            self.llm.eval(missing[i:i + step])
+        return len(missing)
+
+    def _record_cancelled(
+        self,
+        request_id: Optional[str],
+        cancel_token: Optional[CancellationToken],
+        during: str,
+        text: str = "",
+        resume: Optional[Dict[str, Any]] = None,
+        partial: str = ""
+    ) -> str:
+        """Chiude una generazione annullata: finish_reason 'cancelled', latenza di annullamento, testo parziale."""
+        if resume is not None and getattr(cancel_token, "reason", None) == "preempted":
+            # Prelazione dello scheduler: generate() riprende da qui
+            resume.update(preempted=True, text=partial, completion_tokens=self.last_generation.get("completion_tokens") or 0)
+        latency_ms = cancel_token.acknowledge(f"llm.{during}") if cancel_token is not None else None
+        if during == "lock_wait":
+            # Il lock non è mai stato preso: last_generation appartiene a un'altra generazione
+            meta = {"request_id": request_id}
+        else:
+            meta = self.last_generation
+        meta.update(finish_reason="cancelled", cancelled_during=during, cancel_latency_ms=latency_ms,
+                    cancel_reason=getattr(cancel_token, "reason", None))
+        if request_id:
+            self._generation_meta_by_id[request_id] = dict(meta)
+            if len(self._generation_meta_by_id) > 32:
+                self._generation_meta_by_id.pop(next(iter(self._generation_meta_by_id)))
+        logging.info(f"[MobileGemma] Generation cancelled id={request_id} during={during} latency_ms={latency_ms}")
+        return text
+
+    def _record_rejected(self, request_id: Optional[str], ticket: Ticket) -> str:
+        """Richiesta non ammessa dallo scheduler (limite della classe o scadenza): nessun token valutato."""
+        meta = {"request_id": request_id, "finish_reason": "rejected", "priority": ticket.priority.name,
+                "rejected_reason": ticket.reason or ticket.status}
+        if request_id:
+            self._generation_meta_by_id[request_id] = meta
+            if len(self._generation_meta_by_id) > 32:
+                self._generation_meta_by_id.pop(next(iter(self._generation_meta_by_id)))
+        logging.info(f"[MobileGemma] Generation rejected id={request_id} priority={ticket.priority.name} "
+                     f"reason={meta['rejected_reason']}")
+        return ""
+
+    def _record_prefix_reuse(self, prompt_tokens: List[int], conversation_id: Optional[str], requested_at: float) -> None:
+        """
+        Token del prompt già nel contesto ed esito del prefill speculativo (chiamato sotto inference_lock).
+
+        Il risparmio è la parte della valutazione del prefisso avvenuta prima che
+        la generazione venisse richiesta: quella eseguita mentre la generazione
+        attendeva il lock resta sul cammino critico.
+        """
+        pending, self._pending_prefill = self._pending_prefill, None
+        try:
+            reused = self._common_prefix_len(self._evaluated_tokens(), prompt_tokens)
+        except Exception:
+            return
+        self.last_generation["prefix_reused_tokens"] = reused
+        conv = str(conversation_id) if conversation_id else None
+        if not pending or pending["conversation_id"] != conv:
+            return
+
+        n = len(pending["tokens"])
+        hit = reused >= n and prompt_tokens[:n] == pending["tokens"]
+        saved_ms = 0.0
+        if hit:
+            overlap_ms = (min(pending["finished"], requested_at) - pending["started"]) * 1000.0
+            saved_ms = round(max(0.0, min(pending["eval_ms"], overlap_ms)), 2)
+        self.last_generation["prefill_hit"] = hit
+        self.last_generation["prefill_saved_ms"] = saved_ms
+        with self._prefill_stats_lock:
+            self._prefill_stats["hits" if hit else "misses"] += 1
+            self._prefill_stats["saved_ms"] = round(self._prefill_stats["saved_ms"] + saved_ms, 2)
+
+    def get_prefill_stats(self) -> Dict[str, Any]:
+        """Esiti dei prefill speculativi, hit rate sulle generazioni e millisecondi risparmiati."""
+        with self._prefill_stats_lock:
+            stats = dict(self._prefill_stats)
+        judged = stats["hits"] + stats["misses"]
+        stats["hit_rate"] = round(stats["hits"] / judged, 3) if judged else None
+        return stats
+
+    # ------------------------------------------------------------------
+    # Stati KV persistenti (KVStateStore)
+    # ------------------------------------------------------------------
+
+    def _open_kv_store(self) -> None:
+        """Apre l'archivio degli stati KV; richiede i save/load_state leggeri installati da _load."""
+        if not getattr(self.llm, "_allma_light_cache_patched", False):
+            logging.info("[MobileGemma] KV state store disabled (llama state format not supported)")
+            return
+        try:
+            n_ctx = self.llm.n_ctx() if callable(getattr(self.llm, "n_ctx", None)) else self.n_ctx
+            self.kv_store = KVStateStore(
+                self.kv_state_dir,
+                max_bytes=self.KV_STATE_MAX_BYTES,
+                fingerprint=model_fingerprint(self.model_path, n_ctx),
+            )
+            logging.info(f"[MobileGemma] KV state store at {self.kv_state_dir} ({self.kv_store.get_stats()['entries']} entries)")
+        except Exception as e:
+            logging.warning(f"[MobileGemma] KV state store unavailable: {e}")
+            self.kv_store = None
+
+    @staticmethod
+    def _kv_key(conversation_id: Optional[str], prefix_hash: Optional[str]) -> Optional[str]:
+        """Chiave dello stato: conversazione e hash del prefisso di sistema (None se mancano entrambi)."""
+        if not conversation_id and not prefix_hash:
+            return None
+        return f"{conversation_id or ''}|{prefix_hash or ''}"
+
+    def _restore_kv_state(self, prompt_tokens: List[int], conversation_id: Optional[str], prefix_hash: Optional[str]) -> Dict[str, Any]:
+        """
+        Ricarica da disco lo stato della conversazione se copre più prompt del contesto in memoria.
+
+        Chiamato sotto inference_lock prima della valutazione del prompt: con lo
+        stato caricato llama.cpp valuta solo i token oltre il prefisso comune.
+
+        Returns:
+            {'kv_restore': None | 'hit' | 'miss' | 'skipped' | 'error',
+             'kv_restored_tokens': token del prompt coperti dallo stato caricato,
+             'kv_restore_ms': durata di lettura e caricamento}
+        """
+        result: Dict[str, Any] = {"kv_restore": None, "kv_restored_tokens": 0, "kv_restore_ms": 0.0}
+        key = self._kv_key(conversation_id, prefix_hash)
+        if self.kv_store is None or key is None:
+            return result
+
+        live = self._common_prefix_len(self._evaluated_tokens(), prompt_tokens)
+        if live + self.KV_RESTORE_MIN_TOKENS > len(prompt_tokens):
+            # Turno successivo della stessa sessione: nessuno stato può guadagnare abbastanza
+            result["kv_restore"] = "skipped"
+            self._kv_stats["skipped"] += 1
+            return result
+        entry = self.kv_store.peek(key)
+        stored = self._common_prefix_len(entry.tokens, prompt_tokens) if entry is not None else 0
+        if entry is None or stored < self.KV_RESTORE_MIN_TOKENS:
+            result["kv_restore"] = "miss"
+        elif stored < live + self.KV_RESTORE_MIN_TOKENS:
+            # Il contesto in memoria copre già (quasi) altrettanto prompt
+            result["kv_restore"] = "skipped"
+        else:
+            started = time.perf_counter()
+            entry = self.kv_store.get(key)
+            if entry is None:
+                result["kv_restore"] = "miss"
+            else:
+                try:
+                    self.llm.load_state(self._state_from_entry(entry))
+                    result["kv_restore"] = "hit"
+                    result["kv_restored_tokens"] = stored
+                except Exception as e:
+                    # Stato rifiutato da llama.cpp: via dall'archivio e contesto da rivalutare
+                    logging.warning(f"[MobileGemma] KV state rejected key={key}: {e}")
+                    self.kv_store.discard(key)
+                    self.llm.n_tokens = 0
+                    result["kv_restore"] = "error"
+            result["kv_restore_ms"] = round((time.perf_counter() - started) * 1000.0, 2)
+
+        stat_key = {"hit": "restores", "miss": "misses", "skipped": "skipped", "error": "errors"}[result["kv_restore"]]
+        self._kv_stats[stat_key] += 1
+        if result["kv_restore"] == "hit":
+            self._kv_stats["restored_tokens"] += stored
+            self._kv_stats["restore_ms"] = round(self._kv_stats["restore_ms"] + result["kv_restore_ms"], 2)
+            logging.info(
+                f"[MobileGemma] KV state restored conv={conversation_id} tokens={stored} ms={result['kv_restore_ms']}"
+            )
+        return result
+
+    def _state_from_entry(self, entry) -> SimpleNamespace:
+        """Stato nel formato di _save_state_light: input_ids è il buffer di n_ctx token di Llama."""
+        buffer = getattr(self.llm, "input_ids", None)
+        n = len(entry.tokens)
+        if hasattr(buffer, "dtype"):
+            import numpy as np
+            if n > len(buffer):
+                raise ValueError(f"stato di {n} token oltre il contesto di {len(buffer)}")
+            input_ids = np.zeros(len(buffer), dtype=buffer.dtype)
+            input_ids[:n] = entry.tokens
+        else:
+            input_ids = list(entry.tokens)
+        return SimpleNamespace(
+            input_ids=input_ids, n_tokens=n, llama_state=entry.state, llama_state_size=len(entry.state)
+        )
+
+    def _persist_kv_state(self, conversation_id: Optional[str], prefix_hash: Optional[str], force: bool = False) -> bool:
+        """
+        Salva su disco lo stato del contesto corrente (sotto inference_lock).
+
+        save_state() copia lo stato in memoria; la scrittura avviene sul thread
+        dell'archivio. Senza force, al più una volta ogni KV_PERSIST_INTERVAL_S
+        per conversazione.
+        """
+        key = self._kv_key(conversation_id, prefix_hash)
+        if self.kv_store is None or key is None:
+            return False
+        now = time.monotonic()
+        last = self._kv_persisted_at.get(key)
+        if not force and last is not None and now - last < self.KV_PERSIST_INTERVAL_S:
+            return False
+        tokens = self._evaluated_tokens()
+        if len(tokens) < self.KV_RESTORE_MIN_TOKENS:
+            return False
+        state = self.llm.save_state()
+        return self._submit_kv_state(key, tokens[:int(state.n_tokens)], state.llama_state, now)
+
+    def _persist_cached_state(self, conversation_id: str, prefix_hash: Optional[str], cache) -> bool:
+        """Salva su disco l'ultimo stato della LlamaCache di una conversazione espulsa dalla RAM."""
+        key = self._kv_key(conversation_id, prefix_hash)
+        states = getattr(cache, "cache_state", None)
+        if self.kv_store is None or key is None or not states:
+            return False
+        try:
+            # LlamaRAMCache: OrderedDict token → stato, il più recente in fondo
+            tokens, state = next(reversed(states.items()))
+            tokens = list(tokens)[:int(state.n_tokens)]
+        except Exception:
+            return False
+        if len(tokens) < self.KV_RESTORE_MIN_TOKENS:
+            return False
+        return self._submit_kv_state(key, tokens, state.llama_state, time.monotonic())
+
+    def _use_base_prefix(
+        self,
+        base_prompt: Optional[str],
+        prefix_hash: Optional[str],
+        prompt_tokens: List[int],
+        cancel_token: Optional[CancellationToken] = None
+    ) -> Dict[str, Any]:
+        """
+        Porta nel contesto il blocco system condiviso partendo dal suo snapshot.
+
+        Chiamato sotto inference_lock dopo _restore_kv_state: se il contesto non
+        contiene già il blocco (conversazione nuova o espulsa), carica lo
+        snapshot in memoria o su disco; la prima volta dopo il caricamento del
+        modello valuta il blocco e ne salva lo snapshot. La conversazione
+        valuta poi solo il proprio suffisso.
+
+        Returns:
+            {'base_prefix': None | 'warm' | 'hit' | 'restored' | 'created',
+             'base_prefix_ms': durata di caricamento o valutazione}
+        """
+        result: Dict[str, Any] = {"base_prefix": None, "base_prefix_ms": 0.0}
+        if not base_prompt or not hasattr(self.llm, "save_state") or not hasattr(self.llm, "load_state"):
+            return result
+        base_tokens = self._prompt_tokens(base_prompt)
+        if len(base_tokens) < 2 or prompt_tokens[:len(base_tokens)] != base_tokens:
+            return result
+        if self._common_prefix_len(self._evaluated_tokens(), base_tokens) >= len(base_tokens):
+            result["base_prefix"] = "warm"
+            return result
+
+        key = prefix_hash or hashlib.md5(base_prompt.encode("utf-8", "ignore")).hexdigest()
+        store_key = self._kv_key(None, f"base:{key}")
+        started = time.perf_counter()
+        snapshot = self._base_states.get(key)
+        if snapshot is not None and snapshot.tokens == base_tokens:
+            self.llm.load_state(snapshot.state)
+            status = "hit"
+        else:
+            entry = self.kv_store.get(store_key) if self.kv_store is not None else None
+            if entry is not None and entry.tokens == base_tokens:
+                # Snapshot salvato in un processo precedente: costo di valutazione non noto
+                state = self._state_from_entry(entry)
+                self.llm.load_state(state)
+                snapshot = SimpleNamespace(tokens=base_tokens, state=state, eval_ms=None)
+                status = "restored"
+            else:
+                self._extend_context(base_tokens, cancel_token)
+                state = self.llm.save_state()
+                snapshot = SimpleNamespace(
+                    tokens=base_tokens, state=state, eval_ms=(time.perf_counter() - started) * 1000.0
+                )
+                self.kv_cache.observe_eval(len(base_tokens), snapshot.eval_ms)
+                if self.kv_store is not None:
+                    self.kv_store.put_async(store_key, base_tokens, bytes(state.llama_state))
+                status = "created"
+        elapsed_ms = (time.perf_counter() - started) * 1000.0
+        self._base_states[key] = snapshot
+        self._base_states.move_to_end(key)
+        while len(self._base_states) > self.BASE_PREFIX_SLOTS:
+            self._base_states.popitem(last=False)
+
+        self._kv_stats[{"hit": "base_hits", "restored": "base_restored", "created": "base_created"}[status]] += 1
+        if status == "hit" and snapshot.eval_ms is not None:
+            self._kv_stats["base_saved_ms"] = round(
+                self._kv_stats["base_saved_ms"] + max(0.0, snapshot.eval_ms - elapsed_ms), 2
+            )
+        result.update(base_prefix=status, base_prefix_ms=round(elapsed_ms, 2))
+        logging.info(f"[MobileGemma] Base prefix {status} tokens={len(base_tokens)} ms={result['base_prefix_ms']}")
+        return result
+
+    def _submit_kv_state(self, key: str, tokens: List[int], state: bytes, now: float) -> bool:
+        self.kv_store.put_async(key, tokens, bytes(state))
+        self._kv_persisted_at[key] = now
+        self._kv_stats["persists"] += 1
+        return True
+
+    def persist_state(self, timeout: Optional[float] = None) -> bool:
+        """
+        Salva subito lo stato della conversazione attiva e attende la scrittura
+        (on_pause/uscita: il processo può essere terminato da Android).
+
+        Returns:
+            True se lo stato è su disco (o non c'era nulla da salvare)
+        """
+        if self.kv_store is None or not self.llm or self._kv_active is None:
+            return True
+        if not self.inference_lock.acquire(timeout=-1 if timeout is None else timeout):
+            return False
+        try:
+            self._persist_kv_state(*self._kv_active, force=True)
+        except Exception as e:
+            logging.warning(f"[MobileGemma] KV persist error: {e}")
+        finally:
+            self.inference_lock.release()
+        return self.kv_store.flush(timeout)
+
+    def get_kv_state_stats(self) -> Dict[str, Any]:
+        """
+        Ripristini da disco (hit/miss, token e ms di caricamento), snapshot del
+        blocco system condiviso, salvataggi, archivio su disco ('store') e cache
+        in RAM per conversazione ('ram': hit/miss/espulsioni e budget).
+        """
+        stats: Dict[str, Any] = dict(self._kv_stats)
+        judged = stats["restores"] + stats["misses"]
+        stats["hit_rate"] = round(stats["restores"] / judged, 3) if judged else None
+        stats["store"] = self.kv_store.get_stats() if self.kv_store is not None else None
+        stats["ram"] = self.kv_cache.get_stats()
+        return stats
+
     def get_generation_meta(self, request_id: str):
         try:
             return getattr(self, "_generation_meta_by_id", {}).get(request_id)
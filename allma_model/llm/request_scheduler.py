@@ -0,0 +1,318 @@
+"""
+RequestScheduler — Accesso al LLM condiviso per classi di priorità
+
+Scopo:
+    Chat, analisi del turno (detect_emotion_via_llm, _extract_entities_via_llm),
+    condensazione della memoria, sogni (Tree of Thoughts) e messaggi proattivi
+    si contendevano un solo inference_lock in ordine di arrivo: una chiamata
+    di sogno partita un attimo prima ritardava la risposta all'utente di
+    secondi. Lo scheduler decide chi prende il modello e toglie il modello al
+    lavoro di fondo quando arriva una richiesta più urgente.
+
+Architettura:
+    Priority             → FOREGROUND (risposta in chat), INTERACTIVE (analisi
+                           e prefill del turno), BACKGROUND (condensazione,
+                           proattività), IDLE (sogni, curiosità)
+    acquire(...)         → Ticket: ammissione (limite per classe, scadenza
+                           raggiungibile), coda per priorità poi ordine di
+                           arrivo, presa di inference_lock quando è il turno
+    prelazione           → una richiesta più urgente annulla il token del
+                           Ticket in corso se di classe BACKGROUND/IDLE:
+                           la generazione si ferma al token successivo e
+                           il chiamante la rimette in coda (max_preemptions
+                           volte, poi non è più interrompibile: niente fame)
+    release(ticket)      → libera il modello e aggiorna il tempo di servizio
+                           della classe (stima dell'attesa per le scadenze)
+    get_stats()          → per classe: ammessi, rifiutati, scaduti, annullati,
+                           interrotti, completati, attesa in coda p50/p95
+
+Errori:
+    acquire non solleva: il Ticket ha status 'granted' oppure 'rejected'
+    (limite della classe o scadenza non raggiungibile), 'expired', 'timeout',
+    'cancelled'. Chi tiene inference_lock senza passare dallo scheduler
+    (es. persist_state) viene atteso come un lavoro in corso.
+"""
+
+from __future__ import annotations
+
+import functools
+import heapq
+import inspect
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from enum import IntEnum
+from typing import Any, Deque, Dict, List, Optional, Tuple
+
+from allma_model.utils.cancellation import CancellationToken
+
+
+logger = logging.getLogger(__name__)
+
+
+class Priority(IntEnum):
+    """Classi di priorità (valore più basso = più urgente)."""
+    FOREGROUND = 0
+    INTERACTIVE = 1
+    BACKGROUND = 2
+    IDLE = 3
+
+
+@dataclass
+class Ticket:
+    """Richiesta di accesso al modello e suo esito."""
+    priority: Priority
+    seq: int
+    preemptible: bool
+    deadline: Optional[float] = None
+    enqueued: float = field(default_factory=time.monotonic)
+    status: str = "waiting"
+    reason: str = ""
+    granted_at: Optional[float] = None
+    wait_ms: float = 0.0
+    # Token da controllare durante il lavoro: annullamento del chiamante e,
+    # se interrompibile, prelazione ('preempted')
+    token: Optional[CancellationToken] = None
+    _parent: Optional[CancellationToken] = None
+
+    @property
+    def granted(self) -> bool:
+        return self.status == "granted"
+
+    @property
+    def preempted(self) -> bool:
+        return self.token is not None and self.token.reason == "preempted"
+
+
+class RequestScheduler:
+    """
+    Coda per priorità davanti a inference_lock, con prelazione e scadenze.
+
+    Usage:
+        scheduler = RequestScheduler(wrapper.inference_lock)
+        ticket = scheduler.acquire(Priority.BACKGROUND, cancel_token=token, deadline=time.monotonic() + 30)
+        if ticket.granted:
+            try:
+                ...                           # controllare ticket.token a ogni token generato
+            finally:
+                scheduler.release(ticket)
+    """
+
+    PREEMPTIBLE = (Priority.BACKGROUND, Priority.IDLE)
+    # Richieste ammesse (in coda + in corso) per classe
+    DEFAULT_LIMITS = {
+        Priority.FOREGROUND: 4,
+        Priority.INTERACTIVE: 8,
+        Priority.BACKGROUND: 2,
+        Priority.IDLE: 1,
+    }
+    DEFAULT_SERVICE_S = 2.0
+    POLL_S = 0.02
+
+    def __init__(
+        self,
+        lock: Optional[Any] = None,
+        limits: Optional[Dict[Priority, int]] = None,
+        max_preemptions: int = 3,
+    ):
+        self.lock = lock if lock is not None else threading.Lock()
+        self.limits = {**self.DEFAULT_LIMITS, **(limits or {})}
+        self.max_preemptions = max_preemptions
+        self._cond = threading.Condition()
+        self._waiting: List[Tuple[int, int, Ticket]] = []
+        self._running: Optional[Ticket] = None
+        self._seq = itertools.count()
+        # Tempo di servizio per classe (media mobile esponenziale, s)
+        self._service_s = {p: self.DEFAULT_SERVICE_S for p in Priority}
+        self._waits: Dict[Priority, Deque[float]] = {p: deque(maxlen=256) for p in Priority}
+        self._stats = {
+            p: {"admitted": 0, "rejected": 0, "expired": 0, "timeouts": 0, "cancelled": 0,
+                "preempted": 0, "completed": 0}
+            for p in Priority
+        }
+
+    # ------------------------------------------------------------------
+    # Ammissione e attesa
+    # ------------------------------------------------------------------
+
+    def acquire(
+        self,
+        priority: int = Priority.INTERACTIVE,
+        cancel_token: Optional[CancellationToken] = None,
+        timeout: Optional[float] = None,
+        deadline: Optional[float] = None,
+        preemptible: Optional[bool] = None,
+    ) -> Ticket:
+        """
+        Attende il turno per il modello.
+
+        Args:
+            priority: classe della richiesta (Priority)
+            cancel_token: l'annullamento interrompe l'attesa (status 'cancelled')
+            timeout: attesa massima in secondi (status 'timeout')
+            deadline: istante time.monotonic() entro cui il lavoro deve partire:
+                      rifiutata subito se l'attesa stimata lo supera
+            preemptible: default: classi BACKGROUND e IDLE
+        """
+        priority = Priority(priority)
+        if preemptible is None:
+            preemptible = priority in self.PREEMPTIBLE
+        ticket = Ticket(priority, next(self._seq), preemptible, deadline)
+        stats = self._stats[priority]
+        give_up_at = None if timeout is None else ticket.enqueued + timeout
+
+        with self._cond:
+            admitted = sum(1 for _, _, t in self._waiting if t.priority == priority)
+            if self._running is not None and self._running.priority == priority:
+                admitted += 1
+            if admitted >= self.limits[priority]:
+                return self._reject(ticket, "class_limit")
+            if deadline is not None and ticket.enqueued + self._estimate_wait_s(priority) > deadline:
+                return self._reject(ticket, "deadline")
+            stats["admitted"] += 1
+            heapq.heappush(self._waiting, (int(priority), ticket.seq, ticket))
+            self._preempt_for(priority)
+
+            while True:
+                now = time.monotonic()
+                status = None
+                if cancel_token is not None and cancel_token.cancelled:
+                    status = "cancelled"
+                elif deadline is not None and now > deadline:
+                    status = "expired"
+                elif give_up_at is not None and now >= give_up_at:
+                    status = "timeout"
+                if status is not None:
+                    self._remove(ticket)
+                    ticket.status = status
+                    stats["timeouts" if status == "timeout" else status] += 1
+                    self._cond.notify_all()
+                    return ticket
+                if self._waiting[0][2] is ticket and self.lock.acquire(blocking=False):
+                    heapq.heappop(self._waiting)
+                    self._grant(ticket, cancel_token)
+                    return ticket
+                step = self.POLL_S
+                if give_up_at is not None:
+                    step = max(0.0, min(step, give_up_at - now))
+                self._cond.wait(step)
+
+    def _reject(self, ticket: Ticket, reason: str) -> Ticket:
+        ticket.status, ticket.reason = "rejected", reason
+        self._stats[ticket.priority]["rejected"] += 1
+        logger.info(f"[RequestScheduler] Rejected {ticket.priority.name} request ({reason})")
+        return ticket
+
+    def _remove(self, ticket: Ticket) -> None:
+        self._waiting = [entry for entry in self._waiting if entry[2] is not ticket]
+        heapq.heapify(self._waiting)
+
+    def _grant(self, ticket: Ticket, cancel_token: Optional[CancellationToken]) -> None:
+        ticket.granted_at = time.monotonic()
+        ticket.wait_ms = round((ticket.granted_at - ticket.enqueued) * 1000.0, 2)
+        ticket.status = "granted"
+        if ticket.preemptible:
+            # Token proprio: la prelazione non deve annullare il token del chiamante
+            ticket.token = CancellationToken()
+            if cancel_token is not None:
+                ticket._parent = cancel_token
+                cancel_token.add_listener(ticket.token.cancel)
+        else:
+            ticket.token = cancel_token
+        self._running = ticket
+        self._waits[ticket.priority].append(ticket.wait_ms)
+
+    def _preempt_for(self, priority: Priority) -> None:
+        """Interrompe il lavoro in corso se è di fondo e la nuova richiesta è più urgente."""
+        running = self._running
+        if running is None or not running.preemptible or priority >= running.priority:
+            return
+        if running.token is not None and running.token.cancel("preempted"):
+            self._stats[running.priority]["preempted"] += 1
+            logger.info(f"[RequestScheduler] {running.priority.name} preempted by {priority.name}")
+
+    def _estimate_wait_s(self, priority: Priority) -> float:
+        """Attesa stimata: resto del lavoro in corso più le richieste che passano prima."""
+        wait = 0.0
+        running = self._running
+        if running is not None and not (running.preemptible and priority < running.priority):
+            elapsed = time.monotonic() - (running.granted_at or time.monotonic())
+            wait += max(0.0, self._service_s[running.priority] - elapsed)
+        for _, _, ticket in self._waiting:
+            if ticket.priority <= priority:
+                wait += self._service_s[ticket.priority]
+        return wait
+
+    # ------------------------------------------------------------------
+    # Rilascio
+    # ------------------------------------------------------------------
+
+    def release(self, ticket: Ticket) -> None:
+        """Libera il modello: il prossimo in coda (per priorità) lo prende."""
+        if not ticket.granted:
+            return
+        with self._cond:
+            elapsed = time.monotonic() - (ticket.granted_at or time.monotonic())
+            if ticket.preempted:
+                ticket.status = "preempted"
+            else:
+                ticket.status = "done"
+                self._stats[ticket.priority]["completed"] += 1
+                self._service_s[ticket.priority] = 0.8 * self._service_s[ticket.priority] + 0.2 * elapsed
+            if ticket._parent is not None and ticket.token is not None:
+                ticket._parent.remove_listener(ticket.token.cancel)
+            if self._running is ticket:
+                self._running = None
+            self.lock.release()
+            self._cond.notify_all()
+
+    # ------------------------------------------------------------------
+    # Metriche
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def _percentile(values: List[float], q: float) -> Optional[float]:
+        if not values:
+            return None
+        ordered = sorted(values)
+        return round(ordered[min(len(ordered) - 1, int(q * len(ordered)))], 2)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._cond:
+            report: Dict[str, Any] = {
+                "running": self._running.priority.name if self._running is not None else None,
+                "waiting": len(self._waiting),
+            }
+            for p in Priority:
+                waits = list(self._waits[p])
+                report[p.name.lower()] = {
+                    **self._stats[p],
+                    "queue_wait_p50_ms": self._percentile(waits, 0.5),
+                    "queue_wait_p95_ms": self._percentile(waits, 0.95),
+                    "service_ms": round(self._service_s[p] * 1000.0, 1),
+                }
+        return report
+
+
+@functools.lru_cache(maxsize=64)
+def _accepts_priority(generate: Any) -> bool:
+    """True se generate ha il parametro priority (o **kwargs); deciso una volta per funzione."""
+    try:
+        parameters = inspect.signature(generate).parameters.values()
+    except (TypeError, ValueError):
+        return False
+    return any(p.name == "priority" or p.kind is inspect.Parameter.VAR_KEYWORD for p in parameters)
+
+
+def generate_with_priority(llm: Any, prompt: str, priority: int, **kwargs: Any) -> Any:
+    """
+    llm.generate con la classe di priorità; senza scheduler (altri LLM, la cui
+    generate non ha il parametro priority) la chiamata parte senza priorità.
+    """
+    generate = llm.generate
+    if _accepts_priority(getattr(generate, "__func__", generate)):
+        return generate(prompt, priority=priority, **kwargs)
+    return generate(prompt, **kwargs)
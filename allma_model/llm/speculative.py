@@ -0,0 +1,251 @@
+"""
+Speculative — Decodifica speculativa per MobileGemmaWrapper
+
+Scopo:
+    Sui dispositivi senza GPU la risposta esce un token alla volta e ogni
+    token è un passaggio completo del modello principale. Con la decodifica
+    speculativa una bozza economica propone i token successivi e il modello
+    principale li verifica in un solo passaggio (batch): i token accettati
+    costano quanto uno.
+
+Architettura:
+    DraftModel           → bozza da un piccolo GGUF locale con lo stesso
+                           vocabolario (greedy, contesto riusato per prefisso)
+    prompt lookup        → senza modello bozza: LlamaPromptLookupDecoding cerca
+                           l'ultimo n-gramma nella conversazione (cronologia,
+                           ricordi, codice citato) e propone ciò che lo seguiva
+    TrackedDraft         → avvolge la bozza: a ogni chiamata confronta la
+                           proposta precedente con i token poi accettati
+                           (llama.cpp richiama la bozza dopo ogni verifica)
+    SpeculativeDecoder   → attacca la bozza a Llama.draft_model per richiesta;
+                           una generazione ogni BASELINE_EVERY parte senza bozza
+                           e misura i token/s di riferimento, da cui il
+                           guadagno (speedup) di ogni richiesta speculativa
+
+Memoria:
+    llama.cpp verifica la bozza campionando più posizioni per passaggio:
+    serve logits_all=True alla creazione del contesto principale (logits di
+    tutto n_ctx, ~n_ctx × n_vocab float: oltre 1 GB con il vocabolario Qwen e
+    n_ctx=2048). Per questo la modalità è opzionale (speculative=True) e il
+    modello bozza pesa in RAM in più.
+
+Errori:
+    create() restituisce None se llama_cpp.llama_speculative non c'è, se il
+    modello bozza manca o ha un vocabolario diverso e il prompt lookup non è
+    disponibile: il wrapper genera senza bozza come prima.
+"""
+
+from __future__ import annotations
+
+import logging
+import os
+import threading
+from typing import Any, Callable, Dict, Optional
+
+try:
+    import numpy as np
+    from llama_cpp.llama_speculative import LlamaPromptLookupDecoding
+    SPECULATIVE_AVAILABLE = True
+except ImportError:
+    np = None
+    LlamaPromptLookupDecoding = None
+    SPECULATIVE_AVAILABLE = False
+
+
+logger = logging.getLogger(__name__)
+
+
+class DraftModel:
+    """Bozza da un piccolo modello GGUF: num_pred_tokens token greedy dopo il contesto."""
+
+    def __init__(self, llm: Any, num_pred_tokens: int = 4):
+        self.llm = llm
+        self.num_pred_tokens = num_pred_tokens
+
+    def __call__(self, input_ids, **kwargs):
+        proposal = []
+        # generate(reset=True) riusa il prefisso già valutato nel contesto della bozza
+        for token in self.llm.generate(list(input_ids), temp=0.0, reset=True):
+            proposal.append(token)
+            if len(proposal) >= self.num_pred_tokens:
+                break
+        return np.array(proposal, dtype=np.intc) if np is not None else proposal
+
+
+class TrackedDraft:
+    """
+    Bozza con conteggio dei token proposti e accettati.
+
+    llama.cpp chiama la bozza con il contesto più l'ultimo token campionato;
+    la chiamata successiva vede i token usciti dalla verifica: il prefisso
+    comune con la proposta precedente è la parte accettata.
+    """
+
+    def __init__(self, draft: Callable[..., Any]):
+        self.draft = draft
+        self.reset()
+
+    def reset(self) -> None:
+        self.calls = 0
+        self.drafted = 0
+        self.accepted = 0
+        self._pending = None  # (lunghezza del contesto, proposta)
+
+    def __call__(self, input_ids, **kwargs):
+        self._settle(input_ids)
+        proposal = self.draft(input_ids, **kwargs)
+        tokens = [int(t) for t in proposal]
+        self.calls += 1
+        if tokens:
+            self._pending = (len(input_ids), tokens)
+        return proposal
+
+    def _settle(self, input_ids) -> None:
+        if self._pending is None:
+            return
+        start, tokens = self._pending
+        self._pending = None
+        emitted = [int(t) for t in input_ids[start:]]
+        if len(emitted) < 1 or start > len(input_ids):
+            return  # contesto riavviato (altro prompt): proposta non verificata
+        accepted = 0
+        for proposed, actual in zip(tokens, emitted):
+            if proposed != actual:
+                break
+            accepted += 1
+        self.drafted += len(tokens)
+        self.accepted += accepted
+
+
+class SpeculativeDecoder:
+    """
+    Bozza per Llama.draft_model con accettazione e guadagno di token/s per richiesta.
+
+    Usage:
+        decoder = SpeculativeDecoder.create(llm, draft_model_path)   # None: niente bozza
+        decoder.begin(llm, stream=True)
+        ... llm(prompt_tokens, stream=True, ...) ...
+        meta = decoder.end(completion_tokens, decode_s)              # spec_acceptance, spec_speedup
+    """
+
+    # Token proposti per verifica: il prompt lookup sbaglia più spesso e su
+    # CPU ogni token rifiutato costa tempo di verifica
+    PROMPT_LOOKUP_TOKENS = 2
+    PROMPT_LOOKUP_MAX_NGRAM = 3
+    DRAFT_MODEL_TOKENS = 4
+    DRAFT_THREADS = 2
+    # Una generazione ogni BASELINE_EVERY senza bozza: riferimento dei token/s
+    BASELINE_EVERY = 16
+    EMA_ALPHA = 0.2
+
+    def __init__(self, draft: Callable[..., Any], mode: str):
+        self.mode = mode
+        self.draft = TrackedDraft(draft)
+        self._lock = threading.Lock()
+        self._speculating = False
+        self._requests = 0
+        self._tps = {"speculative": None, "baseline": None}
+        self._stats = {
+            "requests": 0, "baseline_requests": 0, "drafted": 0, "accepted": 0, "draft_calls": 0,
+        }
+
+    @classmethod
+    def create(
+        cls,
+        llm: Any,
+        draft_model_path: Optional[str] = None,
+        n_ctx: int = 2048,
+        loader: Optional[Callable[..., Any]] = None
+    ) -> Optional["SpeculativeDecoder"]:
+        """
+        Decoder con il modello bozza se c'è (e ha lo stesso vocabolario), altrimenti prompt lookup.
+
+        Args:
+            llm: modello principale (Llama)
+            draft_model_path: GGUF della bozza (opzionale)
+            loader: costruttore del modello bozza (default: llama_cpp.Llama)
+        """
+        if draft_model_path and os.path.exists(draft_model_path):
+            try:
+                if loader is None:
+                    from llama_cpp import Llama as loader
+                draft_llm = loader(model_path=draft_model_path, n_ctx=n_ctx, n_threads=cls.DRAFT_THREADS,
+                                   n_gpu_layers=0, verbose=False)
+                if draft_llm.n_vocab() != llm.n_vocab():
+                    logger.warning(f"[Speculative] Draft vocab {draft_llm.n_vocab()} != main {llm.n_vocab()}: "
+                                   f"using prompt lookup")
+                else:
+                    logger.info(f"[Speculative] Draft model: {os.path.basename(draft_model_path)}")
+                    return cls(DraftModel(draft_llm, cls.DRAFT_MODEL_TOKENS), "draft_model")
+            except Exception as e:
+                logger.warning(f"[Speculative] Draft model not loaded ({e}): using prompt lookup")
+        elif draft_model_path:
+            logger.info(f"[Speculative] Draft model not found at {draft_model_path}: using prompt lookup")
+
+        if not SPECULATIVE_AVAILABLE:
+            logger.info("[Speculative] llama_cpp.llama_speculative not available: speculative decoding off")
+            return None
+        return cls(
+            LlamaPromptLookupDecoding(max_ngram_size=cls.PROMPT_LOOKUP_MAX_NGRAM,
+                                      num_pred_tokens=cls.PROMPT_LOOKUP_TOKENS),
+            "prompt_lookup"
+        )
+
+    def begin(self, llm: Any, stream: bool = True) -> bool:
+        """
+        Attacca (o stacca, per la misura di riferimento) la bozza prima della generazione.
+
+        Returns:
+            True se questa richiesta usa la bozza
+        """
+        with self._lock:
+            self._requests += 1
+            # Riferimento solo in streaming: lì si misurano i token/s di decodifica
+            baseline = stream and self._requests % self.BASELINE_EVERY == 0
+            self._speculating = not baseline
+        self.draft.reset()
+        llm.draft_model = self.draft if self._speculating else None
+        return self._speculating
+
+    def end(self, completion_tokens: int, decode_s: Optional[float] = None) -> Dict[str, Any]:
+        """Metriche della richiesta: token proposti/accettati, token/s di decodifica e guadagno."""
+        tps = None
+        if decode_s and decode_s > 0 and completion_tokens > 1:
+            tps = (completion_tokens - 1) / decode_s
+        draft = self.draft
+        with self._lock:
+            key = "speculative" if self._speculating else "baseline"
+            if tps is not None:
+                previous = self._tps[key]
+                self._tps[key] = tps if previous is None else (1 - self.EMA_ALPHA) * previous + self.EMA_ALPHA * tps
+            baseline = self._tps["baseline"]
+            if self._speculating:
+                self._stats["requests"] += 1
+                self._stats["drafted"] += draft.drafted
+                self._stats["accepted"] += draft.accepted
+                self._stats["draft_calls"] += draft.calls
+            else:
+                self._stats["baseline_requests"] += 1
+        meta = {
+            "speculative": self.mode if self._speculating else None,
+            "decode_tps": round(tps, 2) if tps is not None else None,
+        }
+        if self._speculating:
+            meta.update(
+                spec_drafted=draft.drafted,
+                spec_accepted=draft.accepted,
+                spec_acceptance=round(draft.accepted / draft.drafted, 3) if draft.drafted else None,
+                spec_speedup=round(tps / baseline, 2) if tps is not None and baseline else None,
+            )
+        return meta
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            spec, base = self._tps["speculative"], self._tps["baseline"]
+        stats["mode"] = self.mode
+        stats["acceptance_rate"] = round(stats["accepted"] / stats["drafted"], 3) if stats["drafted"] else None
+        stats["speculative_tps"] = round(spec, 2) if spec is not None else None
+        stats["baseline_tps"] = round(base, 2) if base is not None else None
+        stats["speedup"] = round(spec / base, 2) if spec is not None and base else None
+        return stats
@@ -0,0 +1,265 @@
+"""
+StructuredOutput — JSON vincolato per le chiamate ausiliarie al LLM
+
+Scopo:
+    Rilevamento delle emozioni, estrazione delle entità e condensazione della
+    memoria chiedevano JSON al modello con istruzioni nel prompt e poi lo
+    cercavano con regex e try/except: il modello spendeva token in preamboli
+    (<think>, spiegazioni, ```json) e un output non valido costava un secondo
+    tentativo. Con una grammatica GBNF derivata dallo schema JSON il
+    campionamento produce solo JSON valido, e lo schema dà anche il massimo
+    di token che la risposta può occupare.
+
+Architettura:
+    schema_max_tokens(schema) → max_tokens stretto dallo schema: lunghezze
+                                massime di stringhe (maxLength), liste
+                                (maxItems) e oggetti (maxProperties)
+    StructuredOutput.grammar  → LlamaGrammar.from_json_schema, una per schema
+                                (la conversione in GBNF si paga una volta)
+    extract_json / validate   → lettura tollerante dell'output non vincolato
+                                e controllo di un sottoinsieme di JSON Schema
+                                (type, enum, required, properties, items); i
+                                limiti di lunghezza servono solo al budget
+    misure di riferimento     → per tipo di chiamata, una ogni BASELINE_EVERY
+                                parte senza grammatica (prompt uguale, budget
+                                della chiamata storica): token, latenza e
+                                fallimenti con e senza vincolo → risparmio
+
+Errori:
+    Senza llama_cpp.LlamaGrammar o con uno schema non convertibile la chiamata
+    parte senza vincolo e l'output passa da extract_json: il chiamante riceve
+    None solo se il JSON manca o non rispetta lo schema.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import math
+import re
+import threading
+from typing import Any, Callable, Dict, Optional, Tuple
+
+try:
+    from llama_cpp import LlamaGrammar
+    GRAMMAR_AVAILABLE = True
+except ImportError:
+    LlamaGrammar = None
+    GRAMMAR_AVAILABLE = False
+
+
+logger = logging.getLogger(__name__)
+
+# Limiti assunti quando lo schema non li dichiara
+DEFAULT_STRING_CHARS = 48
+DEFAULT_ARRAY_ITEMS = 4
+DEFAULT_OBJECT_PROPERTIES = 5
+DEFAULT_KEY_CHARS = 24
+NUMBER_CHARS = 6
+# JSON è ricco di punteggiatura: pochi caratteri per token (stima prudente:
+# una risposta troncata dal budget non è più JSON valido)
+CHARS_PER_TOKEN = 2.5
+TOKEN_MARGIN = 6
+
+
+def max_json_chars(schema: Dict[str, Any]) -> int:
+    """Lunghezza massima in caratteri di un JSON conforme allo schema (spazi dopo ':' e ',' inclusi)."""
+    if "enum" in schema:
+        return max(len(json.dumps(v, ensure_ascii=False)) for v in schema["enum"])
+    kind = schema.get("type", "string")
+    if isinstance(kind, list):
+        return max(max_json_chars({**schema, "type": k}) for k in kind)
+    if kind == "string":
+        return schema.get("maxLength", DEFAULT_STRING_CHARS) + 2
+    if kind in ("number", "integer"):
+        return NUMBER_CHARS
+    if kind == "boolean":
+        return 5
+    if kind == "null":
+        return 4
+    if kind == "array":
+        items = schema.get("maxItems", DEFAULT_ARRAY_ITEMS)
+        return 2 + items * (max_json_chars(schema.get("items", {})) + 2)
+    if kind == "object":
+        chars = 2
+        for key, value in schema.get("properties", {}).items():
+            chars += len(json.dumps(key, ensure_ascii=False)) + max_json_chars(value) + 4
+        extra = schema.get("additionalProperties")
+        if isinstance(extra, dict):
+            key_chars = schema.get("propertyNames", {}).get("maxLength", DEFAULT_KEY_CHARS) + 2
+            count = schema.get("maxProperties", DEFAULT_OBJECT_PROPERTIES) - len(schema.get("properties", {}))
+            chars += max(0, count) * (key_chars + max_json_chars(extra) + 4)
+        return chars
+    return DEFAULT_STRING_CHARS
+
+
+def schema_max_tokens(schema: Dict[str, Any]) -> int:
+    """max_tokens per una risposta conforme allo schema."""
+    return int(math.ceil(max_json_chars(schema) / CHARS_PER_TOKEN)) + TOKEN_MARGIN
+
+
+def extract_json(text: str) -> Any:
+    """
+    JSON dall'output del modello senza vincolo (<think>, ```json, testo intorno).
+
+    Raises:
+        ValueError: se non c'è un oggetto JSON leggibile
+    """
+    cleaned = re.sub(r'<think>.*?</think>', '', text or '', flags=re.DOTALL)
+    cleaned = re.sub(r'```(?:json)?', '', cleaned).strip()
+    try:
+        return json.loads(cleaned)
+    except ValueError:
+        pass
+    match = re.search(r'\{.*\}', cleaned, re.DOTALL)
+    if match:
+        try:
+            return json.loads(match.group(0))
+        except ValueError:
+            pass
+    raise ValueError(f"No JSON object in output: {cleaned[:50]!r}")
+
+
+_TYPES = {
+    "object": dict, "array": list, "string": str, "boolean": bool,
+    "integer": int, "number": (int, float), "null": type(None),
+}
+
+
+def validate(data: Any, schema: Dict[str, Any]) -> bool:
+    """
+    Conformità a un sottoinsieme di JSON Schema: type, enum, required, properties, items.
+
+    maxLength/maxItems/maxProperties non si controllano: non tutte le versioni
+    di llama.cpp li applicano nella grammatica e i chiamanti troncano comunque.
+    """
+    if "enum" in schema:
+        return data in schema["enum"]
+    kind = schema.get("type")
+    if kind is not None:
+        kinds = kind if isinstance(kind, list) else [kind]
+        if not any(isinstance(data, _TYPES[k]) for k in kinds if k in _TYPES):
+            return False
+        if isinstance(data, bool) and not any(k == "boolean" for k in kinds):
+            return False
+    if isinstance(data, list):
+        return all(validate(item, schema.get("items", {})) for item in data)
+    if isinstance(data, dict):
+        if any(key not in data for key in schema.get("required", [])):
+            return False
+        properties = schema.get("properties", {})
+        extra = schema.get("additionalProperties", True)
+        for key, value in data.items():
+            if key in properties:
+                if not validate(value, properties[key]):
+                    return False
+            elif extra is False or (isinstance(extra, dict) and not validate(value, extra)):
+                return False
+    return True
+
+
+def _llama_grammar(schema_json: str) -> Any:
+    try:
+        return LlamaGrammar.from_json_schema(schema_json, verbose=False)
+    except TypeError:
+        return LlamaGrammar.from_json_schema(schema_json)
+
+
+class StructuredOutput:
+    """
+    Grammatiche per schema e metriche per tipo di chiamata (con e senza vincolo).
+
+    Usage:
+        structured = StructuredOutput()
+        constrained = structured.plan("emotion")
+        grammar = structured.grammar(schema) if constrained else None
+        ... generazione ...
+        structured.record("emotion", grammar is not None, completion_tokens, elapsed_ms, ok)
+    """
+
+    BASELINE_EVERY = 20
+    GRAMMAR_SLOTS = 16
+
+    def __init__(self, grammar_factory: Optional[Callable[[str], Any]] = None):
+        """
+        Args:
+            grammar_factory: schema JSON (stringa) → grammatica; default
+                             LlamaGrammar.from_json_schema se llama_cpp c'è
+        """
+        if grammar_factory is None and GRAMMAR_AVAILABLE:
+            grammar_factory = _llama_grammar
+        self.grammar_factory = grammar_factory
+        self._lock = threading.Lock()
+        self._grammars: Dict[str, Any] = {}
+        self._calls: Dict[str, int] = {}
+        self._stats: Dict[str, Dict[str, Dict[str, float]]] = {}
+
+    def plan(self, call_type: str) -> bool:
+        """True se questa chiamata va vincolata (False: misura di riferimento o niente grammatiche)."""
+        if self.grammar_factory is None:
+            return False
+        with self._lock:
+            self._calls[call_type] = self._calls.get(call_type, 0) + 1
+            return self._calls[call_type] % self.BASELINE_EVERY != 0
+
+    def grammar(self, schema: Dict[str, Any]) -> Optional[Any]:
+        """Grammatica GBNF dello schema (memorizzata); None se non disponibile o non convertibile."""
+        if self.grammar_factory is None:
+            return None
+        key = json.dumps(schema, sort_keys=True)
+        with self._lock:
+            if key in self._grammars:
+                return self._grammars[key]
+        try:
+            grammar = self.grammar_factory(key)
+        except Exception as e:
+            logger.warning(f"[StructuredOutput] Schema not convertible to GBNF ({e}): unconstrained")
+            grammar = None
+        with self._lock:
+            if len(self._grammars) >= self.GRAMMAR_SLOTS:
+                self._grammars.pop(next(iter(self._grammars)))
+            self._grammars[key] = grammar
+        return grammar
+
+    def grammar_key(self, grammar: Any) -> Optional[str]:
+        """Schema (JSON ordinato) da cui è stata costruita la grammatica; None se non è di questa istanza."""
+        with self._lock:
+            for key, cached in self._grammars.items():
+                if cached is grammar:
+                    return key
+        return None
+
+    def record(self, call_type: str, constrained: bool, tokens: int, elapsed_ms: float, ok: bool) -> None:
+        mode = "constrained" if constrained else "unconstrained"
+        with self._lock:
+            stats = self._stats.setdefault(call_type, {}).setdefault(
+                mode, {"calls": 0, "failures": 0, "tokens": 0, "ms": 0.0}
+            )
+            stats["calls"] += 1
+            stats["tokens"] += int(tokens or 0)
+            stats["ms"] += float(elapsed_ms)
+            if not ok:
+                stats["failures"] += 1
+
+    def get_stats(self) -> Dict[str, Dict[str, Any]]:
+        """Per tipo di chiamata: medie con e senza vincolo, fallimenti e risparmio di token e latenza."""
+        report: Dict[str, Dict[str, Any]] = {}
+        with self._lock:
+            snapshot = {k: {m: dict(s) for m, s in v.items()} for k, v in self._stats.items()}
+        for call_type, modes in snapshot.items():
+            entry: Dict[str, Any] = {}
+            averages: Dict[str, Tuple[float, float]] = {}
+            for mode, stats in modes.items():
+                calls = stats["calls"]
+                averages[mode] = (stats["tokens"] / calls, stats["ms"] / calls)
+                entry[mode] = {
+                    "calls": calls,
+                    "failure_rate": round(stats["failures"] / calls, 3),
+                    "avg_tokens": round(averages[mode][0], 1),
+                    "avg_ms": round(averages[mode][1], 1),
+                }
+            if "constrained" in averages and "unconstrained" in averages:
+                entry["tokens_saved_per_call"] = round(averages["unconstrained"][0] - averages["constrained"][0], 1)
+                entry["ms_saved_per_call"] = round(averages["unconstrained"][1] - averages["constrained"][1], 1)
+            report[call_type] = entry
+        return report
@@ -0,0 +1,180 @@
+"""
+TokenAccounting — Tokenizzazione unica e conteggi per sezione del prompt di ALLMA
+
+Scopo:
+    Ogni turno tokenizzava lo stesso prompt più volte: per il max_tokens
+    dinamico, per il riuso del prefisso, per la valutazione a blocchi e dentro
+    llama.cpp; poi ritokenizzava la risposta per contare i token generati. Il
+    prefill del prefisso ripeteva il lavoro su system e cronologia.
+
+Architettura:
+    TokenAccountant.prompt(text) → PromptTokens: il prompt diviso nei messaggi
+                                   ChatML (ogni segmento inizia con <|im_start|>),
+                                   ognuno tokenizzato una volta e memorizzato:
+                                   system e cronologia, già visti dal prefill o
+                                   dal turno precedente, non si ritokenizzano
+    PromptTokens                 → ids (passati così a llama.cpp), conteggi per
+                                   sezione (system/history/user/assistant) e
+                                   trim_history() per rientrare nel contesto
+    segmentazione                → esatta perché <|im_start|> è un token speciale:
+                                   il tokenizer divide il testo lì comunque. Al
+                                   primo prompt con più segmenti il risultato
+                                   viene confrontato con la tokenizzazione intera;
+                                   se differisce (tokenizer con prefisso di spazio)
+                                   si tokenizza il prompt intero
+"""
+
+from __future__ import annotations
+
+import logging
+import re
+import threading
+from collections import OrderedDict
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+logger = logging.getLogger(__name__)
+
+_SEGMENT_RE = re.compile(r"(?=<\|im_start\|>)")
+_ROLE_RE = re.compile(r"<\|im_start\|>(\w+)")
+
+
+@dataclass
+class PromptSegment:
+    """Un messaggio ChatML del prompt (o testo libero: role 'raw')."""
+    role: str
+    text: str
+    ids: List[int]
+
+
+@dataclass
+class PromptTokens:
+    """Token del prompt per segmento: gli ids completi sono la loro concatenazione."""
+    segments: List[PromptSegment] = field(default_factory=list)
+
+    @property
+    def ids(self) -> List[int]:
+        return [t for segment in self.segments for t in segment.ids]
+
+    @property
+    def text(self) -> str:
+        return "".join(segment.text for segment in self.segments)
+
+    def __len__(self) -> int:
+        return sum(len(segment.ids) for segment in self.segments)
+
+    def _history_range(self) -> Tuple[int, int]:
+        """Indici [start, end) dei messaggi di cronologia: dopo il system, prima dell'ultimo user."""
+        start = 1 if self.segments and self.segments[0].role == "system" else 0
+        # Senza un messaggio user (testo libero, solo system) non c'è cronologia
+        end = start
+        for i in range(len(self.segments) - 1, start - 1, -1):
+            if self.segments[i].role == "user":
+                end = i
+                break
+        return start, end
+
+    def sections(self) -> Dict[str, int]:
+        """Token per sezione: system, history, user (ultimo messaggio), assistant (coda aperta), raw."""
+        counts: Dict[str, int] = {}
+        start, end = self._history_range()
+        for i, segment in enumerate(self.segments):
+            name = "history" if start <= i < end else segment.role
+            if name not in ("system", "history", "user", "assistant"):
+                name = "raw"
+            counts[name] = counts.get(name, 0) + len(segment.ids)
+        return counts
+
+    def trim_history(self, max_tokens: int) -> Tuple["PromptTokens", int]:
+        """
+        Toglie i messaggi di cronologia più vecchi finché il prompt sta in max_tokens.
+
+        Returns:
+            (prompt ridotto, token tolti); system e ultimo messaggio restano sempre
+        """
+        start, end = self._history_range()
+        segments = list(self.segments)
+        total = len(self)
+        dropped = 0
+        i = start
+        while total > max_tokens and i < end:
+            total -= len(segments[i].ids)
+            dropped += len(segments[i].ids)
+            i += 1
+        return PromptTokens(segments[:start] + segments[i:]), dropped
+
+
+class TokenAccountant:
+    """
+    Tokenizzazione memorizzata per segmento ChatML.
+
+    Usage:
+        accountant = TokenAccountant(lambda data, add_bos: llm.tokenize(data, add_bos=add_bos, special=True))
+        prompt = accountant.prompt(full_prompt)
+        llm(prompt.ids, ...)                  # nessuna ritokenizzazione in llama.cpp
+        prompt.sections()                     # {'system': 120, 'history': 340, 'user': 60, ...}
+    """
+
+    def __init__(self, tokenize: Callable[[bytes, bool], List[int]], cache_size: int = 128):
+        self._tokenize = tokenize
+        self.cache_size = cache_size
+        self._cache: "OrderedDict[Tuple[str, bool], List[int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.segmented: Optional[bool] = None  # None = non ancora verificato
+        self._stats = {"calls": 0, "cached": 0, "tokenized_chars": 0}
+
+    def reset(self) -> None:
+        """Dimentica i token memorizzati (es. modello ricaricato)."""
+        with self._lock:
+            self._cache.clear()
+            self.segmented = None
+
+    def tokens(self, text: str, add_bos: bool = True) -> List[int]:
+        """Token del testo, dalla memoria se già visto."""
+        key = (text, add_bos)
+        with self._lock:
+            self._stats["calls"] += 1
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._cache.move_to_end(key)
+                self._stats["cached"] += 1
+                return cached
+        ids = [int(t) for t in self._tokenize(text.encode("utf-8"), add_bos)]
+        with self._lock:
+            self._stats["tokenized_chars"] += len(text)
+            self._cache[key] = ids
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return ids
+
+    def prompt(self, text: str) -> PromptTokens:
+        """Token del prompt per segmento ChatML (un solo segmento se la segmentazione non è esatta)."""
+        parts = [p for p in _SEGMENT_RE.split(text or "") if p]
+        if len(parts) <= 1 or self.segmented is False:
+            role = self._role(text or "") if len(parts) <= 1 else "raw"
+            return PromptTokens([PromptSegment(role, text or "", self.tokens(text or ""))])
+
+        segments = [
+            PromptSegment(self._role(part), part, self.tokens(part, add_bos=(i == 0)))
+            for i, part in enumerate(parts)
+        ]
+        result = PromptTokens(segments)
+        if self.segmented is None:
+            whole = self.tokens(text)
+            self.segmented = whole == result.ids
+            if not self.segmented:
+                logger.warning("[TokenAccountant] Tokenizzazione per segmenti non esatta: uso il prompt intero")
+                return PromptTokens([PromptSegment("raw", text, whole)])
+        return result
+
+    @staticmethod
+    def _role(text: str) -> str:
+        match = _ROLE_RE.match(text)
+        return match.group(1) if match else "raw"
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["entries"] = len(self._cache)
+        return stats
@@ -17,6 +17,14 @@ except ImportError:
     import logging
     logging.getLogger(__name__).warning("[V6.3] VectorMemoryEngine non disponibile, fallback a TF-IDF classico.")
 
+# Fatti Cognitivi della condensazione con output vincolato (generate_structured):
+# fino a 5 coppie chiave corta → valore sintetico (parse_condensed_facts tronca)
+CONDENSED_FACTS_SCHEMA = {
+    "type": "object",
+    "additionalProperties": {"type": "string", "maxLength": 60},
+    "propertyNames": {"maxLength": 24},
+    "maxProperties": 5,
+}
 
 
 @dataclass
@@ -449,6 +457,9 @@ class ConversationalMemory:
         """
         Condense vecchie conversazioni estraendo i concetti chiave (macro-fatti) usando un LLM,
         poi le cancella per liberare RAM e vettori.
+
+        Percorso legacy a chiamata singola: il GC di ALLMACore usa
+        CondensationJobEngine (memory_condensation.py), che lavora a batch.
         """
         if user_id not in self.conversations:
             return 0
@@ -462,55 +473,133 @@ class ConversationalMemory:
         if not old_messages:
             return 0
             
-        # Preparazione del testo per l'estrazione
-        text_to_compress = "\n".join([f"{m.role}: {m.content}" for m in old_messages])
+        prompt = self.build_condensation_prompt(old_messages)
         
-        prompt = (
+        try:
+            extracted_facts = self.parse_condensed_facts(llm_callback(prompt))
+        except Exception as e:
+            import logging
+            logging.error(f"[ConversationalMemory] GC Condensation failed: {e}", exc_info=True)
+            extracted_facts = {}
+            
+        # Ora che abbiamo salvato i macro concetti, procediamo col wiping pesante
+        result = self.apply_condensed_batch(user_id, old_messages, extracted_facts, before_date)
+        return result['conversations_removed']
+
+    # ------------------------------------------------------------------
+    # Condensazione a batch (usata da CondensationJobEngine)
+    # ------------------------------------------------------------------
+
+    @staticmethod
+    def build_condensation_prompt(messages: List[Message], max_chars: int = 8000) -> str:
+        """Costruisce il prompt di estrazione dei Fatti Cognitivi per un gruppo di messaggi."""
+        text_to_compress = "\n".join([f"{m.role}: {m.content}" for m in messages])
+        return (
             f"Sei un estrattore di memorie a lungo termine. Analizza la seguente cronologia passata e "
             f"estrai un massimo di 5 Fatti Cognitivi su questo utente. "
             f"I fatti devono essere chiavi corte (es. 'hobby', 'lavoro', 'film_preferito', 'relazione') "
             f"e valori sintetici. Rispondi SOLO con un JSON valido in questo formato: "
             f"{{\"hobby\": \"fotografia\", \"colore\": \"rosso\"}}\n"
-            f"---\n{text_to_compress[:8000]}\n---"
+            f"---\n{text_to_compress[:max_chars]}\n---"
         )
-        
+
+    @staticmethod
+    def parse_condensed_facts(raw: str) -> Dict[str, str]:
+        """
+        Converte l'output JSON dell'LLM in fatti puliti (chiavi safe, valori troncati).
+
+        Raises:
+            ValueError: se l'output non contiene un oggetto JSON valido
+        """
+        json_str = re.sub(r'```json\n|\n```|```', '', raw or '').strip()
+        extracted = json.loads(json_str)
+        if not isinstance(extracted, dict):
+            raise ValueError("Condensation output is not a JSON object")
+
+        facts = {}
+        for k, v in extracted.items():
+            if isinstance(v, str):
+                clean_k = re.sub(r'[^a-zA-Z0-9_]', '_', str(k).lower())[:30] # safe key
+                facts[clean_k] = v[:100] # truncate long values
+        return facts
+
+    def get_condensation_candidates(self, before_date: datetime) -> Dict[str, List[Message]]:
+        """Messaggi più vecchi di before_date raggruppati per utente, in ordine cronologico."""
+        candidates: Dict[str, List[Message]] = defaultdict(list)
+        with self.lock:
+            for m in self.messages:
+                if m.timestamp < before_date:
+                    candidates[m.user_id or "user"].append(m)
+        for msgs in candidates.values():
+            msgs.sort(key=lambda m: m.timestamp)
+        return dict(candidates)
+
+    @staticmethod
+    def estimate_message_bytes(message: Message) -> int:
+        """Stima approssimativa dei byte occupati da un messaggio (contenuto + metadata)."""
+        size = len(message.content.encode('utf-8')) if isinstance(message.content, str) else 0
         try:
-            extracted_json_str = llm_callback(prompt)
-            # Pulizia JSON
-            import re
-            json_str = re.sub(r'```json\n|\n```|```', '', extracted_json_str).strip()
-            extracted_facts = json.loads(json_str)
-            
-            # Salvataggio in user_data
-            self.user_data = getattr(self, 'user_data', {})
-            if user_id not in self.user_data: self.user_data[user_id] = {}
-            
-            for k, v in extracted_facts.items():
-                if isinstance(v, str):
-                    clean_k = re.sub(r'[^a-zA-Z0-9_]', '_', k.lower())[:30] # safe key
-                    self.user_data[user_id][clean_k] = v[:100] # truncate long values
-                    print(f"🧠 GC FACT EXTRACTED: {clean_k} = {v[:100]}")
-                    
-        except Exception as e:
-            import logging
-            logging.error(f"[ConversationalMemory] GC Condensation failed: {e}", exc_info=True)
-            
-        # Ora che abbiamo salvato i macro concetti, procediamo col wiping pesante
-        
+            size += len(json.dumps(message.metadata, default=str))
+        except (TypeError, ValueError):
+            pass
+        return size
+
+    def apply_condensed_batch(
+        self,
+        user_id: str,
+        messages: List[Message],
+        facts: Dict[str, str],
+        before_date: Optional[datetime] = None
+    ) -> Dict[str, int]:
+        """
+        Salva i fatti estratti da un batch e rimuove i messaggi condensati.
+
+        I messaggi vengono rimossi per identità, così un batch non tocca mai
+        messaggi arrivati dopo la sua pianificazione. Le conversazioni
+        strutturate e i vettori vengono potati fino al messaggio più recente
+        del batch (o a before_date). Il salvataggio su disco è unico, così
+        fatti e rimozione sono persistiti insieme.
+
+        Returns:
+            Dict con messages_removed, conversations_removed, bytes_reclaimed, facts_stored
+        """
+        batch_ids = {id(m) for m in messages}
+        if before_date is None:
+            before_date = max((m.timestamp for m in messages), default=datetime.min)
+
         with self.lock:
-            # Rimuovi messaggi piatti
-            self.messages = [
-                m for m in self.messages
-                if m.user_id != user_id or m.timestamp >= before_date
-            ]
+            self.user_data = getattr(self, 'user_data', {})
+            if facts:
+                self.user_data.setdefault(user_id, {})
+                for k, v in facts.items():
+                    self.user_data[user_id][k] = v
+                    print(f"🧠 GC FACT EXTRACTED: {k} = {v}")
+
+            kept = []
+            removed = []
+            for m in self.messages:
+                (removed if id(m) in batch_ids else kept).append(m)
+            self.messages = kept
+
+            reclaimed = sum(self.estimate_message_bytes(m) for m in removed)
+            for c in self.conversations.get(user_id, []):
+                if c.timestamp < before_date:
+                    reclaimed += len(c.content.encode('utf-8')) if isinstance(c.content, str) else 0
+                    if c.embeddings is not None:
+                        reclaimed += int(getattr(c.embeddings, 'nbytes', 0))
+
+            # Rimuovi conversazioni strutturate e vettori (richiama la logica standard)
+            wiped_conversations = self.clear_old_conversations(user_id, before_date)
 
-        # Rimuovi conversazioni strutturate e vettori (richiama la logica standard)
-        wiped_conversations = self.clear_old_conversations(user_id, before_date)
-        
         # Salva disco
         self.save_memory()
-        
-        return wiped_conversations
+
+        return {
+            'messages_removed': len(removed),
+            'conversations_removed': wiped_conversations,
+            'bytes_reclaimed': reclaimed,
+            'facts_stored': len(facts),
+        }
 
     def store_message(
         self,
@@ -792,7 +881,8 @@ class ConversationalMemory:
                         "user_id": getattr(m, 'user_id', None)
                     } for m in self.messages
                 ],
-                "trauma_log": self.trauma_log  # AXIOM 3: Persist Scars
+                "trauma_log": self.trauma_log,  # AXIOM 3: Persist Scars
+                "user_data": getattr(self, 'user_data', {})  # Fatti condensati dal GC
             }
         
         try:
@@ -0,0 +1,271 @@
+"""
+InteractionArchive — Partizionamento temporale delle interazioni
+
+La tabella interactions resta "calda": contiene solo gli ultimi mesi.
+Le righe più vecchie vengono spostate in tabelle d'archivio mensili con
+riassunti (rollup) per utente e mese.
+
+Scopo:
+    Quasi tutte le query toccano righe recenti o statistiche aggregate.
+    Con l'archivio, dimensione della tabella calda e profondità dei suoi
+    indici restano costanti anche dopo anni di utilizzo.
+
+Architettura:
+    interactions_archive_YYYYMM  stesso schema di interactions (id originali preservati)
+    interaction_partitions       registro: partizione → mese, min/max timestamp, righe
+    interaction_rollups          (user_id, month) → conteggi, ore, emozioni, topic
+
+Instradamento:
+    partitions_for_range() restituisce le tabelle che intersecano un intervallo:
+    TemporalMemorySystem le interroga in UNION ALL con la tabella calda.
+
+Migrazione:
+    archive() lavora per utente e per mese con un commit per mese, quindi
+    lo stesso metodo sposta anni di dati esistenti senza transazioni enormi.
+"""
+
+import json
+import re
+import sqlite3
+from collections import Counter
+from datetime import datetime
+from typing import Dict, List, Optional, Tuple
+
+from allma_model.memory_system.interaction_index import InteractionIndex
+
+
+_MONTH_RE = re.compile(r'^\d{4}-\d{2}$')
+
+_INTERACTION_COLUMNS = "id, user_id, timestamp, content, context, emotion, topics, metadata"
+
+
+def _next_month(month: str) -> str:
+    year, mon = int(month[:4]), int(month[5:7])
+    return f"{year + 1:04d}-01" if mon == 12 else f"{year:04d}-{mon + 1:02d}"
+
+
+class InteractionArchive:
+    """Archivio mensile delle interazioni; come InteractionIndex, lavora sulla connessione del chiamante."""
+
+    def __init__(self, index: Optional[InteractionIndex] = None):
+        self.index = index
+
+    def ensure_schema(self, conn: sqlite3.Connection) -> None:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS interaction_partitions (
+                name TEXT PRIMARY KEY,
+                month TEXT NOT NULL UNIQUE,
+                min_ts TEXT,
+                max_ts TEXT,
+                row_count INTEGER NOT NULL DEFAULT 0,
+                archived_at TEXT NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS interaction_rollups (
+                user_id TEXT NOT NULL,
+                month TEXT NOT NULL,
+                count INTEGER NOT NULL,
+                first_ts TEXT NOT NULL,
+                last_ts TEXT NOT NULL,
+                hour_counts TEXT NOT NULL,
+                emotion_counts TEXT NOT NULL,
+                topic_counts TEXT NOT NULL,
+                PRIMARY KEY (user_id, month)
+            )
+        """)
+
+    @staticmethod
+    def partition_name(month: str) -> str:
+        if not _MONTH_RE.match(month):
+            raise ValueError(f"Mese di partizione non valido: {month}")
+        return f"interactions_archive_{month[:4]}{month[5:7]}"
+
+    def _ensure_partition(self, conn: sqlite3.Connection, month: str) -> str:
+        name = self.partition_name(month)
+        conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {name} (
+                id INTEGER PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                timestamp DATETIME NOT NULL,
+                content TEXT NOT NULL,
+                context TEXT,
+                emotion TEXT,
+                topics TEXT,
+                metadata TEXT,
+                UNIQUE(user_id, timestamp)
+            )
+        """)
+        conn.execute(
+            "INSERT OR IGNORE INTO interaction_partitions (name, month, row_count, archived_at) VALUES (?, ?, 0, ?)",
+            (name, month, datetime.now().isoformat())
+        )
+        return name
+
+    # ------------------------------------------------------------------
+    # Archiviazione
+    # ------------------------------------------------------------------
+
+    def archive(self, conn: sqlite3.Connection, before: datetime) -> Dict[str, int]:
+        """
+        Sposta in archivio le interazioni con timestamp < before.
+
+        Ogni (utente, mese) è una transazione: copia nella partizione, rollup,
+        rimozione dall'indice lessicale e dalla tabella calda, poi commit.
+
+        Returns:
+            Dict con rows_archived, partitions_touched, rollups_updated
+        """
+        cutoff = before.isoformat()
+        users = [r[0] for r in conn.execute("SELECT DISTINCT user_id FROM interactions").fetchall()]
+        archived = 0
+        partitions = set()
+        rollups = 0
+
+        for user_id in users:
+            months = [r[0] for r in conn.execute(
+                "SELECT DISTINCT substr(timestamp, 1, 7) FROM interactions WHERE user_id = ? AND timestamp < ?",
+                (user_id, cutoff)
+            ).fetchall()]
+            for month in sorted(m for m in months if m and _MONTH_RE.match(m)):
+                upper = min(cutoff, _next_month(month))
+                moved = self._archive_user_month(conn, user_id, month, upper)
+                conn.commit()
+                if moved:
+                    archived += moved
+                    partitions.add(month)
+                    rollups += 1
+
+        return {
+            'rows_archived': archived,
+            'partitions_touched': len(partitions),
+            'rollups_updated': rollups,
+        }
+
+    def _archive_user_month(self, conn: sqlite3.Connection, user_id: str, month: str, upper: str) -> int:
+        name = self._ensure_partition(conn, month)
+        where = "user_id = ? AND timestamp >= ? AND timestamp < ?"
+        params = (user_id, month, upper)
+
+        rows = conn.execute(
+            f"SELECT id, timestamp, emotion, topics FROM interactions WHERE {where}", params
+        ).fetchall()
+        if not rows:
+            return 0
+
+        conn.execute(
+            f"INSERT OR IGNORE INTO {name} ({_INTERACTION_COLUMNS}) "
+            f"SELECT {_INTERACTION_COLUMNS} FROM interactions WHERE {where}",
+            params
+        )
+        self._merge_rollup(conn, user_id, month, rows)
+        if self.index is not None:
+            self.index.remove_interactions(conn, [r[0] for r in rows])
+        conn.execute(f"DELETE FROM interactions WHERE {where}", params)
+
+        conn.execute(
+            f"""
+            UPDATE interaction_partitions SET
+                row_count = (SELECT COUNT(*) FROM {name}),
+                min_ts = (SELECT MIN(timestamp) FROM {name}),
+                max_ts = (SELECT MAX(timestamp) FROM {name})
+            WHERE name = ?
+            """,
+            (name,)
+        )
+        return len(rows)
+
+    @staticmethod
+    def _merge_rollup(conn: sqlite3.Connection, user_id: str, month: str, rows: List[sqlite3.Row]) -> None:
+        hours = Counter()
+        emotions = Counter()
+        topics = Counter()
+        timestamps = []
+        for _id, ts, emotion, raw_topics in rows:
+            timestamps.append(ts)
+            try:
+                hours[str(datetime.fromisoformat(ts).hour)] += 1
+            except ValueError:
+                pass
+            if emotion:
+                emotions[emotion] += 1
+            try:
+                topics.update(json.loads(raw_topics) if raw_topics else [])
+            except (TypeError, ValueError):
+                pass
+
+        existing = conn.execute(
+            "SELECT count, first_ts, last_ts, hour_counts, emotion_counts, topic_counts "
+            "FROM interaction_rollups WHERE user_id = ? AND month = ?",
+            (user_id, month)
+        ).fetchone()
+        count = len(rows)
+        first_ts, last_ts = min(timestamps), max(timestamps)
+        if existing:
+            count += existing[0]
+            first_ts = min(first_ts, existing[1])
+            last_ts = max(last_ts, existing[2])
+            hours.update(json.loads(existing[3]))
+            emotions.update(json.loads(existing[4]))
+            topics.update(json.loads(existing[5]))
+
+        conn.execute(
+            """
+            INSERT OR REPLACE INTO interaction_rollups
+            (user_id, month, count, first_ts, last_ts, hour_counts, emotion_counts, topic_counts)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (user_id, month, count, first_ts, last_ts, json.dumps(dict(hours)),
+             json.dumps(dict(emotions)), json.dumps(dict(topics.most_common(20))))
+        )
+
+    # ------------------------------------------------------------------
+    # Instradamento e lettura
+    # ------------------------------------------------------------------
+
+    def partitions_for_range(
+        self,
+        conn: sqlite3.Connection,
+        start: Optional[str] = None,
+        end: Optional[str] = None
+    ) -> List[Tuple[str, str]]:
+        """Partizioni (name, month) che possono contenere timestamp in [start, end], dalla più recente."""
+        query = "SELECT name, month FROM interaction_partitions WHERE row_count > 0"
+        params: List[str] = []
+        if start:
+            query += " AND max_ts >= ?"
+            params.append(start)
+        if end:
+            query += " AND min_ts <= ?"
+            params.append(end)
+        query += " ORDER BY month DESC"
+        return [(r[0], r[1]) for r in conn.execute(query, params).fetchall()]
+
+    def get_rollups(
+        self,
+        conn: sqlite3.Connection,
+        user_id: str,
+        start_month: Optional[str] = None,
+        end_month: Optional[str] = None
+    ) -> List[Dict]:
+        query = "SELECT * FROM interaction_rollups WHERE user_id = ?"
+        params: List[str] = [user_id]
+        if start_month:
+            query += " AND month >= ?"
+            params.append(start_month)
+        if end_month:
+            query += " AND month <= ?"
+            params.append(end_month)
+        query += " ORDER BY month ASC"
+        return [
+            {
+                'month': r['month'],
+                'count': r['count'],
+                'first_ts': r['first_ts'],
+                'last_ts': r['last_ts'],
+                'hour_counts': json.loads(r['hour_counts']),
+                'emotion_counts': json.loads(r['emotion_counts']),
+                'topic_counts': json.loads(r['topic_counts']),
+            }
+            for r in conn.execute(query, params).fetchall()
+        ]
@@ -0,0 +1,186 @@
+"""
+InteractionIndex — Indice lessicale persistente per TemporalMemorySystem
+
+Sostituisce il re-fit di SimpleTfidf ad ogni query di get_relevant_context.
+
+Scopo:
+    Il costo di una query di rilevanza diventa O(termini della query × postings)
+    invece di vettorizzare tutte le interazioni degli ultimi 30 giorni.
+
+Architettura:
+    interaction_postings   (user_id, term, timestamp, interaction_id) → tf
+                           La chiave primaria partiziona per utente e ordina per
+                           tempo: la finestra temporale è un range scan, non un re-fit.
+    interaction_doc_stats  interaction_id → user_id, timestamp, norma tf
+                           Serve per N (documenti in finestra) e la normalizzazione.
+
+Scoring:
+    Coseno tra query pesata TF-IDF e documento normalizzato sul tf (schema
+    SMART lnc.ltc semplificato), con idf smussato calcolato sulla finestra:
+        idf(t) = log((1 + N) / (1 + df_finestra(t))) + 1
+        score(d) = Σ_t tf_q(t) · idf(t) · tf_d(t) / (|q|_tfidf · |d|_tf)
+    Così la norma del documento resta statica e si salva all'inserimento.
+    L'indice è mantenuto in modo incrementale nella stessa transazione dell'INSERT.
+"""
+
+import math
+import sqlite3
+from collections import Counter, defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from allma_model.utils.text_processing import tokenize
+
+
+class InteractionIndex:
+    """Indice invertito su SQLite; non possiede connessioni né lock (li gestisce il chiamante)."""
+
+    def ensure_schema(self, conn: sqlite3.Connection) -> None:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS interaction_postings (
+                user_id TEXT NOT NULL,
+                term TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                interaction_id INTEGER NOT NULL,
+                tf INTEGER NOT NULL,
+                PRIMARY KEY (user_id, term, timestamp, interaction_id)
+            ) WITHOUT ROWID
+        """)
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS interaction_doc_stats (
+                interaction_id INTEGER PRIMARY KEY,
+                user_id TEXT NOT NULL,
+                timestamp TEXT NOT NULL,
+                tf_norm REAL NOT NULL
+            )
+        """)
+        conn.execute("""
+            CREATE INDEX IF NOT EXISTS idx_doc_stats_user_time
+            ON interaction_doc_stats (user_id, timestamp)
+        """)
+
+    def index_interaction(
+        self,
+        conn: sqlite3.Connection,
+        interaction_id: int,
+        user_id: str,
+        timestamp: str,
+        content: str
+    ) -> int:
+        """
+        Indicizza una singola interazione.
+
+        Returns:
+            Numero di termini distinti indicizzati
+        """
+        counts = Counter(tokenize(content))
+        tf_norm = math.sqrt(sum(c * c for c in counts.values()))
+        conn.execute(
+            "INSERT OR REPLACE INTO interaction_doc_stats (interaction_id, user_id, timestamp, tf_norm) "
+            "VALUES (?, ?, ?, ?)",
+            (interaction_id, user_id, timestamp, tf_norm)
+        )
+        conn.executemany(
+            "INSERT OR REPLACE INTO interaction_postings (user_id, term, timestamp, interaction_id, tf) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [(user_id, term, timestamp, interaction_id, tf) for term, tf in counts.items()]
+        )
+        return len(counts)
+
+    def remove_interactions(self, conn: sqlite3.Connection, interaction_ids: Iterable[int]) -> int:
+        """Rimuove dall'indice le interazioni indicate (es. spostate in archivio)."""
+        ids = list(interaction_ids)
+        removed = 0
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            marks = ",".join("?" * len(chunk))
+            conn.execute(f"DELETE FROM interaction_postings WHERE interaction_id IN ({marks})", chunk)
+            removed += conn.execute(
+                f"DELETE FROM interaction_doc_stats WHERE interaction_id IN ({marks})", chunk
+            ).rowcount
+        return removed
+
+    def backfill(self, conn: sqlite3.Connection) -> int:
+        """Indicizza le interazioni non ancora presenti nell'indice (migrazione)."""
+        rows = conn.execute("""
+            SELECT i.id, i.user_id, i.timestamp, i.content
+            FROM interactions i
+            LEFT JOIN interaction_doc_stats s ON s.interaction_id = i.id
+            WHERE s.interaction_id IS NULL
+        """).fetchall()
+        for row in rows:
+            self.index_interaction(conn, row[0], row[1], row[2], row[3])
+        return len(rows)
+
+    def search(
+        self,
+        conn: sqlite3.Connection,
+        user_id: str,
+        query: str,
+        start_time: Optional[str] = None,
+        end_time: Optional[str] = None,
+        limit: int = 5
+    ) -> List[Tuple[int, float]]:
+        """
+        Cerca le interazioni più rilevanti per la query nella finestra (start_time, end_time].
+
+        Returns:
+            Lista di (interaction_id, score) in ordine di score decrescente
+        """
+        query_counts = Counter(tokenize(query))
+        if not query_counts or limit <= 0:
+            return []
+
+        time_filter = ""
+        time_params: List[str] = []
+        if start_time is not None:
+            time_filter += " AND timestamp > ?"
+            time_params.append(start_time)
+        if end_time is not None:
+            time_filter += " AND timestamp <= ?"
+            time_params.append(end_time)
+
+        n_docs = conn.execute(
+            f"SELECT COUNT(*) FROM interaction_doc_stats WHERE user_id = ?{time_filter}",
+            [user_id] + time_params
+        ).fetchone()[0]
+        if n_docs == 0:
+            return []
+
+        scores: Dict[int, float] = defaultdict(float)
+        query_norm_sq = 0.0
+        for term, q_tf in query_counts.items():
+            postings = conn.execute(
+                f"SELECT interaction_id, tf FROM interaction_postings "
+                f"WHERE user_id = ? AND term = ?{time_filter}",
+                [user_id, term] + time_params
+            ).fetchall()
+            idf = math.log((1 + n_docs) / (1 + len(postings))) + 1.0
+            query_norm_sq += (q_tf * idf) ** 2
+            for interaction_id, tf in postings:
+                scores[interaction_id] += q_tf * idf * tf
+
+        if not scores:
+            return []
+
+        norms = self._doc_norms(conn, scores.keys())
+        query_norm = math.sqrt(query_norm_sq) or 1.0
+        ranked = [
+            (doc_id, score / (query_norm * (norms.get(doc_id) or 1.0)))
+            for doc_id, score in scores.items()
+        ]
+        ranked.sort(key=lambda x: x[1], reverse=True)
+        return ranked[:limit]
+
+    @staticmethod
+    def _doc_norms(conn: sqlite3.Connection, doc_ids: Iterable[int]) -> Dict[int, float]:
+        ids = list(doc_ids)
+        norms: Dict[int, float] = {}
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            marks = ",".join("?" * len(chunk))
+            for doc_id, norm in conn.execute(
+                f"SELECT interaction_id, tf_norm FROM interaction_doc_stats WHERE interaction_id IN ({marks})",
+                chunk
+            ).fetchall():
+                norms[doc_id] = norm
+        return norms
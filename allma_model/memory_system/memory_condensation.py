@@ -0,0 +1,339 @@
+"""
+CondensationJobEngine — ALLMA Memory GC a batch
+
+Sostituisce la singola chiamata LLM di ConversationalMemory.condense_and_clear_old
+con un job incrementale e riprendibile.
+
+Scopo:
+    Tenere la RAM limitata sotto uso intenso senza bloccare la chat.
+    I messaggi vecchi vengono condensati in Fatti Cognitivi a piccoli batch,
+    ognuno confermato su disco prima di passare al successivo.
+
+Architettura:
+    plan()  → messaggi vecchi partizionati per utente in batch con budget di token
+    order   → round-robin tra gli utenti (nessun utente monopolizza il job),
+              ripartendo dall'utente successivo all'ultimo servito
+    run()   → per ogni batch: yield all'inferenza foreground → LLM → apply → checkpoint
+
+Checkpoint:
+    File JSON scritto atomicamente dopo ogni batch. Contiene il cutoff del job
+    in corso, i batch completati e i tentativi falliti, così un crash a metà
+    perde al massimo il batch in volo e il job successivo riprende da lì.
+"""
+
+from __future__ import annotations
+
+import json
+import logging
+import os
+import threading
+import time
+from dataclasses import dataclass, field, asdict
+from datetime import datetime
+from typing import Callable, Dict, List, Optional
+
+from allma_model.memory_system.conversational_memory import ConversationalMemory, Message
+
+
+logger = logging.getLogger(__name__)
+
+
+def estimate_tokens(text: str) -> int:
+    """Stima economica dei token (~4 caratteri per token), senza tokenizer."""
+    return len(text) // 4 + 1 if text else 0
+
+
+@dataclass
+class CondensationBatch:
+    """Un gruppo di messaggi consecutivi di un utente che sta nel budget di token."""
+    batch_id: str
+    user_id: str
+    messages: List[Message]
+    token_estimate: int
+
+
+@dataclass
+class CondensationRunReport:
+    """Esito di una esecuzione del job di condensazione."""
+    started_at: str
+    finished_at: Optional[str] = None
+    users: List[str] = field(default_factory=list)
+    batches_planned: int = 0
+    batches_processed: int = 0
+    batches_failed: int = 0
+    messages_removed: int = 0
+    conversations_removed: int = 0
+    facts_extracted: int = 0
+    bytes_reclaimed: int = 0
+    yields: int = 0
+    resumed: bool = False
+    completed: bool = False
+    stop_reason: Optional[str] = None
+
+    def to_dict(self) -> Dict:
+        return asdict(self)
+
+
+class CondensationJobEngine:
+    """
+    Job engine per la condensazione a batch della memoria conversazionale.
+
+    Usage:
+        engine = CondensationJobEngine(memory, foreground_event=core._user_active)
+        report = engine.run(cutoff_date, llm_extractor)
+        logging.info(report.to_dict())
+    """
+
+    def __init__(
+        self,
+        memory: ConversationalMemory,
+        checkpoint_path: Optional[str] = None,
+        batch_token_budget: int = 1500,
+        max_batches_per_run: Optional[int] = None,
+        max_attempts: int = 3,
+        foreground_event: Optional[threading.Event] = None,
+        yield_poll_s: float = 0.5,
+        max_yield_wait_s: float = 30.0,
+        token_counter: Callable[[str], int] = estimate_tokens,
+    ):
+        """
+        Args:
+            memory: ConversationalMemory da condensare
+            checkpoint_path: file JSON di checkpoint (default: cwd/allma_condensation.json)
+            batch_token_budget: token massimi di cronologia per chiamata LLM
+            max_batches_per_run: limite di batch per run (None = tutti)
+            max_attempts: tentativi LLM per batch prima di condensarlo senza fatti
+            foreground_event: Event settato durante l'inferenza foreground (chat)
+            yield_poll_s: intervallo di polling mentre si cede il passo
+            max_yield_wait_s: attesa massima prima di sospendere il run
+            token_counter: funzione testo → numero di token
+        """
+        self.memory = memory
+        self.checkpoint_path = checkpoint_path or os.path.join(os.getcwd(), 'allma_condensation.json')
+        self.batch_token_budget = max(64, int(batch_token_budget))
+        self.max_batches_per_run = max_batches_per_run
+        self.max_attempts = max(1, int(max_attempts))
+        self.foreground_event = foreground_event
+        self.yield_poll_s = yield_poll_s
+        self.max_yield_wait_s = max_yield_wait_s
+        self.token_counter = token_counter
+        self.last_report: Optional[CondensationRunReport] = None
+        self._run_lock = threading.Lock()
+
+    # ------------------------------------------------------------------
+    # Pianificazione
+    # ------------------------------------------------------------------
+
+    def _message_tokens(self, message: Message) -> int:
+        return self.token_counter(f"{message.role}: {message.content}") + 1
+
+    def plan(self, before_date: datetime) -> Dict[str, List[CondensationBatch]]:
+        """Partiziona i messaggi più vecchi di before_date in batch per utente."""
+        plan: Dict[str, List[CondensationBatch]] = {}
+        for user_id, messages in self.memory.get_condensation_candidates(before_date).items():
+            batches = []
+            current: List[Message] = []
+            current_tokens = 0
+            for m in messages:
+                tokens = self._message_tokens(m)
+                if current and current_tokens + tokens > self.batch_token_budget:
+                    batches.append(self._make_batch(user_id, current, current_tokens))
+                    current, current_tokens = [], 0
+                current.append(m)
+                current_tokens += tokens
+            if current:
+                batches.append(self._make_batch(user_id, current, current_tokens))
+            if batches:
+                plan[user_id] = batches
+        return plan
+
+    @staticmethod
+    def _make_batch(user_id: str, messages: List[Message], tokens: int) -> CondensationBatch:
+        # ID stabile tra i riavvii: i messaggi sotto cutoff non cambiano più
+        batch_id = f"{user_id}:{messages[0].timestamp.isoformat()}:{len(messages)}"
+        return CondensationBatch(batch_id=batch_id, user_id=user_id, messages=list(messages), token_estimate=tokens)
+
+    @staticmethod
+    def fair_order(plan: Dict[str, List[CondensationBatch]], start_after: Optional[str] = None) -> List[CondensationBatch]:
+        """
+        Round-robin tra utenti: un batch per utente a turno.
+
+        L'ordine degli utenti ruota partendo da quello successivo a start_after,
+        così run limitati da max_batches_per_run non servono sempre lo stesso utente.
+        """
+        users = sorted(plan.keys())
+        if start_after in users:
+            idx = users.index(start_after) + 1
+            users = users[idx:] + users[:idx]
+
+        ordered = []
+        depth = 0
+        while True:
+            added = False
+            for user_id in users:
+                if depth < len(plan[user_id]):
+                    ordered.append(plan[user_id][depth])
+                    added = True
+            if not added:
+                return ordered
+            depth += 1
+
+    # ------------------------------------------------------------------
+    # Checkpoint
+    # ------------------------------------------------------------------
+
+    def load_checkpoint(self) -> Dict:
+        try:
+            if os.path.exists(self.checkpoint_path):
+                with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+                    data = json.load(f)
+                if isinstance(data, dict):
+                    return data
+        except Exception as e:
+            logger.warning(f"[Condensation] Checkpoint illeggibile, riparto da zero: {e}")
+        return {}
+
+    def _save_checkpoint(self, state: Dict) -> None:
+        temp_path = self.checkpoint_path + ".tmp"
+        try:
+            state['updated_at'] = datetime.now().isoformat()
+            with open(temp_path, 'w', encoding='utf-8') as f:
+                json.dump(state, f, ensure_ascii=False)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(temp_path, self.checkpoint_path)
+        except Exception as e:
+            logger.error(f"[Condensation] Salvataggio checkpoint fallito: {e}")
+            if os.path.exists(temp_path):
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+
+    def clear_checkpoint(self) -> None:
+        if os.path.exists(self.checkpoint_path):
+            try:
+                os.remove(self.checkpoint_path)
+            except OSError as e:
+                logger.warning(f"[Condensation] Impossibile rimuovere il checkpoint: {e}")
+
+    # ------------------------------------------------------------------
+    # Esecuzione
+    # ------------------------------------------------------------------
+
+    def _wait_for_foreground(self, report: CondensationRunReport) -> bool:
+        """Cede il passo all'inferenza foreground. False se l'attesa supera il limite."""
+        if self.foreground_event is None or not self.foreground_event.is_set():
+            return True
+        report.yields += 1
+        deadline = time.monotonic() + self.max_yield_wait_s
+        while self.foreground_event.is_set():
+            if time.monotonic() >= deadline:
+                return False
+            time.sleep(self.yield_poll_s)
+        return True
+
+    def run(
+        self,
+        before_date: datetime,
+        llm_extractor: Callable[[str], str],
+        should_stop: Optional[Callable[[], bool]] = None,
+    ) -> CondensationRunReport:
+        """
+        Esegue (o riprende) il job di condensazione fino a before_date.
+
+        Se esiste un checkpoint di un job non concluso, ne riusa il cutoff così
+        il piano resta coerente con quello interrotto.
+        """
+        with self._run_lock:
+            report = CondensationRunReport(started_at=datetime.now().isoformat())
+            state = self.load_checkpoint()
+
+            if state.get('in_progress') and state.get('cutoff'):
+                try:
+                    before_date = datetime.fromisoformat(state['cutoff'])
+                    report.resumed = True
+                except ValueError:
+                    state = {}
+            if not report.resumed:
+                state = {
+                    'cutoff': before_date.isoformat(),
+                    'in_progress': True,
+                    'completed_batches': [],
+                    'failed_attempts': {},
+                    'last_user': state.get('last_user'),
+                }
+
+            plan = self.plan(before_date)
+            completed = set(state.get('completed_batches', []))
+            queue = [b for b in self.fair_order(plan, state.get('last_user')) if b.batch_id not in completed]
+            report.users = sorted(plan.keys())
+            report.batches_planned = len(queue)
+
+            for batch in queue:
+                if self.max_batches_per_run is not None and \
+                        report.batches_processed + report.batches_failed >= self.max_batches_per_run:
+                    report.stop_reason = 'batch_limit'
+                    break
+                if should_stop is not None and should_stop():
+                    report.stop_reason = 'stopped'
+                    break
+                if not self._wait_for_foreground(report):
+                    report.stop_reason = 'foreground_busy'
+                    break
+
+                self._process_batch(batch, llm_extractor, state, report)
+                state['last_user'] = batch.user_id
+                self._save_checkpoint(state)
+            else:
+                # Batch falliti ancora da ritentare tengono il job aperto
+                report.completed = not state.get('failed_attempts')
+                if not report.completed:
+                    report.stop_reason = 'pending_retries'
+
+            if report.completed:
+                state['in_progress'] = False
+                state['completed_batches'] = []
+                state['failed_attempts'] = {}
+                self._save_checkpoint(state)
+
+            report.finished_at = datetime.now().isoformat()
+            self.last_report = report
+            return report
+
+    def _process_batch(
+        self,
+        batch: CondensationBatch,
+        llm_extractor: Callable[[str], str],
+        state: Dict,
+        report: CondensationRunReport,
+    ) -> None:
+        # Il budget è in token: ~4 caratteri per token più margine per il ruolo
+        prompt = self.memory.build_condensation_prompt(
+            batch.messages, max_chars=self.batch_token_budget * 4
+        )
+        attempts = state.setdefault('failed_attempts', {})
+        try:
+            facts = self.memory.parse_condensed_facts(llm_extractor(prompt))
+        except Exception as e:
+            attempts[batch.batch_id] = attempts.get(batch.batch_id, 0) + 1
+            report.batches_failed += 1
+            if attempts[batch.batch_id] < self.max_attempts:
+                logger.warning(
+                    f"[Condensation] Batch {batch.batch_id} fallito "
+                    f"({attempts[batch.batch_id]}/{self.max_attempts}): {e}"
+                )
+                return
+            # Batch velenoso: lo condensiamo senza fatti per garantire il limite di RAM
+            logger.error(f"[Condensation] Batch {batch.batch_id} scartato dopo {self.max_attempts} tentativi")
+            facts = {}
+
+        result = self.memory.apply_condensed_batch(batch.user_id, batch.messages, facts)
+        attempts.pop(batch.batch_id, None)
+        state.setdefault('completed_batches', []).append(batch.batch_id)
+
+        report.batches_processed += 1
+        report.messages_removed += result['messages_removed']
+        report.conversations_removed += result['conversations_removed']
+        report.bytes_reclaimed += result['bytes_reclaimed']
+        report.facts_extracted += result['facts_stored']
@@ -0,0 +1,194 @@
+"""
+SQLiteSessionManager — Connessioni SQLite persistenti per la memoria di ALLMA
+
+Sostituisce il sqlite3.connect() per ogni chiamata di TemporalMemorySystem.
+
+Scopo:
+    Un turno di chat chiama store_interaction, get_interactions e
+    get_relevant_context: con una connessione per chiamata paga più volte
+    apertura file, parsing dello schema e fsync del journal.
+
+Architettura:
+    connection()   → una connessione per thread, aperta una volta, in WAL
+    close()        → checkpoint del WAL e chiusura di tutte le connessioni
+    transaction()  → context manager: commit in uscita, rollback su eccezione
+    timed(op)      → cronometra un'operazione e la aggrega per nome
+    stats()        → conteggi e ms per operazione (per i log LLM_GENERATION)
+
+Nota WAL:
+    Se il file del DB viene rimosso (es. tearDown dei test) le connessioni in
+    cache vengono scartate e i file -wal/-shm orfani eliminati prima di
+    riaprire, altrimenti SQLite li riapplicherebbe al nuovo DB vuoto.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterable, Iterator, Sequence
+
+
+logger = logging.getLogger(__name__)
+
+
+class SQLiteSessionManager:
+    """Gestore di connessioni SQLite thread-local in modalità WAL con metriche per operazione."""
+
+    def __init__(self, db_path: str, timeout: float = 20.0):
+        self.db_path = db_path
+        self.timeout = timeout
+        self._local = threading.local()
+        self._connections: Dict[int, sqlite3.Connection] = {}
+        self._conn_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats: Dict[str, Dict[str, float]] = {}
+        self._total_ms = 0.0
+        self._total_ops = 0
+        self._closed = False
+
+    # ------------------------------------------------------------------
+    # Connessioni
+    # ------------------------------------------------------------------
+
+    @property
+    def _is_memory_db(self) -> bool:
+        return self.db_path == ":memory:" or self.db_path.startswith("file::memory:")
+
+    def _remove_orphan_wal_files(self):
+        if self._is_memory_db or os.path.exists(self.db_path):
+            return
+        for suffix in ("-wal", "-shm"):
+            orphan = self.db_path + suffix
+            if os.path.exists(orphan):
+                try:
+                    os.remove(orphan)
+                    logger.warning(f"[SQLiteSession] Rimosso file orfano {orphan}")
+                except OSError as e:
+                    logger.error(f"[SQLiteSession] Impossibile rimuovere {orphan}: {e}")
+
+    def _open(self) -> sqlite3.Connection:
+        self._remove_orphan_wal_files()
+        conn = sqlite3.connect(self.db_path, timeout=self.timeout, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        if not self._is_memory_db:
+            conn.execute("PRAGMA journal_mode=WAL")
+            # In WAL basta NORMAL: durabile ai crash dell'app, fsync solo ai checkpoint
+            conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA foreign_keys=ON")
+        return conn
+
+    def connection(self) -> sqlite3.Connection:
+        """Restituisce la connessione del thread corrente, aprendola se necessario."""
+        if self._closed:
+            raise sqlite3.ProgrammingError("SQLiteSessionManager chiuso")
+        conn = getattr(self._local, "conn", None)
+        if conn is not None and not self._is_memory_db and not os.path.exists(self.db_path):
+            # Il file è sparito sotto la connessione: scarta e riapri
+            self._discard_thread_connection()
+            conn = None
+        if conn is None:
+            conn = self._open()
+            self._local.conn = conn
+            with self._conn_lock:
+                self._connections[threading.get_ident()] = conn
+        return conn
+
+    def _discard_thread_connection(self):
+        conn = getattr(self._local, "conn", None)
+        self._local.conn = None
+        with self._conn_lock:
+            self._connections.pop(threading.get_ident(), None)
+        if conn is not None:
+            try:
+                conn.close()
+            except sqlite3.Error:
+                pass
+
+    def close(self):
+        """
+        Chiude tutte le connessioni aperte (di tutti i thread).
+
+        Prima riporta il WAL nel file del DB e lo tronca (checkpoint TRUNCATE):
+        chiusa l'ultima connessione restano solo il .db, senza -wal/-shm.
+        """
+        with self._conn_lock:
+            connections = list(self._connections.values())
+            self._connections.clear()
+            self._closed = True
+        if connections and not self._is_memory_db:
+            try:
+                connections[0].execute("PRAGMA wal_checkpoint(TRUNCATE)")
+            except sqlite3.Error as e:
+                logger.warning(f"[SQLiteSession] Checkpoint in chiusura fallito: {e}")
+        for conn in connections:
+            try:
+                conn.close()
+            except sqlite3.Error as e:
+                logger.warning(f"[SQLiteSession] Errore in chiusura: {e}")
+        self._local = threading.local()
+
+    # ------------------------------------------------------------------
+    # Transazioni e metriche
+    # ------------------------------------------------------------------
+
+    @contextmanager
+    def timed(self, op: str) -> Iterator[None]:
+        """Cronometra un blocco e lo aggrega sotto il nome op."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._record(op, (time.perf_counter() - start) * 1000.0)
+
+    def _record(self, op: str, elapsed_ms: float):
+        with self._stats_lock:
+            entry = self._stats.setdefault(op, {"count": 0, "total_ms": 0.0, "max_ms": 0.0})
+            entry["count"] += 1
+            entry["total_ms"] += elapsed_ms
+            entry["max_ms"] = max(entry["max_ms"], elapsed_ms)
+            self._total_ms += elapsed_ms
+            self._total_ops += 1
+
+    @contextmanager
+    def transaction(self, op: str = "transaction") -> Iterator[sqlite3.Connection]:
+        """Transazione cronometrata sulla connessione del thread: commit o rollback in uscita."""
+        with self.timed(op):
+            conn = self.connection()
+            try:
+                yield conn
+                conn.commit()
+            except BaseException:
+                conn.rollback()
+                raise
+
+    def executemany(self, sql: str, rows: Iterable[Sequence], op: str = "executemany") -> int:
+        """Esegue un inserimento batch in una sola transazione."""
+        with self.transaction(op) as conn:
+            cursor = conn.executemany(sql, rows)
+            return cursor.rowcount
+
+    def stats(self) -> Dict[str, Dict[str, float]]:
+        """Metriche per operazione: count, total_ms, avg_ms, max_ms."""
+        with self._stats_lock:
+            return {
+                op: {
+                    "count": int(e["count"]),
+                    "total_ms": round(e["total_ms"], 3),
+                    "avg_ms": round(e["total_ms"] / e["count"], 3) if e["count"] else 0.0,
+                    "max_ms": round(e["max_ms"], 3),
+                }
+                for op, e in self._stats.items()
+            }
+
+    def totals(self) -> Dict[str, float]:
+        """Totali cumulativi (ms, operazioni): il chiamante fa la differenza tra due snapshot."""
+        with self._stats_lock:
+            return {"ms": self._total_ms, "ops": self._total_ops}
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._stats.clear()
+            self._total_ms = 0.0
+            self._total_ops = 0
@@ -1,31 +1,40 @@
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from datetime import datetime, timedelta, date
+from typing import Dict, List, Optional, Tuple
 import sqlite3
 import json
+import math
 from collections import defaultdict
 import numpy as np
-import numpy as np
-from allma_model.utils.text_processing import SimpleTfidf, cosine_similarity
+from allma_model.memory_system.interaction_index import InteractionIndex
+from allma_model.memory_system.sqlite_session import SQLiteSessionManager
+from allma_model.memory_system.interaction_archive import InteractionArchive
 
 import threading
 import logging
 
 class TemporalMemorySystem:
-    def __init__(self, db_path: str = "memory.db"):
+    def __init__(self, db_path: str = "memory.db", hot_retention_days: int = 90):
         """
         Inizializza il sistema di memoria temporale.
         
         Args:
             db_path: Percorso del database SQLite
+            hot_retention_days: Giorni tenuti nella tabella calda prima dell'archivio mensile
         """
         self.db_path = db_path
         self.context_window = timedelta(days=30)
-        self.vectorizer = SimpleTfidf()
+        # La tabella calda deve sempre coprire la finestra di contesto
+        self.hot_retention = max(timedelta(days=hot_retention_days), self.context_window)
         self.lock = threading.Lock()
+        self._expired_before_day: Optional[date] = None
+        self.index = InteractionIndex()
+        self.archive = InteractionArchive(self.index)
+        # Connessione persistente per thread (WAL) con metriche per operazione
+        self.session = SQLiteSessionManager(db_path)
         
         # Crea le tabelle se non esistono
-        with self.lock:
-            conn = self._get_db_connection()
+        with self.lock, self.session.timed('init'):
+            conn = self.session.connection()
             try:
                 conn.execute("""
                     CREATE TABLE IF NOT EXISTS interactions (
@@ -50,16 +59,145 @@ class TemporalMemorySystem:
                         PRIMARY KEY (user_id, pattern_type)
                     )
                 """)
+
+                # Aggregati temporali incrementali (finestra allineata al giorno).
+                # temporal_agg_daily tiene anche le somme dei gap per la frequenza:
+                # gap_sq_sum = somma dei gap² (ore²) verso l'interazione precedente
+                # per ogni interazione del giorno, first_gap_sq = gap² della prima.
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS temporal_agg_daily (
+                        user_id TEXT NOT NULL,
+                        day TEXT NOT NULL,
+                        weekday INTEGER NOT NULL,
+                        count INTEGER NOT NULL,
+                        first_ts TEXT NOT NULL,
+                        last_ts TEXT NOT NULL,
+                        gap_sq_sum REAL NOT NULL DEFAULT 0,
+                        first_gap_sq REAL NOT NULL DEFAULT 0,
+                        PRIMARY KEY (user_id, day)
+                    )
+                """)
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS temporal_agg_day_hour (
+                        user_id TEXT NOT NULL,
+                        day TEXT NOT NULL,
+                        hour INTEGER NOT NULL,
+                        count INTEGER NOT NULL,
+                        PRIMARY KEY (user_id, day, hour)
+                    )
+                """)
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS temporal_agg_hour_of_day (
+                        user_id TEXT NOT NULL,
+                        hour INTEGER NOT NULL,
+                        count INTEGER NOT NULL,
+                        PRIMARY KEY (user_id, hour)
+                    )
+                """)
+                conn.execute("""
+                    CREATE TABLE IF NOT EXISTS temporal_agg_weekday (
+                        user_id TEXT NOT NULL,
+                        weekday INTEGER NOT NULL,
+                        count INTEGER NOT NULL,
+                        PRIMARY KEY (user_id, weekday)
+                    )
+                """)
+                self.index.ensure_schema(conn)
+                self.archive.ensure_schema(conn)
                 conn.commit()
-            finally:
-                conn.close()
+
+                # Migrazione: interazioni salvate prima dell'indice lessicale
+                indexed = self.index.backfill(conn)
+                if indexed:
+                    logging.info(f"Indice interazioni: {indexed} interazioni indicizzate")
+                    conn.commit()
+
+                # Migrazione: DB esistenti senza aggregati vengono ricostruiti una volta
+                has_aggregates = conn.execute("SELECT 1 FROM temporal_agg_daily LIMIT 1").fetchone()
+                has_interactions = conn.execute("SELECT 1 FROM interactions LIMIT 1").fetchone()
+                if has_interactions and not has_aggregates:
+                    self._rebuild_aggregates(conn)
+                    conn.commit()
+                self._ensure_timestamp_index(conn)
+            except Exception:
+                conn.rollback()
+                raise
 
     def _get_db_connection(self):
-        """Crea una nuova connessione al database"""
+        """Crea una nuova connessione al database (uso ad-hoc; i metodi usano self.session)"""
         conn = sqlite3.connect(self.db_path, timeout=20)
         conn.row_factory = sqlite3.Row
         return conn
 
+    def _ensure_timestamp_index(self, conn: sqlite3.Connection):
+        """
+        Garantisce un indice (user_id, timestamp) su interactions.
+
+        Lo schema standard lo ha già tramite UNIQUE(user_id, timestamp), che
+        include il rowid (id) ed è quindi covering per le lookup su id/timestamp;
+        DB creati senza il vincolo ricevono un indice esplicito.
+        """
+        for index in conn.execute("PRAGMA index_list(interactions)").fetchall():
+            columns = [c['name'] for c in conn.execute(f"PRAGMA index_info('{index['name']}')").fetchall()]
+            if columns[:2] == ['user_id', 'timestamp']:
+                return
+        conn.execute(
+            "CREATE INDEX IF NOT EXISTS idx_interactions_user_timestamp ON interactions (user_id, timestamp)"
+        )
+        conn.commit()
+
+    def close(self):
+        """Chiude le connessioni persistenti del database."""
+        self.session.close()
+
+    def get_db_stats(self) -> Dict[str, Dict[str, float]]:
+        """Tempi per operazione del database (count, total_ms, avg_ms, max_ms)."""
+        return self.session.stats()
+
+    def _prepare_interaction_row(
+        self,
+        user_id: str,
+        interaction: Dict,
+        metadata: Optional[Dict] = None
+    ) -> Optional[tuple]:
+        """Valida un'interazione e la converte nella riga da inserire (None se non valida)."""
+        if not user_id:
+            logging.error("User ID mancante")
+            return None
+            
+        # Gestisci contenuto mancante o non valido
+        content = interaction.get('content')
+        if content is None:
+            logging.error("Contenuto mancante")
+            return None
+        elif not isinstance(content, str):
+            content = str(content)
+            
+        # Gestisci contesto non valido
+        context = interaction.get('context', {})
+        if not isinstance(context, dict):
+            context = {'raw_context': str(context)}
+            
+        # Gestisci emozione non valida
+        emotion = interaction.get('emotion')
+        if not isinstance(emotion, str):
+            emotion = str(emotion)
+            
+        # Se c'è un timestamp nell'interazione, usalo
+        timestamp = interaction.get('timestamp', datetime.now().isoformat())
+        if isinstance(timestamp, datetime):
+            timestamp = timestamp.isoformat()
+            
+        return (
+            user_id,
+            timestamp,
+            content,
+            json.dumps(context),
+            emotion,
+            json.dumps(self._extract_topics(content)),
+            json.dumps(metadata or {})
+        )
+
     def store_interaction(
         self,
         user_id: str,
@@ -78,41 +216,16 @@ class TemporalMemorySystem:
             bool: True se l'interazione è stata memorizzata con successo, False altrimenti
         """
         try:
-            if not user_id:
-                logging.error("User ID mancante")
-                return False
-                
-            # Gestisci contenuto mancante o non valido
-            content = interaction.get('content')
-            if content is None:
-                logging.error("Contenuto mancante")
+            row = self._prepare_interaction_row(user_id, interaction, metadata)
+            if row is None:
                 return False
-            elif not isinstance(content, str):
-                content = str(content)
                 
-            # Gestisci contesto non valido
-            context = interaction.get('context', {})
-            if not isinstance(context, dict):
-                context = {'raw_context': str(context)}
-                
-            # Gestisci emozione non valida
-            emotion = interaction.get('emotion')
-            if not isinstance(emotion, str):
-                emotion = str(emotion)
-                
-            with self.lock:
-                conn = self._get_db_connection()
+            with self.lock, self.session.timed('store_interaction'):
+                conn = self.session.connection()
                 try:
-                    # Se c'è un timestamp nell'interazione, usalo
-                    timestamp = interaction.get('timestamp', datetime.now().isoformat())
-                    if isinstance(timestamp, datetime):
-                        timestamp = timestamp.isoformat()
-                    
-                    topics = self._extract_topics(content)
-                    
                     # Log dei dati che stiamo per inserire
                     logging.debug(f"Memorizzazione interazione per user_id={user_id}")
-                    logging.debug(f"Contenuto={content[:50]}...")
+                    logging.debug(f"Contenuto={row[2][:50]}...")
                     
                     cursor = conn.execute(
                         """
@@ -120,19 +233,13 @@ class TemporalMemorySystem:
                         (user_id, timestamp, content, context, emotion, topics, metadata)
                         VALUES (?, ?, ?, ?, ?, ?, ?)
                         """,
-                        (
-                            user_id,
-                            timestamp,
-                            content,
-                            json.dumps(context),
-                            emotion,
-                            json.dumps(topics),
-                            json.dumps(metadata or {})
-                        )
+                        row
                     )
                     
-                    # Aggiorna i pattern temporali
-                    self._update_temporal_patterns(user_id, conn)
+                    # Indice lessicale e aggregati temporali (incrementali, niente rescan)
+                    self.index.index_interaction(conn, cursor.lastrowid, user_id, row[1], row[2])
+                    self._maybe_expire_aggregates(conn)
+                    self._apply_interaction_to_aggregates(user_id, row[1], conn)
                     
                     conn.commit()
                     logging.debug(f"Interazione memorizzata con ID={cursor.lastrowid}")
@@ -143,57 +250,411 @@ class TemporalMemorySystem:
                     logging.error(f"Errore durante la memorizzazione dell'interazione: {e}")
                     conn.rollback()
                     return False
-                finally:
-                    conn.close()
                     
         except Exception as e:
             logging.error(f"Errore durante la preparazione dell'interazione: {e}")
             return False
 
-    def _update_temporal_patterns(self, user_id: str, conn: sqlite3.Connection):
+    def store_interactions(
+        self,
+        user_id: str,
+        interactions: List[Dict],
+        metadata: Optional[Dict] = None
+    ) -> int:
         """
-        Aggiorna i pattern temporali per un utente
+        Memorizza un blocco di interazioni in una sola transazione (executemany).
         
-        Args:
-            user_id: ID dell'utente
-            conn: Connessione al database
+        Le interazioni non valide o già presenti (stesso user_id/timestamp) vengono
+        saltate. Gli aggregati temporali dell'utente vengono ricostruiti una volta
+        per blocco invece di essere aggiornati riga per riga.
+        
+        Returns:
+            Numero di interazioni inserite
         """
-        try:
-            # Recupera tutte le interazioni degli ultimi 30 giorni
-            cursor = conn.execute(
+        rows = {}
+        for interaction in interactions:
+            row = self._prepare_interaction_row(user_id, interaction, metadata)
+            if row is not None:
+                rows.setdefault(row[1], row)
+        if not rows:
+            return 0
+            
+        with self.lock, self.session.timed('store_interactions'):
+            conn = self.session.connection()
+            try:
+                timestamps = list(rows.keys())
+                existing = set()
+                for start in range(0, len(timestamps), 500):
+                    chunk = timestamps[start:start + 500]
+                    existing.update(r[0] for r in conn.execute(
+                        f"SELECT timestamp FROM interactions WHERE user_id = ? "
+                        f"AND timestamp IN ({','.join('?' * len(chunk))})",
+                        [user_id] + chunk
+                    ).fetchall())
+                new_rows = [row for ts, row in rows.items() if ts not in existing]
+                if not new_rows:
+                    return 0
+                    
+                conn.executemany(
+                    """
+                    INSERT INTO interactions 
+                    (user_id, timestamp, content, context, emotion, topics, metadata)
+                    VALUES (?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    new_rows
+                )
+                for row in new_rows:
+                    interaction_id = conn.execute(
+                        "SELECT id FROM interactions WHERE user_id = ? AND timestamp = ?",
+                        (user_id, row[1])
+                    ).fetchone()[0]
+                    self.index.index_interaction(conn, interaction_id, user_id, row[1], row[2])
+                    
+                self._maybe_expire_aggregates(conn)
+                self._rebuild_aggregates(conn, user_id)
+                conn.commit()
+                return len(new_rows)
+                
+            except Exception as e:
+                logging.error(f"Errore durante la memorizzazione batch delle interazioni: {e}")
+                conn.rollback()
+                return 0
+
+    # ------------------------------------------------------------------
+    # Aggregati temporali incrementali
+    # ------------------------------------------------------------------
+
+    def _window_start_day(self, now: Optional[datetime] = None) -> date:
+        """Primo giorno incluso nella finestra dei pattern (allineata a mezzanotte)."""
+        return ((now or datetime.now()) - self.context_window).date()
+
+    @staticmethod
+    def _gap_sq_hours(later: datetime, earlier: datetime) -> float:
+        return ((later - earlier).total_seconds() / 3600.0) ** 2
+
+    @staticmethod
+    def _weekday_name(weekday: int) -> str:
+        # 1 gennaio 2024 era lunedì: stesso nome (e locale) di strftime('%A')
+        return (datetime(2024, 1, 1) + timedelta(days=weekday)).strftime('%A')
+
+    def _apply_interaction_to_aggregates(self, user_id: str, timestamp: str, conn: sqlite3.Connection):
+        """
+        Applica una nuova interazione agli aggregati (chiamata dopo l'INSERT, stessa transazione).
+
+        Gli inserimenti fuori ordine sono gestiti: il gap tra predecessore e
+        successore viene sostituito dai due nuovi gap.
+        """
+        ts = datetime.fromisoformat(timestamp)
+        prev_row = conn.execute(
+            "SELECT timestamp FROM interactions WHERE user_id = ? AND timestamp < ? "
+            "ORDER BY timestamp DESC LIMIT 1",
+            (user_id, timestamp)
+        ).fetchone()
+        next_row = conn.execute(
+            "SELECT timestamp FROM interactions WHERE user_id = ? AND timestamp > ? "
+            "ORDER BY timestamp ASC LIMIT 1",
+            (user_id, timestamp)
+        ).fetchone()
+        prev_ts = datetime.fromisoformat(prev_row[0]) if prev_row else None
+        gap_sq = self._gap_sq_hours(ts, prev_ts) if prev_ts else 0.0
+
+        if ts.date() >= self._window_start_day():
+            day = ts.date().isoformat()
+            row = conn.execute(
+                "SELECT first_ts, last_ts FROM temporal_agg_daily WHERE user_id = ? AND day = ?",
+                (user_id, day)
+            ).fetchone()
+            if row is None:
+                conn.execute(
+                    """
+                    INSERT INTO temporal_agg_daily
+                    (user_id, day, weekday, count, first_ts, last_ts, gap_sq_sum, first_gap_sq)
+                    VALUES (?, ?, ?, 1, ?, ?, ?, ?)
+                    """,
+                    (user_id, day, ts.weekday(), timestamp, timestamp, gap_sq, gap_sq)
+                )
+            else:
+                is_first = ts < datetime.fromisoformat(row[0])
+                is_last = ts > datetime.fromisoformat(row[1])
+                conn.execute(
+                    """
+                    UPDATE temporal_agg_daily SET
+                        count = count + 1,
+                        gap_sq_sum = gap_sq_sum + ?,
+                        first_ts = CASE WHEN ? THEN ? ELSE first_ts END,
+                        first_gap_sq = CASE WHEN ? THEN ? ELSE first_gap_sq END,
+                        last_ts = CASE WHEN ? THEN ? ELSE last_ts END
+                    WHERE user_id = ? AND day = ?
+                    """,
+                    (gap_sq, is_first, timestamp, is_first, gap_sq, is_last, timestamp, user_id, day)
+                )
+
+            conn.execute(
+                "INSERT INTO temporal_agg_day_hour (user_id, day, hour, count) VALUES (?, ?, ?, 1) "
+                "ON CONFLICT(user_id, day, hour) DO UPDATE SET count = count + 1",
+                (user_id, day, ts.hour)
+            )
+            conn.execute(
+                "INSERT INTO temporal_agg_hour_of_day (user_id, hour, count) VALUES (?, ?, 1) "
+                "ON CONFLICT(user_id, hour) DO UPDATE SET count = count + 1",
+                (user_id, ts.hour)
+            )
+            conn.execute(
+                "INSERT INTO temporal_agg_weekday (user_id, weekday, count) VALUES (?, ?, 1) "
+                "ON CONFLICT(user_id, weekday) DO UPDATE SET count = count + 1",
+                (user_id, ts.weekday())
+            )
+
+        if next_row:
+            next_ts = datetime.fromisoformat(next_row[0])
+            new_gap_sq = self._gap_sq_hours(next_ts, ts)
+            old_gap_sq = self._gap_sq_hours(next_ts, prev_ts) if prev_ts else 0.0
+            conn.execute(
                 """
-                SELECT timestamp FROM interactions
-                WHERE user_id = ? AND timestamp > ?
+                UPDATE temporal_agg_daily SET
+                    gap_sq_sum = gap_sq_sum + ?,
+                    first_gap_sq = CASE WHEN first_ts = ? THEN ? ELSE first_gap_sq END
+                WHERE user_id = ? AND day = ?
                 """,
-                (user_id, (datetime.now() - self.context_window).isoformat())
+                (new_gap_sq - old_gap_sq, next_row[0], new_gap_sq, user_id, next_ts.date().isoformat())
             )
-            recent_interactions = cursor.fetchall()
 
-            if not recent_interactions:
-                return
+    def _maybe_expire_aggregates(self, conn: sqlite3.Connection):
+        """Esegue il pass di scadenza al massimo una volta per giorno di finestra."""
+        if self._expired_before_day != self._window_start_day():
+            self._expire_aggregates(conn)
 
-            # Analizza pattern temporali
-            timestamps = [datetime.fromisoformat(t['timestamp']) for t in recent_interactions]
-            patterns = {
-                'hour_distribution': self._analyze_hour_distribution(timestamps),
-                'day_distribution': self._analyze_day_distribution(timestamps),
-                'frequency': self._calculate_interaction_frequency(timestamps)
-            }
+    def _expire_aggregates(self, conn: sqlite3.Connection, now: Optional[datetime] = None) -> int:
+        """Decrementa gli aggregati rolling per i giorni usciti dalla finestra e li elimina."""
+        start_day = self._window_start_day(now)
+        cutoff = start_day.isoformat()
 
-            # Salva i pattern
+        expired_days = conn.execute(
+            "SELECT user_id, day, weekday, count FROM temporal_agg_daily WHERE day < ?",
+            (cutoff,)
+        ).fetchall()
+        for user_id, day, weekday, count in expired_days:
+            conn.execute(
+                "UPDATE temporal_agg_weekday SET count = count - ? WHERE user_id = ? AND weekday = ?",
+                (count, user_id, weekday)
+            )
+        for user_id, hour, count in conn.execute(
+            "SELECT user_id, hour, count FROM temporal_agg_day_hour WHERE day < ?",
+            (cutoff,)
+        ).fetchall():
             conn.execute(
+                "UPDATE temporal_agg_hour_of_day SET count = count - ? WHERE user_id = ? AND hour = ?",
+                (count, user_id, hour)
+            )
+
+        conn.execute("DELETE FROM temporal_agg_daily WHERE day < ?", (cutoff,))
+        conn.execute("DELETE FROM temporal_agg_day_hour WHERE day < ?", (cutoff,))
+        conn.execute("DELETE FROM temporal_agg_hour_of_day WHERE count <= 0")
+        conn.execute("DELETE FROM temporal_agg_weekday WHERE count <= 0")
+
+        if now is None:
+            self._expired_before_day = start_day
+        return len(expired_days)
+
+    def expire_temporal_aggregates(self, now: Optional[datetime] = None) -> int:
+        """
+        Pass di scadenza programmato degli aggregati temporali.
+
+        Args:
+            now: Istante di riferimento (default: adesso)
+
+        Returns:
+            Numero di giorni-utente rimossi dalla finestra
+        """
+        with self.lock, self.session.timed('expire_temporal_aggregates'):
+            conn = self.session.connection()
+            try:
+                expired = self._expire_aggregates(conn, now)
+                conn.commit()
+                return expired
+            except Exception as e:
+                logging.error(f"Errore nella scadenza degli aggregati temporali: {e}")
+                conn.rollback()
+                return 0
+
+    def _recompute_patterns(self, user_id: str, conn: sqlite3.Connection) -> Optional[Dict]:
+        """Ricalcolo completo dei pattern dalla tabella interactions (riferimento del checker)."""
+        cursor = conn.execute(
+            "SELECT timestamp FROM interactions WHERE user_id = ? AND timestamp >= ?",
+            (user_id, self._window_start_day().isoformat())
+        )
+        timestamps = [datetime.fromisoformat(t['timestamp']) for t in cursor.fetchall()]
+        if not timestamps:
+            return None
+        return {
+            'hour_distribution': self._analyze_hour_distribution(timestamps),
+            'day_distribution': self._analyze_day_distribution(timestamps),
+            'frequency': self._calculate_interaction_frequency(timestamps)
+        }
+
+    def _patterns_from_aggregates(self, user_id: str, conn: sqlite3.Connection) -> Optional[Dict]:
+        """Legge i pattern dagli aggregati: costo proporzionale ai giorni in finestra."""
+        days = conn.execute(
+            """
+            SELECT count, first_ts, last_ts, gap_sq_sum, first_gap_sq
+            FROM temporal_agg_daily
+            WHERE user_id = ? AND day >= ?
+            ORDER BY day ASC
+            """,
+            (user_id, self._window_start_day().isoformat())
+        ).fetchall()
+        total = sum(d['count'] for d in days)
+        if total == 0:
+            return None
+
+        hours = conn.execute(
+            "SELECT hour, count FROM temporal_agg_hour_of_day WHERE user_id = ? AND count > 0",
+            (user_id,)
+        ).fetchall()
+        weekdays = conn.execute(
+            "SELECT weekday, count FROM temporal_agg_weekday WHERE user_id = ? AND count > 0",
+            (user_id,)
+        ).fetchall()
+
+        if total < 2:
+            frequency = {'average_gap_hours': 24.0, 'std_gap_hours': 0.0}
+        else:
+            n_gaps = total - 1
+            span_hours = (
+                datetime.fromisoformat(days[-1]['last_ts']) - datetime.fromisoformat(days[0]['first_ts'])
+            ).total_seconds() / 3600.0
+            average_gap = span_hours / n_gaps
+            # Il gap della prima interazione punta fuori finestra: va escluso
+            gap_sq_total = sum(d['gap_sq_sum'] for d in days) - days[0]['first_gap_sq']
+            variance = gap_sq_total / n_gaps - average_gap ** 2
+            std_gap = math.sqrt(max(variance, 0.0)) if n_gaps > 1 else 0.0
+            frequency = {'average_gap_hours': average_gap, 'std_gap_hours': std_gap}
+
+        return {
+            'hour_distribution': {str(h['hour']): h['count'] / total for h in hours},
+            'day_distribution': {self._weekday_name(w['weekday']): w['count'] / total for w in weekdays},
+            'frequency': frequency
+        }
+
+    def _rebuild_aggregates(self, conn: sqlite3.Connection, user_id: Optional[str] = None):
+        """Ricostruisce da zero gli aggregati (migrazione o riparazione)."""
+        if user_id is None:
+            users = [r[0] for r in conn.execute("SELECT DISTINCT user_id FROM interactions").fetchall()]
+            for table in ('temporal_agg_daily', 'temporal_agg_day_hour',
+                          'temporal_agg_hour_of_day', 'temporal_agg_weekday'):
+                conn.execute(f"DELETE FROM {table}")
+        else:
+            users = [user_id]
+            for table in ('temporal_agg_daily', 'temporal_agg_day_hour',
+                          'temporal_agg_hour_of_day', 'temporal_agg_weekday'):
+                conn.execute(f"DELETE FROM {table} WHERE user_id = ?", (user_id,))
+
+        cutoff = self._window_start_day().isoformat()
+        for uid in users:
+            prev_row = conn.execute(
+                "SELECT timestamp FROM interactions WHERE user_id = ? AND timestamp < ? "
+                "ORDER BY timestamp DESC LIMIT 1",
+                (uid, cutoff)
+            ).fetchone()
+            rows = conn.execute(
+                "SELECT timestamp FROM interactions WHERE user_id = ? AND timestamp >= ? ORDER BY timestamp ASC",
+                (uid, cutoff)
+            ).fetchall()
+
+            prev_ts = datetime.fromisoformat(prev_row[0]) if prev_row else None
+            daily: Dict[str, Dict] = {}
+            day_hour: Dict[Tuple[str, int], int] = defaultdict(int)
+            hour_of_day: Dict[int, int] = defaultdict(int)
+            weekday: Dict[int, int] = defaultdict(int)
+            for (raw,) in rows:
+                ts = datetime.fromisoformat(raw)
+                gap_sq = self._gap_sq_hours(ts, prev_ts) if prev_ts else 0.0
+                day = ts.date().isoformat()
+                if day not in daily:
+                    daily[day] = {'weekday': ts.weekday(), 'count': 0, 'first_ts': raw,
+                                  'last_ts': raw, 'gap_sq_sum': 0.0, 'first_gap_sq': gap_sq}
+                entry = daily[day]
+                entry['count'] += 1
+                entry['last_ts'] = raw
+                entry['gap_sq_sum'] += gap_sq
+                day_hour[(day, ts.hour)] += 1
+                hour_of_day[ts.hour] += 1
+                weekday[ts.weekday()] += 1
+                prev_ts = ts
+
+            conn.executemany(
                 """
-                INSERT OR REPLACE INTO temporal_patterns
-                (user_id, pattern_type, pattern_data, last_updated)
-                VALUES (?, 'time_patterns', ?, ?)
+                INSERT INTO temporal_agg_daily
+                (user_id, day, weekday, count, first_ts, last_ts, gap_sq_sum, first_gap_sq)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
                 """,
-                (user_id, json.dumps(patterns), datetime.now().isoformat())
+                [(uid, day, e['weekday'], e['count'], e['first_ts'], e['last_ts'],
+                  e['gap_sq_sum'], e['first_gap_sq']) for day, e in daily.items()]
             )
-            conn.commit()
+            conn.executemany(
+                "INSERT INTO temporal_agg_day_hour (user_id, day, hour, count) VALUES (?, ?, ?, ?)",
+                [(uid, day, hour, c) for (day, hour), c in day_hour.items()]
+            )
+            conn.executemany(
+                "INSERT INTO temporal_agg_hour_of_day (user_id, hour, count) VALUES (?, ?, ?)",
+                [(uid, hour, c) for hour, c in hour_of_day.items()]
+            )
+            conn.executemany(
+                "INSERT INTO temporal_agg_weekday (user_id, weekday, count) VALUES (?, ?, ?)",
+                [(uid, wd, c) for wd, c in weekday.items()]
+            )
+        self._expired_before_day = self._window_start_day()
 
-        except Exception as e:
-            logging.error(f"Errore nell'aggiornamento dei pattern temporali: {str(e)}")
-            conn.rollback()
+    def check_temporal_aggregates(self, user_id: str, repair: bool = False, tolerance: float = 1e-6) -> Dict:
+        """
+        Verifica di consistenza: confronta gli aggregati con un ricalcolo completo.
+
+        Args:
+            user_id: ID dell'utente
+            repair: Se True e ci sono differenze, ricostruisce gli aggregati dell'utente
+            tolerance: Tolleranza relativa sui valori numerici
+
+        Returns:
+            Dict con consistent, mismatches, aggregated, recomputed, repaired
+        """
+        def close(a: float, b: float) -> bool:
+            return abs(a - b) <= tolerance * max(1.0, abs(a), abs(b))
+
+        with self.lock, self.session.timed('check_temporal_aggregates'):
+            conn = self.session.connection()
+            try:
+                self._maybe_expire_aggregates(conn)
+                aggregated = self._patterns_from_aggregates(user_id, conn)
+                recomputed = self._recompute_patterns(user_id, conn)
+
+                mismatches = []
+                if (aggregated is None) != (recomputed is None):
+                    mismatches.append('presence')
+                elif aggregated is not None:
+                    for section in ('hour_distribution', 'day_distribution', 'frequency'):
+                        got, expected = aggregated[section], recomputed[section]
+                        for key in set(got) | set(expected):
+                            if not close(got.get(key, 0.0), expected.get(key, 0.0)):
+                                mismatches.append(f"{section}.{key}")
+
+                repaired = False
+                if mismatches and repair:
+                    self._rebuild_aggregates(conn, user_id)
+                    repaired = True
+                conn.commit()
+
+                if mismatches:
+                    logging.warning(f"Aggregati temporali incoerenti per {user_id}: {mismatches}")
+                return {
+                    'consistent': not mismatches,
+                    'mismatches': mismatches,
+                    'aggregated': aggregated,
+                    'recomputed': recomputed,
+                    'repaired': repaired
+                }
+            except Exception:
+                conn.rollback()
+                raise
 
     def _extract_topics(self, content: str) -> List[str]:
         """
@@ -263,61 +724,19 @@ class TemporalMemorySystem:
         Returns:
             Dizionario contenente i pattern temporali o None
         """
-        with self.lock:
-            conn = self._get_db_connection()
+        with self.lock, self.session.timed('get_temporal_patterns'):
+            conn = self.session.connection()
             try:
-                # Recupera i pattern salvati
-                cursor = conn.execute(
-                    """
-                    SELECT pattern_data FROM temporal_patterns
-                    WHERE user_id = ? AND pattern_type = 'time_patterns'
-                    """,
-                    (user_id,)
-                )
-                row = cursor.fetchone()
-                
-                if row:
-                    return json.loads(row['pattern_data'])
-                
-                # Se non ci sono pattern salvati, calcolali
-                cursor = conn.execute(
-                    """
-                    SELECT timestamp FROM interactions
-                    WHERE user_id = ? AND timestamp > ?
-                    """,
-                    (user_id, (datetime.now() - self.context_window).isoformat())
-                )
-                recent_interactions = cursor.fetchall()
-                
-                if not recent_interactions:
-                    return None
-                
-                # Analizza pattern temporali
-                timestamps = [datetime.fromisoformat(t['timestamp']) for t in recent_interactions]
-                patterns = {
-                    'hour_distribution': self._analyze_hour_distribution(timestamps),
-                    'day_distribution': self._analyze_day_distribution(timestamps),
-                    'frequency': self._calculate_interaction_frequency(timestamps)
-                }
-                
-                # Salva i pattern
-                conn.execute(
-                    """
-                    INSERT OR REPLACE INTO temporal_patterns
-                    (user_id, pattern_type, pattern_data, last_updated)
-                    VALUES (?, 'time_patterns', ?, ?)
-                    """,
-                    (user_id, json.dumps(patterns), datetime.now().isoformat())
-                )
+                # Letti direttamente dagli aggregati incrementali
+                self._maybe_expire_aggregates(conn)
+                patterns = self._patterns_from_aggregates(user_id, conn)
                 conn.commit()
-                
                 return patterns
                 
             except Exception as e:
                 logging.error(f"Errore nel recupero dei pattern temporali: {str(e)}")
+                conn.rollback()
                 return None
-            finally:
-                conn.close()
 
     def get_relevant_context(self, user_id: str, current_topic: str, limit: int = 5) -> List[dict]:
         """
@@ -331,56 +750,53 @@ class TemporalMemorySystem:
         Returns:
             Lista di interazioni rilevanti
         """
-        with self.lock:
-            conn = self._get_db_connection()
+        window_start = (datetime.now() - self.context_window).isoformat()
+        with self.lock, self.session.timed('get_relevant_context'):
+            conn = self.session.connection()
             try:
-                cursor = conn.execute(
-                    """
-                    SELECT content, context, timestamp
-                    FROM interactions
-                    WHERE user_id = ? AND timestamp > ?
-                    ORDER BY timestamp DESC
-                    """,
-                    (user_id, (datetime.now() - self.context_window).isoformat())
-                )
-                recent_interactions = cursor.fetchall()
+                # Ricerca sull'indice persistente: la finestra è un range sui postings
+                ranked = self.index.search(conn, user_id, current_topic, start_time=window_start, limit=limit)
+                similarities = dict(ranked)
+                ids = [doc_id for doc_id, _ in ranked]
 
-                if not recent_interactions:
-                    return []
+                rows = {}
+                if ids:
+                    marks = ",".join("?" * len(ids))
+                    for row in conn.execute(
+                        f"SELECT id, content, context, timestamp FROM interactions WHERE id IN ({marks})",
+                        ids
+                    ).fetchall():
+                        rows[row['id']] = row
 
-                # Calcola similarità con il topic corrente
-                contents = [dict(r)['content'] for r in recent_interactions]
-                contents.append(current_topic)
-                
-                try:
-                    tfidf_matrix = self.vectorizer.fit_transform(contents)
-                    similarities = cosine_similarity(tfidf_matrix[-1:], tfidf_matrix[:-1])[0]
-                except:
-                    # Fallback se la vectorization fallisce
-                    similarities = [0] * len(recent_interactions)
-
-                # Ordina per similarità e prendi i top N
-                sorted_interactions = sorted(
-                    zip(similarities, recent_interactions),
-                    key=lambda x: x[0],
-                    reverse=True
-                )[:limit]
+                # Completa con le interazioni più recenti (similarità 0), come il vecchio ranking
+                if len(ids) < limit:
+                    query = (
+                        "SELECT id, content, context, timestamp FROM interactions "
+                        "WHERE user_id = ? AND timestamp > ?"
+                    )
+                    params = [user_id, window_start]
+                    if ids:
+                        query += f" AND id NOT IN ({','.join('?' * len(ids))})"
+                        params.extend(ids)
+                    query += " ORDER BY timestamp DESC LIMIT ?"
+                    params.append(limit - len(ids))
+                    for row in conn.execute(query, params).fetchall():
+                        rows[row['id']] = row
+                        ids.append(row['id'])
 
                 return [
                     {
-                        'content': dict(interaction)['content'],
-                        'context': json.loads(dict(interaction)['context']),
-                        'timestamp': dict(interaction)['timestamp'],
-                        'similarity': float(similarity)
+                        'content': rows[doc_id]['content'],
+                        'context': json.loads(rows[doc_id]['context']) if rows[doc_id]['context'] else {},
+                        'timestamp': rows[doc_id]['timestamp'],
+                        'similarity': float(similarities.get(doc_id, 0.0))
                     }
-                    for similarity, interaction in sorted_interactions
+                    for doc_id in ids if doc_id in rows
                 ]
 
             except Exception as e:
                 logging.error(f"Errore nel recupero del contesto: {str(e)}")
                 return []
-            finally:
-                conn.close()
 
     def get_last_interaction_id(self, user_id: str) -> Optional[int]:
         """
@@ -392,25 +808,27 @@ class TemporalMemorySystem:
         Returns:
             ID dell'ultima interazione o None
         """
-        with self.lock:
-            conn = self._get_db_connection()
+        with self.lock, self.session.timed('get_last_interaction_id'):
+            conn = self.session.connection()
             try:
-                cursor = conn.execute(
-                    """
-                    SELECT id FROM interactions
-                    WHERE user_id = ?
-                    ORDER BY timestamp DESC
-                    LIMIT 1
-                    """,
-                    (user_id,)
-                )
-                result = cursor.fetchone()
-                return result[0] if result else None
+                # Tabella calda prima, poi le partizioni dalla più recente
+                tables = ['interactions'] + [name for name, _ in self.archive.partitions_for_range(conn)]
+                for table in tables:
+                    result = conn.execute(
+                        f"""
+                        SELECT id FROM {table}
+                        WHERE user_id = ?
+                        ORDER BY timestamp DESC
+                        LIMIT 1
+                        """,
+                        (user_id,)
+                    ).fetchone()
+                    if result:
+                        return result[0]
+                return None
             except Exception as e:
                 logging.error(f"Errore durante il recupero dell'ultima interazione: {str(e)}")
                 return None
-            finally:
-                conn.close()
 
     def get_interactions(
         self,
@@ -421,6 +839,9 @@ class TemporalMemorySystem:
         """
         Recupera le interazioni di un utente in un intervallo di tempo.
         
+        L'intervallo viene instradato in modo trasparente sulla tabella calda
+        e sulle sole partizioni d'archivio che lo intersecano.
+        
         Args:
             user_id: ID dell'utente
             start_time: Tempo di inizio opzionale
@@ -432,22 +853,31 @@ class TemporalMemorySystem:
         if not user_id:
             raise ValueError("User ID richiesto")
             
-        query = "SELECT * FROM interactions WHERE user_id = ?"
+        where = "user_id = ?"
         params = [user_id]
         
         if start_time:
-            query += " AND timestamp >= ?"
+            where += " AND timestamp >= ?"
             params.append(start_time.isoformat())
             
         if end_time:
-            query += " AND timestamp <= ?"
+            where += " AND timestamp <= ?"
             params.append(end_time.isoformat())
             
-        query += " ORDER BY timestamp DESC"
-        
-        with self.lock:
-            conn = self._get_db_connection()
-            cursor = conn.execute(query, params)
+        with self.lock, self.session.timed('get_interactions'):
+            conn = self.session.connection()
+            partitions = self.archive.partitions_for_range(
+                conn,
+                start_time.isoformat() if start_time else None,
+                end_time.isoformat() if end_time else None
+            )
+            tables = ['interactions'] + [name for name, _ in partitions]
+            query = " UNION ALL ".join(
+                f"SELECT id, user_id, timestamp, content, context, emotion, topics, metadata "
+                f"FROM {table} WHERE {where}"
+                for table in tables
+            ) + " ORDER BY timestamp DESC"
+            cursor = conn.execute(query, params * len(tables))
             rows = cursor.fetchall()
             
         interactions = []
@@ -465,3 +895,56 @@ class TemporalMemorySystem:
             interactions.append(interaction)
             
         return interactions
+
+    def archive_old_interactions(self, before: Optional[datetime] = None) -> Dict[str, int]:
+        """
+        Sposta le interazioni più vecchie della retention calda nelle partizioni mensili.
+        
+        È anche il percorso di migrazione per DB esistenti: lavora per utente e
+        mese con un commit ciascuno, quindi può essere interrotto e ripreso.
+        
+        Args:
+            before: Limite esclusivo (default: adesso - hot_retention), mai oltre
+                l'inizio della finestra di contesto
+            
+        Returns:
+            Dict con rows_archived, partitions_touched, rollups_updated
+        """
+        before = before or (datetime.now() - self.hot_retention)
+        # Mai dentro la finestra di contesto: indice e aggregati leggono solo la tabella calda
+        before = min(before, datetime.combine(self._window_start_day(), datetime.min.time()))
+        with self.lock, self.session.timed('archive_old_interactions'):
+            conn = self.session.connection()
+            try:
+                result = self.archive.archive(conn, before)
+                if result['rows_archived']:
+                    logging.info(
+                        f"Archivio interazioni: {result['rows_archived']} righe in "
+                        f"{result['partitions_touched']} partizioni mensili"
+                    )
+                return result
+            except Exception as e:
+                logging.error(f"Errore durante l'archiviazione delle interazioni: {e}")
+                conn.rollback()
+                return {'rows_archived': 0, 'partitions_touched': 0, 'rollups_updated': 0}
+
+    def get_rollups(
+        self,
+        user_id: str,
+        start_month: Optional[str] = None,
+        end_month: Optional[str] = None
+    ) -> List[Dict]:
+        """
+        Riassunti mensili dei periodi archiviati.
+        
+        Args:
+            user_id: ID dell'utente
+            start_month: Primo mese incluso ('YYYY-MM')
+            end_month: Ultimo mese incluso ('YYYY-MM')
+            
+        Returns:
+            Lista di rollup (count, first_ts, last_ts, hour/emotion/topic counts) per mese
+        """
+        with self.lock, self.session.timed('get_rollups'):
+            conn = self.session.connection()
+            return self.archive.get_rollups(conn, user_id, start_month, end_month)
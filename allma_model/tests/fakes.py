@@ -0,0 +1,72 @@
+"""Modello finto condiviso dai test di MobileGemmaWrapper: tokenizer, contesto KV e generazione di llama.cpp in piccolo."""
+
+import re
+import time
+
+
+class FakeLlama:
+    """
+    Contesto llama.cpp minimo.
+
+    Un token per parola, spazio o token speciale (<|...|>), con id stabili nel
+    vocabolario (condivisibile tra istanze, come lo stesso GGUF riaperto).
+    La KV sono input_ids[:n_tokens]: eval valuta dopo n_tokens e, come
+    Llama.generate, __call__ riusa il prefisso comune e valuta il resto.
+    La risposta è reply (testo o sequenza di pezzi), troncata a max_tokens;
+    eval_s e token_s sono i secondi per token di valutazione e di generazione.
+    """
+
+    def __init__(self, reply="Ciao!", vocab=None, eval_s=0.0, token_s=0.0):
+        self.reply = reply
+        self.vocab = {} if vocab is None else vocab
+        self.eval_s = eval_s
+        self.token_s = token_s
+        self._ids = []
+        self.n_tokens = 0
+        self.evaluated = []
+        self.prompts = []
+        self.generated = 0
+
+    @property
+    def input_ids(self):
+        return self._ids[:self.n_tokens]
+
+    def tokenize(self, data, add_bos=True, special=False):
+        parts = re.findall(r'<\|[^|]+\|>|\S+|\s', data.decode("utf-8"))
+        return [self.vocab.setdefault(p, len(self.vocab) + 1) for p in parts]
+
+    def eval(self, tokens):
+        self.evaluated.append(len(tokens))
+        if self.eval_s:
+            time.sleep(self.eval_s * len(tokens))
+        self._ids = self._ids[:self.n_tokens] + list(tokens)
+        self.n_tokens = len(self._ids)
+
+    def reply_pieces(self, max_tokens):
+        """Pezzi della risposta (uno per token generato)."""
+        pieces = re.findall(r'\s*\S+', self.reply) if isinstance(self.reply, str) else list(self.reply)
+        return pieces if max_tokens in (-1, None) else pieces[:max_tokens]
+
+    def __call__(self, prompt, stream=False, max_tokens=-1, **kwargs):
+        self.prompts.append(prompt)
+        tokens = self.tokenize(prompt.encode("utf-8")) if isinstance(prompt, str) else list(prompt)
+        common = 0
+        for a, b in zip(self.input_ids, tokens[:-1]):
+            if a != b:
+                break
+            common += 1
+        self.n_tokens = common
+        self.eval(tokens[common:])
+        pieces = self.reply_pieces(max_tokens)
+
+        def chunks():
+            for piece in pieces:
+                if self.token_s:
+                    time.sleep(self.token_s)
+                self.generated += 1
+                yield {'choices': [{'text': piece, 'finish_reason': None}]}
+        if stream:
+            return chunks()
+        text = "".join(chunk['choices'][0]['text'] for chunk in chunks())
+        return {'choices': [{'text': text, 'finish_reason': 'stop'}],
+                'usage': {'prompt_tokens': len(tokens), 'completion_tokens': len(pieces)}}
@@ -77,8 +77,10 @@ class TestALLMACore(unittest.TestCase):
     
     def tearDown(self):
         """Cleanup dopo i test"""
-        if os.path.exists(self.test_db):
-            os.remove(self.test_db)
+        self.memory_system.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.test_db + suffix):
+                os.remove(self.test_db + suffix)
     
     def test_process_interaction(self):
         """Test del processamento di un'interazione"""
@@ -323,8 +325,10 @@ class TestALLMACoreEdgeCases(unittest.TestCase):
     
     def tearDown(self):
         """Cleanup dopo i test"""
-        if os.path.exists(self.test_db):
-            os.remove(self.test_db)
+        self.memory_system.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.test_db + suffix):
+                os.remove(self.test_db + suffix)
     
     def test_concurrent_interactions(self):
         """Test di interazioni concorrenti"""
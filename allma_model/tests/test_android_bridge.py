@@ -6,6 +6,7 @@ import unittest
 import tempfile
 import os
 import json
+import shutil
 from datetime import datetime
 from typing import Dict, Any
 
@@ -26,9 +27,9 @@ class TestAndroidBridge(unittest.TestCase):
         
     def tearDown(self):
         """Cleanup dopo i test"""
-        if os.path.exists(self.db_path):
-            os.remove(self.db_path)
-        os.rmdir(self.temp_dir)
+        # Il DB in WAL ha anche i file -wal/-shm: si chiude e si rimuove tutta la directory
+        self.bridge.allma.memory_system.close()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
         
     def test_session_initialization(self):
         """Test dell'inizializzazione della sessione"""
@@ -0,0 +1,130 @@
+"""Test per il backend simulato: tempi di prefill e decodifica, riuso del contesto, stati e rallentamento termico."""
+
+import tempfile
+import unittest
+
+from allma_model.llm.backends import LLMBackend, MockLLMBackend, MockStateCache, thermal_ramp
+from allma_model.llm.mobile_gemma_wrapper import MobileGemmaWrapper
+
+PROMPT = "<|im_start|>system\nSei ALLMA.<|im_end|>\n<|im_start|>user\nciao come stai<|im_end|>\n<|im_start|>assistant\n"
+
+
+class FakeClock:
+    """Attese registrate invece che dormite."""
+
+    def __init__(self):
+        self.slept = []
+
+    def __call__(self, seconds):
+        self.slept.append(seconds)
+
+
+class TestMockBackend(unittest.TestCase):
+    """Test per MockLLMBackend da solo."""
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.backend = MockLLMBackend(prefill_tps=100, decode_tps=10, sleep=self.clock)
+
+    def test_satisfies_backend_protocol(self):
+        self.assertIsInstance(self.backend, LLMBackend)
+        self.assertNotIsInstance(object(), LLMBackend)
+
+    def test_tokenizer_round_trip(self):
+        tokens = self.backend.tokenize(PROMPT.encode("utf-8"))
+        self.assertEqual(tokens[0], MockLLMBackend.BOS_ID)
+        self.assertEqual(self.backend.detokenize(tokens).decode("utf-8"), PROMPT)
+        # Id stabili tra istanze (stati su disco dopo un riavvio)
+        self.assertEqual(MockLLMBackend().tokenize(PROMPT.encode("utf-8")), tokens)
+
+    def test_templated_output_and_timing(self):
+        out = self.backend(PROMPT, max_tokens=32)
+        self.assertEqual(out["choices"][0]["text"], "Risposta simulata a: ciao come stai")
+        prompt_tokens, completion_tokens = out["usage"]["prompt_tokens"], out["usage"]["completion_tokens"]
+        self.assertEqual(completion_tokens, 6)
+        self.assertAlmostEqual(self.clock.slept[0], prompt_tokens / 100)
+        self.assertEqual(self.clock.slept[1:], [0.1] * completion_tokens)
+
+    def test_prefix_reuse_skips_prefill(self):
+        self.backend(PROMPT, max_tokens=32)
+        before = self.backend.get_stats()["prefilled_tokens"]
+        self.backend(PROMPT + "altro", max_tokens=32)
+        stats = self.backend.get_stats()
+        # Solo la parte nuova (più l'ultimo token, rivalutato come in llama.cpp)
+        self.assertLessEqual(stats["prefilled_tokens"] - before, 3)
+        self.assertGreater(stats["reused_tokens"], 10)
+
+    def test_scripted_output_stop_and_length(self):
+        backend = MockLLMBackend(responses=["uno due tre<|im_end|> dopo", "quattro cinque sei"], sleep=self.clock)
+        chunks = list(backend(PROMPT, stream=True, stop=["<|im_end|>"]))
+        self.assertEqual("".join(c["choices"][0]["text"] for c in chunks), "uno due tre")
+        self.assertEqual(chunks[-1]["choices"][0]["finish_reason"], "stop")
+        out = backend(PROMPT, max_tokens=2)
+        self.assertEqual((out["choices"][0]["text"], out["choices"][0]["finish_reason"]), ("quattro cinque", "length"))
+
+    def test_state_save_load_and_cache(self):
+        self.backend(PROMPT, max_tokens=32)
+        state = self.backend.save_state()
+        self.assertEqual(state.llama_state_size, state.n_tokens * self.backend.kv_bytes_per_token)
+        self.backend.reset()
+        self.backend.load_state(state)
+        self.assertEqual(self.backend.n_tokens, state.n_tokens)
+        state.llama_state = b"\xff" + state.llama_state[1:]
+        with self.assertRaises(RuntimeError):
+            self.backend.load_state(state)
+
+        cache = MockStateCache()
+        self.backend.set_cache(cache)
+        self.backend(PROMPT, max_tokens=32)
+        self.backend.reset()
+        self.backend(PROMPT, max_tokens=32)
+        self.assertEqual(self.backend.get_stats()["cache_loads"], 1)
+
+    def test_thermal_slowdown(self):
+        curve = thermal_ramp(onset_s=1.0, full_s=3.0, max_slowdown=2.0)
+        self.assertEqual((curve(0.5), curve(2.0), curve(10.0)), (1.0, 1.5, 2.0))
+        backend = MockLLMBackend(prefill_tps=1000, decode_tps=1, thermal_curve=curve, sleep=self.clock,
+                                 responses="a b c d e f")
+        backend(PROMPT, max_tokens=8)
+        decode = self.clock.slept[1:]
+        self.assertEqual(decode[0], 1.0)
+        self.assertGreater(decode[-1], decode[0])
+        self.assertLessEqual(max(decode), 2.0)
+
+
+class TestWrapperWithMockBackend(unittest.TestCase):
+    """Test per MobileGemmaWrapper(backend=MockLLMBackend)."""
+
+    def setUp(self):
+        self.models_dir = tempfile.mkdtemp()
+        self.backend = MockLLMBackend(prefill_tps=2000, decode_tps=200, responses="Sto bene, grazie!")
+        self.wrapper = MobileGemmaWrapper(self.models_dir, backend=self.backend)
+
+    def test_stream_timing_and_prefix_reuse(self):
+        tokens = []
+        text = self.wrapper.generate(PROMPT, max_tokens=32, callback=tokens.append, conversation_id="c1")
+        self.assertEqual(text, "Sto bene, grazie!")
+        self.assertEqual("".join(tokens), text)
+        first = self.wrapper.last_generation
+        self.assertGreater(first["ttft_ms"], 0)
+        self.assertEqual(first["completion_tokens"], 3)
+
+        self.wrapper.generate(PROMPT + text + "<|im_end|>\n<|im_start|>user\nbene<|im_end|>\n<|im_start|>assistant\n",
+                              max_tokens=32, conversation_id="c1")
+        # Tutto il primo prompt resta nel contesto (meno il confine prompt/risposta)
+        self.assertGreaterEqual(self.wrapper.last_generation["prefix_reused_tokens"], first["prompt_tokens"] - 1)
+
+    def test_kv_state_survives_restart(self):
+        self.assertIsNotNone(self.wrapper.kv_store)
+        long_prompt = PROMPT.replace("Sei ALLMA.", "Sei ALLMA. " + "parola " * 80)
+        self.wrapper.generate(long_prompt, max_tokens=8, conversation_id="c1", prefix_hash="h")
+        self.assertTrue(self.wrapper.persist_state(timeout=5))
+
+        restarted = MobileGemmaWrapper(self.models_dir, backend=MockLLMBackend(prefill_tps=2000, decode_tps=200))
+        restarted.generate(long_prompt, max_tokens=8, conversation_id="c1", prefix_hash="h")
+        self.assertEqual(restarted.last_generation["kv_restore"], "hit")
+        self.assertGreater(restarted.llm.get_stats()["reused_tokens"], 80)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,141 @@
+"""Test per i token di annullamento e l'interruzione della generazione."""
+
+import tempfile
+import threading
+import time
+import unittest
+
+from allma_model.llm.mobile_gemma_wrapper import MobileGemmaWrapper
+from allma_model.tests.fakes import FakeLlama
+from allma_model.utils.cancellation import CancellationToken, OperationCancelledError
+
+
+class TestCancellationToken(unittest.TestCase):
+    """Test per CancellationToken."""
+
+    def test_cancel_check_and_listeners(self):
+        token = CancellationToken()
+        reasons = []
+        token.add_listener(reasons.append)
+        token.check()
+        self.assertIsNone(token.acknowledge("x"))
+        self.assertTrue(token.cancel("superseded"))
+        self.assertFalse(token.cancel("again"))
+        with self.assertRaises(OperationCancelledError) as ctx:
+            token.check()
+        self.assertEqual(ctx.exception.reason, "superseded")
+        self.assertEqual(reasons, ["superseded"])
+
+    def test_removed_listener_is_not_called(self):
+        token = CancellationToken()
+        calls = []
+        token.add_listener(calls.append)
+        token.remove_listener(calls.append)
+        token.cancel()
+        self.assertEqual(calls, [])
+
+    def test_latency_is_first_acknowledge(self):
+        """La latenza va da cancel() al primo acknowledge()"""
+        token = CancellationToken()
+        token.cancel("stop")
+        time.sleep(0.02)
+        first = token.acknowledge("llm.generation")
+        time.sleep(0.02)
+        self.assertEqual(token.acknowledge("process_message"), first)
+        self.assertEqual(token.stopped_by, "llm.generation")
+        self.assertGreaterEqual(first, 15.0)
+
+
+class TestGenerationCancellation(unittest.TestCase):
+    """Test per l'annullamento in MobileGemmaWrapper.generate."""
+
+    def setUp(self):
+        self.wrapper = MobileGemmaWrapper(tempfile.mkdtemp())
+        # Generazione in streaming lenta: 200 token, uno ogni 5 ms
+        self.llm = FakeLlama(reply=[f" t{i}" for i in range(200)], eval_s=0.002, token_s=0.005)
+        self.wrapper.llm = self.llm
+
+    def test_generation_stops_at_token_granularity(self):
+        """L'annullamento ferma la generazione al token successivo e libera il modello"""
+        token = CancellationToken()
+        streamed = []
+
+        def on_token(t):
+            streamed.append(t)
+            if len(streamed) == 5:
+                token.cancel("superseded")
+
+        text = self.wrapper.generate("ciao come stai", max_tokens=500, callback=on_token,
+                                     request_id="g1", cancel_token=token)
+        meta = self.wrapper.get_generation_meta("g1")
+        self.assertEqual(meta['finish_reason'], 'cancelled')
+        self.assertEqual(meta['cancelled_during'], 'generation')
+        self.assertEqual(len(streamed), 5)
+        self.assertLessEqual(self.llm.generated, 6)
+        self.assertTrue(text.startswith("t0 t1"))
+        self.assertIsNotNone(meta['cancel_latency_ms'])
+        self.assertEqual(token.stopped_by, "llm.generation")
+        self.assertFalse(self.wrapper.inference_lock.locked())
+
+    def test_non_streaming_call_is_cancellable(self):
+        """Con un cancel_token anche una chiamata senza callback è interrompibile"""
+        token = CancellationToken()
+        threading.Timer(0.05, token.cancel, args=("user_stop",)).start()
+        started = time.perf_counter()
+        self.wrapper.generate("ciao", max_tokens=500, request_id="g2", cancel_token=token)
+        self.assertLess(time.perf_counter() - started, 0.5)
+        self.assertEqual(self.wrapper.get_generation_meta("g2")['finish_reason'], 'cancelled')
+
+    def test_prompt_evaluation_is_chunked(self):
+        """Il prompt viene valutato a blocchi e l'annullamento interrompe la valutazione"""
+        prompt = " ".join(f"parola{i}" for i in range(400))
+        token = CancellationToken()
+        original_eval = self.llm.eval
+
+        def eval_and_cancel(tokens):
+            original_eval(tokens)
+            token.cancel("superseded")
+
+        self.llm.eval = eval_and_cancel
+        self.wrapper.generate(prompt, max_tokens=50, request_id="g3", cancel_token=token)
+        meta = self.wrapper.get_generation_meta("g3")
+        self.assertEqual(meta['cancelled_during'], 'prompt_eval')
+        self.assertEqual(self.llm.evaluated, [MobileGemmaWrapper.EVAL_CHUNK_TOKENS])
+        self.assertEqual(self.llm.generated, 0)
+
+    def test_long_prompt_eval_calls_follow_n_batch(self):
+        """Con un cancel_token il prompt lungo costa le passate di n_batch, non blocchi piccoli"""
+        prompt = " ".join(f"parola{i}" for i in range(400))
+        n_prompt = len(self.llm.tokenize(prompt.encode("utf-8")))
+        self.wrapper.generate(prompt, max_tokens=5, request_id="g5", cancel_token=CancellationToken())
+        chunk = MobileGemmaWrapper.EVAL_CHUNK_TOKENS
+        # Prefill a blocchi pieni (l'ultimo token lo valuta la generazione)
+        self.assertEqual(self.llm.evaluated, [chunk, n_prompt - 1 - chunk, 1])
+
+        # Con n_batch del modello i blocchi seguono quello
+        self.llm.evaluated, self.llm.n_tokens, self.llm.n_batch = [], 0, 256
+        self.wrapper.generate(prompt, max_tokens=5, request_id="g6", cancel_token=CancellationToken())
+        self.assertEqual(self.llm.evaluated[:3], [256, 256, 256])
+        self.assertEqual(sum(self.llm.evaluated), n_prompt)
+
+    def test_cancel_while_waiting_for_model(self):
+        """Un turno annullato in attesa del lock non occupa mai il modello"""
+        token = CancellationToken()
+        with self.wrapper.inference_lock:
+            threading.Timer(0.05, token.cancel, args=("superseded",)).start()
+            text = self.wrapper.generate("ciao", max_tokens=50, request_id="g4", cancel_token=token)
+        self.assertEqual(text, "")
+        meta = self.wrapper.get_generation_meta("g4")
+        self.assertEqual(meta['cancelled_during'], 'lock_wait')
+        self.assertEqual(self.llm.evaluated, [])
+
+    def test_prefill_is_cancellable(self):
+        token = CancellationToken()
+        token.cancel("superseded")
+        result = self.wrapper.prefill("uno due tre", conversation_id="c1", cancel_token=token)
+        self.assertEqual(result['status'], 'cancelled')
+        self.assertEqual(self.wrapper.get_prefill_stats()['cancelled'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
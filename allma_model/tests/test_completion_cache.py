@@ -0,0 +1,106 @@
+"""Test per la cache delle risposte deterministiche: chiavi, limiti, persistenza e uso nel wrapper."""
+
+import json
+import os
+import tempfile
+import unittest
+
+from allma_model.emotional_system.emotional_core import EMOTION_SCHEMA
+from allma_model.llm.completion_cache import CompletionCache, completion_key, is_deterministic
+from allma_model.llm.mobile_gemma_wrapper import MobileGemmaWrapper
+from allma_model.llm.structured_output import StructuredOutput
+from allma_model.tests.fakes import FakeLlama
+
+
+class TestCompletionCache(unittest.TestCase):
+    """Test per CompletionCache."""
+
+    def setUp(self):
+        self.path = os.path.join(tempfile.mkdtemp(), "cache.sqlite")
+
+    def test_key_changes_with_every_input(self):
+        base = completion_key("m", "p", {"max_tokens": 8, "temperature": 0.0}, "")
+        self.assertEqual(base, completion_key("m", "p", {"temperature": 0.0, "max_tokens": 8}, ""))
+        for other in (completion_key("m2", "p", {"max_tokens": 8, "temperature": 0.0}, ""),
+                      completion_key("m", "p2", {"max_tokens": 8, "temperature": 0.0}, ""),
+                      completion_key("m", "p", {"max_tokens": 9, "temperature": 0.0}, ""),
+                      completion_key("m", "p", {"max_tokens": 8, "temperature": 0.0}, "{}")):
+            self.assertNotEqual(base, other)
+        self.assertTrue(is_deterministic(0.0))
+        self.assertTrue(is_deterministic(0.7, seed=42))
+        self.assertFalse(is_deterministic(0.1))
+
+    def test_persistence_and_model_change(self):
+        cache = CompletionCache(self.path, model_id="a")
+        cache.put("k", "testo", 3, 120.0)
+        cache.close()
+        reopened = CompletionCache(self.path, model_id="a")
+        self.assertEqual(reopened.get("k"), ("testo", 3))
+        stats = reopened.get_stats()
+        self.assertEqual((stats["hits"], stats["saved_ms"], stats["saved_tokens"]), (1, 120.0, 3))
+        reopened.close()
+        # Un altro modello non vede (e cancella) le risposte del precedente
+        other = CompletionCache(self.path, model_id="b")
+        self.assertIsNone(other.get("k"))
+        self.assertEqual(other.get_stats()["entries"], 0)
+
+    def test_lru_eviction_within_limits(self):
+        cache = CompletionCache(self.path, max_entries=2)
+        cache.put("a", "1", 1, 1.0)
+        cache.put("b", "2", 1, 1.0)
+        cache.get("a")  # "b" diventa la meno usata
+        cache.put("c", "3", 1, 1.0)
+        self.assertIsNone(cache.get("b"))
+        self.assertIsNotNone(cache.get("a"))
+        self.assertEqual(cache.get_stats()["evictions"], 1)
+
+        small = CompletionCache(os.path.join(os.path.dirname(self.path), "small.sqlite"), max_bytes=200)
+        self.assertFalse(small.put("x", "y" * 300, 1, 1.0))
+        for i in range(5):
+            small.put(f"k{i}", "z" * 60, 1, 1.0)
+        self.assertLessEqual(small.get_stats()["bytes"], 200)
+
+
+class TestWrapperCompletionCache(unittest.TestCase):
+    """Test per generate(cache=True) in MobileGemmaWrapper."""
+
+    def setUp(self):
+        models_dir = tempfile.mkdtemp()
+        self.wrapper = MobileGemmaWrapper(models_dir)
+        self.llm = FakeLlama(reply="ciao a te")
+        self.wrapper.llm = self.llm
+        self.wrapper.completion_cache = CompletionCache(os.path.join(models_dir, "c.sqlite"), model_id="m")
+
+    def test_greedy_request_is_served_from_cache(self):
+        first = self.wrapper.generate("p", max_tokens=8, temperature=0.0, cache=True)
+        streamed = []
+        second = self.wrapper.generate("p", max_tokens=8, temperature=0.0, cache=True, callback=streamed.append,
+                                       request_id="r2")
+        self.assertEqual(first, second)
+        self.assertEqual(len(self.llm.prompts), 1)
+        self.assertEqual(streamed, [first])
+        self.assertTrue(self.wrapper.get_generation_meta("r2")["cache_hit"])
+        # Parametri diversi: nuova inferenza
+        self.wrapper.generate("p", max_tokens=9, temperature=0.0, cache=True)
+        self.assertEqual(len(self.llm.prompts), 2)
+
+    def test_sampling_and_opt_out_bypass_cache(self):
+        for _ in range(2):
+            self.wrapper.generate("p", max_tokens=8, temperature=0.7, cache=True)
+            self.wrapper.generate("q", max_tokens=8, temperature=0.0)
+        self.assertEqual(len(self.llm.prompts), 4)
+        stats = self.wrapper.get_completion_cache_stats()
+        self.assertEqual((stats["bypassed"], stats["stores"], stats["hits"]), (2, 0, 0))
+
+    def test_structured_call_hit_skips_metrics(self):
+        self.llm.reply = json.dumps({"e": "joy", "c": 0.9, "i": 0.6})
+        self.wrapper.structured = StructuredOutput(lambda schema: object())
+        for _ in range(2):
+            data = self.wrapper.generate_structured("p", EMOTION_SCHEMA, call_type="emotion", cache=True)
+            self.assertEqual(data["e"], "joy")
+        self.assertEqual(len(self.llm.prompts), 1)
+        self.assertEqual(self.wrapper.get_structured_stats()["emotion"]["constrained"]["calls"], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+"""Test del turno completo di ALLMACore su backend simulato: profilo, emozione e lavoro post-risposta."""
+
+import json
+import os
+import tempfile
+import unittest
+import uuid
+
+from allma_model.core.allma_core import ALLMACore
+from allma_model.llm.backends import MockLLMBackend
+
+
+def scripted_responses(prompt):
+    """Emozione in JSON per la classificazione, una frase fissa per la risposta."""
+    if "Classifica l'emozione" in prompt:
+        return json.dumps({"e": "joy", "c": 0.9, "i": 0.8})
+    return "Ciao! Che bello sentirti."
+
+
+class TestCorePipeline(unittest.TestCase):
+    """Test per ALLMACore(mobile_mode=True, llm_backend=MockLLMBackend)."""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.backend = MockLLMBackend(prefill_tps=5000, decode_tps=500, responses=scripted_responses)
+        cls.core = ALLMACore(mobile_mode=True, models_dir=tempfile.mkdtemp(),
+                             db_path=os.path.join(tempfile.mkdtemp(), "allma_test.db"),
+                             llm_backend=cls.backend)
+
+    def setUp(self):
+        self.user_id = f"u-{uuid.uuid4().hex[:8]}"
+        self.conversation_id = f"c-{uuid.uuid4().hex[:8]}"
+
+    def test_full_turns_on_mock_backend(self):
+        first = self.core.process_message(self.user_id, self.conversation_id,
+                                          "Mi racconti qualcosa sulla storia di Roma antica e dei suoi imperatori?")
+        second = self.core.process_message(self.user_id, self.conversation_id,
+                                           "E invece cosa mi dici di Augusto e del suo regno?")
+        self.assertTrue(self.core.drain_post_response(10))
+
+        for response in (first, second):
+            self.assertEqual(response.content, "Ciao! Che bello sentirti.")
+            self.assertEqual(response.metadata["pipeline_profile"], "NORMAL")
+        # Risposta in streaming dal backend simulato, col contesto del turno precedente
+        generation = self.core._llm.last_generation
+        self.assertEqual(generation["priority"], "FOREGROUND")
+        self.assertGreater(generation["ttft_ms"], 0)
+        self.assertGreater(generation["prompt_sections"]["history"], 0)
+        self.assertGreater(generation["prefix_reused_tokens"], 0)
+        self.assertGreaterEqual(self.backend.get_stats()["calls"], 2)
+        stored = self.core.conversational_memory.get_conversation_history(self.conversation_id)
+        self.assertEqual([m.role for m in stored], ["user", "assistant"] * 2)
+
+    def test_simple_turn_keeps_computed_emotion(self):
+        response = self.core.process_message(self.user_id, self.conversation_id, "ciao, oggi sono felice!")
+        self.assertTrue(self.core.drain_post_response(10))
+
+        self.assertEqual(response.metadata["pipeline_profile"], "SIMPLE")
+        self.assertEqual(response.emotion, "joy")
+        self.assertEqual(response.metadata["emotion_value"], "joy")
+        # Salvataggio differito e milestone vedono l'emozione del turno, non "neutral"
+        stored = self.core.conversational_memory.get_conversation_history(self.conversation_id)
+        self.assertEqual([m.role for m in stored], ["user", "assistant"])
+        self.assertEqual(stored[-1].metadata["emotion"], "joy")
+        self.assertEqual(self.core.emotional_milestones.emotional_history[self.user_id][-1].emotion, "joy")
+
+    def test_follow_up_is_not_simple(self):
+        self.assertEqual(self.core._analyze_query_complexity("ok e l'altro?", [], intent="affermazione"), "SIMPLE")
+        history = ["turno precedente"]
+        self.assertNotEqual(self.core._analyze_query_complexity("ok e l'altro?", history, intent="affermazione"),
+                            "SIMPLE")
+        self.assertEqual(self.core._analyze_query_complexity("ok!", history, intent="affermazione"), "SIMPLE")
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -25,6 +25,7 @@ class TestIntegration(unittest.TestCase):
             
         # Inizializza il core
         self.core = ALLMACore(db_path=self.test_db)
+        self.addCleanup(self._remove_test_db)
         required = [
             "create_project",
             "handle_project_creation_request",
@@ -42,6 +43,13 @@ class TestIntegration(unittest.TestCase):
             {"topic": "python"}
         )
         
+    def _remove_test_db(self):
+        """Chiude il DB (in WAL) e rimuove il file con i suoi -wal/-shm."""
+        self.core.memory_system.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.test_db + suffix):
+                os.remove(self.test_db + suffix)
+
     def test_end_to_end_interaction(self):
         """Test di un'interazione completa end-to-end."""
         # 1. Inizia una nuova conversazione
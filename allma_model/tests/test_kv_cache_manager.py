@@ -0,0 +1,128 @@
+"""Test per KVCacheManager: budget in byte, espulsione cost-aware e metriche."""
+
+import tempfile
+import unittest
+from types import SimpleNamespace
+
+from allma_model.llm.kv_cache_manager import KVCacheManager
+from allma_model.llm.mobile_gemma_wrapper import MobileGemmaWrapper
+from allma_model.tests.fakes import FakeLlama
+
+MB = 1 << 20
+
+
+class FakeCache:
+    """LlamaRAMCache minima: stati per sequenza di token, cache_size in byte."""
+
+    def __init__(self, capacity_bytes):
+        self.capacity_bytes = capacity_bytes
+        self.cache_state = {}
+
+    @property
+    def cache_size(self):
+        return sum(s.llama_state_size for s in self.cache_state.values())
+
+    def put(self, n_tokens, size):
+        self.cache_state[tuple(range(n_tokens))] = SimpleNamespace(n_tokens=n_tokens, llama_state_size=size,
+                                                                   llama_state=b"")
+
+
+def monitor(temp=25.0, load=0.2):
+    state = SimpleNamespace(battery_temp_celsius=temp, cognitive_load=load)
+    return SimpleNamespace(get_metabolic_state=lambda: state)
+
+
+class TestKVCacheManager(unittest.TestCase):
+    """Test per KVCacheManager."""
+
+    def _manager(self, available=4000 * MB, **kwargs):
+        self.evicted = []
+        return KVCacheManager(FakeCache, memory_probe=lambda: available,
+                              on_evict=self.evicted.append, **kwargs)
+
+    def _fill(self, manager, conv, n_tokens, size):
+        cache = manager.cache_for(conv, "h")
+        cache.put(n_tokens, size)
+        manager.update(conv)
+        return cache
+
+    def test_hits_misses_and_invalidation(self):
+        manager = self._manager()
+        self._fill(manager, "c1", 100, MB)
+        self.assertIs(manager.cache_for("c1", "h"), manager.cache_for("c1", ""))
+        manager.cache_for("c1", "altro")
+        stats = manager.get_stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["invalidations"]), (2, 2, 1))
+        self.assertEqual(stats["hit_rate"], 0.5)
+
+    def test_budget_follows_memory_and_device_state(self):
+        """Budget = frazione di (RAM disponibile + cache), entro i limiti; pressione e calore lo spostano"""
+        self.assertEqual(self._manager(available=1000 * MB).budget_bytes(), 250 * MB)
+        self.assertEqual(self._manager(available=100 * MB).budget_bytes(), 64 * MB)
+        self.assertEqual(self._manager(available=10000 * MB).budget_bytes(), 768 * MB)
+        self.assertEqual(self._manager(available=None).budget_bytes(), 768 * MB)
+        self.assertEqual(self._manager(available=1000 * MB, system_monitor=monitor(load=0.8)).budget_bytes(), 64 * MB)
+        self.assertEqual(self._manager(available=1000 * MB, system_monitor=monitor(temp=42.0)).budget_bytes(), 350 * MB)
+
+    def test_eviction_prefers_cheap_and_stale_states(self):
+        """Oltre il budget esce lo stato con recenza × costo di prefill più basso, mai quello attivo"""
+        manager = self._manager(available=400 * MB)  # budget 100 MB
+        self._fill(manager, "long", 1500, 40 * MB)
+        self._fill(manager, "short", 100, 40 * MB)
+        self._fill(manager, "active", 800, 40 * MB)
+        self.assertEqual([e.conversation_id for e in self.evicted], ["short"])
+        self.assertEqual(manager.get_stats()["evictions"], 1)
+
+        # Molto vecchio, anche se costoso, perde contro uno recente
+        manager._entries["long"].last_used -= 10 * manager.RECENCY_HALF_LIFE_S
+        self._fill(manager, "new", 200, 40 * MB)
+        self.assertEqual([e.conversation_id for e in self.evicted], ["short", "long"])
+        self.assertIn("new", manager._entries)
+
+    def test_active_conversation_is_capped_not_evicted(self):
+        manager = self._manager(available=200 * MB)  # budget 64 MB (minimo)
+        cache = self._fill(manager, "solo", 1000, 100 * MB)
+        self.assertEqual(self.evicted, [])
+        self.assertEqual(cache.capacity_bytes, 64 * MB)
+
+    def test_max_entries(self):
+        manager = self._manager(max_entries=2)
+        for conv in ("a", "b", "c"):
+            self._fill(manager, conv, 10, MB)
+        self.assertEqual(manager.get_stats()["entries"], 2)
+
+
+class CachingLlama(FakeLlama):
+    """FakeLlama che, come Llama.create_completion, salva lo stato nella cache attiva."""
+
+    def __init__(self):
+        super().__init__()
+        self.cache = None
+
+    def set_cache(self, cache):
+        self.cache = cache
+
+    def __call__(self, prompt, **kwargs):
+        output = super().__call__(prompt, **kwargs)
+        if self.cache is not None:
+            self.cache.put(self.n_tokens, 10 * MB)
+        return output
+
+
+class TestWrapperConversationCaches(unittest.TestCase):
+    """Test per le LlamaCache per conversazione di MobileGemmaWrapper."""
+
+    def test_switching_between_three_chats_keeps_hits(self):
+        wrapper = MobileGemmaWrapper(tempfile.mkdtemp())
+        wrapper.llm = CachingLlama()
+        wrapper.kv_cache = KVCacheManager(FakeCache, memory_probe=lambda: 2000 * MB)
+        for conv in ("c1", "c2", "c3", "c1", "c2", "c3"):
+            wrapper.generate(f"<|im_start|>user\nciao da {conv}<|im_end|>\n", max_tokens=8,
+                             conversation_id=conv, prefix_hash="h")
+        stats = wrapper.get_kv_state_stats()["ram"]
+        self.assertEqual((stats["entries"], stats["hits"], stats["misses"], stats["evictions"]), (3, 3, 3, 0))
+        self.assertEqual(stats["bytes"], 30 * MB)
+
+
+if __name__ == '__main__':
+    unittest.main()
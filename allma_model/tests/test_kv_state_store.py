@@ -0,0 +1,223 @@
+"""Test per l'archivio su disco degli stati KV e il ripristino in MobileGemmaWrapper."""
+
+import os
+import tempfile
+import time
+import unittest
+from types import SimpleNamespace
+
+from allma_model.llm.kv_state_store import KVStateStore
+from allma_model.llm.mobile_gemma_wrapper import MobileGemmaWrapper
+from allma_model.tests.fakes import FakeLlama
+
+
+class TestKVStateStore(unittest.TestCase):
+    """Test per KVStateStore."""
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+
+    def test_roundtrip_and_peek(self):
+        store = KVStateStore(self.dir, fingerprint="m1")
+        self.assertTrue(store.put("c1|h", [1, 2, 3], b"stato"))
+        peeked = store.peek("c1|h")
+        self.assertEqual((peeked.tokens, peeked.state), ([1, 2, 3], None))
+        entry = store.get("c1|h")
+        self.assertEqual((entry.tokens, entry.state), ([1, 2, 3], b"stato"))
+        self.assertIsNone(store.get("c2|h"))
+        stats = store.get_stats()
+        self.assertEqual((stats["hits"], stats["misses"], stats["entries"]), (1, 1, 1))
+
+    def test_other_model_or_context_is_discarded(self):
+        """Una voce scritta con un'altra impronta (modello o n_ctx) non viene mai restituita"""
+        KVStateStore(self.dir, fingerprint="m1|n_ctx=2048").put("c1|h", [1, 2], b"x")
+        store = KVStateStore(self.dir, fingerprint="m1|n_ctx=4096")
+        self.assertIsNone(store.peek("c1|h"))
+        self.assertEqual(store.get_stats()["stale"], 1)
+        self.assertEqual(os.listdir(self.dir), [])
+
+    def test_corrupted_blob_is_discarded(self):
+        store = KVStateStore(self.dir, fingerprint="m1")
+        store.put("c1|h", [1, 2], b"stato integro")
+        path = os.path.join(self.dir, os.listdir(self.dir)[0])
+        with open(path, "r+b") as f:
+            f.seek(-3, os.SEEK_END)
+            f.write(b"XXX")
+        self.assertIsNone(store.get("c1|h"))
+        self.assertEqual(store.get_stats()["corrupt"], 1)
+        self.assertIsNone(store.peek("c1|h"))
+
+    def test_lru_eviction_survives_reopen(self):
+        """Oltre il budget si espelle la voce usata meno di recente, anche dopo un riavvio"""
+        store = KVStateStore(self.dir, max_bytes=2500, fingerprint="m1")
+        store.put("a", [1], b"a" * 1000)
+        store.put("b", [1], b"b" * 1000)
+        time.sleep(0.01)
+        self.assertIsNotNone(store.get("a"))  # "a" diventa la più recente
+        store.put("c", [1], b"c" * 1000)
+        self.assertIsNone(store.peek("b"))
+        self.assertIsNotNone(store.peek("a"))
+        self.assertEqual(store.get_stats()["evictions"], 1)
+
+        reopened = KVStateStore(self.dir, max_bytes=1500, fingerprint="m1")
+        self.assertIsNone(reopened.peek("a"))
+        self.assertIsNotNone(reopened.peek("c"))
+
+    def test_oversized_state_is_not_written(self):
+        store = KVStateStore(self.dir, max_bytes=100, fingerprint="m1")
+        self.assertFalse(store.put("a", [1], b"x" * 200))
+        self.assertEqual(store.get_stats()["entries"], 0)
+
+    def test_put_async_and_flush(self):
+        store = KVStateStore(self.dir, fingerprint="m1")
+        future = store.put_async("a", [1, 2], b"stato")
+        self.assertTrue(store.flush(timeout=2))
+        self.assertTrue(future.result())
+        self.assertEqual(store.get("a").state, b"stato")
+
+
+class StatefulLlama(FakeLlama):
+    """FakeLlama con save_state/load_state leggeri (stato = token valutati)."""
+
+    _allma_light_cache_patched = True
+
+    def save_state(self):
+        blob = ",".join(str(t) for t in self.input_ids).encode()
+        return SimpleNamespace(input_ids=list(self._ids), n_tokens=self.n_tokens,
+                               llama_state=blob, llama_state_size=len(blob))
+
+    def load_state(self, state):
+        if state.llama_state != ",".join(str(t) for t in state.input_ids[:state.n_tokens]).encode():
+            raise RuntimeError("Failed to set llama state data")
+        self._ids = list(state.input_ids)
+        self.n_tokens = int(state.n_tokens)
+
+
+SYSTEM = "<|im_start|>system\n" + " ".join(f"regola{i}" for i in range(80)) + "<|im_end|>\n"
+TURN = "<|im_start|>user\ncome va?<|im_end|>\n<|im_start|>assistant\n"
+
+
+class TestWrapperKVRestore(unittest.TestCase):
+    """Test per il ripristino dello stato KV dopo un riavvio."""
+
+    def setUp(self):
+        self.kv_dir = tempfile.mkdtemp()
+        self.vocab = {}
+
+    def _start(self, fingerprint="qwen.gguf|n_ctx=2048"):
+        """Un 'processo' nuovo: wrapper e contesto vuoti, stesso archivio su disco."""
+        wrapper = MobileGemmaWrapper(tempfile.mkdtemp(), kv_state_dir=self.kv_dir)
+        wrapper.llm = StatefulLlama(vocab=self.vocab)
+        wrapper.kv_store = KVStateStore(self.kv_dir, fingerprint=fingerprint)
+        return wrapper
+
+    def test_warm_restart_evaluates_only_the_tail(self):
+        first = self._start()
+        first.generate(SYSTEM + TURN, max_tokens=16, conversation_id="c1", prefix_hash="h", request_id="g1")
+        self.assertEqual(first.get_generation_meta("g1")["kv_restore"], "miss")
+        self.assertEqual(first.get_kv_state_stats()["persists"], 1)
+        self.assertTrue(first.kv_store.flush(timeout=2))
+
+        second = self._start()
+        second.generate(SYSTEM + TURN + "Ciao!", max_tokens=16, conversation_id="c1", prefix_hash="h", request_id="g2")
+        meta = second.get_generation_meta("g2")
+        self.assertEqual(meta["kv_restore"], "hit")
+        prompt_tokens = len(second._prompt_tokens(SYSTEM + TURN))
+        self.assertEqual(meta["kv_restored_tokens"], prompt_tokens)
+        self.assertEqual(meta["prefix_reused_tokens"], prompt_tokens)
+        self.assertEqual(second.llm.evaluated, [1])
+        self.assertEqual(second.get_kv_state_stats()["hit_rate"], 1.0)
+
+    def test_other_conversation_or_model_is_cold(self):
+        first = self._start()
+        first.generate(SYSTEM + TURN, max_tokens=16, conversation_id="c1", prefix_hash="h")
+        first.kv_store.flush(timeout=2)
+
+        other_conv = self._start()
+        other_conv.generate(SYSTEM + TURN, max_tokens=16, conversation_id="c2", prefix_hash="h", request_id="g")
+        self.assertEqual(other_conv.get_generation_meta("g")["kv_restore"], "miss")
+
+        other_model = self._start(fingerprint="altro.gguf|n_ctx=2048")
+        other_model.generate(SYSTEM + TURN, max_tokens=16, conversation_id="c1", prefix_hash="h", request_id="g")
+        self.assertEqual(other_model.get_generation_meta("g")["kv_restore"], "miss")
+        self.assertEqual(other_model.kv_store.get_stats()["stale"], 1)
+
+    def test_rejected_state_is_discarded_and_reevaluated(self):
+        store = KVStateStore(self.kv_dir, fingerprint="qwen.gguf|n_ctx=2048")
+        wrapper = self._start()
+        tokens = wrapper._prompt_tokens(SYSTEM + TURN)
+        store.put("c1|h", tokens, b"blob non valido")
+        wrapper = self._start()
+        wrapper.generate(SYSTEM + TURN, max_tokens=16, conversation_id="c1", prefix_hash="h", request_id="g")
+        self.assertEqual(wrapper.get_generation_meta("g")["kv_restore"], "error")
+        self.assertEqual(sum(wrapper.llm.evaluated), len(tokens))
+        self.assertIsNone(wrapper.kv_store.peek("c1|h"))
+
+    def test_persist_state_is_throttled_but_forceable(self):
+        wrapper = self._start()
+        wrapper.generate(SYSTEM + TURN, max_tokens=16, conversation_id="c1", prefix_hash="h")
+        wrapper.generate(SYSTEM + TURN + "Ciao!" + TURN, max_tokens=16, conversation_id="c1", prefix_hash="h")
+        self.assertEqual(wrapper.get_kv_state_stats()["persists"], 1)
+        self.assertTrue(wrapper.persist_state(timeout=2))
+        self.assertEqual(wrapper.get_kv_state_stats()["persists"], 2)
+        self.assertEqual(wrapper.kv_store.get("c1|h").tokens, wrapper._evaluated_tokens())
+
+
+
+BASE_IT = "<|im_start|>system\n" + " ".join(f"identità{i}" for i in range(40)) + " LINGUA: italiano<|im_end|>\n"
+BASE_EN = "<|im_start|>system\n" + " ".join(f"identità{i}" for i in range(40)) + " LINGUA: inglese<|im_end|>\n"
+
+
+class TestSharedBasePrefix(unittest.TestCase):
+    """Test per lo snapshot del blocco system condiviso tra le conversazioni."""
+
+    def setUp(self):
+        self.kv_dir = tempfile.mkdtemp()
+        self.vocab = {}
+
+    def _start(self):
+        wrapper = MobileGemmaWrapper(tempfile.mkdtemp(), kv_state_dir=self.kv_dir)
+        wrapper.llm = StatefulLlama(vocab=self.vocab)
+        wrapper.kv_store = KVStateStore(self.kv_dir, fingerprint="qwen.gguf|n_ctx=2048")
+        return wrapper
+
+    def _generate(self, wrapper, base, conv, request_id, hash_=None):
+        wrapper.generate(base + TURN, max_tokens=16, conversation_id=conv, prefix_hash=hash_ or base[-20:],
+                         base_prompt=base, request_id=request_id)
+        return wrapper.get_generation_meta(request_id)
+
+    def test_new_conversation_starts_from_snapshot(self):
+        """Una conversazione nuova carica lo snapshot e valuta solo il proprio suffisso"""
+        wrapper = self._start()
+        self.assertEqual(self._generate(wrapper, BASE_IT, "c1", "g1")["base_prefix"], "created")
+        self.assertEqual(self._generate(wrapper, BASE_EN, "c2", "g2")["base_prefix"], "created")
+        wrapper.llm.evaluated.clear()
+        meta = self._generate(wrapper, BASE_IT, "c3", "g3")
+        self.assertEqual(meta["base_prefix"], "hit")
+        self.assertEqual(meta["prefix_reused_tokens"], len(wrapper._prompt_tokens(BASE_IT)))
+        self.assertEqual(sum(wrapper.llm.evaluated), len(wrapper._prompt_tokens(BASE_IT + TURN)) - len(wrapper._prompt_tokens(BASE_IT)))
+        stats = wrapper.get_kv_state_stats()
+        self.assertEqual((stats["base_created"], stats["base_hits"]), (2, 1))
+
+    def test_context_with_the_block_is_warm(self):
+        wrapper = self._start()
+        self._generate(wrapper, BASE_IT, "c1", "g1")
+        self.assertEqual(self._generate(wrapper, BASE_IT, "c2", "g2")["base_prefix"], "warm")
+
+    def test_snapshot_survives_restart(self):
+        first = self._start()
+        self._generate(first, BASE_IT, "c1", "g1")
+        self.assertTrue(first.kv_store.flush(timeout=2))
+        second = self._start()
+        meta = self._generate(second, BASE_IT, "c2", "g2")
+        self.assertEqual(meta["base_prefix"], "restored")
+        self.assertEqual(meta["prefix_reused_tokens"], len(second._prompt_tokens(BASE_IT)))
+
+    def test_prompt_without_the_block_is_untouched(self):
+        wrapper = self._start()
+        wrapper.generate(BASE_EN + TURN, max_tokens=16, conversation_id="c1", base_prompt=BASE_IT, request_id="g")
+        self.assertIsNone(wrapper.get_generation_meta("g")["base_prefix"])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,139 @@
+"""Test per il job engine di condensazione della memoria."""
+
+import json
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from datetime import datetime, timedelta
+
+from allma_model.memory_system.conversational_memory import ConversationalMemory, Message
+from allma_model.memory_system.memory_condensation import CondensationJobEngine
+
+
+class TestCondensationJobEngine(unittest.TestCase):
+    """Test per CondensationJobEngine."""
+
+    def setUp(self):
+        """Setup per i test: cwd temporanea perché save_memory scrive in os.getcwd()."""
+        self.old_cwd = os.getcwd()
+        self.tmp_dir = tempfile.mkdtemp()
+        os.chdir(self.tmp_dir)
+        self.memory = ConversationalMemory(load_persistent=False)
+        self.checkpoint = os.path.join(self.tmp_dir, "condensation.json")
+        self.cutoff = datetime.now() - timedelta(days=30)
+        old = self.cutoff - timedelta(days=5)
+        for user_id, count in (("alice", 6), ("bob", 2)):
+            for i in range(count):
+                self.memory.messages.append(Message(
+                    conversation_id=f"{user_id}_conv",
+                    role="user",
+                    content=f"{user_id} messaggio numero {i} " + "x" * 80,
+                    timestamp=old + timedelta(minutes=i),
+                    metadata={},
+                    user_id=user_id,
+                ))
+        # Messaggio recente: non deve essere toccato
+        self.memory.messages.append(Message(
+            conversation_id="alice_conv", role="user", content="recente",
+            timestamp=datetime.now(), metadata={}, user_id="alice",
+        ))
+
+    def tearDown(self):
+        """Pulizia dopo ogni test."""
+        os.chdir(self.old_cwd)
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+    def _engine(self, **kwargs):
+        kwargs.setdefault("batch_token_budget", 64)
+        return CondensationJobEngine(self.memory, checkpoint_path=self.checkpoint, **kwargs)
+
+    def test_plan_respects_token_budget(self):
+        """I batch non superano il budget (salvo un singolo messaggio enorme)."""
+        engine = self._engine()
+        plan = engine.plan(self.cutoff)
+        self.assertEqual(set(plan.keys()), {"alice", "bob"})
+        for batches in plan.values():
+            for batch in batches:
+                self.assertTrue(batch.token_estimate <= 64 or len(batch.messages) == 1)
+        self.assertEqual(sum(len(b.messages) for b in plan["alice"]), 6)
+
+    def test_fair_round_robin_order(self):
+        """Gli utenti vengono serviti a turno, non uno dopo l'altro."""
+        engine = self._engine()
+        ordered = engine.fair_order(engine.plan(self.cutoff))
+        self.assertEqual(ordered[0].user_id, "alice")
+        self.assertEqual(ordered[1].user_id, "bob")
+
+        rotated = engine.fair_order(engine.plan(self.cutoff), start_after="alice")
+        self.assertEqual(rotated[0].user_id, "bob")
+
+    def test_run_condenses_all_users(self):
+        """Un run completo condensa tutti gli utenti e salva i fatti."""
+        prompts = []
+
+        def extractor(prompt):
+            prompts.append(prompt)
+            return '{"hobby": "fotografia"}'
+
+        report = self._engine().run(self.cutoff, extractor)
+
+        self.assertTrue(report.completed)
+        self.assertEqual(report.messages_removed, 8)
+        self.assertGreater(report.bytes_reclaimed, 0)
+        self.assertEqual(report.batches_processed, len(prompts))
+        self.assertEqual([m.content for m in self.memory.messages], ["recente"])
+        self.assertEqual(self.memory.user_data["bob"]["hobby"], "fotografia")
+
+        with open(self.checkpoint) as f:
+            self.assertFalse(json.load(f)["in_progress"])
+
+    def test_resume_after_interruption(self):
+        """Un run interrotto riprende dal checkpoint senza rifare i batch completati."""
+        engine = self._engine(max_batches_per_run=1)
+        first = engine.run(self.cutoff, lambda p: "{}")
+        self.assertFalse(first.completed)
+        self.assertEqual(first.stop_reason, "batch_limit")
+
+        with open(self.checkpoint) as f:
+            state = json.load(f)
+        self.assertTrue(state["in_progress"])
+        self.assertEqual(len(state["completed_batches"]), 1)
+
+        # Nuovo engine (es. dopo un riavvio) con cutoff diverso: il job riprende col cutoff salvato
+        resumed = self._engine().run(datetime.now(), lambda p: "{}")
+        self.assertTrue(resumed.resumed)
+        self.assertTrue(resumed.completed)
+        self.assertEqual(first.messages_removed + resumed.messages_removed, 8)
+        self.assertEqual([m.content for m in self.memory.messages], ["recente"])
+
+    def test_failed_batch_is_retried_then_dropped(self):
+        """Un batch con output non valido viene ritentato, poi condensato senza fatti."""
+        engine = self._engine(batch_token_budget=10_000, max_attempts=2)
+
+        first = engine.run(self.cutoff, lambda p: "non json")
+        self.assertEqual(first.batches_failed, 2)
+        self.assertEqual(first.messages_removed, 0)
+
+        second = engine.run(self.cutoff, lambda p: "non json")
+        self.assertEqual(second.messages_removed, 8)
+        self.assertTrue(second.completed)
+
+    def test_yields_to_foreground(self):
+        """Con la chat attiva il job cede il passo e si sospende oltre il limite d'attesa."""
+        busy = threading.Event()
+        busy.set()
+        engine = self._engine(foreground_event=busy, yield_poll_s=0.01, max_yield_wait_s=0.05)
+
+        report = engine.run(self.cutoff, lambda p: "{}")
+        self.assertEqual(report.stop_reason, "foreground_busy")
+        self.assertEqual(report.messages_removed, 0)
+        self.assertEqual(report.yields, 1)
+
+        busy.clear()
+        self.assertTrue(engine.run(self.cutoff, lambda p: "{}").completed)
+
+
+if __name__ == '__main__':
+    unittest.main()
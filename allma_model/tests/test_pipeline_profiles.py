@@ -0,0 +1,119 @@
+"""Test per i profili di pipeline per classe di complessità."""
+
+import time
+import unittest
+
+from allma_model.core.pipeline_profiles import (
+    DEFAULT_PROFILES,
+    PipelineProfile,
+    ProfileLatencyReport,
+    StagePolicy,
+    deferred_graph,
+    require_steps,
+    split_stages
+)
+from allma_model.core.stage_graph import Stage, StageGraph
+
+
+class TestPipelineProfiles(unittest.TestCase):
+    """Test per PipelineProfile, split_stages e deferred_graph."""
+
+    def setUp(self):
+        self.calls = []
+
+        def stage(name, value, seconds=0.0):
+            def fn(deps):
+                self.calls.append((name, dict(deps)))
+                time.sleep(seconds)
+                return value
+            return fn
+
+        self.stages = [
+            Stage('topic', stage('topic', 'music')),
+            Stage('emotion', stage('emotion', 'joy', 0.2), fallback=lambda: 'neutral'),
+            Stage('memory_gate', stage('memory_gate', ['m1'], 0.2), fallback=list),
+            Stage('store_message', stage('store_message', 'stored'),
+                  deps=('emotion', 'topic', 'memory_gate')),
+        ]
+        self.profile = PipelineProfile('SIMPLE', {
+            'emotion': StagePolicy.DEFER,
+            'memory_gate': StagePolicy.DROP,
+            'store_message': StagePolicy.DEFER,
+        })
+
+    def test_turn_graph_uses_fallbacks_without_waiting(self):
+        """Gli stadi DEFER/DROP non girano nel turno e valgono il loro fallback"""
+        current, deferred = split_stages(self.stages, self.profile)
+        run = StageGraph(current).run(None)
+        self.assertEqual(run.values, {
+            'topic': 'music', 'emotion': 'neutral', 'memory_gate': [], 'store_message': None
+        })
+        self.assertEqual([name for name, _ in self.calls], ['topic'])
+        self.assertEqual(deferred, ['emotion', 'store_message'])
+        self.assertLess(run.wall_ms, 150)
+
+    def test_deferred_graph_gets_real_values(self):
+        """Dopo la risposta i differiti girano in ordine con i valori reali"""
+        current, deferred = split_stages(self.stages, self.profile)
+        turn_values = StageGraph(current).run(None).values
+        later = deferred_graph(self.stages, deferred, turn_values)
+        run = later.run(None)
+        self.assertEqual(run.values, {'emotion': 'joy', 'store_message': 'stored'})
+        store_deps = [deps for name, deps in self.calls if name == 'store_message'][0]
+        # emotion differito → valore reale; memory_gate saltato → fallback del turno
+        self.assertEqual(store_deps, {'emotion': 'joy', 'topic': 'music', 'memory_gate': []})
+        self.assertNotIn('memory_gate', [name for name, _ in self.calls])
+
+    def test_no_deferred_stages(self):
+        current, deferred = split_stages(self.stages, DEFAULT_PROFILES['NORMAL'])
+        self.assertEqual(deferred, [])
+        self.assertEqual([s.fn for s in current], [s.fn for s in self.stages])
+        self.assertIsNone(deferred_graph(self.stages, deferred, {}))
+
+    def test_profile_from_config(self):
+        profile = PipelineProfile.from_config('SIMPLE', {'emotion': 'defer', 'pattern': 'DROP'})
+        self.assertEqual(profile.policy('emotion'), StagePolicy.DEFER)
+        self.assertEqual(profile.policy('pattern'), StagePolicy.DROP)
+        self.assertTrue(profile.runs('topic'))
+        with self.assertRaises(ValueError):
+            PipelineProfile.from_config('SIMPLE', {'emotion': 'later'})
+
+    def test_default_simple_profile_skips_heavy_stages(self):
+        simple = DEFAULT_PROFILES['SIMPLE']
+        for step in ('pattern', 'memory_gate', 'orchestrator', 'context'):
+            self.assertFalse(simple.runs(step), step)
+        for step in ('legacy_brain', 'store_message'):
+            self.assertEqual(simple.policy(step), StagePolicy.DEFER, step)
+        self.assertTrue(simple.runs('topic'))
+        # L'emozione serve alla risposta e al lavoro post-risposta
+        self.assertTrue(simple.runs('emotion'))
+
+    def test_required_steps_always_run(self):
+        profiles = require_steps({'SIMPLE': self.profile, 'NORMAL': DEFAULT_PROFILES['NORMAL']}, ('emotion',))
+        self.assertTrue(profiles['SIMPLE'].runs('emotion'))
+        self.assertEqual(profiles['SIMPLE'].policy('memory_gate'), StagePolicy.DROP)
+        self.assertIs(profiles['NORMAL'], DEFAULT_PROFILES['NORMAL'])
+        # Il profilo originale non cambia
+        self.assertEqual(self.profile.policy('emotion'), StagePolicy.DEFER)
+
+
+class TestProfileLatencyReport(unittest.TestCase):
+    """Test per ProfileLatencyReport."""
+
+    def test_percentiles_per_class(self):
+        report = ProfileLatencyReport(window=10)
+        for ms in range(1, 21):
+            report.record('SIMPLE', total_ms=ms, first_token_ms=None)
+        report.record('COMPLEX', total_ms=500.0, pre_llm_ms=40.0)
+        data = report.report()
+        self.assertEqual(data['SIMPLE']['count'], 20)
+        # finestra di 10 campioni: 11..20
+        self.assertEqual(data['SIMPLE']['total_ms_p50'], 15.0)
+        self.assertEqual(data['SIMPLE']['total_ms_p95'], 20.0)
+        self.assertNotIn('first_token_ms_p50', data['SIMPLE'])
+        self.assertEqual(data['COMPLEX']['pre_llm_ms_p50'], 40.0)
+        self.assertIn('SIMPLE(n=20', report.summary())
+
+
+if __name__ == '__main__':
+    unittest.main()
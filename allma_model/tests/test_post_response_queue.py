@@ -0,0 +1,90 @@
+"""Test per la coda del lavoro post-risposta."""
+
+import threading
+import time
+import unittest
+
+from allma_model.core.post_response_queue import PostResponseQueue
+
+
+class TestPostResponseQueue(unittest.TestCase):
+    """Test per PostResponseQueue."""
+
+    def setUp(self):
+        self.queue = PostResponseQueue(max_workers=2)
+
+    def tearDown(self):
+        self.queue.shutdown(timeout=5)
+
+    def test_fifo_per_conversation(self):
+        """I task di una conversazione girano in ordine, uno alla volta"""
+        order = []
+        running = []
+        overlaps = []
+
+        def task(i):
+            running.append(i)
+            overlaps.append(len(running))
+            time.sleep(0.005)
+            order.append(i)
+            running.remove(i)
+
+        for i in range(10):
+            self.queue.submit("c1", f"t{i}", task, i)
+        self.assertTrue(self.queue.wait_for("c1", timeout=5))
+        self.assertEqual(order, list(range(10)))
+        self.assertEqual(max(overlaps), 1)
+
+    def test_conversations_run_in_parallel(self):
+        """Conversazioni diverse non si attendono a vicenda"""
+        gate = threading.Event()
+        self.queue.submit("slow", "block", gate.wait, 5)
+        done = self.queue.submit("fast", "quick", lambda: "ok")
+        self.assertEqual(done.result(timeout=2), "ok")
+        self.assertEqual(self.queue.depth("slow"), 1)
+        self.assertFalse(self.queue.wait_for("slow", timeout=0.05))
+        gate.set()
+        self.assertTrue(self.queue.wait_for("slow", timeout=5))
+
+    def test_failure_does_not_stop_fifo(self):
+        """Un task che fallisce è contato e i successivi proseguono"""
+        def boom():
+            raise ValueError("x")
+
+        failed = self.queue.submit("c1", "boom", boom)
+        after = self.queue.submit("c1", "after", lambda: 42)
+        self.assertEqual(after.result(timeout=2), 42)
+        self.assertIsInstance(failed.exception(timeout=2), ValueError)
+        stats = self.queue.stats()
+        self.assertEqual(stats['failed'], 1)
+        self.assertEqual(stats['completed'], 2)
+        self.assertEqual(stats['depth'], 0)
+
+    def test_depth_metrics(self):
+        gate = threading.Event()
+        self.queue.submit("c1", "block", gate.wait, 5)
+        for _ in range(3):
+            self.queue.submit("c1", "noop", lambda: None)
+        self.assertEqual(self.queue.depth("c1"), 4)
+        self.assertEqual(self.queue.depth(), 4)
+        gate.set()
+        self.assertTrue(self.queue.drain(timeout=5))
+        stats = self.queue.stats()
+        self.assertEqual(stats['max_depth'], 4)
+        self.assertEqual(stats['submitted'], 4)
+        self.assertEqual(stats['depth'], 0)
+
+    def test_shutdown_drains_pending_work(self):
+        """shutdown esegue i task pendenti; dopo la chiusura i task girano nel chiamante"""
+        results = []
+        for i in range(5):
+            self.queue.submit("c1", "slow", lambda i=i: (time.sleep(0.01), results.append(i)))
+        self.assertTrue(self.queue.shutdown(timeout=5))
+        self.assertEqual(results, [0, 1, 2, 3, 4])
+
+        future = self.queue.submit("c1", "late", lambda: threading.current_thread().name)
+        self.assertEqual(future.result(timeout=1), threading.current_thread().name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,101 @@
+"""Test per PromptAssembler: sezioni con priorità entro un budget esatto di token."""
+
+import unittest
+
+from allma_model.core.prompt_assembler import PromptAssembler, PromptSection
+
+
+class WordCounter:
+    """Un token per parola; conta le chiamate per verificare la memorizzazione."""
+
+    def __init__(self):
+        self.calls = 0
+        self.cache = {}
+
+    def __call__(self, text):
+        self.calls += 1
+        if text not in self.cache:
+            self.cache[text] = len(text.split())
+        return self.cache[text]
+
+
+def words(n, tag="w"):
+    return " ".join(f"{tag}{i}" for i in range(n))
+
+
+def render(parts):
+    return " ".join(" ".join(parts[name]) for name in ("system", "history", "memory", "context", "user"))
+
+
+class TestPromptAssembler(unittest.TestCase):
+    """Test per PromptAssembler."""
+
+    def setUp(self):
+        self.counter = WordCounter()
+        self.assembler = PromptAssembler(self.counter)
+
+    def _sections(self, history=6, memory=3, context=4):
+        return [
+            PromptSection("system", [words(20, "s")], priority=100, min_tokens=20),
+            PromptSection("user", [words(10, "u")], priority=90, min_tokens=10),
+            PromptSection("history", [words(10, f"h{i}_") for i in range(history)], priority=60, drop="head"),
+            PromptSection("memory", [words(10, f"m{i}_") for i in range(memory)], priority=40, max_tokens=25),
+            PromptSection("context", [words(5, f"c{i}_") for i in range(context)], priority=30),
+        ]
+
+    def test_fits_without_cuts(self):
+        result = self.assembler.assemble(self._sections(), budget=1000, render=render)
+        self.assertTrue(result.fits)
+        self.assertEqual(result.section_tokens["history"], 60)
+        # Il massimo della sezione vale anche con budget libero: ricordi meno rilevanti fuori
+        self.assertEqual(result.section_tokens["memory"], 20)
+        self.assertEqual(result.dropped_tokens, {"memory": 10})
+        self.assertEqual(result.tokens, len(result.prompt.split()))
+
+    def test_lowest_priority_is_cut_first(self):
+        # 20 + 10 + 60 + 20 + 20 = 130 token: 20 di troppo tolgono tutto il contesto
+        result = self.assembler.assemble(self._sections(), budget=110, render=render)
+        self.assertTrue(result.fits)
+        self.assertEqual(result.sections["context"], [])
+        self.assertEqual(result.section_tokens["history"], 60)
+        # 45 di troppo: poi i ricordi, infine la cronologia perde un messaggio intero
+        result = self.assembler.assemble(self._sections(), budget=85, render=render)
+        self.assertEqual((result.section_tokens["memory"], result.section_tokens["history"]), (0, 50))
+        self.assertEqual(result.tokens, 80)
+
+    def test_history_drops_oldest_and_minimums_are_kept(self):
+        result = self.assembler.assemble(self._sections(), budget=50, render=render)
+        self.assertEqual(result.sections["history"], [words(10, "h4_"), words(10, "h5_")])
+        # System e messaggio utente restano interi anche sotto un budget impossibile
+        result = self.assembler.assemble(self._sections(), budget=10, render=render)
+        self.assertFalse(result.fits)
+        self.assertEqual((result.section_tokens["system"], result.section_tokens["user"]), (20, 10))
+        self.assertEqual(self.assembler.get_stats()["over_budget"], 1)
+
+    def test_truncate(self):
+        text = words(100)
+        self.assertLessEqual(self.counter(self.assembler.truncate(text, 30)), 30)
+        self.assertTrue(self.assembler.truncate(text, 30).startswith("w0 "))
+        self.assertTrue(self.assembler.truncate(text, 30, keep="tail").endswith(" w99"))
+        self.assertEqual(self.assembler.truncate(text, 0), "")
+
+    def test_history_window_is_stable_between_turns(self):
+        """La finestra scorre a blocchi: l'inizio della cronologia non cambia a ogni turno"""
+        messages = [words(10, f"t{i}_") for i in range(10)]
+        kept = self.assembler.window("c1", messages, max_tokens=100)
+        self.assertEqual(kept, messages)
+        messages.append(words(10, "t10_"))
+        kept = self.assembler.window("c1", messages, max_tokens=100)
+        self.assertEqual(len(kept), 7)  # sceso a 75 token
+        first = kept[0]
+        for i in range(11, 14):
+            messages.append(words(10, f"t{i}_"))
+            kept = self.assembler.window("c1", messages, max_tokens=100)
+            self.assertEqual(kept[0], first)
+        self.assertEqual(self.assembler.get_stats()["window_slides"], 1)
+        # Altra conversazione: finestra indipendente
+        self.assertEqual(self.assembler.window("c2", messages[:3], max_tokens=100), messages[:3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,210 @@
+"""Test per RequestScheduler: priorità, limiti per classe, scadenze e prelazione del lavoro di fondo."""
+
+import tempfile
+import threading
+import time
+import unittest
+
+from allma_model.llm.mobile_gemma_wrapper import MobileGemmaWrapper
+from allma_model.llm.request_scheduler import Priority, RequestScheduler, generate_with_priority
+from allma_model.tests.fakes import FakeLlama
+from allma_model.utils.cancellation import CancellationToken
+
+
+class TestRequestScheduler(unittest.TestCase):
+    """Test per RequestScheduler."""
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.scheduler = RequestScheduler(self.lock)
+
+    def _waiter(self, priority, order, **kwargs):
+        def run():
+            ticket = self.scheduler.acquire(priority, **kwargs)
+            order.append((priority, ticket.status))
+            if ticket.granted:
+                self.scheduler.release(ticket)
+        thread = threading.Thread(target=run)
+        thread.start()
+        time.sleep(0.05)
+        return thread
+
+    def test_higher_priority_goes_first(self):
+        ticket = self.scheduler.acquire(Priority.INTERACTIVE)
+        order = []
+        threads = [self._waiter(p, order) for p in (Priority.IDLE, Priority.BACKGROUND, Priority.FOREGROUND)]
+        self.assertEqual(self.scheduler.get_stats()["waiting"], 3)
+        self.scheduler.release(ticket)
+        for thread in threads:
+            thread.join(2)
+        self.assertEqual([p for p, _ in order], [Priority.FOREGROUND, Priority.BACKGROUND, Priority.IDLE])
+        stats = self.scheduler.get_stats()
+        self.assertEqual(stats["idle"]["completed"], 1)
+        self.assertGreater(stats["idle"]["queue_wait_p50_ms"], stats["foreground"]["queue_wait_p50_ms"])
+
+    def test_class_limit_and_deadline_admission(self):
+        scheduler = RequestScheduler(self.lock, limits={Priority.IDLE: 1})
+        self.scheduler = scheduler
+        ticket = scheduler.acquire(Priority.FOREGROUND)
+        order = []
+        thread = self._waiter(Priority.IDLE, order)
+        rejected = scheduler.acquire(Priority.IDLE)
+        self.assertEqual((rejected.status, rejected.reason), ("rejected", "class_limit"))
+        # Lavoro in corso stimato in 2 s: una scadenza a 0.1 s non è raggiungibile
+        late = scheduler.acquire(Priority.INTERACTIVE, deadline=time.monotonic() + 0.1)
+        self.assertEqual((late.status, late.reason), ("rejected", "deadline"))
+        scheduler.release(ticket)
+        thread.join(2)
+        self.assertEqual(order, [(Priority.IDLE, "granted")])
+        self.assertEqual(scheduler.get_stats()["idle"]["rejected"], 1)
+
+    def test_cancel_and_timeout_while_waiting(self):
+        ticket = self.scheduler.acquire(Priority.INTERACTIVE)
+        token = CancellationToken()
+        order = []
+        thread = self._waiter(Priority.BACKGROUND, order, cancel_token=token)
+        token.cancel("superseded")
+        thread.join(2)
+        self.assertEqual(order, [(Priority.BACKGROUND, "cancelled")])
+        self.assertEqual(self.scheduler.acquire(Priority.FOREGROUND, timeout=0.05).status, "timeout")
+        self.assertEqual(self.scheduler.get_stats()["waiting"], 0)
+        self.scheduler.release(ticket)
+        self.assertFalse(self.lock.locked())
+
+    def test_foreground_preempts_background(self):
+        parent = CancellationToken()
+        background = self.scheduler.acquire(Priority.BACKGROUND, cancel_token=parent)
+        self.assertIsNot(background.token, parent)
+        order = []
+        thread = self._waiter(Priority.FOREGROUND, order)
+        # La prelazione annulla il token del lavoro, non quello del chiamante
+        self.assertTrue(background.preempted)
+        self.assertFalse(parent.cancelled)
+        self.scheduler.release(background)
+        thread.join(2)
+        self.assertEqual(order, [(Priority.FOREGROUND, "granted")])
+        self.assertEqual(background.status, "preempted")
+        self.assertEqual(self.scheduler.get_stats()["background"]["preempted"], 1)
+
+    def test_non_preemptible_keeps_running(self):
+        ticket = self.scheduler.acquire(Priority.IDLE, preemptible=False)
+        order = []
+        thread = self._waiter(Priority.FOREGROUND, order)
+        self.assertIsNone(ticket.token)
+        self.scheduler.release(ticket)
+        thread.join(2)
+        self.assertEqual(order, [(Priority.FOREGROUND, "granted")])
+
+
+class TestGenerateWithPriority(unittest.TestCase):
+    """Test per generate_with_priority con LLM con e senza scheduler."""
+
+    def test_priority_passed_only_when_accepted(self):
+        class Scheduled:
+            def generate(self, prompt, max_tokens=8, priority=Priority.INTERACTIVE):
+                return (prompt, max_tokens, priority)
+
+        class Plain:
+            def generate(self, prompt, max_tokens=8):
+                return (prompt, max_tokens)
+
+        self.assertEqual(generate_with_priority(Scheduled(), "p", Priority.IDLE, max_tokens=4), ("p", 4, Priority.IDLE))
+        self.assertEqual(generate_with_priority(Plain(), "p", Priority.IDLE, max_tokens=4), ("p", 4))
+
+    def test_type_error_inside_generate_is_not_retried(self):
+        calls = []
+
+        class Failing:
+            def generate(self, prompt, **kwargs):
+                calls.append(kwargs)
+                raise TypeError("errore nel modello")
+
+        with self.assertRaises(TypeError):
+            generate_with_priority(Failing(), "p", Priority.BACKGROUND)
+        self.assertEqual(calls, [{"priority": Priority.BACKGROUND}])
+
+
+class TestWrapperScheduling(unittest.TestCase):
+    """Test per le priorità in MobileGemmaWrapper.generate."""
+
+    def setUp(self):
+        self.wrapper = MobileGemmaWrapper(tempfile.mkdtemp())
+        # Generazione lenta: un token ogni 10 ms, parole numerate
+        self.llm = FakeLlama(reply=[f" w{i}" for i in range(60)], token_s=0.01)
+        self.wrapper.llm = self.llm
+
+    def test_chat_preempts_dream_which_resumes(self):
+        result = {}
+
+        def dream():
+            tokens = []
+            result["text"] = self.wrapper.generate("sogno", max_tokens=40, callback=tokens.append,
+                                                   request_id="dream", priority=Priority.IDLE)
+            result["tokens"] = tokens
+
+        thread = threading.Thread(target=dream)
+        thread.start()
+        time.sleep(0.1)
+        self.wrapper.generate("chat", max_tokens=5, request_id="chat", priority=Priority.FOREGROUND)
+        chat_meta = self.wrapper.get_generation_meta("chat")
+        thread.join(5)
+
+        # La chat attende al più un token del sogno, non i suoi 40
+        self.assertLess(chat_meta["lock_wait_ms"], 200)
+        dream_meta = self.wrapper.get_generation_meta("dream")
+        self.assertEqual(dream_meta["preemptions"], 1)
+        # Il sogno riprende dal testo già generato e completa i token richiesti
+        partial = len(result["tokens"]) - dream_meta["completion_tokens"]
+        self.assertGreater(partial, 0)
+        self.assertEqual(len(result["tokens"]), 40)
+        self.assertEqual(len(result["text"].split()), 40)
+        # Il callback ha ricevuto ogni token una volta sola, anche dopo la ripresa
+        self.assertEqual("".join(result["tokens"]).strip(), result["text"])
+        self.assertEqual(self.llm.prompts[-1][-partial:],
+                         self.llm.tokenize("".join(result["tokens"][:partial]).encode("utf-8"))[-partial:])
+        stats = self.wrapper.get_scheduler_stats()
+        self.assertEqual((stats["idle"]["preempted"], stats["idle"]["completed"]), (1, 1))
+        self.assertFalse(self.wrapper.inference_lock.locked())
+
+    def test_streamed_grammar_request_is_not_preempted(self):
+        result = {}
+
+        def structured():
+            tokens = []
+            result["text"] = self.wrapper.generate("json", max_tokens=40, callback=tokens.append, grammar=object(),
+                                                   request_id="json", priority=Priority.BACKGROUND)
+            result["tokens"] = tokens
+
+        thread = threading.Thread(target=structured)
+        thread.start()
+        time.sleep(0.1)
+        self.wrapper.generate("chat", max_tokens=5, request_id="chat", priority=Priority.FOREGROUND)
+        thread.join(5)
+
+        # Ripartire da capo ripeterebbe al callback i token già inviati: la chat attende
+        self.assertNotIn("preemptions", self.wrapper.get_generation_meta("json"))
+        self.assertEqual(len(result["tokens"]), 40)
+        self.assertEqual("".join(result["tokens"]).strip(), result["text"])
+        self.assertEqual(self.wrapper.get_scheduler_stats()["background"]["preempted"], 0)
+
+    def test_user_cancel_is_not_resumed(self):
+        token = CancellationToken()
+        threading.Timer(0.05, token.cancel, args=("user_stop",)).start()
+        self.wrapper.generate("sogno", max_tokens=40, callback=lambda t: None, request_id="d",
+                              priority=Priority.IDLE, cancel_token=token)
+        meta = self.wrapper.get_generation_meta("d")
+        self.assertEqual((meta["finish_reason"], meta["cancel_reason"]), ("cancelled", "user_stop"))
+        self.assertNotIn("preemptions", meta)
+
+    def test_rejected_past_deadline(self):
+        with self.wrapper.inference_lock:
+            text = self.wrapper.generate("x", max_tokens=4, request_id="late", priority=Priority.BACKGROUND,
+                                         deadline_s=0.05)
+        self.assertEqual(text, "")
+        meta = self.wrapper.get_generation_meta("late")
+        self.assertEqual(meta["finish_reason"], "rejected")
+        self.assertIn(meta["rejected_reason"], ("deadline", "expired"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -49,8 +49,10 @@ class TestSevenSystemsIntegration(unittest.TestCase):
         
     def tearDown(self):
         """Cleanup dopo i test"""
-        if os.path.exists(self.test_db):
-            os.remove(self.test_db)
+        self.core.memory_system.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.test_db + suffix):
+                os.remove(self.test_db + suffix)
             
     def test_full_interaction_flow(self):
         """Test del flusso completo di interazione attraverso tutti i sistemi"""
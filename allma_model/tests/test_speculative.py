@@ -0,0 +1,174 @@
+"""Test per la decodifica speculativa: accettazione della bozza, guadagno di token/s e ripiego senza bozza."""
+
+import tempfile
+import time
+import unittest
+
+from allma_model.llm.mobile_gemma_wrapper import MobileGemmaWrapper
+from allma_model.llm.speculative import SPECULATIVE_AVAILABLE, DraftModel, SpeculativeDecoder, TrackedDraft
+
+
+def lookup_draft(input_ids, num_pred_tokens=2):
+    """Bozza n-gramma minima: ciò che seguiva l'ultima occorrenza dell'ultimo token."""
+    ids = [int(t) for t in input_ids]
+    last = ids[-1]
+    for i in range(len(ids) - 2, -1, -1):
+        if ids[i] == last:
+            return ids[i + 1:i + 1 + num_pred_tokens]
+    return []
+
+
+class SpeculativeLlama:
+    """
+    Verifica a blocchi come llama.cpp: ogni passaggio (pass_s) accetta il prefisso
+    della bozza che coincide con la risposta e aggiunge un token campionato.
+    """
+
+    def __init__(self, reply, pass_s=0.004):
+        self.reply = list(reply)
+        self.pass_s = pass_s
+        self.draft_model = None
+        self.passes = 0
+
+    def n_vocab(self):
+        return 1000
+
+    def tokenize(self, data, add_bos=True, special=False):
+        return [int(w) for w in data.decode("utf-8").split()]
+
+    def __call__(self, prompt, stream=False, max_tokens=16, **kwargs):
+        ids = list(prompt)
+        target = self.reply[:max_tokens] if max_tokens != -1 else self.reply
+
+        def chunks():
+            pos, draft = 0, []
+            while pos < len(target):
+                time.sleep(self.pass_s)
+                self.passes += 1
+                accepted = 0
+                while accepted < len(draft) and pos + accepted < len(target) and draft[accepted] == target[pos + accepted]:
+                    accepted += 1
+                emitted = target[pos:pos + accepted + 1]
+                pos += len(emitted)
+                for token in emitted:
+                    yield {'choices': [{'text': f" {token}", 'finish_reason': None}]}
+                draft = [int(t) for t in self.draft_model(ids + target[:pos])] if self.draft_model is not None else []
+        if stream:
+            return chunks()
+        text = "".join(chunk['choices'][0]['text'] for chunk in chunks())
+        return {'choices': [{'text': text, 'finish_reason': 'stop'}], 'usage': {'completion_tokens': len(target)}}
+
+
+class TestTrackedDraft(unittest.TestCase):
+    """Test per il conteggio dei token proposti e accettati."""
+
+    def test_acceptance_is_common_prefix_with_next_context(self):
+        tracked = TrackedDraft(lambda ids: [7, 8, 9])
+        tracked([1, 2, 3])
+        tracked([1, 2, 3, 7, 8, 5])   # 7 e 8 accettati, 5 campionato al posto di 9
+        tracked([1, 2, 3, 7, 8, 5, 4])  # nessuno accettato
+        self.assertEqual((tracked.calls, tracked.drafted, tracked.accepted), (3, 6, 2))
+        tracked.reset()
+        self.assertEqual((tracked.drafted, tracked.accepted), (0, 0))
+
+    def test_empty_proposal_is_not_counted(self):
+        tracked = TrackedDraft(lambda ids: [])
+        tracked([1])
+        tracked([1, 2])
+        self.assertEqual((tracked.calls, tracked.drafted), (2, 0))
+
+
+class FakeDraftLlama:
+    """Modello bozza: continua la sequenza 1, 2, 3, ..."""
+
+    def __init__(self, n_vocab=1000, **kwargs):
+        self._n_vocab = n_vocab
+        self.kwargs = kwargs
+
+    def n_vocab(self):
+        return self._n_vocab
+
+    def generate(self, tokens, **kwargs):
+        token = tokens[-1]
+        while True:
+            token += 1
+            yield token
+
+
+class TestSpeculativeDecoder(unittest.TestCase):
+    """Test per la scelta della bozza e le metriche per richiesta."""
+
+    def setUp(self):
+        self.models_dir = tempfile.mkdtemp()
+        self.draft_path = f"{self.models_dir}/draft.gguf"
+        open(self.draft_path, "wb").close()
+        self.main = SpeculativeLlama(range(10))
+
+    def test_draft_model_with_same_vocab(self):
+        decoder = SpeculativeDecoder.create(self.main, self.draft_path, loader=FakeDraftLlama)
+        self.assertEqual(decoder.mode, "draft_model")
+        self.assertEqual([int(t) for t in decoder.draft.draft([3, 4])], [5, 6, 7, 8])
+
+    def test_falls_back_without_usable_draft(self):
+        expected = "prompt_lookup" if SPECULATIVE_AVAILABLE else None
+        mismatched = lambda **kw: FakeDraftLlama(n_vocab=32000, **kw)
+        for path, loader in ((self.draft_path, mismatched), (f"{self.models_dir}/missing.gguf", None), (None, None)):
+            decoder = SpeculativeDecoder.create(self.main, path, loader=loader)
+            self.assertEqual(decoder.mode if decoder else None, expected)
+
+    def test_draft_model_generates_greedy_proposals(self):
+        draft = DraftModel(FakeDraftLlama(), num_pred_tokens=3)
+        self.assertEqual([int(t) for t in draft([10, 11])], [12, 13, 14])
+
+
+class TestWrapperSpeculative(unittest.TestCase):
+    """Test per la decodifica speculativa in MobileGemmaWrapper.generate."""
+
+    def setUp(self):
+        self.wrapper = MobileGemmaWrapper(tempfile.mkdtemp())
+        # Risposta che ripete una frase del prompt: la bozza n-gramma la indovina
+        phrase = [101, 102, 103, 104, 105, 106]
+        self.llm = SpeculativeLlama(phrase * 4, pass_s=0.005)
+        self.wrapper.llm = self.llm
+        self.decoder = SpeculativeDecoder(lookup_draft, "prompt_lookup")
+        self.decoder.BASELINE_EVERY = 2
+        self.wrapper.speculative_decoder = self.decoder
+        self.prompt = "1 " + " ".join(str(t) for t in phrase) + " 2 101"
+
+    def _generate(self):
+        self.wrapper.generate(self.prompt, max_tokens=-1, callback=lambda t: None)
+        return self.wrapper.last_generation
+
+    def test_acceptance_and_speedup_per_request(self):
+        first = self._generate()
+        self.assertEqual(first["speculative"], "prompt_lookup")
+        self.assertGreater(first["spec_acceptance"], 0.5)
+        self.assertIsNone(first["spec_speedup"])  # nessun riferimento ancora
+        # I token accettati non costano passaggi del modello principale
+        self.assertLess(self.llm.passes, first["completion_tokens"] - first["spec_accepted"] + 2)
+        self.assertLess(self.llm.passes, first["completion_tokens"] // 2)
+
+        passes = self.llm.passes
+        baseline = self._generate()
+        self.assertIsNone(baseline["speculative"])
+        self.assertIsNone(self.llm.draft_model)
+        self.assertEqual(self.llm.passes - passes, 24)
+
+        third = self._generate()
+        self.assertEqual(third["completion_tokens"], 24)
+        self.assertGreater(third["spec_speedup"], 1.3)
+        stats = self.wrapper.get_speculative_stats()
+        self.assertEqual((stats["requests"], stats["baseline_requests"]), (2, 1))
+        self.assertGreater(stats["speedup"], 1.3)
+        self.assertEqual(stats["acceptance_rate"], round(stats["accepted"] / stats["drafted"], 3))
+
+    def test_no_decoder_generates_as_before(self):
+        self.wrapper.speculative_decoder = None
+        meta = self._generate()
+        self.assertNotIn("speculative", meta)
+        self.assertEqual(self.wrapper.get_speculative_stats(), {"mode": None})
+        self.assertEqual(self.llm.passes, 24)
+
+
+if __name__ == '__main__':
+    unittest.main()
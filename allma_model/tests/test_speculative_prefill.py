@@ -0,0 +1,92 @@
+"""Test per il prefill speculativo del prefisso stabile del prompt."""
+
+import tempfile
+import threading
+import unittest
+
+from allma_model.llm.mobile_gemma_wrapper import MobileGemmaWrapper
+from allma_model.tests.fakes import FakeLlama
+
+SYSTEM = "<|im_start|>system\nSei ALLMA.<|im_end|>\n"
+HISTORY = "<|im_start|>user\nciao<|im_end|>\n<|im_start|>assistant\nciao a te<|im_end|>\n"
+TAIL = "<|im_start|>user\nCONTEXT:\numore sereno\n\ncome va?<|im_end|>\n<|im_start|>assistant\n"
+
+
+class TestSpeculativePrefill(unittest.TestCase):
+    """Test per MobileGemmaWrapper.prefill e le metriche di riuso."""
+
+    def setUp(self):
+        self.wrapper = MobileGemmaWrapper(tempfile.mkdtemp())
+        self.llm = FakeLlama(eval_s=0.001)
+        self.wrapper.llm = self.llm
+
+    def test_prefill_is_reused_by_generation(self):
+        """La generazione valuta solo la coda dopo il prefisso già valutato"""
+        result = self.wrapper.prefill(SYSTEM + HISTORY, conversation_id="c1")
+        self.assertEqual(result['status'], 'evaluated')
+        self.assertEqual(result['evaluated_tokens'], result['tokens'])
+
+        self.wrapper.generate(SYSTEM + HISTORY + TAIL, max_tokens=16, conversation_id="c1", request_id="g1")
+        meta = self.wrapper.get_generation_meta("g1")
+        self.assertTrue(meta['prefill_hit'])
+        self.assertEqual(meta['prefix_reused_tokens'], result['tokens'])
+        self.assertGreater(meta['prefill_saved_ms'], 0.0)
+        self.assertEqual(self.llm.evaluated[-1], len(self.llm.tokenize(TAIL.encode())))
+
+        stats = self.wrapper.get_prefill_stats()
+        self.assertEqual((stats['hits'], stats['misses'], stats['hit_rate']), (1, 0, 1.0))
+
+    def test_prefill_extends_previous_context(self):
+        """Il prefill valuta solo i token nuovi rispetto al contesto del turno precedente"""
+        self.wrapper.generate(SYSTEM + TAIL, max_tokens=16, conversation_id="c1")
+        result = self.wrapper.prefill(SYSTEM + HISTORY, conversation_id="c1")
+        self.assertEqual(result['status'], 'evaluated')
+        common = MobileGemmaWrapper._common_prefix_len(
+            self.llm.tokenize((SYSTEM + TAIL).encode()), self.llm.tokenize((SYSTEM + HISTORY).encode())
+        )
+        self.assertGreaterEqual(common, len(self.llm.tokenize(SYSTEM.encode())))
+        self.assertEqual(result['evaluated_tokens'], result['tokens'] - common)
+
+        warm = self.wrapper.prefill(SYSTEM + HISTORY, conversation_id="c1")
+        self.assertEqual((warm['status'], warm['evaluated_tokens']), ('warm', 0))
+
+    def test_diverging_prompt_is_a_miss(self):
+        self.wrapper.prefill(SYSTEM + HISTORY, conversation_id="c1")
+        self.wrapper.generate(SYSTEM + TAIL, max_tokens=16, conversation_id="c1", request_id="g1")
+        meta = self.wrapper.get_generation_meta("g1")
+        self.assertFalse(meta['prefill_hit'])
+        self.assertEqual(meta['prefill_saved_ms'], 0.0)
+        self.assertEqual(self.wrapper.get_prefill_stats()['misses'], 1)
+
+    def test_other_conversation_is_not_judged(self):
+        """Un prefill di un'altra conversazione non conta come hit né come miss"""
+        self.wrapper.prefill(SYSTEM + HISTORY, conversation_id="c1")
+        self.wrapper.generate(SYSTEM + HISTORY + TAIL, max_tokens=16, conversation_id="c2", request_id="g2")
+        self.assertIsNone(self.wrapper.get_generation_meta("g2")['prefill_hit'])
+        self.assertIsNone(self.wrapper.get_prefill_stats()['hit_rate'])
+
+    def test_busy_model_skips_prefill(self):
+        """Con il modello occupato il prefill non attende oltre il timeout"""
+        held = threading.Event()
+        release = threading.Event()
+
+        def hold_lock():
+            with self.wrapper.inference_lock:
+                held.set()
+                release.wait(2)
+
+        worker = threading.Thread(target=hold_lock)
+        worker.start()
+        held.wait(2)
+        try:
+            result = self.wrapper.prefill(SYSTEM + HISTORY, conversation_id="c1", lock_timeout=0.01)
+        finally:
+            release.set()
+            worker.join(2)
+        self.assertEqual(result['status'], 'busy')
+        self.assertEqual(self.llm.evaluated, [])
+        self.assertEqual(self.wrapper.get_prefill_stats()['busy'], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
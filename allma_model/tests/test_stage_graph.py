@@ -0,0 +1,179 @@
+"""Test per l'esecutore a DAG degli stadi pre-LLM."""
+
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from allma_model.core.stage_graph import Stage, StageGraph
+from allma_model.utils.cancellation import CancellationToken, OperationCancelledError
+from allma_model.utils.tracing import Tracer
+
+
+class TestStageGraph(unittest.TestCase):
+    """Test per StageGraph."""
+
+    def setUp(self):
+        self.pool = ThreadPoolExecutor(max_workers=4)
+
+    def tearDown(self):
+        self.pool.shutdown(wait=True)
+
+    @staticmethod
+    def sleeper(value, seconds):
+        def fn(deps):
+            time.sleep(seconds)
+            return value
+        return fn
+
+    def test_independent_stages_run_concurrently(self):
+        """Il tempo reale segue il cammino critico, non la somma"""
+        graph = StageGraph([
+            Stage('a', self.sleeper('A', 0.2)),
+            Stage('b', self.sleeper('B', 0.2)),
+            Stage('c', self.sleeper('C', 0.2)),
+        ])
+        run = graph.run(self.pool)
+        self.assertEqual(run.values, {'a': 'A', 'b': 'B', 'c': 'C'})
+        self.assertLess(run.wall_ms, 450)
+        self.assertGreater(run.serial_ms, 550)
+
+    def test_dependencies_receive_values(self):
+        """Uno stadio parte dopo le dipendenze e ne riceve i valori"""
+        order = []
+        lock = threading.Lock()
+
+        def record(name, fn):
+            def wrapped(deps):
+                value = fn(deps)
+                with lock:
+                    order.append(name)
+                return value
+            return wrapped
+
+        graph = StageGraph([
+            Stage('sum', record('sum', lambda d: d['x'] + d['y']), deps=('x', 'y')),
+            Stage('x', record('x', self.sleeper(2, 0.05))),
+            Stage('y', record('y', lambda d: 3)),
+        ])
+        run = graph.run(self.pool)
+        self.assertEqual(run.values['sum'], 5)
+        self.assertEqual(order[-1], 'sum')
+        self.assertEqual(run.critical_path, ['x', 'sum'])
+
+    def test_timeout_uses_fallback(self):
+        """Uno stadio lento prende il fallback e i dipendenti proseguono"""
+        graph = StageGraph([
+            Stage('slow', self.sleeper('late', 1.0), timeout_s=0.1, fallback=lambda: 'fallback'),
+            Stage('next', lambda d: d['slow'] + '!', deps=('slow',)),
+        ])
+        start = time.perf_counter()
+        run = graph.run(self.pool)
+        self.assertLess(time.perf_counter() - start, 0.8)
+        self.assertEqual(run.outcomes['slow'].status, 'timeout')
+        self.assertEqual(run.values['next'], 'fallback!')
+        self.assertEqual(run.degraded, ['slow'])
+
+    def test_error_uses_fallback(self):
+        """Un'eccezione non interrompe il grafo"""
+        def boom(deps):
+            raise RuntimeError("boom")
+
+        graph = StageGraph([
+            Stage('bad', boom, fallback=list),
+            Stage('good', lambda d: len(d['bad']), deps=('bad',)),
+        ])
+        for executor in (self.pool, None):
+            run = graph.run(executor)
+            self.assertEqual(run.outcomes['bad'].status, 'error')
+            self.assertIn('boom', run.outcomes['bad'].error)
+            self.assertEqual(run.values['good'], 0)
+
+    def test_required_stage_raises(self):
+        """Errore o timeout di uno stadio required interrompono il run"""
+        def boom(deps):
+            raise RuntimeError("scrittura fallita")
+
+        graph = StageGraph([
+            Stage('store', boom, required=True, fallback=lambda: 'fallback'),
+            Stage('after', lambda d: d['store'], deps=('store',)),
+        ])
+        for executor in (self.pool, None):
+            with self.assertRaisesRegex(RuntimeError, "scrittura fallita"):
+                graph.run(executor)
+
+        slow = StageGraph([Stage('store', self.sleeper('late', 1.0), timeout_s=0.05, required=True)])
+        start = time.perf_counter()
+        with self.assertRaises(TimeoutError):
+            slow.run(self.pool)
+        self.assertLess(time.perf_counter() - start, 0.8)
+
+    def test_fallback_factory_not_shared(self):
+        """Il fallback è una factory: ogni run riceve un oggetto nuovo"""
+        def boom(deps):
+            raise ValueError()
+
+        graph = StageGraph([Stage('info', boom, fallback=dict)])
+        first = graph.run(None).values['info']
+        first['pattern'] = 1
+        self.assertEqual(graph.run(None).values['info'], {})
+
+    def test_invalid_graphs(self):
+        """Nomi duplicati, dipendenze inesistenti e cicli sono rifiutati"""
+        with self.assertRaises(ValueError):
+            StageGraph([Stage('a', lambda d: 1), Stage('a', lambda d: 2)])
+        with self.assertRaises(ValueError):
+            StageGraph([Stage('a', lambda d: 1, deps=('missing',))])
+        with self.assertRaises(ValueError):
+            StageGraph([Stage('a', lambda d: 1, deps=('b',)), Stage('b', lambda d: 1, deps=('a',))])
+
+    def test_shutdown_pool_runs_inline(self):
+        """Con il pool chiuso gli stadi girano nel thread chiamante"""
+        self.pool.shutdown(wait=True)
+        graph = StageGraph([Stage('a', lambda d: 1), Stage('b', lambda d: d['a'] + 1, deps=('a',))])
+        run = graph.run(self.pool)
+        self.assertEqual(run.values, {'a': 1, 'b': 2})
+        self.assertIn('critical=a>b', run.summary())
+
+    def test_stages_inherit_caller_context(self):
+        """Gli span aperti negli stadi sono figli dello span del chiamante"""
+        tracer = Tracer(log_summary=False)
+
+        def traced(deps):
+            with tracer.span('stage.a'):
+                return 1
+
+        with tracer.span('pre_llm') as parent:
+            StageGraph([Stage('a', traced)]).run(self.pool)
+        spans = {s.name: s for s in tracer.last_trace().spans}
+        self.assertEqual(spans['stage.a'].parent_id, parent.span_id)
+
+    def test_cancel_stops_waiting_and_scheduling(self):
+        """All'annullamento run() non attende lo stadio lento e non avvia i dipendenti"""
+        token = CancellationToken()
+        started = []
+
+        def slow(deps):
+            started.append('slow')
+            time.sleep(0.5)
+
+        graph = StageGraph([
+            Stage('slow', slow),
+            Stage('after', lambda d: started.append('after'), deps=('slow',)),
+        ])
+        threading.Timer(0.05, token.cancel, args=("superseded",)).start()
+        t0 = time.perf_counter()
+        with self.assertRaises(OperationCancelledError):
+            graph.run(self.pool, cancel_token=token)
+        self.assertLess(time.perf_counter() - t0, 0.3)
+        time.sleep(0.5)
+        self.assertEqual(started, ['slow'])
+
+        inline = StageGraph([Stage('a', lambda d: started.append('inline'))])
+        with self.assertRaises(OperationCancelledError):
+            inline.run(None, cancel_token=token)
+        self.assertNotIn('inline', started)
+
+
+if __name__ == '__main__':
+    unittest.main()
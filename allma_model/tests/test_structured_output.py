@@ -0,0 +1,139 @@
+"""Test per l'output JSON vincolato: budget dallo schema, ripiego senza grammatica e metriche per tipo di chiamata."""
+
+import json
+import tempfile
+import unittest
+
+from allma_model.emotional_system.emotional_core import EMOTION_SCHEMA, EmotionalCore
+from allma_model.llm.mobile_gemma_wrapper import MobileGemmaWrapper
+from allma_model.llm.structured_output import (
+    StructuredOutput,
+    extract_json,
+    max_json_chars,
+    schema_max_tokens,
+    validate,
+)
+from allma_model.tests.fakes import FakeLlama
+
+
+class FakeGrammar:
+    def __init__(self, schema_json):
+        self.schema = json.loads(schema_json)
+
+
+class JsonLlama(FakeLlama):
+    """Con grammatica risponde solo col JSON; senza, con ragionamento e blocco ```json."""
+
+    def __init__(self, answer):
+        super().__init__()
+        self.answer = json.dumps(answer)
+        self.calls = []
+
+    def __call__(self, prompt, max_tokens=16, grammar=None, **kwargs):
+        self.calls.append({"max_tokens": max_tokens, "grammar": grammar})
+        if grammar is not None:
+            self.reply = self.answer
+        else:
+            self.reply = "<think>L'utente sembra felice, quindi</think> Ecco il JSON:\n```json\n" + self.answer + "\n```"
+        return super().__call__(prompt, max_tokens=max_tokens, **kwargs)
+
+
+class TestSchemaHelpers(unittest.TestCase):
+    """Test per budget, lettura e validazione."""
+
+    def test_budget_covers_longest_answer(self):
+        longest = json.dumps({"e": "surprise", "c": 0.95, "i": 0.95})
+        self.assertLessEqual(len(longest), max_json_chars(EMOTION_SCHEMA))
+        self.assertLess(schema_max_tokens(EMOTION_SCHEMA), 64)
+        lists = {"type": "array", "items": {"type": "string", "maxLength": 10}, "maxItems": 2}
+        self.assertEqual(max_json_chars(lists), 2 + 2 * 14)
+
+    def test_extract_json(self):
+        self.assertEqual(extract_json('<think>x</think>```json\n{"a": 1}\n```'), {"a": 1})
+        self.assertEqual(extract_json('Risposta: {"a": [1, 2]} fine'), {"a": [1, 2]})
+        with self.assertRaises(ValueError):
+            extract_json("nessun json qui")
+
+    def test_validate(self):
+        self.assertTrue(validate({"e": "joy", "c": 0.9, "i": 0.5}, EMOTION_SCHEMA))
+        self.assertFalse(validate({"e": "boredom", "c": 0.9, "i": 0.5}, EMOTION_SCHEMA))
+        self.assertFalse(validate({"e": "joy", "c": 0.9}, EMOTION_SCHEMA))
+        self.assertFalse(validate({"e": "joy", "c": True, "i": 0.5}, EMOTION_SCHEMA))
+        self.assertFalse(validate({"e": "joy", "c": 0.9, "i": 0.5, "x": 1}, EMOTION_SCHEMA))
+        facts = {"type": "object", "additionalProperties": {"type": "string"}}
+        self.assertTrue(validate({"hobby": "foto"}, facts))
+        self.assertFalse(validate({"hobby": 3}, facts))
+
+    def test_grammar_is_built_once_per_schema(self):
+        built = []
+        structured = StructuredOutput(lambda schema: built.append(schema) or FakeGrammar(schema))
+        first = structured.grammar(EMOTION_SCHEMA)
+        self.assertIs(structured.grammar(dict(EMOTION_SCHEMA)), first)
+        self.assertEqual(len(built), 1)
+        self.assertIsNone(StructuredOutput(lambda schema: 1 / 0).grammar(EMOTION_SCHEMA))
+
+
+class TestWrapperStructured(unittest.TestCase):
+    """Test per MobileGemmaWrapper.generate_structured."""
+
+    def setUp(self):
+        self.wrapper = MobileGemmaWrapper(tempfile.mkdtemp())
+        self.llm = JsonLlama({"e": "joy", "c": 0.9, "i": 0.6})
+        self.wrapper.llm = self.llm
+        self.wrapper.structured = StructuredOutput(FakeGrammar)
+        self.wrapper.structured.BASELINE_EVERY = 2
+
+    def test_constrained_call_uses_schema_budget_and_grammar(self):
+        data = self.wrapper.generate_structured("p", EMOTION_SCHEMA, call_type="emotion", unconstrained_max_tokens=64)
+        self.assertEqual(data, {"e": "joy", "c": 0.9, "i": 0.6})
+        call = self.llm.calls[-1]
+        self.assertEqual(call["max_tokens"], schema_max_tokens(EMOTION_SCHEMA))
+        self.assertEqual(call["grammar"].schema, EMOTION_SCHEMA)
+
+    def test_baseline_call_and_savings_report(self):
+        for _ in range(4):
+            self.assertIsNotNone(self.wrapper.generate_structured("p", EMOTION_SCHEMA, call_type="emotion",
+                                                                  unconstrained_max_tokens=64))
+        # Una chiamata su BASELINE_EVERY senza grammatica, col budget storico
+        self.assertEqual([c["grammar"] is None for c in self.llm.calls], [False, True, False, True])
+        self.assertEqual(self.llm.calls[1]["max_tokens"], 64)
+        report = self.wrapper.get_structured_stats()["emotion"]
+        self.assertEqual((report["constrained"]["calls"], report["unconstrained"]["calls"]), (2, 2))
+        self.assertGreater(report["tokens_saved_per_call"], 0)
+        self.assertIn("ms_saved_per_call", report)
+
+    def test_invalid_output_returns_none(self):
+        self.llm.answer = json.dumps({"e": "boredom", "c": 0.9, "i": 0.6})
+        self.assertIsNone(self.wrapper.generate_structured("p", EMOTION_SCHEMA, call_type="emotion"))
+        self.assertEqual(self.wrapper.get_structured_stats()["emotion"]["constrained"]["failure_rate"], 1.0)
+
+    def test_without_grammar_support_output_is_parsed(self):
+        self.wrapper.structured.grammar_factory = None  # llama_cpp senza LlamaGrammar
+        data = self.wrapper.generate_structured("p", EMOTION_SCHEMA, call_type="emotion", unconstrained_max_tokens=64)
+        self.assertEqual(data["e"], "joy")
+        self.assertIsNone(self.llm.calls[-1]["grammar"])
+
+
+class TestEmotionStructured(unittest.TestCase):
+    """Test per detect_emotion con output vincolato."""
+
+    def test_state_from_structured_output(self):
+        class Client:
+            def __init__(self, answer):
+                self.answer = answer
+                self.calls = []
+
+            def generate_structured(self, prompt, schema, **kwargs):
+                self.calls.append((schema, kwargs))
+                return self.answer
+
+        core = EmotionalCore()
+        client = Client({"e": "sadness", "c": 1.4, "i": 0.7})
+        state = core.detect_emotion_structured("oggi mi sento giù", client)
+        self.assertEqual((state.primary_emotion, state.confidence, state.intensity), ("sadness", 1.0, 0.7))
+        self.assertEqual(client.calls[0][1]["call_type"], "emotion")
+        self.assertIsNone(core.detect_emotion_structured("ciao", Client(None)))
+
+
+if __name__ == '__main__':
+    unittest.main()
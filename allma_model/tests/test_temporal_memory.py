@@ -13,8 +13,10 @@ class TestTemporalMemorySystem(unittest.TestCase):
         
     def tearDown(self):
         """Pulizia dopo ogni test"""
-        if os.path.exists(self.test_db):
-            os.remove(self.test_db)
+        self.memory_system.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.test_db + suffix):
+                os.remove(self.test_db + suffix)
 
     def test_store_interaction(self):
         """Test della memorizzazione di un'interazione"""
@@ -89,6 +91,100 @@ class TestTemporalMemorySystem(unittest.TestCase):
         # Verifica che le interazioni su ML siano più rilevanti
         self.assertIn('machine learning', relevant[0]['content'].lower())
 
+    def test_relevant_context_time_window(self):
+        """Le interazioni fuori finestra non vengono restituite dall'indice"""
+        self.memory_system.store_interaction(self.test_user_id, {
+            'content': 'Vecchia discussione su machine learning',
+            'context': {},
+            'emotion': 'neutral',
+            'timestamp': datetime.now() - timedelta(days=60)
+        })
+        self.memory_system.store_interaction(self.test_user_id, {
+            'content': 'Oggi parliamo di cucina',
+            'context': {},
+            'emotion': 'neutral'
+        })
+        
+        relevant = self.memory_system.get_relevant_context(self.test_user_id, "machine learning")
+        self.assertEqual([r['content'] for r in relevant], ['Oggi parliamo di cucina'])
+        self.assertEqual(relevant[0]['similarity'], 0.0)
+
+    def test_index_backfill(self):
+        """Le interazioni presenti prima dell'indice vengono indicizzate all'apertura"""
+        self.memory_system.store_interaction(self.test_user_id, {
+            'content': 'Parliamo di machine learning',
+            'context': {},
+            'emotion': 'neutral'
+        })
+        conn = self.memory_system._get_db_connection()
+        conn.execute("DELETE FROM interaction_postings")
+        conn.execute("DELETE FROM interaction_doc_stats")
+        conn.commit()
+        conn.close()
+        
+        reopened = TemporalMemorySystem(db_path=self.test_db)
+        relevant = reopened.get_relevant_context(self.test_user_id, "machine learning")
+        reopened.close()
+        self.assertGreater(relevant[0]['similarity'], 0.0)
+
+    def test_batch_store_interactions(self):
+        """Il batch inserisce in una transazione, salta i duplicati e mantiene gli aggregati"""
+        base_time = datetime.now()
+        batch = [
+            {'content': f'Messaggio {i}', 'context': {}, 'emotion': 'neutral',
+             'timestamp': base_time - timedelta(hours=i)}
+            for i in range(10)
+        ]
+        batch.append({'content': None})
+        
+        self.assertEqual(self.memory_system.store_interactions(self.test_user_id, batch), 10)
+        self.assertEqual(self.memory_system.store_interactions(self.test_user_id, batch[:3]), 0)
+        self.assertEqual(len(self.memory_system.get_interactions(self.test_user_id)), 10)
+        self.assertTrue(self.memory_system.check_temporal_aggregates(self.test_user_id)['consistent'])
+
+    def test_persistent_session(self):
+        """Una connessione WAL per thread, riusata tra le chiamate, con tempi per operazione"""
+        conn = self.memory_system.session.connection()
+        self.assertEqual(conn.execute("PRAGMA journal_mode").fetchone()[0], "wal")
+        
+        self.memory_system.store_interaction(self.test_user_id, {
+            'content': 'Test', 'context': {}, 'emotion': 'neutral'
+        })
+        self.memory_system.get_interactions(self.test_user_id)
+        self.assertIs(self.memory_system.session.connection(), conn)
+        
+        stats = self.memory_system.get_db_stats()
+        self.assertEqual(stats['store_interaction']['count'], 1)
+        self.assertEqual(stats['get_interactions']['count'], 1)
+        self.assertGreater(self.memory_system.session.totals()['ops'], 0)
+
+    def test_close_checkpoints_wal(self):
+        """close() riporta il WAL nel DB: restano solo i dati nel file .db"""
+        import threading
+        self.memory_system.store_interaction(self.test_user_id, {
+            'content': 'Test', 'context': {}, 'emotion': 'neutral'
+        })
+        reader = threading.Thread(target=self.memory_system.get_interactions, args=(self.test_user_id,))
+        reader.start()
+        reader.join()
+        self.assertTrue(os.path.exists(self.test_db + "-wal"))
+
+        self.memory_system.close()
+        self.assertFalse(os.path.exists(self.test_db + "-wal"))
+        self.assertFalse(os.path.exists(self.test_db + "-shm"))
+        reopened = TemporalMemorySystem(db_path=self.test_db)
+        self.assertEqual(len(reopened.get_interactions(self.test_user_id)), 1)
+        reopened.close()
+
+    def test_timestamp_lookup_uses_covering_index(self):
+        """Le lookup per (user_id, timestamp) non toccano la tabella"""
+        conn = self.memory_system.session.connection()
+        plan = conn.execute(
+            "EXPLAIN QUERY PLAN SELECT id FROM interactions WHERE user_id = ? ORDER BY timestamp DESC LIMIT 1",
+            (self.test_user_id,)
+        ).fetchall()
+        self.assertIn("COVERING INDEX", " ".join(str(row[-1]) for row in plan))
+
     def test_hour_distribution(self):
         """Test della distribuzione oraria"""
         current_hour = datetime.now().hour
@@ -134,6 +230,66 @@ class TestTemporalMemorySystem(unittest.TestCase):
         # Verifica che la media sia circa 2 ore
         self.assertAlmostEqual(frequency['average_gap_hours'], 2.0, delta=0.5)
 
+    def test_aggregates_match_full_recompute(self):
+        """Gli aggregati incrementali coincidono con un ricalcolo completo, anche fuori ordine"""
+        base_time = datetime.now().replace(minute=30, second=0, microsecond=0)
+        offsets_hours = [5, 49, 1, 120, 26, 3, 300, 72, 0.5, 200]
+        
+        for h in offsets_hours:
+            t = base_time - timedelta(hours=h)
+            self.memory_system.store_interaction(self.test_user_id, {
+                'content': f'Interazione a {t}',
+                'context': {},
+                'emotion': 'neutral',
+                'timestamp': t
+            })
+        
+        report = self.memory_system.check_temporal_aggregates(self.test_user_id)
+        self.assertTrue(report['consistent'], report['mismatches'])
+        self.assertAlmostEqual(
+            report['aggregated']['frequency']['std_gap_hours'],
+            report['recomputed']['frequency']['std_gap_hours'],
+            places=6
+        )
+
+    def test_aggregate_expiry(self):
+        """Il pass di scadenza decrementa gli aggregati dei giorni usciti dalla finestra"""
+        now = datetime.now().replace(hour=12, minute=0, second=0, microsecond=0)
+        for t in (now - timedelta(days=3), now - timedelta(days=3, hours=1), now):
+            self.memory_system.store_interaction(self.test_user_id, {
+                'content': 'Test interaction',
+                'context': {},
+                'emotion': 'neutral',
+                'timestamp': t
+            })
+        
+        # Restringe la finestra: i giorni vecchi scadono alla lettura successiva
+        self.memory_system.context_window = timedelta(days=1)
+        patterns = self.memory_system.get_temporal_patterns(self.test_user_id)
+        self.assertEqual(patterns['hour_distribution'], {'12': 1.0})
+        self.assertEqual(patterns['frequency']['average_gap_hours'], 24.0)
+        self.assertTrue(self.memory_system.check_temporal_aggregates(self.test_user_id)['consistent'])
+
+    def test_aggregate_repair(self):
+        """Il checker rileva aggregati corrotti e li ripara su richiesta"""
+        for i in range(3):
+            self.memory_system.store_interaction(self.test_user_id, {
+                'content': 'Test interaction',
+                'context': {},
+                'emotion': 'neutral',
+                'timestamp': datetime.now() - timedelta(hours=i)
+            })
+        
+        conn = self.memory_system._get_db_connection()
+        conn.execute("UPDATE temporal_agg_hour_of_day SET count = count + 7")
+        conn.commit()
+        conn.close()
+        
+        report = self.memory_system.check_temporal_aggregates(self.test_user_id, repair=True)
+        self.assertFalse(report['consistent'])
+        self.assertTrue(report['repaired'])
+        self.assertTrue(self.memory_system.check_temporal_aggregates(self.test_user_id)['consistent'])
+
     def test_error_handling(self):
         """Test della gestione degli errori"""
         # Test con interazione malformata
@@ -151,5 +307,75 @@ class TestTemporalMemorySystem(unittest.TestCase):
         success = self.memory_system.store_interaction(None, {})
         self.assertFalse(success)
 
+class TestTemporalArchiveScale(unittest.TestCase):
+    """Scala: anni di dati sintetici con archivio mensile"""
+    
+    def setUp(self):
+        self.test_db = "test_archive_scale.db"
+        self.memory_system = TemporalMemorySystem(db_path=self.test_db, hot_retention_days=90)
+        self.user_id = "scale_user"
+        
+    def tearDown(self):
+        self.memory_system.close()
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(self.test_db + suffix):
+                os.remove(self.test_db + suffix)
+    
+    def _hot_count(self):
+        conn = self.memory_system.session.connection()
+        return conn.execute("SELECT COUNT(*) FROM interactions").fetchone()[0]
+
+    def test_multi_year_archive(self):
+        """Tre anni di interazioni: tabella calda limitata, query instradate, rollup coerenti"""
+        now = datetime.now().replace(microsecond=0)
+        emotions = ['happy', 'neutral', 'sad']
+        interactions = [
+            {
+                'content': f'Interazione sintetica {i} su argomento{i % 7}',
+                'context': {},
+                'emotion': emotions[i % 3],
+                'timestamp': now - timedelta(hours=9 * i)
+            }
+            for i in range(3 * 365 * 24 // 9)
+        ]
+        total = len(interactions)
+        self.assertEqual(self.memory_system.store_interactions(self.user_id, interactions), total)
+        
+        # Migrazione dei dati esistenti verso le partizioni mensili
+        hot_cutoff = now - timedelta(days=90)
+        result = self.memory_system.archive_old_interactions(before=hot_cutoff)
+        expected_hot = sum(1 for it in interactions if it['timestamp'] >= hot_cutoff)
+        self.assertEqual(self._hot_count(), expected_hot)
+        self.assertEqual(result['rows_archived'], total - expected_hot)
+        self.assertGreaterEqual(result['partitions_touched'], 33)
+        
+        # Un secondo passaggio è idempotente; un limite dentro la finestra di contesto viene ignorato
+        self.assertEqual(self.memory_system.archive_old_interactions(before=hot_cutoff)['rows_archived'], 0)
+        self.memory_system.archive_old_interactions(before=now)
+        self.assertGreaterEqual(self._hot_count(), 30 * 24 // 9)
+        self.assertLessEqual(self._hot_count(), expected_hot)
+        
+        # Instradamento trasparente: intervallo a cavallo tra archivio e tabella calda
+        start, end = now - timedelta(days=400), now - timedelta(days=10)
+        routed = self.memory_system.get_interactions(self.user_id, start, end)
+        expected = [it for it in interactions if start <= it['timestamp'] <= end]
+        self.assertEqual(len(routed), len(expected))
+        self.assertEqual(routed[0]['timestamp'], max(it['timestamp'] for it in expected))
+        self.assertEqual(len(self.memory_system.get_interactions(self.user_id)), total)
+        
+        # I rollup riassumono esattamente le righe archiviate
+        rollups = self.memory_system.get_rollups(self.user_id)
+        archived_total = total - self._hot_count()
+        self.assertEqual(sum(r['count'] for r in rollups), archived_total)
+        self.assertEqual(
+            sum(sum(r['emotion_counts'].values()) for r in rollups),
+            archived_total
+        )
+        
+        # Il contesto recente resta servito dalla sola tabella calda
+        self.assertIsNotNone(self.memory_system.get_last_interaction_id(self.user_id))
+        self.assertTrue(self.memory_system.check_temporal_aggregates(self.user_id)['consistent'])
+
+
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,109 @@
+"""Test per il motore TF-IDF sparso di utils/text_processing."""
+
+import math
+import unittest
+
+import numpy as np
+
+from allma_model.memory_system import interaction_index
+from allma_model.learning_system import topic_model
+from allma_model.utils.text_processing import SimpleTfidf, TfidfMatrix, cosine_similarity, tokenize
+
+
+class TestSimpleTfidf(unittest.TestCase):
+    """Test per SimpleTfidf e TfidfMatrix."""
+
+    def setUp(self):
+        self.docs = [
+            "il gatto dorme sul divano",
+            "il cane dorme in giardino",
+            "il gatto e il cane giocano",
+        ]
+
+    def test_vocab_and_idf_formula(self):
+        """Vocabolario ordinato e idf = log(N / (1 + df))"""
+        vec = SimpleTfidf()
+        matrix = vec.fit_transform(self.docs)
+        self.assertIsInstance(matrix, TfidfMatrix)
+        self.assertEqual(vec.vocab, sorted(vec.vocab))
+        self.assertEqual(matrix.shape, (3, len(vec.vocab)))
+        self.assertAlmostEqual(vec.idf["gatto"], math.log(3 / 3))
+        self.assertAlmostEqual(vec.idf["divano"], math.log(3 / 2))
+
+        dense = matrix.toarray()
+        # "il" compare due volte nel terzo documento
+        col = vec.vocab.index("il")
+        self.assertAlmostEqual(dense[2, col], 2 * vec.idf["il"])
+
+    def test_max_features_keeps_most_frequent(self):
+        """max_features tiene i termini più frequenti, parità per prima occorrenza"""
+        vec = SimpleTfidf(max_features=3)
+        vec.fit_transform(self.docs)
+        # il=4, gatto/dorme/cane=2: a parità vince chi compare prima
+        self.assertEqual(vec.vocab, ["dorme", "gatto", "il"])
+        self.assertEqual(vec.get_feature_names_out().tolist(), ["dorme", "gatto", "il"])
+
+    def test_non_string_documents(self):
+        """fit_transform salta i non stringa, transform li rende righe nulle"""
+        vec = SimpleTfidf()
+        matrix = vec.fit_transform(["uno due", None, "due tre"])
+        self.assertEqual(matrix.shape[0], 2)
+        self.assertEqual(vec.doc_count, 3)
+
+        transformed = vec.transform([None, "tre sconosciuto"])
+        self.assertEqual(transformed.shape, (2, len(vec.vocab)))
+        self.assertFalse(transformed[0].any())
+        self.assertEqual(np.count_nonzero(transformed[1]), 1)
+
+    def test_row_access(self):
+        """Indicizzazione per riga, slicing e iterazione"""
+        vec = SimpleTfidf()
+        matrix = vec.fit_transform(self.docs)
+        dense = matrix.toarray()
+        np.testing.assert_allclose(matrix[-1], dense[-1])
+        np.testing.assert_allclose(matrix[1:].toarray(), dense[1:])
+        for row, expected in zip(matrix, dense):
+            np.testing.assert_allclose(row, expected)
+        self.assertEqual(len(matrix), 3)
+        # nnz conta le coppie (documento, termine) memorizzate, anche con idf = 0
+        self.assertEqual(matrix.nnz, sum(len(set(d.split())) for d in self.docs))
+
+    def test_sparse_cosine_matches_dense(self):
+        """cosine_similarity dà lo stesso risultato su input sparsi e densi"""
+        vec = SimpleTfidf()
+        matrix = vec.fit_transform(self.docs + ["frase del tutto diversa"])
+        query = vec.transform(["gatto che dorme"])
+        dense = matrix.toarray()
+
+        expected = cosine_similarity(query.toarray(), dense)
+        np.testing.assert_allclose(cosine_similarity(query, matrix), expected)
+        np.testing.assert_allclose(cosine_similarity(query, dense), expected)
+        np.testing.assert_allclose(cosine_similarity(query[0], matrix), expected)
+
+        # Righe nulle: similarità 0, non NaN
+        zero = vec.transform(["nessuna parola nota"])
+        self.assertTrue(np.all(cosine_similarity(zero, matrix) == 0))
+
+    def test_cosine_shape_mismatch(self):
+        """Dimensioni incompatibili sollevano ValueError come np.dot"""
+        vec = SimpleTfidf()
+        matrix = vec.fit_transform(self.docs)
+        with self.assertRaises(ValueError):
+            cosine_similarity(matrix, np.ones((1, matrix.shape[1] + 1)))
+
+
+class TestTokenize(unittest.TestCase):
+    """Test per il tokenizer lessicale condiviso"""
+
+    def test_lowercase_word_tokens(self):
+        self.assertEqual(tokenize("Caffè, l'ALBA e 42!"), ["caffè", "l", "alba", "e", "42"])
+        self.assertEqual(tokenize(None), [])
+
+    def test_index_and_topic_model_share_tokenizer(self):
+        """Indice e topic model non possono tokenizzare in modo diverso"""
+        self.assertIs(interaction_index.tokenize, tokenize)
+        self.assertIs(topic_model.tokenize, tokenize)
+
+
+if __name__ == '__main__':
+    unittest.main()
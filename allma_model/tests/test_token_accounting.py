@@ -0,0 +1,132 @@
+"""Test per TokenAccountant: tokenizzazione unica del prompt e conteggi per sezione."""
+
+import tempfile
+import unittest
+
+from allma_model.llm.mobile_gemma_wrapper import MobileGemmaWrapper
+from allma_model.llm.token_accounting import TokenAccountant
+from allma_model.tests.fakes import FakeLlama
+
+
+SYSTEM = "<|im_start|>system\nSei ALLMA, rispondi in italiano.<|im_end|>\n"
+HISTORY = (
+    "<|im_start|>user\nciao come stai<|im_end|>\n"
+    "<|im_start|>assistant\nbene grazie e tu<|im_end|>\n"
+)
+TURN = "<|im_start|>user\nparliamo di musica<|im_end|>\n<|im_start|>assistant\n"
+
+
+class CountingLlama(FakeLlama):
+    """FakeLlama che registra ogni chiamata del tokenizer."""
+
+    def __init__(self):
+        super().__init__(reply=("Ciao", "!", " Come", " va", "?"))
+        self.tokenize_calls = []
+
+    def tokenize(self, data, add_bos=True, special=False):
+        self.tokenize_calls.append(data)
+        return super().tokenize(data, add_bos, special)
+
+
+class TestTokenAccountant(unittest.TestCase):
+    """Test per TokenAccountant e PromptTokens."""
+
+    def setUp(self):
+        self.llm = CountingLlama()
+        self.accountant = TokenAccountant(lambda data, add_bos: self.llm.tokenize(data, add_bos=add_bos))
+
+    def test_segments_match_whole_prompt(self):
+        prompt = SYSTEM + HISTORY + TURN
+        tokens = self.accountant.prompt(prompt)
+        self.assertTrue(self.accountant.segmented)
+        self.assertEqual(tokens.ids, self.llm.tokenize(prompt.encode("utf-8")))
+        self.assertEqual(tokens.text, prompt)
+
+    def test_stable_prefix_is_not_retokenized(self):
+        """Il turno successivo tokenizza solo i messaggi nuovi"""
+        self.accountant.prompt(SYSTEM + HISTORY + TURN)
+        self.llm.tokenize_calls.clear()
+        self.accountant.prompt(SYSTEM + HISTORY + TURN.replace("musica", "sport"))
+        self.assertEqual(self.llm.tokenize_calls, [b"<|im_start|>user\nparliamo di sport<|im_end|>\n"])
+        self.assertNotIn(SYSTEM.encode("utf-8"), self.llm.tokenize_calls)
+
+    def test_inexact_segmentation_falls_back_to_whole_prompt(self):
+        """Tokenizer che unisce testo oltre il confine dei messaggi: si usa il prompt intero"""
+        def merging(data, add_bos):
+            return [hash(w) & 0xFFFF for w in data.decode("utf-8").replace("\n<|im_start|>", " ").split(" ")]
+        accountant = TokenAccountant(merging)
+        prompt = SYSTEM + TURN
+        tokens = accountant.prompt(prompt)
+        self.assertFalse(accountant.segmented)
+        self.assertEqual(tokens.ids, merging(prompt.encode("utf-8"), True))
+        self.assertEqual(tokens.sections(), {"raw": len(tokens)})
+
+    def test_sections(self):
+        tokens = self.accountant.prompt(SYSTEM + HISTORY + TURN)
+        sections = tokens.sections()
+        tok = lambda text: len(self.llm.tokenize(text.encode("utf-8")))
+        self.assertEqual(sections["system"], tok(SYSTEM))
+        self.assertEqual(sections["history"], tok(HISTORY))
+        self.assertEqual(sections["user"], tok("<|im_start|>user\nparliamo di musica<|im_end|>\n"))
+        self.assertEqual(sections["assistant"], tok("<|im_start|>assistant\n"))
+        self.assertEqual(sum(sections.values()), len(tokens))
+
+    def test_trim_history_keeps_system_and_turn(self):
+        tokens = self.accountant.prompt(SYSTEM + HISTORY + TURN)
+        history = tokens.sections()["history"]
+        trimmed, dropped = tokens.trim_history(len(tokens) - 1)
+        self.assertGreater(dropped, 0)
+        self.assertEqual(len(trimmed), len(tokens) - dropped)
+        self.assertTrue(trimmed.text.startswith(SYSTEM))
+        self.assertTrue(trimmed.text.endswith(TURN))
+        # Anche con un limite impossibile si toglie solo la cronologia
+        trimmed, dropped = tokens.trim_history(1)
+        self.assertEqual((dropped, trimmed.text), (history, SYSTEM + TURN))
+
+
+class TestWrapperTokenAccounting(unittest.TestCase):
+    """Test per la tokenizzazione unica in MobileGemmaWrapper.generate."""
+
+    def setUp(self):
+        self.wrapper = MobileGemmaWrapper(tempfile.mkdtemp())
+        self.llm = CountingLlama()
+        self.wrapper.llm = self.llm
+
+    def test_single_tokenizer_pass_and_ids_to_llama(self):
+        prompt = SYSTEM + HISTORY + TURN
+        self.wrapper.generate(prompt, max_tokens=-1, callback=lambda t: None, conversation_id="c1")
+        meta = self.wrapper.last_generation
+        # Ogni segmento una volta, più il controllo iniziale sul prompt intero; mai la risposta
+        self.assertEqual(len(self.llm.tokenize_calls), 6)
+        self.assertEqual(self.llm.prompts[-1], self.llm.tokenize(prompt.encode("utf-8")))
+        self.assertEqual(meta["prompt_tokens"], len(self.llm.prompts[-1]))
+        self.assertEqual(meta["completion_tokens"], 5)  # un chunk per token
+        self.assertEqual(meta["total_tokens"], meta["prompt_tokens"] + 5)
+        self.assertEqual(meta["max_tokens"], self.wrapper.n_ctx - meta["prompt_tokens"] - 64)
+        self.assertEqual(sum(meta["prompt_sections"].values()), meta["prompt_tokens"])
+
+        self.llm.tokenize_calls.clear()
+        self.wrapper.generate(prompt + "ok<|im_end|>\n" + TURN, max_tokens=32)
+        self.assertEqual(len(self.llm.tokenize_calls), 1)  # solo il messaggio nuovo
+
+    def test_completion_tokens_from_usage(self):
+        self.wrapper.generate(SYSTEM + TURN, max_tokens=32)
+        meta = self.wrapper.last_generation
+        self.assertEqual(meta["completion_tokens"], 5)
+        self.assertNotIn("".join(self.llm.reply).encode("utf-8"), self.llm.tokenize_calls)
+
+    def test_over_context_prompt_drops_oldest_history(self):
+        self.wrapper.n_ctx = 160
+        history = "".join(
+            f"<|im_start|>user\nmessaggio numero {i} con qualche parola in più<|im_end|>\n" for i in range(12)
+        )
+        self.wrapper.generate(SYSTEM + history + TURN, max_tokens=16)
+        meta = self.wrapper.last_generation
+        self.assertGreater(meta["trimmed_history_tokens"], 0)
+        self.assertLessEqual(meta["prompt_tokens"], 160 - self.wrapper.PROMPT_CTX_RESERVE)
+        sent = self.llm.prompts[-1]
+        self.assertEqual(sent[:meta["prompt_sections"]["system"]], self.llm.tokenize(SYSTEM.encode("utf-8")))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+"""Test per TopicExtractor e il modello di topic precalcolato."""
+
+import unittest
+
+import numpy as np
+
+from allma_model.learning_system.topic_extractor import TOPIC_DESCRIPTIONS, TopicExtractor
+from allma_model.learning_system.topic_model import TopicModel
+
+
+class TestTopicExtractor(unittest.TestCase):
+    """Test per TopicExtractor."""
+
+    def setUp(self):
+        self.extractor = TopicExtractor()
+
+    def test_base_model_shared(self):
+        """Il modello base è costruito una volta e condiviso"""
+        other = TopicExtractor()
+        self.assertIs(self.extractor.model, other.model)
+        self.assertIs(self.extractor.model, TopicExtractor.get_base_model())
+        self.assertEqual(self.extractor.model.topics, list(TOPIC_DESCRIPTIONS.keys()))
+
+    def test_statistical_topic(self):
+        """Frasi senza parole chiave delle regole usano i centroidi"""
+        self.assertEqual(self.extractor.extract_topic("la timeline del project è stretta"), "project")
+        self.assertEqual(self.extractor.extract_topic("oggi sono molto felice"), "emotion")
+        self.assertEqual(self.extractor.extract_topic("xyz qwerty"), "general")
+
+    def test_scores_match_dense_cosine(self):
+        """Lo score sparso coincide con il coseno denso sui centroidi"""
+        model = self.extractor.model
+        text = "vorrei vestiti chiari per l'estate"
+        scores = model.scores(text)
+        _, _, norm = model.vectorize(text)
+        embedding = model.embed(text)
+        for topic, col in model.topic_index.items():
+            centroid = model.centroid_sums[:, col]
+            expected = embedding @ centroid / (norm * np.linalg.norm(centroid))
+            self.assertAlmostEqual(scores[topic], expected)
+
+    def test_update_user_topic(self):
+        """I topic dell'utente non modificano il modello condiviso"""
+        base = TopicExtractor.get_base_model()
+        n_terms = len(base.terms)
+        self.assertTrue(self.extractor.update_user_topic("cucina", "ricetta pasta pomodoro basilico"))
+        self.assertIsNot(self.extractor.model, base)
+        self.assertEqual(len(base.terms), n_terms)
+        self.assertNotIn("cucina", base.topics)
+        self.assertEqual(self.extractor.extract_topic("una ricetta con il basilico"), "cucina")
+        self.assertEqual(TopicExtractor().extract_topic("una ricetta con il basilico"), "general")
+
+    def test_update_existing_topic(self):
+        """Un esempio aggiunto a un topic esistente ne sposta il centroide"""
+        model = TopicModel.build(["alfa", "beta"], {"a": "alfa", "b": "beta"})
+        self.assertEqual(model.best_topic("gamma")[1], 0.0)
+        model.update_topic("b", "beta gamma")
+        self.assertEqual(model.best_topic("gamma")[0], "b")
+        self.assertEqual(int(model.counts[model.topic_index["b"]]), 2)
+        self.assertFalse(model.update_topic("b", "   "))
+
+    def test_calculate_similarity(self):
+        """Similarità tra testi, anche con termini fuori vocabolario"""
+        self.assertAlmostEqual(self.extractor.calculate_similarity("python", "python"), 1.0)
+        self.assertAlmostEqual(self.extractor.calculate_similarity("pizza", "pizza margherita"), 1 / np.sqrt(2))
+        self.assertEqual(self.extractor.calculate_similarity("python", ""), 0.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
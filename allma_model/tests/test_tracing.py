@@ -0,0 +1,146 @@
+"""Test per gli span di tracing della pipeline dei messaggi."""
+
+import json
+import os
+import shutil
+import sqlite3
+import tempfile
+import threading
+import time
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+
+from allma_model.utils.tracing import JsonlTraceSink, SQLiteTraceSink, Tracer, sink_for_path
+
+
+class TestTracer(unittest.TestCase):
+    """Test per Tracer, SpanScope e sink."""
+
+    def setUp(self):
+        self.tracer = Tracer(capacity=4, log_summary=False)
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        self.tracer.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_nested_spans_share_trace_and_parent(self):
+        """Gli span annidati hanno il padre corretto e finiscono nella stessa trace"""
+        with self.tracer.span("turn", conversation_id="c1") as root:
+            with self.tracer.span("stage.topic") as child:
+                with self.tracer.span("inner") as inner:
+                    time.sleep(0.01)
+        trace = self.tracer.last_trace()
+        self.assertIs(trace.root, root)
+        self.assertEqual(child.parent_id, root.span_id)
+        self.assertEqual(inner.parent_id, child.span_id)
+        self.assertEqual({s.trace_id for s in trace.spans}, {trace.trace_id})
+        self.assertGreaterEqual(inner.duration_ms, 10)
+        self.assertGreaterEqual(root.duration_ms, child.duration_ms)
+        self.assertEqual(root.attributes["conversation_id"], "c1")
+        self.assertIsNone(Tracer.current_span())
+
+    def test_error_is_recorded_and_reraised(self):
+        """Un'eccezione marca lo span come error senza essere inghiottita"""
+        with self.assertRaises(ValueError):
+            with self.tracer.span("turn"):
+                with self.tracer.span("failing"):
+                    raise ValueError("boom")
+        spans = {s.name: s for s in self.tracer.last_trace().spans}
+        self.assertEqual(spans["failing"].status, "error")
+        self.assertIn("boom", spans["failing"].error)
+
+    def test_unfinished_children_are_abandoned(self):
+        """Uno span figlio mai chiuso viene chiuso con la radice come abandoned"""
+        with self.tracer.span("turn"):
+            self.tracer.span("prompt_build").start()  # un ramo che salta end()
+        spans = {s.name: s for s in self.tracer.last_trace().spans}
+        self.assertEqual(spans["prompt_build"].status, "abandoned")
+        self.assertIsNotNone(spans["prompt_build"].end)
+
+    def test_spans_follow_work_into_worker_threads(self):
+        """Con Tracer.bind gli span aperti in un worker sono figli dello span chiamante"""
+        pool = ThreadPoolExecutor(max_workers=2)
+        try:
+            def work():
+                with self.tracer.span("llm.generate") as span:
+                    span.set_attribute("worker", threading.current_thread().name)
+
+            with self.tracer.span("turn") as root:
+                with self.tracer.span("llm_inference") as llm_span:
+                    pool.submit(Tracer.bind(work)).result()
+                pool.submit(work).result()  # senza bind: trace separata
+        finally:
+            pool.shutdown(wait=True)
+
+        traces = self.tracer.traces()
+        turn = [t for t in traces if t.root is root][0]
+        generate = [s for s in turn.spans if s.name == "llm.generate"]
+        self.assertEqual(len(generate), 1)
+        self.assertEqual(generate[0].parent_id, llm_span.span_id)
+        self.assertNotEqual(generate[0].thread, root.thread)
+        self.assertEqual(len(traces), 2)
+
+    def test_ring_buffer_is_bounded(self):
+        for i in range(10):
+            with self.tracer.span(f"turn-{i}"):
+                pass
+        names = [t.root.name for t in self.tracer.traces()]
+        self.assertEqual(names, ["turn-6", "turn-7", "turn-8", "turn-9"])
+        self.assertEqual(self.tracer.last_trace("turn-7").root.name, "turn-7")
+
+    def test_jsonl_sink(self):
+        path = os.path.join(self.temp_dir, "traces.jsonl")
+        self.tracer.add_sink(JsonlTraceSink(path))
+        for _ in range(2):
+            with self.tracer.span("turn"):
+                with self.tracer.span("stage.emotion"):
+                    pass
+        self.tracer.flush()
+        with open(path, encoding="utf-8") as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual(len(rows), 2)
+        self.assertEqual([s["name"] for s in rows[0]["spans"]], ["turn", "stage.emotion"])
+        self.assertIsNone(rows[0]["spans"][0]["parent_id"])
+
+    def test_same_sink_path_is_added_once(self):
+        path = os.path.join(self.temp_dir, "traces.jsonl")
+        first = self.tracer.add_sink(sink_for_path(path))
+        self.assertIs(self.tracer.add_sink(sink_for_path(path)), first)
+        with self.tracer.span("turn"):
+            pass
+        self.tracer.flush()
+        with open(path, encoding="utf-8") as f:
+            self.assertEqual(len(f.readlines()), 1)
+
+    def test_sqlite_sink_keeps_latest_traces(self):
+        path = os.path.join(self.temp_dir, "traces.db")
+        self.tracer.add_sink(SQLiteTraceSink(path, max_traces=3))
+        for i in range(5):
+            with self.tracer.span("turn", index=i):
+                with self.tracer.span("post_response"):
+                    pass
+        self.tracer.flush()
+        conn = sqlite3.connect(path)
+        try:
+            roots = conn.execute("SELECT COUNT(*) FROM trace_spans WHERE parent_id IS NULL").fetchone()[0]
+            children = conn.execute("SELECT COUNT(*) FROM trace_spans WHERE name = 'post_response'").fetchone()[0]
+            latest = conn.execute(
+                "SELECT attributes FROM trace_spans WHERE parent_id IS NULL ORDER BY started_at DESC, rowid DESC LIMIT 1"
+            ).fetchone()[0]
+        finally:
+            conn.close()
+        self.assertEqual(roots, 3)
+        self.assertEqual(children, 3)
+        self.assertEqual(json.loads(latest)["index"], 4)
+
+    def test_disabled_tracer_records_nothing(self):
+        self.tracer.enabled = False
+        with self.tracer.span("turn") as span:
+            Tracer.set_attribute("ignored", True)
+        self.assertIsNone(span)
+        self.assertEqual(self.tracer.traces(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
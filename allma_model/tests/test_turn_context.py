@@ -0,0 +1,101 @@
+"""Test per il contesto condiviso del turno."""
+
+import threading
+import time
+import unittest
+from types import SimpleNamespace
+
+from allma_model.core.information_extractor import InformationExtractor
+from allma_model.core.turn_context import TurnContext
+
+
+class TestTurnContext(unittest.TestCase):
+    """Test per TurnContext."""
+
+    def setUp(self):
+        self.calls = []
+        self.lock = threading.Lock()
+
+    def counted(self, name, value, seconds=0.0):
+        def provider(turn):
+            with self.lock:
+                self.calls.append(name)
+            time.sleep(seconds)
+            return value
+        return provider
+
+    def test_fact_is_computed_once(self):
+        """Un fatto letto più volte viene calcolato una sola volta"""
+        turn = TurnContext("u1", "c1", "Ciao Marco", providers={
+            'entities': self.counted('entities', {'persons': ['Marco']}),
+        })
+        self.assertEqual(turn.entities, {'persons': ['Marco']})
+        self.assertEqual(turn.entities, {'persons': ['Marco']})
+        self.assertEqual(self.calls, ['entities'])
+        stats = turn.stats()
+        self.assertIn('entities', stats['computed'])
+        self.assertEqual(stats['reused'], {'entities': 1})
+
+    def test_concurrent_stages_share_one_computation(self):
+        """Stadi paralleli che chiedono lo stesso fatto attendono il primo calcolo"""
+        turn = TurnContext("u1", "c1", "msg", providers={
+            'metabolic_state': self.counted('metabolic_state', 'tired', seconds=0.05),
+        })
+        results = []
+
+        def stage():
+            results.append(turn.metabolic_state)
+
+        threads = [threading.Thread(target=stage) for _ in range(6)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, ['tired'] * 6)
+        self.assertEqual(self.calls, ['metabolic_state'])
+
+    def test_default_tokens_and_intent(self):
+        understanding = SimpleNamespace(intent=SimpleNamespace(value='saluto'))
+        turn = TurnContext("u1", "c1", " ciao   come stai ", providers={
+            'understanding': self.counted('understanding', understanding),
+        })
+        self.assertEqual(turn.tokens, ['ciao', 'come', 'stai'])
+        self.assertEqual(turn.intent, 'saluto')
+        self.assertIs(turn.understanding, understanding)
+        self.assertEqual(self.calls, ['understanding'])
+
+        no_understanding = TurnContext("u1", "c1", "x", providers={'understanding': lambda t: None})
+        self.assertEqual(no_understanding.intent, 'unknown')
+
+    def test_failure_is_not_retried(self):
+        """Un provider che fallisce non viene ritentato nello stesso turno"""
+        def boom(turn):
+            self.calls.append('emotion')
+            raise RuntimeError("sensor")
+
+        turn = TurnContext("u1", "c1", "msg", providers={'emotion': boom})
+        for _ in range(2):
+            with self.assertRaises(RuntimeError):
+                turn.emotion
+        self.assertEqual(self.calls, ['emotion'])
+        self.assertEqual(turn.stats()['failed'], ['emotion'])
+
+    def test_seed_peek_and_missing_provider(self):
+        turn = TurnContext("u1", "c1", "msg")
+        self.assertIsNone(turn.peek('personality'))
+        turn.seed('personality', {'curiosity': 0.8})
+        self.assertTrue(turn.has('personality'))
+        self.assertEqual(turn.personality, {'curiosity': 0.8})
+        with self.assertRaises(KeyError):
+            turn.get('unknown_fact')
+
+    def test_extractor_reuses_turn_entities(self):
+        """InformationExtractor usa le entità del turno invece di ricalcolarle"""
+        entities = {'persons': ['Marco'], 'organizations': [], 'locations': []}
+        info = InformationExtractor().extract_information("Ciao Marco, parliamo di machine learning", entities=entities)
+        self.assertIs(info['entities'], entities)
+        self.assertIn('machine_learning', info['concepts'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,130 @@
+"""Test per gli eventi di streaming e il controllo dei turni in volo."""
+
+import threading
+import time
+import unittest
+
+from allma_model.core.turn_stream import (
+    StreamEvent,
+    StreamEventType,
+    TurnHandle,
+    TurnRegistry,
+    TurnSupersededError
+)
+
+
+class TestStreamEvent(unittest.TestCase):
+    """Test per StreamEvent."""
+
+    def test_from_chunk(self):
+        token = StreamEvent.from_chunk({'type': 'answer', 'content': 'Ciao'})
+        self.assertEqual(token.type, StreamEventType.TOKEN)
+        self.assertEqual(token.content, 'Ciao')
+        self.assertEqual(StreamEvent.from_chunk({'type': 'thought', 'content': 'hmm'}).type,
+                         StreamEventType.THINKING)
+        self.assertIsNone(StreamEvent.from_chunk({'type': 'answer', 'content': ''}))
+        self.assertIsNone(StreamEvent.from_chunk({'type': 'unknown', 'content': 'x'}))
+
+    def test_to_dict(self):
+        event = StreamEvent(StreamEventType.STAGE, stage='topic', data={'status': 'done'})
+        self.assertEqual(event.to_dict(), {
+            'type': 'stage', 'content': '', 'stage': 'topic', 'data': {'status': 'done'}
+        })
+
+
+class TestTurnRegistry(unittest.TestCase):
+    """Test per TurnHandle e TurnRegistry."""
+
+    def setUp(self):
+        self.registry = TurnRegistry()
+
+    def test_handle_cancel_and_listeners(self):
+        handle = TurnHandle("c1")
+        reasons = []
+        handle.add_listener(reasons.append)
+        handle.check()
+        self.assertTrue(handle.cancel("stop"))
+        self.assertFalse(handle.cancel("again"))
+        with self.assertRaises(TurnSupersededError) as ctx:
+            handle.check()
+        self.assertEqual(ctx.exception.reason, "stop")
+        handle.add_listener(reasons.append)  # già annullato: chiamato subito
+        self.assertEqual(reasons, ["stop", "stop"])
+
+    def test_same_conversation_is_serialized(self):
+        """Senza supersede il secondo turno attende la fine del primo"""
+        first = TurnHandle("c1")
+        self.assertTrue(self.registry.begin(first))
+        second = TurnHandle("c1")
+        self.assertFalse(self.registry.begin(second, timeout=0.05))
+
+        order = []
+
+        def run_second():
+            self.registry.begin(second)
+            order.append("second")
+            self.registry.end(second)
+
+        worker = threading.Thread(target=run_second)
+        worker.start()
+        time.sleep(0.05)
+        order.append("first")
+        self.registry.end(first)
+        worker.join(timeout=2)
+        self.assertEqual(order, ["first", "second"])
+        self.assertFalse(first.cancelled)
+
+    def test_other_conversations_run_in_parallel(self):
+        self.assertTrue(self.registry.begin(TurnHandle("c1")))
+        self.assertTrue(self.registry.begin(TurnHandle("c2"), timeout=0.05))
+        self.assertEqual(self.registry.stats()['active'], 2)
+
+    def test_supersede_cancels_active_and_waiting_turns(self):
+        """Un nuovo messaggio con supersede annulla il turno in volo e quelli in attesa"""
+        active = TurnHandle("c1")
+        self.registry.begin(active)
+        waiting = TurnHandle("c1")
+        errors = []
+
+        def wait_turn():
+            try:
+                self.registry.begin(waiting)
+            except TurnSupersededError as e:
+                errors.append(e.reason)
+
+        worker = threading.Thread(target=wait_turn)
+        worker.start()
+        time.sleep(0.05)
+
+        newest = TurnHandle("c1")
+        acquired = []
+        newest_worker = threading.Thread(target=lambda: acquired.append(self.registry.begin(newest, supersede=True)))
+        newest_worker.start()
+        worker.join(timeout=2)
+        self.assertEqual(errors, ["superseded"])
+        self.assertTrue(active.cancelled)
+
+        # Il turno annullato raggiunge un punto di controllo e libera la conversazione
+        with self.assertRaises(TurnSupersededError):
+            active.check()
+        self.registry.end(active)
+        newest_worker.join(timeout=2)
+        self.assertEqual(acquired, [True])
+        self.assertIs(self.registry.active("c1"), newest)
+        stats = self.registry.stats()
+        self.assertEqual(stats['superseded'], 2)
+        self.assertEqual(stats['cancelled_waiting'], 1)
+        self.assertEqual(stats['waiting'], 0)
+
+    def test_registry_cancel(self):
+        self.assertFalse(self.registry.cancel("c1"))
+        handle = TurnHandle("c1")
+        self.registry.begin(handle)
+        self.assertTrue(self.registry.cancel("c1", "user_stop"))
+        self.assertEqual(handle.reason, "user_stop")
+        self.registry.end(handle)
+        self.assertIsNone(self.registry.active("c1"))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -176,9 +176,15 @@ class AllmaInternalApp(MDApp):
             if hasattr(self, 'chat_screen') and hasattr(self.chat_screen, 'core'):
                 # 1. Force Save Memory
                 core = self.chat_screen.core
+                # Prima il lavoro post-risposta in coda (risposte e apprendimento non ancora salvati)
+                if hasattr(core, 'drain_post_response'):
+                    core.drain_post_response(timeout=5.0)
                 if core.conversational_memory:
                     core.conversational_memory.save_memory()
                     print("[AllmaInternalApp] Memory saved on pause.")
+                # Stato KV dell'LLM su disco: al ritorno niente prefill da capo
+                if hasattr(core, 'persist_llm_state'):
+                    core.persist_llm_state(timeout=3.0)
                 
                 # 2. Suspend Dreaming/Heavy processes
                 if hasattr(core, 'dream_manager'):
@@ -191,6 +197,17 @@ class AllmaInternalApp(MDApp):
             
         return True # Allow backgrounding
 
+    def on_stop(self):
+        """Called when the app is closing."""
+        try:
+            if hasattr(self, 'chat_screen') and hasattr(self.chat_screen, 'core'):
+                core = self.chat_screen.core
+                if hasattr(core, 'shutdown'):
+                    core.shutdown(timeout=5.0)
+                    print("[AllmaInternalApp] Post-response queue drained on stop.")
+        except Exception as e:
+            print(f"[AllmaInternalApp] Error in on_stop: {e}")
+
     def on_resume(self):
         """Called when the app resumes."""
         print("[AllmaInternalApp] Resumed.")
@@ -27,6 +27,7 @@ from kivy.metrics import dp
 # Import Theme
 from allma_model.ui.theme import Theme
 from allma_model.core.allma_core import ALLMACore
+from allma_model.core.turn_stream import TurnSupersededError
 
 # Register Theme for KV
 from kivy.factory import Factory
@@ -372,11 +373,13 @@ class ChatView(MDScreen):
                             break
             
             # Call Core with Callback
+            # supersede: un nuovo messaggio annulla il turno ancora in volo
             processed_response = self.core.process_message(
                 user_id="user_default",
                 conversation_id=self.conversation_id,
                 message=user_text,
-                stream_callback=on_stream_data
+                stream_callback=on_stream_data,
+                supersede=True
             )
             
             # End Stream
@@ -417,6 +420,9 @@ class ChatView(MDScreen):
             if not processed_response.is_valid:
                  self.bridge.stream_chunk("\n[Errore Generazione]", False)
 
+        except TurnSupersededError:
+            # Superato da un messaggio più recente: il suo stream prende il posto di questo
+            print(f"ChatView: turno annullato -> {user_text[:50]}")
         except Exception as e:
             print(f"Error processing message: {e}")
             import traceback
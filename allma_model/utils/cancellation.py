@@ -0,0 +1,135 @@
+"""
+Cancellation — Token di annullamento per il lavoro di un turno di ALLMA
+
+Un turno superato da un nuovo messaggio si fermava solo ai punti di
+controllo di process_message: gli stadi già in coda partivano comunque e
+l'inferenza in corso arrivava fino all'ultimo token tenendo inference_lock,
+mentre il turno nuovo aspettava dietro.
+
+Scopo:
+    Un solo oggetto, passato dalla pipeline fino a MobileGemmaWrapper, che
+    chi lavora controlla a grana fine (tra stadi, tra blocchi di prompt
+    valutati, a ogni token generato) per liberare subito la CPU.
+
+Architettura:
+    CancellationToken        → cancel(reason), cancelled, check(), listener
+                               chiamati all'annullamento (per svegliare attese)
+    acknowledge(where)       → chi si ferma davvero lo segnala: il token misura
+                               la latenza di annullamento (cancel → stop)
+    OperationCancelledError  → sollevata da check(); TurnSupersededError di
+                               core.turn_stream ne è la versione per i turni
+
+Tempi:
+    cancelled_at e stopped_at da time.perf_counter(); latency_ms è None
+    finché nessuno ha riconosciuto l'annullamento.
+"""
+
+from __future__ import annotations
+
+import logging
+import threading
+import time
+from typing import Callable, List, Optional
+
+
+logger = logging.getLogger(__name__)
+
+
+class OperationCancelledError(RuntimeError):
+    """Il lavoro è stato annullato tramite il suo CancellationToken."""
+
+    def __init__(self, reason: str = "cancelled", message: Optional[str] = None):
+        super().__init__(message or f"Operazione annullata: {reason}")
+        self.reason = reason
+
+
+class CancellationToken:
+    """
+    Richiesta di annullamento condivisa tra chi annulla e chi lavora.
+
+    Usage:
+        token = CancellationToken()
+        token.add_listener(lambda reason: ...)   # notifica immediata
+        ...
+        token.check()                            # punto di controllo
+        if token.cancelled:                      # controllo senza eccezione
+            token.acknowledge("llm.generate")    # latenza cancel → stop
+    """
+
+    def __init__(self):
+        self.reason: Optional[str] = None
+        self.cancelled_at: Optional[float] = None
+        self.stopped_at: Optional[float] = None
+        self.stopped_by: Optional[str] = None
+        self._event = threading.Event()
+        self._listeners: List[Callable[[str], None]] = []
+        self._lock = threading.Lock()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._event.is_set()
+
+    def cancel(self, reason: str = "cancelled") -> bool:
+        """Annulla. False se era già annullato."""
+        with self._lock:
+            if self._event.is_set():
+                return False
+            self.reason = reason
+            self.cancelled_at = time.perf_counter()
+            self._event.set()
+            listeners = list(self._listeners)
+            self._listeners.clear()
+        for listener in listeners:
+            try:
+                listener(reason)
+            except Exception as e:
+                logger.warning(f"[CancellationToken] Listener di annullamento fallito: {e}")
+        return True
+
+    def add_listener(self, listener: Callable[[str], None]) -> None:
+        """listener(reason) viene chiamato all'annullamento (subito, se già annullato)."""
+        with self._lock:
+            if not self._event.is_set():
+                self._listeners.append(listener)
+                return
+        listener(self.reason or "cancelled")
+
+    def remove_listener(self, listener: Callable[[str], None]) -> None:
+        with self._lock:
+            if listener in self._listeners:
+                self._listeners.remove(listener)
+
+    def wait(self, timeout: Optional[float] = None) -> bool:
+        """Attende l'annullamento. True se annullato entro il timeout."""
+        return self._event.wait(timeout)
+
+    def error(self) -> OperationCancelledError:
+        """Eccezione da sollevare per questo annullamento."""
+        return OperationCancelledError(self.reason or "cancelled")
+
+    def check(self) -> None:
+        """Punto di controllo: solleva l'eccezione del token se è stato annullato."""
+        if self._event.is_set():
+            raise self.error()
+
+    def acknowledge(self, where: str) -> Optional[float]:
+        """
+        Segnala che il lavoro si è fermato. Vale il primo riconoscimento.
+
+        Returns:
+            latenza di annullamento in ms (None se il token non è annullato)
+        """
+        with self._lock:
+            if self.cancelled_at is None:
+                return None
+            if self.stopped_at is None:
+                self.stopped_at = time.perf_counter()
+                self.stopped_by = where
+        return self.latency_ms
+
+    @property
+    def latency_ms(self) -> Optional[float]:
+        """Millisecondi tra cancel() e il primo acknowledge()."""
+        if self.cancelled_at is None or self.stopped_at is None:
+            return None
+        return round((self.stopped_at - self.cancelled_at) * 1000.0, 2)
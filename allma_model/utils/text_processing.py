@@ -1,95 +1,271 @@
-import math
-from collections import Counter
+"""
+SimpleTfidf — TF-IDF leggero senza scikit-learn
+
+Motore sparso vettorizzato: ogni matrice è in formato CSR
+(indptr = offset delle righe, indices = id dei termini, data = pesi).
+DF/IDF e cosine_similarity sono calcolati con NumPy invece che con
+cicli Python su ogni coppia (termine, documento).
+
+Compatibilità con l'implementazione densa precedente:
+    - vocabolario ordinato, idf = log(N / (1 + df)), N include i documenti non stringa
+    - max_features tiene i termini più frequenti (parità risolta per prima occorrenza)
+    - fit_transform salta i documenti non stringa, transform li rende righe nulle
+    - le matrici espongono toarray(), shape, len() e indicizzazione; M[i] è una riga densa
+
+tokenize() è il tokenizer lessicale condiviso da InteractionIndex e TopicModel.
+"""
+
+import re
+from typing import Dict, Iterable, List, Tuple
+
 import numpy as np
 
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(text: str) -> List[str]:
+    """Tokenizzazione lessicale (minuscolo, solo caratteri di parola)."""
+    if not isinstance(text, str):
+        return []
+    return _TOKEN_RE.findall(text.lower())
+
+
+class TfidfMatrix:
+    """Matrice sparsa CSR restituita da SimpleTfidf (sottoinsieme dell'API di scipy.sparse)."""
+
+    def __init__(self, indptr: np.ndarray, indices: np.ndarray, data: np.ndarray, shape: Tuple[int, int]):
+        self.indptr = indptr
+        self.indices = indices
+        self.data = data
+        self.shape = shape
+
+    ndim = 2
+
+    @property
+    def nnz(self) -> int:
+        return int(self.indptr[-1]) if len(self.indptr) else 0
+
+    def __len__(self) -> int:
+        return self.shape[0]
+
+    def toarray(self) -> np.ndarray:
+        dense = np.zeros(self.shape, dtype=np.float64)
+        dense[self._row_ids(), self.indices] = self.data
+        return dense
+
+    def __array__(self, dtype=None, copy=None):
+        dense = self.toarray()
+        return dense.astype(dtype) if dtype is not None else dense
+
+    def _row_ids(self) -> np.ndarray:
+        return np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+
+    def _row(self, i: int) -> np.ndarray:
+        start, end = self.indptr[i], self.indptr[i + 1]
+        row = np.zeros(self.shape[1], dtype=np.float64)
+        row[self.indices[start:end]] = self.data[start:end]
+        return row
+
+    def _take_rows(self, rows: np.ndarray) -> 'TfidfMatrix':
+        starts, ends = self.indptr[rows], self.indptr[rows + 1]
+        lengths = ends - starts
+        indptr = np.concatenate(([0], np.cumsum(lengths))).astype(np.int64)
+        if indptr[-1]:
+            positions = np.concatenate([np.arange(s, e) for s, e in zip(starts, ends)])
+        else:
+            positions = np.zeros(0, dtype=np.int64)
+        return TfidfMatrix(indptr, self.indices[positions], self.data[positions], (len(rows), self.shape[1]))
+
+    def __getitem__(self, key):
+        if isinstance(key, (int, np.integer)):
+            i = int(key)
+            if i < 0:
+                i += self.shape[0]
+            if not 0 <= i < self.shape[0]:
+                raise IndexError("row index out of range")
+            return self._row(i)
+        if isinstance(key, slice):
+            return self._take_rows(np.arange(self.shape[0])[key])
+        return np.asarray(self)[key]
+
+    def __iter__(self):
+        for i in range(self.shape[0]):
+            yield self._row(i)
+
+    def row_norms(self) -> np.ndarray:
+        """Norma L2 di ogni riga."""
+        sq = np.bincount(self._row_ids(), weights=self.data * self.data, minlength=self.shape[0])
+        return np.sqrt(sq)
+
+    def dot_vector(self, x: np.ndarray) -> np.ndarray:
+        """Prodotto matrice-vettore denso: una somma pesata per riga, senza densificare."""
+        return np.bincount(self._row_ids(), weights=self.data * x[self.indices], minlength=self.shape[0])
+
+
 class SimpleTfidf:
     def __init__(self, max_features=None, stop_words=None):
-        self.vocab = {}
+        self.vocab = []
         self.doc_count = 0
         self.idf = {}
         self.max_features = max_features
         self.stop_words = stop_words or []
-        
-    def fit_transform(self, documents):
-        self.doc_count = len(documents)
-        word_counts = []
-        all_words = set()
-        
-        for doc in documents:
+        self._term_index: Dict[str, int] = {}
+        self._idf_array = np.zeros(0, dtype=np.float64)
+
+    @staticmethod
+    def _tokenize(documents: Iterable, term_ids: Dict[str, int], grow: bool) -> Tuple[List[int], List[int], List[int]]:
+        """
+        Converte i documenti in id di termini.
+
+        Returns:
+            (id dei termini, riga di ogni token, indici dei documenti stringa)
+        """
+        ids: List[int] = []
+        rows: List[int] = []
+        kept: List[int] = []
+        for doc_index, doc in enumerate(documents):
             if not isinstance(doc, str):
                 continue
-            words = doc.lower().split()
-            # Basic stop word filtering if list provided
-            if self.stop_words == 'english':
-                # Minimal placeholder list for english
-                pass 
-                
-            counts = Counter(words)
-            word_counts.append(counts)
-            all_words.update(words)
-            
-        self.vocab = sorted(list(all_words))
-        
+            row = len(kept)
+            kept.append(doc_index)
+            for word in doc.lower().split():
+                term = term_ids.get(word)
+                if term is None:
+                    if not grow:
+                        continue
+                    term = len(term_ids)
+                    term_ids[word] = term
+                ids.append(term)
+                rows.append(row)
+        return ids, rows, kept
+
+    @staticmethod
+    def _pair_counts(ids: np.ndarray, rows: np.ndarray, n_terms: int) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+        """Conteggi (riga, termine) vettorizzati con np.unique su chiavi combinate."""
+        if len(ids) == 0:
+            empty = np.zeros(0, dtype=np.int64)
+            return empty, empty, empty
+        keys, counts = np.unique(rows * max(n_terms, 1) + ids, return_counts=True)
+        return keys // max(n_terms, 1), keys % max(n_terms, 1), counts
+
+    def _build_matrix(self, pair_rows, pair_cols, pair_values, n_rows) -> TfidfMatrix:
+        order = np.lexsort((pair_cols, pair_rows))
+        pair_rows, pair_cols, pair_values = pair_rows[order], pair_cols[order], pair_values[order]
+        indptr = np.zeros(n_rows + 1, dtype=np.int64)
+        np.cumsum(np.bincount(pair_rows, minlength=n_rows), out=indptr[1:])
+        return TfidfMatrix(indptr, pair_cols.astype(np.int64), pair_values.astype(np.float64),
+                           (n_rows, len(self.vocab)))
+
+    def fit_transform(self, documents):
+        self.doc_count = len(documents)
+        # Basic stop word filtering if list provided
+        if self.stop_words == 'english':
+            # Minimal placeholder list for english
+            pass
+
+        # Gli id temporanei seguono l'ordine di prima occorrenza (serve per le parità di max_features)
+        raw_ids: Dict[str, int] = {}
+        ids, rows, kept = self._tokenize(documents, raw_ids, grow=True)
+        ids = np.asarray(ids, dtype=np.int64)
+        rows = np.asarray(rows, dtype=np.int64)
+        n_raw = len(raw_ids)
+        n_rows = len(kept)
+        raw_terms = np.array(list(raw_ids.keys()), dtype=object)
+
+        pair_rows, pair_terms, pair_counts = self._pair_counts(ids, rows, n_raw)
+        df = np.bincount(pair_terms, minlength=n_raw)
+
+        selected = np.arange(n_raw)
         # Implement max_features limitation if requested
-        if self.max_features and len(self.vocab) > self.max_features:
+        if self.max_features and n_raw > self.max_features:
             # Sort by frequency across all docs
-            total_counts = Counter()
-            for wc in word_counts:
-                total_counts.update(wc)
-            most_common = total_counts.most_common(self.max_features)
-            self.vocab = sorted([word for word, count in most_common])
+            total = np.bincount(ids, minlength=n_raw)
+            selected = np.lexsort((np.arange(n_raw), -total))[:self.max_features]
 
-        self.idf = {}
-        
-        for word in self.vocab:
-            doc_freq = sum(1 for counts in word_counts if word in counts)
-            self.idf[word] = math.log(self.doc_count / (1 + doc_freq))
-            
-        vectors = []
-        for counts in word_counts:
-            vector = [counts[word] * self.idf.get(word, 0) for word in self.vocab]
-            vectors.append(vector)
-            
-        return np.array(vectors)
+        # Colonne finali in ordine alfabetico
+        selected = selected[np.argsort(raw_terms[selected].astype(str), kind='stable')] if len(selected) else selected
+        self.vocab = [str(t) for t in raw_terms[selected]]
+        self._term_index = {term: col for col, term in enumerate(self.vocab)}
+
+        column_of = np.full(n_raw, -1, dtype=np.int64)
+        column_of[selected] = np.arange(len(selected))
+
+        with np.errstate(divide='ignore'):
+            self._idf_array = np.log(self.doc_count / (1.0 + df[selected].astype(np.float64))) \
+                if len(selected) else np.zeros(0, dtype=np.float64)
+        self.idf = dict(zip(self.vocab, self._idf_array.tolist()))
+
+        cols = column_of[pair_terms]
+        mask = cols >= 0
+        values = pair_counts[mask] * self._idf_array[cols[mask]]
+        return self._build_matrix(pair_rows[mask], cols[mask], values, n_rows)
 
     def get_feature_names_out(self):
-        return self.vocab
-        
+        return np.array(self.vocab, dtype=object)
+
     def transform(self, documents):
-        vectors = []
-        for doc in documents:
-            if not isinstance(doc, str):
-                vectors.append([0] * len(self.vocab))
-                continue
-            words = doc.lower().split()
-            counts = Counter(words)
-            vector = [counts[word] * self.idf.get(word, 0) for word in self.vocab]
-            vectors.append(vector)
-        return np.array(vectors)
+        documents = list(documents)
+        ids, rows, kept = self._tokenize(documents, self._term_index, grow=False)
+        ids = np.asarray(ids, dtype=np.int64)
+        # I documenti non stringa restano come righe nulle
+        rows = np.asarray(kept, dtype=np.int64)[np.asarray(rows, dtype=np.int64)] if len(ids) else ids
+        pair_rows, pair_cols, pair_counts = self._pair_counts(ids, rows, len(self.vocab))
+        values = pair_counts * self._idf_array[pair_cols] if len(pair_cols) else pair_counts.astype(np.float64)
+        return self._build_matrix(pair_rows, pair_cols, values, len(documents))
+
+
+def _as_rows(v):
+    """Normalizza un operando di cosine_similarity: TfidfMatrix o array 2D."""
+    if isinstance(v, TfidfMatrix):
+        return v
+    v = np.array(v)
+    if v.ndim == 1:
+        v = v.reshape(1, -1)
+    return v
+
 
 def cosine_similarity(v1, v2):
-    # Ensure inputs are numpy arrays
-    v1 = np.array(v1)
-    v2 = np.array(v2)
-    
-    # Handle 2D arrays (matrices) vs 1D arrays
-    if v1.ndim == 1:
-        v1 = v1.reshape(1, -1)
-    if v2.ndim == 1:
-        v2 = v2.reshape(1, -1)
-        
+    v1 = _as_rows(v1)
+    v2 = _as_rows(v2)
+
+    if isinstance(v1, TfidfMatrix) or isinstance(v2, TfidfMatrix):
+        return _sparse_cosine_similarity(v1, v2)
+
     # Calculate norms
     norm1 = np.linalg.norm(v1, axis=1)
     norm2 = np.linalg.norm(v2, axis=1)
-    
+
     # Avoid division by zero
     norm1[norm1 == 0] = 1e-10
     norm2[norm2 == 0] = 1e-10
-    
+
     # Calculate dot product
     dot_product = np.dot(v1, v2.T)
-    
+
     # Calculate similarity
     similarity = dot_product / (norm1[:, None] * norm2)
-    
+
     return similarity
+
+
+def _sparse_cosine_similarity(v1, v2) -> np.ndarray:
+    """Stessa semantica della versione densa, iterando sulle righe del primo operando."""
+    if v1.shape[1] != v2.shape[1]:
+        raise ValueError(f"shapes {v1.shape} and {v2.shape} not aligned")
+
+    def norms(m):
+        n = m.row_norms() if isinstance(m, TfidfMatrix) else np.linalg.norm(m, axis=1)
+        n = np.asarray(n, dtype=np.float64)
+        n[n == 0] = 1e-10
+        return n
+
+    norm1 = norms(v1)
+    norm2 = norms(v2)
+
+    dot_product = np.zeros((v1.shape[0], v2.shape[0]), dtype=np.float64)
+    for i in range(v1.shape[0]):
+        row = v1[i] if isinstance(v1, TfidfMatrix) else v1[i].astype(np.float64)
+        dot_product[i] = v2.dot_vector(row) if isinstance(v2, TfidfMatrix) else v2 @ row
+
+    return dot_product / (norm1[:, None] * norm2)
@@ -0,0 +1,452 @@
+"""
+Tracing — Span leggeri per la pipeline dei messaggi di ALLMA
+
+I log LLM_GENERATION_START/END coprono solo l'inferenza. Gli span coprono
+l'intero turno: stadi pre-LLM, costruzione del prompt, generazione,
+CognitivePipeline e lavoro post-risposta.
+
+Scopo:
+    Sul dispositivo, capire quale stadio ha rallentato un turno specifico
+    senza profiler esterni.
+
+Architettura:
+    Tracer.span(name, **attrs)  → SpanScope: context manager (o start()/end())
+    contextvars                 → span corrente e trace; i worker thread li
+                                  ereditano con contextvars.copy_context().run
+    Trace                       → completata quando termina lo span radice
+    ring buffer                 → ultime N trace in memoria (deque)
+    sink opzionali              → JsonlTraceSink / SQLiteTraceSink, scritti da un
+                                  thread dedicato per non pesare sul turno
+
+Tempi:
+    start/end da time.perf_counter() (monotonico), CPU da time.thread_time()
+    del thread che esegue lo span; started_at (epoch) solo per correlare i log.
+"""
+
+from __future__ import annotations
+
+import contextvars
+import itertools
+import json
+import logging
+import os
+import queue
+import sqlite3
+import threading
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, Callable, Deque, Dict, List, Optional
+
+
+logger = logging.getLogger(__name__)
+
+_ids = itertools.count(1)
+
+
+def _next_id() -> str:
+    return f"{os.getpid():x}-{next(_ids):x}"
+
+
+@dataclass
+class Span:
+    """Un intervallo misurato. I tempi sono in secondi di perf_counter."""
+    trace_id: str
+    span_id: str
+    parent_id: Optional[str]
+    name: str
+    start: float
+    thread: str
+    attributes: Dict[str, Any] = field(default_factory=dict)
+    end: Optional[float] = None
+    cpu_ms: Optional[float] = None
+    status: str = "ok"         # 'ok' | 'error' | 'abandoned'
+    error: Optional[str] = None
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end if self.end is not None else time.perf_counter()) - self.start) * 1000.0
+
+    def set_attribute(self, key: str, value: Any) -> None:
+        self.attributes[key] = value
+
+    def to_dict(self, origin: float) -> Dict[str, Any]:
+        return {
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "start_ms": round((self.start - origin) * 1000.0, 3),
+            "duration_ms": round(self.duration_ms, 3),
+            "cpu_ms": round(self.cpu_ms, 3) if self.cpu_ms is not None else None,
+            "thread": self.thread,
+            "status": self.status,
+            "error": self.error,
+            "attributes": self.attributes,
+        }
+
+
+class Trace:
+    """Tutti gli span di un turno, dalla radice in giù."""
+
+    def __init__(self, trace_id: str, root: Span):
+        self.trace_id = trace_id
+        self.root = root
+        self.started_at = time.time()
+        self.spans: List[Span] = [root]
+        self._lock = threading.Lock()
+
+    def add(self, span: Span) -> None:
+        with self._lock:
+            self.spans.append(span)
+
+    @property
+    def duration_ms(self) -> float:
+        return self.root.duration_ms
+
+    def slowest(self, n: int = 3, exclude_root: bool = True) -> List[Span]:
+        with self._lock:
+            spans = [s for s in self.spans if not (exclude_root and s is self.root)]
+        return sorted(spans, key=lambda s: s.duration_ms, reverse=True)[:n]
+
+    def to_dict(self) -> Dict[str, Any]:
+        with self._lock:
+            spans = list(self.spans)
+        return {
+            "trace_id": self.trace_id,
+            "name": self.root.name,
+            "started_at": self.started_at,
+            "duration_ms": round(self.duration_ms, 3),
+            "spans": [s.to_dict(self.root.start) for s in spans],
+        }
+
+
+_current_span: contextvars.ContextVar[Optional[Span]] = contextvars.ContextVar("allma_span", default=None)
+_current_trace: contextvars.ContextVar[Optional[Trace]] = contextvars.ContextVar("allma_trace", default=None)
+
+
+class SpanScope:
+    """Apertura/chiusura di uno span: `with tracer.span(...) as span` oppure start()/end()."""
+
+    def __init__(self, tracer: 'Tracer', name: str, attributes: Dict[str, Any]):
+        self.tracer = tracer
+        self.name = name
+        self.attributes = attributes
+        self.span: Optional[Span] = None
+        self._trace: Optional[Trace] = None
+        self._cpu_start = 0.0
+        self._tokens = None
+
+    def start(self) -> 'SpanScope':
+        parent = _current_span.get()
+        trace = _current_trace.get()
+        if trace is None or parent is None or parent.end is not None:
+            # Nessuno span attivo (o il padre è già chiuso): si apre una nuova trace
+            trace_id = _next_id()
+            span = Span(trace_id, _next_id(), None, self.name, time.perf_counter(),
+                        threading.current_thread().name, dict(self.attributes))
+            trace = Trace(trace_id, span)
+        else:
+            span = Span(trace.trace_id, _next_id(), parent.span_id, self.name, time.perf_counter(),
+                        threading.current_thread().name, dict(self.attributes))
+            trace.add(span)
+        self.span = span
+        self._trace = trace
+        self._cpu_start = time.thread_time()
+        self._tokens = (_current_span.set(span), _current_trace.set(trace))
+        return self
+
+    def end(self, error: Optional[BaseException] = None) -> None:
+        span = self.span
+        if span is None or span.end is not None:
+            return
+        span.end = time.perf_counter()
+        span.cpu_ms = (time.thread_time() - self._cpu_start) * 1000.0
+        if error is not None:
+            span.status = "error"
+            span.error = repr(error)
+        if self._tokens is not None:
+            span_token, trace_token = self._tokens
+            self._tokens = None
+            try:
+                _current_span.reset(span_token)
+                _current_trace.reset(trace_token)
+            except ValueError:
+                # end() chiamato in un altro Context: il chiamante non eredita nulla
+                pass
+        if self._trace is not None and span is self._trace.root:
+            self.tracer._complete(self._trace)
+
+    def __enter__(self) -> Span:
+        self.start()
+        return self.span
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        self.end(exc)
+        return False
+
+
+class JsonlTraceSink:
+    """Una trace per riga in un file JSONL, ruotato quando supera max_bytes."""
+
+    def __init__(self, path: str, max_bytes: int = 5 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+
+    def write(self, trace: Trace) -> None:
+        try:
+            if os.path.exists(self.path) and os.path.getsize(self.path) > self.max_bytes:
+                os.replace(self.path, self.path + ".1")
+        except OSError:
+            pass
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(trace.to_dict(), ensure_ascii=False, default=str) + "\n")
+
+    def close(self) -> None:
+        pass
+
+
+class SQLiteTraceSink:
+    """Span in una tabella SQLite interrogabile (es. media per nome di span)."""
+
+    def __init__(self, db_path: str, max_traces: int = 2000):
+        self.db_path = db_path
+        self.path = db_path
+        self.max_traces = max_traces
+        self._conn: Optional[sqlite3.Connection] = None
+
+    def _connection(self) -> sqlite3.Connection:
+        # Usata solo dal thread di scrittura del Tracer
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute("""
+                CREATE TABLE IF NOT EXISTS trace_spans (
+                    trace_id TEXT NOT NULL,
+                    span_id TEXT NOT NULL,
+                    parent_id TEXT,
+                    name TEXT NOT NULL,
+                    started_at REAL NOT NULL,
+                    start_ms REAL NOT NULL,
+                    duration_ms REAL NOT NULL,
+                    cpu_ms REAL,
+                    thread TEXT,
+                    status TEXT,
+                    error TEXT,
+                    attributes TEXT,
+                    PRIMARY KEY (trace_id, span_id)
+                )
+            """)
+            self._conn.execute("CREATE INDEX IF NOT EXISTS idx_trace_spans_name ON trace_spans (name, started_at)")
+        return self._conn
+
+    def write(self, trace: Trace) -> None:
+        conn = self._connection()
+        data = trace.to_dict()
+        conn.executemany(
+            "INSERT OR REPLACE INTO trace_spans VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+            [
+                (trace.trace_id, s["span_id"], s["parent_id"], s["name"], trace.started_at, s["start_ms"],
+                 s["duration_ms"], s["cpu_ms"], s["thread"], s["status"], s["error"],
+                 json.dumps(s["attributes"], ensure_ascii=False, default=str))
+                for s in data["spans"]
+            ]
+        )
+        # Mantiene solo le ultime max_traces trace
+        conn.execute(
+            """
+            DELETE FROM trace_spans WHERE trace_id NOT IN (
+                SELECT trace_id FROM trace_spans WHERE parent_id IS NULL
+                ORDER BY started_at DESC, rowid DESC LIMIT ?
+            )
+            """,
+            (self.max_traces,)
+        )
+        conn.commit()
+
+    def close(self) -> None:
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+class Tracer:
+    """
+    Tracer in-process con ring buffer e sink opzionali.
+
+    Usage:
+        tracer = Tracer.get_instance()
+        with tracer.span("process_message", conversation_id=cid):
+            with tracer.span("stage.topic"):
+                ...
+        trace = tracer.last_trace()
+        print([(s.name, s.duration_ms) for s in trace.slowest()])
+    """
+
+    _instance: Optional['Tracer'] = None
+    _instance_lock = threading.Lock()
+
+    def __init__(self, capacity: int = 64, enabled: bool = True, log_summary: bool = True):
+        self.enabled = enabled
+        self.log_summary = log_summary
+        self._traces: Deque[Trace] = deque(maxlen=capacity)
+        self._traces_lock = threading.Lock()
+        self._sinks: List[Any] = []
+        self._queue: "queue.Queue[Optional[Trace]]" = queue.Queue(maxsize=256)
+        self._writer: Optional[threading.Thread] = None
+        self._writer_lock = threading.Lock()
+        self.dropped = 0
+
+    @classmethod
+    def get_instance(cls) -> 'Tracer':
+        if cls._instance is None:
+            with cls._instance_lock:
+                if cls._instance is None:
+                    cls._instance = cls()
+        return cls._instance
+
+    # ------------------------------------------------------------------
+    # Span
+    # ------------------------------------------------------------------
+
+    def span(self, name: str, **attributes) -> SpanScope:
+        if not self.enabled:
+            return _NoopScope()
+        return SpanScope(self, name, attributes)
+
+    @staticmethod
+    def current_span() -> Optional[Span]:
+        return _current_span.get()
+
+    @staticmethod
+    def set_attribute(key: str, value: Any) -> None:
+        """Imposta un attributo sullo span corrente (no-op se non ce n'è uno)."""
+        span = _current_span.get()
+        if span is not None:
+            span.attributes[key] = value
+
+    @staticmethod
+    def bind(fn: Callable) -> Callable:
+        """Lega fn al Context corrente: da usare quando si passa lavoro a un altro thread."""
+        ctx = contextvars.copy_context()
+        return lambda *args, **kwargs: ctx.run(fn, *args, **kwargs)
+
+    # ------------------------------------------------------------------
+    # Trace completate
+    # ------------------------------------------------------------------
+
+    def _complete(self, trace: Trace) -> None:
+        # Span figli ancora aperti (es. stadi scaduti) vengono chiusi qui
+        for span in list(trace.spans):
+            if span.end is None:
+                span.end = trace.root.end
+                span.status = "abandoned"
+        with self._traces_lock:
+            self._traces.append(trace)
+        if self.log_summary:
+            slowest = ",".join(f"{s.name}:{s.duration_ms:.0f}" for s in trace.slowest(4))
+            logger.info(
+                f"⏱️ TURN_TRACE id={trace.trace_id} name={trace.root.name} "
+                f"total_ms={trace.duration_ms:.2f} spans={len(trace.spans)} slowest={slowest}"
+            )
+        if self._sinks:
+            self._ensure_writer()
+            try:
+                self._queue.put_nowait(trace)
+            except queue.Full:
+                self.dropped += 1
+
+    def traces(self, limit: Optional[int] = None) -> List[Trace]:
+        with self._traces_lock:
+            items = list(self._traces)
+        return items[-limit:] if limit else items
+
+    def last_trace(self, name: Optional[str] = None) -> Optional[Trace]:
+        for trace in reversed(self.traces()):
+            if name is None or trace.root.name == name:
+                return trace
+        return None
+
+    def clear(self) -> None:
+        with self._traces_lock:
+            self._traces.clear()
+
+    # ------------------------------------------------------------------
+    # Sink
+    # ------------------------------------------------------------------
+
+    def add_sink(self, sink):
+        """
+        Registra un sink; un sink sullo stesso file di uno già registrato non
+        viene aggiunto (il Tracer è condiviso: ogni ALLMACore creato con lo
+        stesso trace_sink_path scriverebbe ogni trace una volta in più).
+
+        Returns:
+            il sink in uso per quel file
+        """
+        path = getattr(sink, "path", None)
+        with self._writer_lock:
+            for existing in self._sinks:
+                if path is not None and getattr(existing, "path", None) == path:
+                    return existing
+            self._sinks.append(sink)
+        return sink
+
+    def _ensure_writer(self) -> None:
+        with self._writer_lock:
+            if self._writer is None or not self._writer.is_alive():
+                self._writer = threading.Thread(target=self._write_loop, daemon=True, name="AllmaTraceWriter")
+                self._writer.start()
+
+    def _write_loop(self) -> None:
+        while True:
+            trace = self._queue.get()
+            try:
+                if trace is None:
+                    return
+                for sink in list(self._sinks):
+                    try:
+                        sink.write(trace)
+                    except Exception as e:
+                        logger.warning(f"[Tracer] Scrittura sink fallita: {e}")
+            finally:
+                self._queue.task_done()
+
+    def flush(self) -> None:
+        """Attende che le trace in coda siano scritte sui sink."""
+        if self._writer is not None and self._writer.is_alive():
+            self._queue.join()
+
+    def close(self) -> None:
+        self.flush()
+        if self._writer is not None and self._writer.is_alive():
+            self._queue.put(None)
+            self._writer.join(timeout=2.0)
+        for sink in self._sinks:
+            try:
+                sink.close()
+            except Exception:
+                pass
+
+
+class _NoopScope:
+    """Scope usato con il tracing disabilitato."""
+
+    span = None
+
+    def start(self) -> '_NoopScope':
+        return self
+
+    def end(self, error: Optional[BaseException] = None) -> None:
+        pass
+
+    def __enter__(self):
+        return None
+
+    def __exit__(self, exc_type, exc, tb) -> bool:
+        return False
+
+
+def sink_for_path(path: str):
+    """JSONL o SQLite in base all'estensione del file."""
+    if path.endswith((".db", ".sqlite", ".sqlite3")):
+        return SQLiteTraceSink(path)
+    return JsonlTraceSink(path)
@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+"""
+ALLMA KV-State Restart Benchmark
+================================
+Confronta il TTFT del primo turno dopo un riavvio dell'app:
+- cold: archivio degli stati KV vuoto, system prompt e cronologia valutati da capo
+- warm: stato della conversazione ricaricato da disco (KVStateStore)
+
+Ogni "riavvio" crea un nuovo MobileGemmaWrapper (modello ricaricato, contesto
+vuoto); il tempo di caricamento del modello è escluso dal TTFT.
+
+Uso:
+    python benchmark_kv_restart.py --models-dir models [--model qwen3-1.7b-q8_0.gguf] [--runs 3]
+"""
+
+import argparse
+import gc
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from statistics import median
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+logging.basicConfig(level=logging.ERROR)
+
+from allma_model.llm.mobile_gemma_wrapper import MobileGemmaWrapper, _DEFAULT_MODEL_NAME
+
+
+SYSTEM = (
+    "Sei ALLMA, un'assistente personale empatica che vive sul telefono dell'utente. "
+    "Rispondi in italiano, in modo breve e naturale, ricordando i dettagli delle conversazioni. "
+)
+
+
+def build_prompt(history_turns: int) -> str:
+    """Prompt ChatML con system prompt e una cronologia sintetica di history_turns scambi."""
+    parts = [f"<|im_start|>system\n{SYSTEM * 4}<|im_end|>\n"]
+    for i in range(history_turns):
+        parts.append(f"<|im_start|>user\nTi racconto la giornata numero {i}: lavoro, sport e una cena con amici.<|im_end|>\n")
+        parts.append(f"<|im_start|>assistant\nChe bella giornata la numero {i}! Com'è andata la cena?<|im_end|>\n")
+    parts.append("<|im_start|>user\nCosa ti ricordi delle ultime giornate?<|im_end|>\n<|im_start|>assistant\n")
+    return "".join(parts)
+
+
+def measure_restart(models_dir: str, model: str, kv_dir: str, prompt: str) -> dict:
+    """Un riavvio: carica il modello e misura il TTFT del primo turno."""
+    load_t0 = time.perf_counter()
+    wrapper = MobileGemmaWrapper(models_dir, model_name=model, kv_state_dir=kv_dir)
+    load_ms = (time.perf_counter() - load_t0) * 1000
+    if wrapper.llm is None:
+        raise RuntimeError(f"Modello non caricato da {models_dir}")
+    if wrapper.kv_store is None:
+        raise RuntimeError("KVStateStore non attivo (formato dello stato llama.cpp non supportato)")
+
+    first_token = []
+    t0 = time.perf_counter()
+    wrapper.generate(
+        prompt, max_tokens=8, temperature=0.0, conversation_id="bench", prefix_hash="bench",
+        request_id="bench", callback=lambda _: first_token or first_token.append(time.perf_counter()),
+    )
+    meta = wrapper.get_generation_meta("bench") or {}
+    persisted = wrapper.persist_state(timeout=30.0)
+    result = {
+        "load_ms": load_ms,
+        "ttft_ms": ((first_token[0] if first_token else time.perf_counter()) - t0) * 1000,
+        "kv_restore": meta.get("kv_restore"),
+        "kv_restore_ms": meta.get("kv_restore_ms") or 0.0,
+        "prompt_tokens": meta.get("prompt_tokens"),
+        "reused_tokens": meta.get("prefix_reused_tokens"),
+        "persisted": persisted,
+        "store_bytes": wrapper.kv_store.get_stats()["bytes"],
+    }
+    del wrapper
+    gc.collect()
+    return result
+
+
+def run_benchmark(models_dir: str, model: str, runs: int, history_turns: int):
+    print("=" * 60)
+    print("🚀 ALLMA KV-STATE RESTART BENCHMARK")
+    print("=" * 60)
+    prompt = build_prompt(history_turns)
+
+    cold, warm = [], []
+    for run in range(runs):
+        kv_dir = tempfile.mkdtemp(prefix="allma_kv_")
+        try:
+            c = measure_restart(models_dir, model, kv_dir, prompt)
+            w = measure_restart(models_dir, model, kv_dir, prompt)
+        finally:
+            shutil.rmtree(kv_dir, ignore_errors=True)
+        cold.append(c)
+        warm.append(w)
+        print(
+            f"Run {run + 1}: prompt={c['prompt_tokens']} tok | "
+            f"cold TTFT={c['ttft_ms']:.0f}ms | warm TTFT={w['ttft_ms']:.0f}ms "
+            f"(restore={w['kv_restore']} {w['kv_restore_ms']:.0f}ms, reused={w['reused_tokens']} tok) | "
+            f"stato su disco={c['store_bytes'] / (1024 * 1024):.1f} MB"
+        )
+
+    cold_ttft = median(r["ttft_ms"] for r in cold)
+    warm_ttft = median(r["ttft_ms"] for r in warm)
+    print("\n📊 Mediane")
+    print(f"  Caricamento modello: {median(r['load_ms'] for r in cold):.0f} ms")
+    print(f"  TTFT cold restart:   {cold_ttft:.0f} ms")
+    print(f"  TTFT warm restart:   {warm_ttft:.0f} ms (di cui lettura e load_state: {median(r['kv_restore_ms'] for r in warm):.0f} ms)")
+    if warm_ttft > 0:
+        print(f"  Speedup:             {cold_ttft / warm_ttft:.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--models-dir", default=os.environ.get("ALLMA_MODELS_DIR", "models"))
+    parser.add_argument("--model", default=_DEFAULT_MODEL_NAME)
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--history-turns", type=int, default=12)
+    args = parser.parse_args()
+    run_benchmark(args.models_dir, args.model, args.runs, args.history_turns)
@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+ALLMA TopicExtractor Benchmark
+==============================
+Confronta il percorso statistico di TopicExtractor.extract_topic:
+    - legacy: re-fit di SimpleTfidf sul vocabolario base per il testo e per
+      ognuna delle 8 descrizioni di topic (9 fit per messaggio)
+    - modello precalcolato: un solo prodotto sparso contro i centroidi
+Misura latenza e accuratezza su frasi etichettate che non vengono
+intercettate dalle regole.
+"""
+
+import os
+import sys
+import time
+from statistics import mean, median
+
+import numpy as np
+
+sys.path.append(os.path.dirname(os.path.abspath(__file__)))
+
+from allma_model.learning_system.topic_extractor import BASE_VOCAB, TOPIC_DESCRIPTIONS, TopicExtractor
+from allma_model.utils.text_processing import SimpleTfidf, cosine_similarity
+
+
+class LegacyTopicExtractor(TopicExtractor):
+    """Percorso statistico precedente, riportato come riferimento."""
+
+    def get_embeddings(self, text):
+        vectorizer = SimpleTfidf(max_features=40)
+        embeddings = vectorizer.fit_transform(BASE_VOCAB + [text])
+        return np.asarray(embeddings[-1])
+
+    def statistical_topic(self, text):
+        embeddings = self.get_embeddings(text)
+        similarities = {}
+        for topic, description in TOPIC_DESCRIPTIONS.items():
+            similarities[topic] = cosine_similarity(
+                embeddings.reshape(1, -1), self.get_embeddings(description).reshape(1, -1)
+            )[0][0]
+        best_topic, best_score = max(similarities.items(), key=lambda x: x[1])
+        return "general" if best_score < 0.05 else best_topic
+
+
+def current_statistical_topic(extractor, text):
+    best_topic, best_score = extractor.model.best_topic(text)
+    return "general" if best_topic is None or best_score < 0.05 else best_topic
+
+
+# Frasi senza parole chiave delle regole: arrivano al percorso statistico
+LABELED = [
+    ("vorrei migliorare la development del mio programming", "technical"),
+    ("il code della app non compila", "technical"),
+    ("che javascript framework consigli", "technical"),
+    ("la timeline del project è stretta", "project"),
+    ("gestione tasks e management del team", "project"),
+    ("dobbiamo rifare il deploy stasera", "project"),
+    ("un corso di education per adulti", "learning"),
+    ("sto cercando un training serio", "learning"),
+    ("ho bisogno di help con una cosa", "support"),
+    ("mi serve guidance per iniziare", "support"),
+    ("raccontami la history dei romani", "history"),
+    ("napoleone a waterloo", "history"),
+    ("oggi sono molto felice", "emotion"),
+    ("che tristezza, mi sento triste e con un po' di rabbia", "emotion"),
+    ("la mia emozione più forte", "emotion"),
+    ("odio le giornate grigie", "preference"),
+    ("vorrei vestiti per l'estate", "preference"),
+    ("discussion libera, parliamo un po'", "general"),
+    ("facciamo due chiacchiere in chat", "general"),
+    ("una conversation tranquilla", "general"),
+]
+
+
+def time_calls(func, texts, repeat):
+    samples = []
+    for _ in range(repeat):
+        for text in texts:
+            start = time.perf_counter()
+            func(text)
+            samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def main():
+    print("=" * 60)
+    print("🚀 ALLMA TOPIC EXTRACTOR BENCHMARK")
+    print("=" * 60)
+
+    start = time.perf_counter()
+    TopicExtractor._base_model = None
+    current = TopicExtractor()
+    build_ms = (time.perf_counter() - start) * 1000
+    legacy = LegacyTopicExtractor()
+    print(f"Costruzione modello precalcolato: {build_ms:.2f} ms (una volta per processo)")
+
+    texts = [t for t, _ in LABELED]
+    for name, func, repeat in (
+        ("legacy", legacy.statistical_topic, 5),
+        ("precalcolato", lambda t: current_statistical_topic(current, t), 50),
+    ):
+        samples = time_calls(func, texts, repeat)
+        correct = sum(func(t) == label for t, label in LABELED)
+        print(
+            f"  {name:<13} mean {mean(samples):7.3f} ms | p50 {median(samples):7.3f} ms | "
+            f"max {max(samples):7.3f} ms | accuratezza {correct}/{len(LABELED)}"
+        )
+
+    # extract_topic completo (regole + statistico) sul percorso attuale
+    samples = time_calls(current.extract_topic, texts, 50)
+    print(f"\nextract_topic completo: mean {mean(samples):.3f} ms")
+
+
+if __name__ == "__main__":
+    main()
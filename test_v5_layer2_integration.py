@@ -74,6 +74,8 @@ class TestIdentityStateIntegration(unittest.TestCase):
         
         # 3. Execute process_message
         self.core.process_message("Hello", "user", "conv_id", "topic")
+        # L'aggiornamento identitario gira nella coda post-risposta
+        self.core.drain_post_response(timeout=10)
         
         # 4. Verify COMPUTE STATE called PRE-GENERATION
         self.mock_engine_instance.compute_state.assert_called_once()
@@ -78,6 +78,8 @@ class TestNeuroplasticityIntegration(unittest.TestCase):
         
         # 2. Process message (Triggering the violation)
         self.core.process_message("Chi sei?", "user", "conv_id", "topic")
+        # Neuroplasticità e identità girano nella coda post-risposta
+        self.core.drain_post_response(timeout=10)
         
         # 3. Verify Structural Correction
         # The LLM output was "Ciao, sono un'intelligenza artificiale..."
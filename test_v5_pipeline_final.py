@@ -96,6 +96,8 @@ class TestV5FinalPipeline(unittest.TestCase):
         # 2. Execute Pipeline
         response = self.core.process_message("Test", "user", "conv_id", "topic")
         final_text = response.content
+        # Neuroplasticità e identità girano nella coda post-risposta
+        self.core.drain_post_response(timeout=10)
         
         print(f"Raw Output: {raw_llm_output}")
         print(f"Final Output: {final_text}")
@@ -9,6 +9,8 @@ RE_END = re.compile(
     r"prompt_t=([^ ]+) comp_t=([^ ]+) total_t=([^ ]+) "
     r"cpu_c=([^ ]+)->([^ ]+) batt_c=([^ ]+)->([^ ]+) thermal=([^ ]+)"
 )
+# Campi aggiunti dopo thermal= (es. db_ms, db_ops): chiave=valore opzionali
+RE_EXTRA = re.compile(r" (\w+)=([^ ]+)")
 
 
 def _to_float(x):
@@ -46,6 +48,15 @@ def _summarize(name, rows):
             round(min(ttft), 2),
             round(max(ttft), 2),
         )
+    db_ms = [r["extra"]["db_ms"] for r in rows if r["extra"].get("db_ms") is not None]
+    if db_ms:
+        print(
+            "  db_ms    avg/med/min/max=",
+            round(statistics.mean(db_ms), 2),
+            round(statistics.median(db_ms), 2),
+            round(min(db_ms), 2),
+            round(max(db_ms), 2),
+        )
     thermals = sorted({r["thermal"] for r in rows})
     print("  thermal counts=", {k: sum(1 for r in rows if r["thermal"] == k) for k in thermals})
 
@@ -87,6 +98,7 @@ def main():
         ) = m.groups()
 
         ttft = _to_float(ttft_ms)
+        extra = {k: _to_float(v) for k, v in RE_EXTRA.findall(ln[m.end():])}
         rows.append(
             {
                 "id": gen_id,
@@ -102,6 +114,7 @@ def main():
                 "batt0": _to_float(batt0),
                 "batt1": _to_float(batt1),
                 "thermal": thermal,
+                "extra": extra,
             }
         )
 